@@ -1,6 +1,7 @@
 from twisted.application.internet import TCPClient
 from twisted.application.service import MultiService
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    Deferred, inlineCallbacks, returnValue, succeed)
 from twisted.internet.protocol import ReconnectingClientFactory
 from twisted.python import log
 from twisted.web import http
@@ -86,6 +87,67 @@ class AmqpFactory(ReconnectingClientFactory, object):
         super(AmqpFactory, self).clientConnectionLost(connector, reason)
 
 
+class ConcurrentConsumer(object):
+    '''Mixin for vumi consumers that consumes the next message without
+    waiting for the current message to be consumed. Each message is still
+    only acked once it has been consumed, and the amount of messages being
+    consumed at the same time is bounded by the prefetch count of the
+    consumer.'''
+
+    def consume(self, message):
+        # The consumer reads the next message once this returns, so the
+        # message is consumed, and acked, in the background
+        d = super(ConcurrentConsumer, self).consume(message)
+        d.addErrback(log.err)
+        return succeed(None)
+
+
+def concurrent_consumer_class(consumer_class):
+    '''Returns a subclass of the vumi consumer class ``consumer_class``
+    that consumes messages concurrently'''
+    return type(
+        consumer_class.__name__, (ConcurrentConsumer, consumer_class), {})
+
+
+class KeyedSequencer(object):
+    '''Runs the calls that share a key one after another, in the order
+    they were made, while calls with different keys run concurrently. Keeps
+    the order of related messages that are consumed concurrently.'''
+
+    def __init__(self):
+        self._last = {}
+
+    def run(self, key, f, *args, **kwargs):
+        '''Calls ``f`` with ``args`` and ``kwargs`` once the earlier calls
+        for ``key`` are done, whether they succeeded or failed. Returns a
+        deferred that fires with the result of the call. Calls with a key of
+        ``None`` are made immediately.'''
+        d = Deferred()
+        if key is None:
+            d.callback(None)
+            return d.addCallback(lambda _: f(*args, **kwargs))
+
+        previous = self._last.get(key)
+        done = self._last[key] = Deferred()
+        if previous is None:
+            d.callback(None)
+        else:
+            previous.addCallback(d.callback)
+        d.addCallback(lambda _: f(*args, **kwargs))
+        d.addBoth(self._done, key, done)
+        return d
+
+    def _done(self, result, key, done):
+        if self._last.get(key) is done:
+            del self._last[key]
+        done.callback(None)
+        return result
+
+    def pending(self):
+        '''Returns the amount of keys with calls that are not done yet'''
+        return len(self._last)
+
+
 class RoutingKeyError(Exception):
     def __init__(self, value):
         self.value = value
@@ -1,24 +1,75 @@
 from functools import partial
+from math import ceil
 from klein import Klein
 
+from twisted.protocols.basic import FileSender
 from twisted.python import log
+from twisted.python.failure import Failure
 from werkzeug.exceptions import HTTPException
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.web import http
 
 from twisted.internet import defer
-from vumi.persist.txredis_manager import TxRedisManager
 from vumi.utils import load_class_by_string
 
+from junebug import json_codec
 from junebug.amqp import MessageSender
+from junebug.cache import (
+    CacheInvalidationListener, ConfigCache, get_shared_cache, supports_pubsub)
 from junebug.channel import Channel
 from junebug.error import JunebugError
+from junebug.event_stream import SUBSCRIBERS, EventStreams
 from junebug.rabbitmq import RabbitmqManagementClient
+from junebug.redis_pool import acquire_redis_manager, get_redis_pools
+from junebug.retries import get_retry_schedulers
 from junebug.router import Router
-from junebug.utils import api_from_event, json_body, response
-from junebug.validate import body_schema, validate
+from junebug.streaming import LineStream, LineTooLong, StreamingSite
+from junebug.supervisor import (
+    CHANNEL_WORKERS, ROUTER_WORKERS, WorkerReconciler)
+from junebug.utils import (
+    TOO_MANY_REQUESTS, JsonDecodeError, api_from_event, json_body, response)
+from junebug.validate import (
+    QUERY_BOOLEANS, body_schema, query_bool, query_int, validate)
+from junebug.waiters import get_event_waiters, wait_for_event
+from junebug.webhooks import get_webhook_clients
 from junebug.stores import (
-    InboundMessageStore, MessageRateStore, OutboundMessageStore, RouterStore)
+    ChannelIndexStore, EventLogStore, InboundMessageStore, MessageRateStore,
+    OutboundMessageStore, RateLimitStore, RouterStore, get_codec)
+
+
+# The default and maximum amount of channels in a page of the channel list
+CHANNEL_PAGE_SIZE = 100
+MAX_CHANNEL_PAGE_SIZE = 1000
+
+# The maximum amount of seconds a message status request can wait for the
+# next event of the message
+MAX_STATUS_WAIT = 60
+
+# The maximum amount of messages that statuses can be retrieved for in a
+# single request
+MAX_STATUS_BATCH_SIZE = 5000
+
+
+OUTBOUND_MESSAGE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'to': {'type': 'string'},
+        'from': {'type': ['string', 'null']},
+        'group': {'type': ['string', 'null']},
+        'reply_to': {'type': 'string'},
+        'content': {'type': ['string', 'null']},
+        'event_url': {'type': 'string'},
+        'event_auth_token': {'type': 'string'},
+        'priority': {
+            'type': ['string', 'integer'], 'minimum': 1, 'maximum': 5},
+        'channel_data': {'type': 'object'},
+    },
+    'required': ['content'],
+    'additionalProperties': False,
+}
+
+
+validate_outbound_message = body_schema(OUTBOUND_MESSAGE_SCHEMA)
 
 
 class ApiUsageError(JunebugError):
@@ -29,6 +80,22 @@ class ApiUsageError(JunebugError):
     code = http.BAD_REQUEST
 
 
+class RateLimitExceeded(JunebugError):
+    '''Exception that is raised when a message is sent on a channel that has
+    reached its rate limit. ``retry_after`` is the amount of seconds until
+    the message can be sent.'''
+    name = 'RateLimitExceeded'
+    description = 'rate limit exceeded'
+    code = TOO_MANY_REQUESTS
+
+    def __init__(self, channel, retry_after):
+        super(RateLimitExceeded, self).__init__(
+            'Channel %s is limited to %s messages every %s seconds' % (
+                channel.id, channel.rate_limit_count,
+                channel.rate_limit_window))
+        self.retry_after = retry_after
+
+
 class JunebugApi(object):
     app = Klein()
 
@@ -41,7 +108,8 @@ class JunebugApi(object):
     @inlineCallbacks
     def setup(self, redis=None, message_sender=None):
         if redis is None:
-            redis = yield TxRedisManager.from_config(self.redis_config)
+            redis = yield acquire_redis_manager(
+                self.redis_config, self.config.redis_pool_size)
 
         if message_sender is None:
             message_sender = MessageSender(
@@ -51,42 +119,114 @@ class JunebugApi(object):
         self.message_sender = message_sender
         self.message_sender.setServiceParent(self.service)
 
+        codec = get_codec(
+            self.config.message_codec, self.config.project_stored_messages)
+
         self.inbounds = InboundMessageStore(
-            self.redis, self.config.inbound_message_ttl)
+            self.redis, self.config.inbound_message_ttl, codec=codec)
+
+        self.event_routes = get_shared_cache(
+            self.redis, 'event_routes', self.config.event_route_cache_size,
+            self.config.outbound_message_ttl)
 
         self.outbounds = OutboundMessageStore(
-            self.redis, self.config.outbound_message_ttl)
+            self.redis, self.config.outbound_message_ttl,
+            event_routes=self.event_routes, codec=codec)
+
+        self.message_rate = MessageRateStore(
+            self.redis, flush_interval=self.config.metric_flush_interval)
+
+        self.rate_limits = RateLimitStore(
+            self.redis, self.config.rate_limit_lease_size)
+
+        self.channel_cache = ConfigCache(
+            self.redis, 'channels', self.config.config_cache_ttl)
+
+        self.router_cache = ConfigCache(
+            self.redis, 'routers', self.config.config_cache_ttl)
+
+        self.router_store = RouterStore(self.redis, cache=self.router_cache)
 
-        self.message_rate = MessageRateStore(self.redis)
+        self.channel_index = ChannelIndexStore(self.redis)
 
-        self.router_store = RouterStore(self.redis)
+        self.event_logs = EventLogStore(
+            self.redis, self.config.event_log_size)
+        self.event_streams = EventStreams(
+            self.event_logs, self.config.event_stream_poll_interval)
+
+        self.event_waiters = get_event_waiters(self.redis)
+
+        if supports_pubsub(self.redis):
+            self.cache_listener = CacheInvalidationListener(
+                self.redis_config, self.redis)
+            self.cache_listener.add_cache(self.channel_cache)
+            self.cache_listener.add_cache(self.router_cache)
+            self.cache_listener.add_cache(self.event_waiters)
+            self.cache_listener.setServiceParent(self.service)
 
         self.plugins = []
+        if not self.config.api_only:
+            # API only processes leave the plugins and workers to the
+            # supervising process
+            yield self.start_workers()
+
+        if self.config.rabbitmq_management_interface:
+            self.rabbitmq_management_client = RabbitmqManagementClient(
+                self.config.rabbitmq_management_interface,
+                self.amqp_config['username'],
+                self.amqp_config['password'])
+
+    @inlineCallbacks
+    def start_workers(self):
+        '''Starts the plugins, and the workers of all channels and routers.
+        If the API is served from API only processes, the workers are
+        restarted whenever those processes request it.'''
+        if self.config.api_workers and not supports_pubsub(self.redis):
+            raise ValueError(
+                'Serving the API from API processes requires redis pub/sub')
+
         for plugin_config in self.config.plugins:
             cls = load_class_by_string(plugin_config['type'])
             plugin = cls()
             yield plugin.start_plugin(plugin_config, self.config)
             self.plugins.append(plugin)
 
+        yield Channel.index_all(self.redis)
+
         yield Channel.start_all_channels(
             self.redis, self.config, self.service, self.plugins)
 
         yield Router.start_all_routers(self)
 
-        if self.config.rabbitmq_management_interface:
-            self.rabbitmq_management_client = RabbitmqManagementClient(
-                self.config.rabbitmq_management_interface,
-                self.amqp_config['username'],
-                self.amqp_config['password'])
+        if self.config.api_workers:
+            self.channel_workers = WorkerReconciler(
+                CHANNEL_WORKERS,
+                lambda id: Channel.restart_workers(
+                    self.redis, self.config, self.service, id, self.plugins),
+                lambda: Channel.sync_workers(
+                    self.redis, self.config, self.service, self.plugins))
+            self.router_workers = WorkerReconciler(
+                ROUTER_WORKERS,
+                partial(Router.restart_worker, self),
+                partial(Router.sync_workers, self))
+            self.cache_listener.add_cache(self.channel_workers)
+            self.cache_listener.add_cache(self.router_workers)
 
     @inlineCallbacks
     def teardown(self):
+        self.event_streams.stop()
+        yield self.message_rate.close()
         yield self.redis.close_manager()
         for plugin in self.plugins:
             yield plugin.stop_plugin()
 
     @app.handle_errors(JunebugError)
     def generic_junebug_error(self, request, failure):
+        retry_after = getattr(failure.value, 'retry_after', None)
+        if retry_after is not None:
+            request.setHeader(
+                'Retry-After', str(max(int(ceil(retry_after)), 1)))
+
         return response(request, failure.value.description, {
             'errors': [{
                 'type': failure.value.name,
@@ -120,11 +260,27 @@ class JunebugApi(object):
             }, code=http.INTERNAL_SERVER_ERROR)
 
     @app.route('/channels/', methods=['GET'])
+    @validate(
+        query_int('limit', 1, MAX_CHANNEL_PAGE_SIZE),
+        query_int('cursor', 0))
     @inlineCallbacks
     def get_channel_list(self, request):
-        '''List all channels'''
-        ids = yield Channel.get_all(self.redis)
-        returnValue(response(request, 'channels listed', sorted(ids)))
+        '''List all channels, or a page of channels if any of the ``limit``,
+        ``cursor``, ``type`` or ``label`` parameters are given'''
+        args = dict((k, v[0]) for k, v in request.args.iteritems())
+        if not any(k in args for k in ('limit', 'cursor', 'type', 'label')):
+            ids = yield Channel.get_all(self.redis)
+            returnValue(response(request, 'channels listed', sorted(ids)))
+
+        cursor = args.get('cursor')
+        ids, cursor = yield self.channel_index.list(
+            int(args.get('limit', CHANNEL_PAGE_SIZE)),
+            None if cursor is None else int(cursor),
+            type=args.get('type'), label=args.get('label'))
+        returnValue(response(request, 'channels listed', {
+            'channels': ids,
+            'next_cursor': cursor,
+        }))
 
     @app.route('/channels/', methods=['POST'])
     @json_body
@@ -140,6 +296,15 @@ class JunebugApi(object):
                 'mo_url': {'type': 'string'},
                 'mo_url_auth_token': {'type': 'string'},
                 'amqp_queue': {'type': 'string'},
+                'event_stream': {'type': 'boolean'},
+                'mo_batch_size': {
+                    'type': 'integer',
+                    'minimum': 0,
+                },
+                'mo_batch_max_delay_ms': {
+                    'type': 'integer',
+                    'minimum': 0,
+                },
                 'rate_limit_count': {
                     'type': 'integer',
                     'minimum': 0,
@@ -159,7 +324,8 @@ class JunebugApi(object):
     def create_channel(self, request, body):
         '''Create a channel'''
         channel = Channel(
-            self.redis, self.config, body, self.plugins)
+            self.redis, self.config, body, self.plugins,
+            cache=self.channel_cache)
         yield channel.start(self.service)
         yield channel.save()
         returnValue(response(
@@ -171,7 +337,8 @@ class JunebugApi(object):
     def get_channel(self, request, channel_id):
         '''Return the channel configuration and a nested status object'''
         channel = yield Channel.from_id(
-            self.redis, self.config, channel_id, self.service, self.plugins)
+            self.redis, self.config, channel_id, self.service, self.plugins,
+            cache=self.channel_cache)
         resp = yield channel.status()
         returnValue(response(
             request, 'channel found', resp))
@@ -188,6 +355,15 @@ class JunebugApi(object):
                 'metadata': {'type': 'object'},
                 'status_url': {'type': ['string', 'null']},
                 'mo_url': {'type': ['string', 'null']},
+                'event_stream': {'type': 'boolean'},
+                'mo_batch_size': {
+                    'type': 'integer',
+                    'minimum': 0,
+                },
+                'mo_batch_max_delay_ms': {
+                    'type': 'integer',
+                    'minimum': 0,
+                },
                 'rate_limit_count': {
                     'type': 'integer',
                     'minimum': 0,
@@ -206,7 +382,8 @@ class JunebugApi(object):
     def modify_channel(self, request, body, channel_id):
         '''Mondify the channel configuration'''
         channel = yield Channel.from_id(
-            self.redis, self.config, channel_id, self.service, self.plugins)
+            self.redis, self.config, channel_id, self.service, self.plugins,
+            cache=self.channel_cache)
         resp = yield channel.update(body)
         returnValue(response(
             request, 'channel updated', resp))
@@ -216,7 +393,8 @@ class JunebugApi(object):
     def delete_channel(self, request, channel_id):
         '''Delete the channel'''
         channel = yield Channel.from_id(
-            self.redis, self.config, channel_id, self.service, self.plugins)
+            self.redis, self.config, channel_id, self.service, self.plugins,
+            cache=self.channel_cache)
         yield channel.stop()
         yield channel.delete()
         returnValue(response(
@@ -227,7 +405,8 @@ class JunebugApi(object):
     def restart_channel(self, request, channel_id):
         '''Restart a channel.'''
         channel = yield Channel.from_id(
-            self.redis, self.config, channel_id, self.service, self.plugins)
+            self.redis, self.config, channel_id, self.service, self.plugins,
+            cache=self.channel_cache)
         yield channel.stop()
         yield channel.start(self.service)
         returnValue(response(request, 'channel restarted', {}))
@@ -241,34 +420,71 @@ class JunebugApi(object):
         if n is not None:
             n = int(n[0])
         channel = yield Channel.from_id(
-            self.redis, self.config, channel_id, self.service, self.plugins)
+            self.redis, self.config, channel_id, self.service, self.plugins,
+            cache=self.channel_cache)
         logs = yield channel.get_logs(n)
         returnValue(response(request, 'logs retrieved', logs))
 
+    @app.route('/channels/<string:channel_id>/metrics', methods=['GET'])
+    @inlineCallbacks
+    def get_channel_metrics(self, request, channel_id):
+        '''Get the message count series of a channel for the given labels
+        and resolution.'''
+        labels = request.args.get('label', [])
+        resolution = request.args.get('resolution', ['1m'])[0]
+        channel = yield Channel.from_id(
+            self.redis, self.config, channel_id, self.service, self.plugins,
+            cache=self.channel_cache)
+        metrics = yield channel.get_metrics(labels, resolution)
+        returnValue(response(request, 'metrics retrieved', metrics))
+
+    @app.route(
+        '/channels/<string:channel_id>/events/stream', methods=['GET'])
+    @validate(query_int('offset', 0))
+    @inlineCallbacks
+    def stream_events(self, request, channel_id):
+        '''Stream the events of a channel as server-sent events, or as
+        newline delimited JSON if ``format`` is ``ndjson``. Events after
+        ``offset``, or the ``Last-Event-ID`` header, are sent first if they
+        are still in the event log of the channel.'''
+        channel = yield Channel.from_id(
+            self.redis, self.config, channel_id, self.service, self.plugins,
+            cache=self.channel_cache)
+
+        if not channel.event_stream:
+            raise ApiUsageError(
+                'This channel does not have "event_stream" enabled')
+
+        fmt = request.args.get('format', ['sse'])[0]
+        if fmt not in SUBSCRIBERS:
+            raise ApiUsageError(
+                'Unknown stream format %r, expected one of %s' % (
+                    fmt, ', '.join(sorted(SUBSCRIBERS))))
+
+        offset = request.args.get('offset', [None])[0]
+        if offset is None:
+            offset = request.getHeader('Last-Event-ID')
+        if offset is None or not offset.isdigit():
+            offset = yield self.event_logs.get_offset(channel_id)
+
+        cls = SUBSCRIBERS[fmt]
+        request.setHeader('Content-Type', cls.CONTENT_TYPE)
+        request.setHeader('Cache-Control', 'no-cache')
+        # Send the headers now, rather than with the first event
+        request.write('')
+
+        yield self.event_streams.subscribe(
+            channel_id, cls(request, int(offset)))
+
     @app.route('/channels/<string:channel_id>/messages/', methods=['POST'])
     @json_body
-    @validate(
-        body_schema({
-            'type': 'object',
-            'properties': {
-                'to': {'type': 'string'},
-                'from': {'type': ['string', 'null']},
-                'group': {'type': ['string', 'null']},
-                'reply_to': {'type': 'string'},
-                'content': {'type': ['string', 'null']},
-                'event_url': {'type': 'string'},
-                'event_auth_token': {'type': 'string'},
-                'priority': {'type': 'string'},
-                'channel_data': {'type': 'object'},
-            },
-            'required': ['content'],
-            'additionalProperties': False,
-        }))
+    @validate(body_schema(OUTBOUND_MESSAGE_SCHEMA))
     @inlineCallbacks
     def send_message(self, request, body, channel_id):
         '''Send an outbound (mobile terminated) message'''
         channel = yield Channel.from_id(
-            self.redis, self.config, channel_id, self.service, self.plugins)
+            self.redis, self.config, channel_id, self.service, self.plugins,
+            cache=self.channel_cache)
 
         if (channel.has_destination):
             msg = yield self.send_message_on_channel(channel_id, body)
@@ -279,14 +495,140 @@ class JunebugApi(object):
             raise ApiUsageError(
                 'This channel has no "mo_url" or "amqp_queue"')
 
+    @app.route(
+        '/channels/<string:channel_id>/messages/batch', methods=['POST'])
+    @json_body
+    @validate(body_schema({
+        'type': 'array',
+        'items': OUTBOUND_MESSAGE_SCHEMA,
+        'minItems': 1,
+    }))
+    @inlineCallbacks
+    def send_message_batch(self, request, body, channel_id):
+        '''Send a batch of outbound (mobile terminated) messages'''
+        if len(body) > self.config.max_message_batch_size:
+            raise ApiUsageError(
+                'A batch may contain at most %d messages' % (
+                    self.config.max_message_batch_size,))
+
+        channel = yield Channel.from_id(
+            self.redis, self.config, channel_id, self.service, self.plugins,
+            cache=self.channel_cache)
+
+        if not channel.has_destination:
+            raise ApiUsageError(
+                'This channel has no "mo_url" or "amqp_queue"')
+
+        results = yield self.send_messages_on_channel(channel, body)
+        returnValue(response(request, 'messages submitted', {
+            'messages': [
+                self._message_result(success, result)
+                for success, result in results],
+        }))
+
+    @app.route(
+        '/channels/<string:channel_id>/messages/stream', methods=['POST'])
+    @inlineCallbacks
+    def send_message_stream(self, request, channel_id):
+        '''Send outbound (mobile terminated) messages from a newline
+        delimited JSON body, as the body is received'''
+        stream = request.content
+        if not isinstance(stream, LineStream):
+            # The body was buffered, eg. by a site that does not stream
+            body = stream.read()
+            stream = self._create_message_stream(channel_id)
+            stream.write(body)
+        stream.finish()
+        try:
+            yield stream.channel
+            yield stream.wait()
+            request.setHeader('Content-Type', 'application/x-ndjson')
+            stream.output.seek(0)
+            yield FileSender().beginFileTransfer(stream.output, request)
+        finally:
+            stream.output.close()
+        returnValue('')
+
+    def create_message_stream(self, request, channel_id):
+        '''Returns the stream that the body of a streamed send request for
+        ``channel_id`` is written to as it is received. Messages are only
+        sent once the channel has been found.'''
+        return self._create_message_stream(
+            channel_id, request.body_producer)
+
+    def _create_message_stream(self, channel_id, producer=None):
+        stream = LineStream(
+            partial(self._send_stream_message, channel_id),
+            format_result=self._format_stream_result,
+            producer=producer,
+            max_pending=self.config.message_stream_window)
+        stream.channel = self._get_sending_channel(channel_id)
+        stream.channel.addCallbacks(
+            lambda channel: stream.start(), self._message_stream_failed,
+            errbackArgs=(stream,))
+        return stream
+
+    def _message_stream_failed(self, f, stream):
+        # No messages can be sent, but the rest of the body still needs to be
+        # read before the error can be returned
+        stream.stop()
+        return f
+
+    def _format_stream_result(self, result):
+        if isinstance(result, Failure):
+            line_number = getattr(result.value, 'line_number', None)
+            if result.check(LineTooLong):
+                result = Failure(ApiUsageError(result.getErrorMessage()))
+            result = self._message_result(False, result)
+            result['line'] = line_number
+        return json_codec.dumps(result) + '\n'
+
+    @inlineCallbacks
+    def _get_sending_channel(self, channel_id):
+        channel = yield Channel.from_id(
+            self.redis, self.config, channel_id, self.service, self.plugins,
+            cache=self.channel_cache)
+        if not channel.has_destination:
+            raise ApiUsageError(
+                'This channel has no "mo_url" or "amqp_queue"')
+        returnValue(channel)
+
+    @inlineCallbacks
+    def _send_stream_message(self, channel_id, line_number, line):
+        try:
+            body = json_codec.loads(line)
+        except ValueError as e:
+            result = self._message_result(
+                False, Failure(JsonDecodeError(e.message)))
+        else:
+            errors = validate_outbound_message(None, body)
+            if errors:
+                result = self._result(
+                    http.BAD_REQUEST, ApiUsageError.description,
+                    {'errors': sorted(errors)})
+            else:
+                d = self.send_message_on_channel(channel_id, body)
+                d.addCallbacks(
+                    partial(self._message_result, True),
+                    partial(self._message_result, False))
+                result = yield d
+        result['line'] = line_number
+        returnValue(result)
+
     @app.route(
         '/channels/<string:channel_id>/messages/<string:message_id>',
         methods=['GET'])
+    @validate(
+        query_int('wait', 0, MAX_STATUS_WAIT),
+        query_bool('last_only'))
     @inlineCallbacks
     def get_message_status(self, request, channel_id, message_id):
-        '''Retrieve the status of a message'''
+        '''Retrieve the status of a message. If ``wait`` is given, waits up
+        to that many seconds for the next event of the message first. If
+        ``last_only`` is true, only the last event is returned.'''
         channel = yield Channel.from_id(
-            self.redis, self.config, channel_id, self.service, self.plugins)
+            self.redis, self.config, channel_id, self.service, self.plugins,
+            cache=self.channel_cache)
 
         if (channel.has_destination):
             data = yield self.get_message_events(
@@ -296,6 +638,42 @@ class JunebugApi(object):
             raise ApiUsageError(
                 'This channel has no "mo_url" or "amqp_queue"')
 
+    @app.route(
+        '/channels/<string:channel_id>/messages/status', methods=['POST'])
+    @json_body
+    @validate(body_schema({
+        'type': 'object',
+        'properties': {
+            'message_ids': {
+                'type': 'array',
+                'items': {'type': 'string'},
+                'minItems': 1,
+                'maxItems': MAX_STATUS_BATCH_SIZE,
+            },
+            'last_only': {'type': 'boolean'},
+        },
+        'required': ['message_ids'],
+    }))
+    @inlineCallbacks
+    def get_message_statuses(self, request, body, channel_id):
+        '''Retrieve the statuses of a batch of messages'''
+        channel = yield Channel.from_id(
+            self.redis, self.config, channel_id, self.service, self.plugins,
+            cache=self.channel_cache)
+
+        if not channel.has_destination:
+            raise ApiUsageError(
+                'This channel has no "mo_url" or "amqp_queue"')
+
+        message_ids = body['message_ids']
+        events = yield self.outbounds.load_all_events_many(
+            channel_id, message_ids, last_only=body.get('last_only', False))
+        returnValue(response(request, 'message statuses', {
+            'messages': [
+                self._message_status(channel_id, message_id, message_events)
+                for message_id, message_events in zip(message_ids, events)],
+        }))
+
     @app.route('/routers/', methods=['GET'])
     def get_router_list(self, request):
         """List all routers"""
@@ -322,7 +700,7 @@ class JunebugApi(object):
         """Create a new router"""
         router = Router(self, body)
         yield router.validate_config()
-        router.start(self.service)
+        yield router.start(self.service)
         yield router.save()
         returnValue(response(
             request,
@@ -365,7 +743,7 @@ class JunebugApi(object):
 
         # Stop and start the router for the worker to get the new config
         yield router.stop()
-        router.start(self.service)
+        yield router.start(self.service)
         yield router.save()
         returnValue(response(
             request, 'router updated', (yield router.status())))
@@ -394,7 +772,7 @@ class JunebugApi(object):
 
         # Stop and start the router for the worker to get the new config
         yield router.stop()
-        router.start(self.service)
+        yield router.start(self.service)
         yield router.save()
         returnValue(response(
             request, 'router updated', (yield router.status())))
@@ -431,6 +809,14 @@ class JunebugApi(object):
                 'mo_url': {'type': 'string'},
                 'mo_url_token': {'type': 'string'},
                 'amqp_queue': {'type': 'string'},
+                'mo_batch_size': {
+                    'type': 'integer',
+                    'minimum': 0,
+                },
+                'mo_batch_max_delay_ms': {
+                    'type': 'integer',
+                    'minimum': 0,
+                },
                 'character_limit': {
                     'type': 'integer',
                     'minimum': 0,
@@ -447,7 +833,7 @@ class JunebugApi(object):
 
         destination = router.add_destination(body)
         yield router.stop()
-        router.start(self.service)
+        yield router.start(self.service)
         yield destination.save()
 
         returnValue(response(
@@ -489,6 +875,14 @@ class JunebugApi(object):
                 'mo_url': {'type': 'string'},
                 'mo_url_token': {'type': 'string'},
                 'amqp_queue': {'type': 'string'},
+                'mo_batch_size': {
+                    'type': 'integer',
+                    'minimum': 0,
+                },
+                'mo_batch_max_delay_ms': {
+                    'type': 'integer',
+                    'minimum': 0,
+                },
                 'character_limit': {
                     'type': 'integer',
                     'minimum': 0,
@@ -510,7 +904,7 @@ class JunebugApi(object):
 
         # Stop and start the router for the worker to get the new config
         yield router.stop()
-        router.start(self.service)
+        yield router.start(self.service)
         yield destination.save()
         returnValue(response(
             request, 'destination updated', (yield destination.status())))
@@ -529,6 +923,14 @@ class JunebugApi(object):
                 'mo_url': {'type': 'string'},
                 'mo_url_token': {'type': 'string'},
                 'amqp_queue': {'type': 'string'},
+                'mo_batch_size': {
+                    'type': 'integer',
+                    'minimum': 0,
+                },
+                'mo_batch_max_delay_ms': {
+                    'type': 'integer',
+                    'minimum': 0,
+                },
                 'character_limit': {
                     'type': 'integer',
                     'minimum': 0,
@@ -550,7 +952,7 @@ class JunebugApi(object):
 
         # Stop and start the router for the worker to get the new config
         yield router.stop()
-        router.start(self.service)
+        yield router.start(self.service)
         yield destination.save()
         returnValue(response(
             request, 'destination updated', (yield destination.status())))
@@ -566,7 +968,7 @@ class JunebugApi(object):
 
         yield router.stop()
         yield destination.delete()
-        router.start(self.service)
+        yield router.start(self.service)
 
         returnValue(response(request, 'destination deleted', {}))
 
@@ -574,23 +976,7 @@ class JunebugApi(object):
         '/routers/<string:router_id>/destinations/<string:destination_id>/messages/',  # noqa
         methods=['POST'])
     @json_body
-    @validate(
-        body_schema({
-            'type': 'object',
-            'properties': {
-                'to': {'type': 'string'},
-                'from': {'type': ['string', 'null']},
-                'group': {'type': ['string', 'null']},
-                'reply_to': {'type': 'string'},
-                'content': {'type': ['string', 'null']},
-                'event_url': {'type': 'string'},
-                'event_auth_token': {'type': 'string'},
-                'priority': {'type': 'string'},
-                'channel_data': {'type': 'object'},
-            },
-            'required': ['content'],
-            'additionalProperties': False,
-        }))
+    @validate(body_schema(OUTBOUND_MESSAGE_SCHEMA))
     @inlineCallbacks
     def send_destination_message(
             self, request, body, router_id, destination_id):
@@ -616,6 +1002,9 @@ class JunebugApi(object):
     @app.route(
         '/routers/<string:router_id>/destinations/<string:destination_id>/messages/<string:message_id>',  # noqa
         methods=['GET'])
+    @validate(
+        query_int('wait', 0, MAX_STATUS_WAIT),
+        query_bool('last_only'))
     @inlineCallbacks
     def get_destination_message_status(
             self, request, router_id, destination_id, message_id):
@@ -630,21 +1019,37 @@ class JunebugApi(object):
 
     @inlineCallbacks
     def get_message_events(self, request, location_id, message_id):
-        events = yield self.outbounds.load_all_events(location_id, message_id)
-        events = sorted(
-            (api_from_event(location_id, e) for e in events),
-            key=lambda e: e['timestamp'])
+        wait = int(request.args.get('wait', [0])[0])
+        if wait:
+            # The events are loaded after waiting, so that the response
+            # includes the event that woke the request
+            yield wait_for_event(self.redis, location_id, message_id, wait)
+
+        last_only = request.args.get('last_only', ['false'])[0].lower()
+        if QUERY_BOOLEANS[last_only]:
+            event = yield self.outbounds.load_last_event(
+                location_id, message_id)
+            events = [event] if event is not None else []
+        else:
+            events = yield self.outbounds.load_all_events(
+                location_id, message_id)
+        returnValue(self._message_status(location_id, message_id, events))
+
+    def _message_status(self, location_id, message_id, events):
+        '''Returns the status of a message, given its events, oldest
+        first'''
+        events = [api_from_event(location_id, e) for e in events]
 
         last_event = events[-1] if events else None
         last_event_type = last_event['event_type'] if last_event else None
         last_event_timestamp = last_event['timestamp'] if last_event else None
 
-        returnValue({
+        return {
             'id': message_id,
             'last_event_type': last_event_type,
             'last_event_timestamp': last_event_timestamp,
             'events': events,
-        })
+        }
 
     @inlineCallbacks
     def send_message_on_channel(self, channel_id, body, in_msg=None):
@@ -653,22 +1058,127 @@ class JunebugApi(object):
                 'Either "to" or "reply_to" must be specified')
 
         channel = yield Channel.from_id(
-            self.redis, self.config, channel_id, self.service, self.plugins)
-
-        if 'reply_to' in body:
-            msg = yield channel.send_reply_message(
-                self.message_sender, self.outbounds, self.inbounds, body,
-                allow_expired_replies=self.config.allow_expired_replies,
-                in_msg=in_msg)
-        else:
-            msg = yield channel.send_message(
-                self.message_sender, self.outbounds, body)
+            self.redis, self.config, channel_id, self.service, self.plugins,
+            cache=self.channel_cache)
+
+        taken, retry_after = yield self.take_rate_limit_tokens(channel, 1)
+        if not taken:
+            raise RateLimitExceeded(channel, retry_after)
+
+        try:
+            if 'reply_to' in body:
+                msg = yield channel.send_reply_message(
+                    self.message_sender, self.outbounds, self.inbounds, body,
+                    allow_expired_replies=self.config.allow_expired_replies,
+                    in_msg=in_msg)
+            else:
+                msg = yield channel.send_message(
+                    self.message_sender, self.outbounds, body)
+        except Exception:
+            # Messages that fail, e.g. replies to messages that cannot be
+            # found, should not count towards the rate limit
+            self.give_back_rate_limit_tokens(channel, 1)
+            raise
 
         yield self.message_rate.increment(
             channel_id, 'outbound', self.config.metric_window)
 
         returnValue(msg)
 
+    @inlineCallbacks
+    def send_messages_on_channel(self, channel, msgs):
+        '''Sends a batch of messages on ``channel``. Returns a list of
+        ``(success, result)`` pairs for the messages, where ``result`` is the
+        sent message, or the failure to send it.'''
+        results = [None] * len(msgs)
+        sending = []
+        for i, msg in enumerate(msgs):
+            if 'to' not in msg and 'reply_to' not in msg:
+                results[i] = (False, Failure(ApiUsageError(
+                    'Either "to" or "reply_to" must be specified')))
+            else:
+                sending.append(i)
+
+        taken, retry_after = yield self.take_rate_limit_tokens(
+            channel, len(sending), partial=True)
+        for i in sending[taken:]:
+            results[i] = (False, Failure(
+                RateLimitExceeded(channel, retry_after)))
+        sending = sending[:taken]
+
+        sent = yield channel.send_messages(
+            self.message_sender, self.outbounds, self.inbounds,
+            [msgs[i] for i in sending],
+            allow_expired_replies=self.config.allow_expired_replies)
+        for i, result in zip(sending, sent):
+            results[i] = result
+
+        count = len([success for success, _ in sent if success])
+        self.give_back_rate_limit_tokens(channel, len(sent) - count)
+        if count:
+            yield self.message_rate.increment(
+                channel.id, 'outbound', self.config.metric_window,
+                count=count)
+
+        returnValue(results)
+
+    def take_rate_limit_tokens(self, channel, amount, partial=False):
+        '''Takes ``amount`` tokens from the rate limit of ``channel``, or as
+        many as there are if ``partial`` is ``True``. Returns a deferred
+        ``(taken, retry_after)`` pair.'''
+        if not channel.rate_limited:
+            return defer.succeed((amount, 0))
+        return self.rate_limits.take(
+            channel.id, channel.rate_limit_count, channel.rate_limit_window,
+            amount, partial=partial)
+
+    def give_back_rate_limit_tokens(self, channel, amount):
+        '''Gives back ``amount`` tokens taken for messages that could not be
+        sent to the rate limit of ``channel``'''
+        if channel.rate_limited and amount > 0:
+            self.rate_limits.give_back(
+                channel.id, channel.rate_limit_window, amount)
+
+    def create_site(self):
+        '''Returns the site that serves this API'''
+        return StreamingSite(self.app.resource(), [
+            ('POST', r'^/channels/([^/]+)/messages/stream$',
+             self.create_message_stream),
+        ])
+
+    def _message_result(self, success, result):
+        if success:
+            code, description, data = (
+                http.CREATED, 'message submitted', result)
+        elif result.check(JunebugError):
+            code, description, data = (
+                result.value.code, result.value.description, {
+                    'errors': [{
+                        'type': result.value.name,
+                        'message': result.getErrorMessage(),
+                    }]
+                })
+        else:
+            log.err(result)
+            code, description, data = (
+                http.INTERNAL_SERVER_ERROR, 'generic error', {
+                    'errors': [{
+                        'type': result.type.__name__,
+                        'message': result.getErrorMessage(),
+                    }]
+                })
+        return self._result(code, description, data)
+
+    def _result(self, code, description, data):
+        '''Returns what :func:`junebug.utils.response` would respond with,
+        for results that are part of a larger response'''
+        return {
+            'status': code,
+            'code': http.RESPONSES.get(code, code),
+            'description': description,
+            'result': data,
+        }
+
     @app.route('/health', methods=['GET'])
     def health_status(self, request):
         if self.config.rabbitmq_management_interface:
@@ -719,7 +1229,11 @@ class JunebugApi(object):
                     status = "queues stuck"
                     code = http.INTERNAL_SERVER_ERROR
 
-                return response(request, status, queues, code=code)
+                # The result is the list of queues, so the JSON libraries
+                # are given alongside it
+                return response(request, status, queues, code=code, extra={
+                    'json': json_codec.get_backends(),
+                })
 
             def get_routers_objects(router_ids):
                 gets = []
@@ -747,4 +1261,23 @@ class JunebugApi(object):
             d.addCallback(return_queue_results)
             return d
         else:
-            return response(request, 'health ok', {})
+            return response(request, 'health ok', {
+                'json': json_codec.get_backends(),
+            })
+
+    @app.route('/stats', methods=['GET'])
+    def stats(self, request):
+        '''Statistics about the in-memory caches, redis connection pools and
+        webhook connection pools and retry schedulers of this Junebug
+        process'''
+        return response(request, 'stats', {
+            'event_route_cache': self.event_routes.stats(),
+            'event_streams': self.event_streams.stats(),
+            'message_status_waiters': len(self.event_waiters),
+            'redis_pools': [pool.stats() for pool in get_redis_pools()],
+            'webhook_clients': [
+                client.stats() for client in get_webhook_clients()],
+            'webhook_retries': [
+                scheduler.stats() for scheduler in get_retry_schedulers()],
+            'json': json_codec.get_backends(),
+        })
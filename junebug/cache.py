@@ -0,0 +1,254 @@
+import json
+import logging
+import weakref
+from collections import OrderedDict
+from copy import deepcopy
+
+from twisted.application.internet import TCPClient
+from twisted.application.service import MultiService
+from twisted.internet import reactor
+from twisted.internet.defer import succeed
+from txredis.client import RedisSubscriber, RedisSubscriberFactory
+
+
+INVALIDATION_CHANNEL = 'config-cache-invalidations'
+
+
+def supports_pubsub(redis):
+    '''Returns whether or not the client of the redis manager ``redis`` can
+    publish messages. The fake redis used in tests cannot.'''
+    return getattr(redis._client, 'publish', None) is not None
+
+
+def publish_invalidation(redis, name, id):
+    '''Publishes that ``id`` was invalidated for the caches called ``name``
+    in all processes that listen with a :class:`CacheInvalidationListener`.
+    Does nothing if the redis client does not support pub/sub.'''
+    if not supports_pubsub(redis):
+        return succeed(None)
+    return redis._client.publish(
+        redis._key(INVALIDATION_CHANNEL), json.dumps([name, id]))
+
+
+class ConfigCache(object):
+    '''An in-memory cache of configuration that is stored in redis, such as
+    channel properties, keyed by id.
+
+    Entries are invalidated in this process when they are changed, and in
+    other processes by publishing the invalidated id on a redis pub/sub
+    channel, which is listened to by a :class:`CacheInvalidationListener`.
+    Entries also expire after ``ttl`` seconds, so that an invalidation that
+    was missed, eg. while the listener was reconnecting, can only leave an
+    entry stale for a limited time.
+
+    Values that are read from redis should be cached with the
+    :meth:`generation` of their entry from before the read started, so that
+    a value that was invalidated while it was being read is not cached.
+
+    :param redis: Redis manager used to publish invalidations
+    :type redis: :class:`vumi.persist.redis_manager.RedisManager`
+    :param name: The name of the cache, unique for each kind of configuration
+    :type name: str
+    :param ttl: Time (in seconds) that entries are kept for. If ``0``, nothing
+        is cached.
+    :type ttl: float
+    '''
+
+    def __init__(self, redis, name, ttl, clock=reactor):
+        self.redis = redis
+        self.name = name
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = {}
+        self._generations = {}
+        self._cleared = 0
+
+    def generation(self, id):
+        '''Returns the generation of the entry for ``id``, which changes
+        whenever the entry is discarded.'''
+        return (self._cleared, self._generations.get(id, 0))
+
+    def get(self, id):
+        '''Returns a copy of the cached value for ``id``, or ``None`` if there
+        is no cached value.'''
+        entry = self._entries.get(id)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if self.clock.seconds() >= expires_at:
+            del self._entries[id]
+            return None
+        return deepcopy(value)
+
+    def set(self, id, value, generation=None):
+        '''Caches a copy of ``value`` for ``id``. If ``generation`` is given,
+        the value is only cached if the entry has not been discarded since
+        :meth:`generation` returned it.'''
+        if generation is not None and generation != self.generation(id):
+            return
+        if self.ttl:
+            self._entries[id] = (
+                deepcopy(value), self.clock.seconds() + self.ttl)
+
+    def discard(self, id):
+        '''Removes the cached value for ``id`` in this process only.'''
+        self._entries.pop(id, None)
+        self._generations[id] = self._generations.get(id, 0) + 1
+
+    def clear(self):
+        '''Removes all cached values in this process only.'''
+        self._entries.clear()
+        self._generations.clear()
+        self._cleared += 1
+
+    def invalidate(self, id):
+        '''Removes the cached value for ``id`` in this process, and publishes
+        the invalidation to all other processes.'''
+        self.discard(id)
+        return publish_invalidation(self.redis, self.name, id)
+
+
+class LRUCache(object):
+    '''A bounded in-memory cache that discards the least recently used
+    entries once it is full, and discards entries once they are older than
+    ``ttl`` seconds. Keeps count of cache hits and misses.
+
+    :param max_size: The maximum amount of entries. If ``0``, nothing is
+        cached.
+    :type max_size: int
+    :param ttl: Time (in seconds) that entries are kept for, or ``None`` to
+        keep them until they are discarded to make space.
+    :type ttl: float
+    '''
+
+    def __init__(self, max_size, ttl=None, clock=reactor):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''Returns the cached value for ``key``, or ``None`` if there is no
+        cached value.'''
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at is None or self.clock.seconds() < expires_at:
+                self._entries[key] = entry
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        '''Caches ``value`` for ``key``'''
+        if not self.max_size:
+            return
+        self._entries.pop(key, None)
+        expires_at = None
+        if self.ttl is not None:
+            expires_at = self.clock.seconds() + self.ttl
+        self._entries[key] = (value, expires_at)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        '''Returns a dictionary of the cache size and hit counts'''
+        return {
+            'size': len(self),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+_shared_caches = weakref.WeakValueDictionary()
+
+
+def get_shared_cache(redis, name, max_size, ttl=None):
+    '''Returns the :class:`LRUCache` called ``name`` that is shared by
+    everything in this process that uses the same redis config as the redis
+    manager ``redis``, creating it with ``max_size`` and ``ttl`` if it does
+    not exist yet. This allows the API and the workers that it runs to share
+    cached data.'''
+    key = (name, repr(sorted(redis._config.items())))
+    cache = _shared_caches.get(key)
+    if cache is None:
+        cache = LRUCache(max_size, ttl)
+        _shared_caches[key] = cache
+    return cache
+
+
+class CacheInvalidationSubscriber(RedisSubscriber):
+    '''Redis subscriber that passes invalidations on to its listener'''
+
+    def connectionMade(self):
+        d = RedisSubscriber.connectionMade(self)
+        d.addCallback(lambda _: self.subscribe(self.factory.channel))
+        d.addCallback(lambda _: self.factory.listener.connected())
+        return d
+
+    def messageReceived(self, channel, message):
+        self.factory.listener.invalidation_received(message)
+
+
+class CacheInvalidationFactory(RedisSubscriberFactory):
+    protocol = CacheInvalidationSubscriber
+
+    def __init__(self, listener, channel, **kwargs):
+        RedisSubscriberFactory.__init__(self, **kwargs)
+        self.listener = listener
+        self.channel = channel
+
+
+class CacheInvalidationListener(MultiService):
+    '''Listens for invalidations published by :class:`ConfigCache` in other
+    processes, and removes the invalidated entries from the caches in this
+    process. All caches are cleared whenever the listener (re)connects, since
+    invalidations could have been missed while it was disconnected.
+
+    :param redis_config: The config of the redis connection
+    :type redis_config: dict
+    :param redis: The redis manager that the caches publish on
+    :type redis: :class:`vumi.persist.redis_manager.RedisManager`
+    '''
+
+    def __init__(self, redis_config, redis):
+        super(CacheInvalidationListener, self).__init__()
+        self.redis_config = redis_config
+        self.redis = redis
+        self.caches = {}
+
+    def add_cache(self, cache):
+        self.caches[cache.name] = cache
+
+    def startService(self):
+        super(CacheInvalidationListener, self).startService()
+        factory = CacheInvalidationFactory(
+            self, self.redis._key(INVALIDATION_CHANNEL),
+            db=self.redis_config.get('db'),
+            password=self.redis_config.get('password'))
+        self.redis_service = TCPClient(
+            self.redis_config.get('host', 'localhost'),
+            self.redis_config.get('port', 6379),
+            factory)
+        self.redis_service.setServiceParent(self)
+
+    def connected(self):
+        for cache in self.caches.values():
+            cache.clear()
+
+    def invalidation_received(self, message):
+        try:
+            name, id = json.loads(message)
+        except ValueError:
+            logging.warning('Invalid cache invalidation %r' % (message,))
+            return
+        cache = self.caches.get(name)
+        if cache is not None:
+            cache.discard(id)
@@ -1,19 +1,31 @@
 from copy import deepcopy
-import json
 import uuid
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    DeferredList, gatherResults, inlineCallbacks, maybeDeferred, returnValue)
 from twisted.web import http
 from vumi.message import TransportUserMessage
 from vumi.service import WorkerCreator
 from vumi.servicemaker import VumiOptions
 
+from junebug import json_codec
 from junebug.logging_service import JunebugLoggerService, read_logs
-from junebug.stores import StatusStore, MessageRateStore
+from junebug.priority import lane_routing_key, priority_level
+from junebug.stores import (
+    ChannelIndexStore, StatusStore, MessageRateStore, RetryQueueStore)
+from junebug.supervisor import CHANNEL_WORKERS, request_restart
+from junebug.webhooks import DEFAULT_BATCH_MAX_DELAY_MS
+from junebug.workers import forwarding_concurrency_config
 from junebug.utils import (
     api_from_message, message_from_api, api_from_status, convert_unicode)
 from junebug.error import JunebugError
 
 
+# Properties that the workers of a channel need to be restarted for
+RESTART_PROPERTIES = frozenset([
+    'config', 'mo_url', 'amqp_queue', 'event_stream', 'mo_batch_size',
+    'mo_batch_max_delay_ms'])
+
+
 class MessageNotFound(JunebugError):
     '''Raised when a message is not found.'''
     name = 'MessageNotFound'
@@ -42,6 +54,13 @@ class MessageTooLong(JunebugError):
     code = http.BAD_REQUEST
 
 
+class InvalidMetric(JunebugError):
+    '''Raised when an unknown metric label or resolution is requested'''
+    name = 'InvalidMetric'
+    description = 'invalid metric'
+    code = http.BAD_REQUEST
+
+
 transports = {
     'telnet': 'vumi.transports.telnet.TelnetServerTransport',
     'xmpp': 'vumi.transports.xmpp.XMPPTransport',
@@ -56,6 +75,10 @@ allowed_message_fields = [
 # to_addr_type, from_addr_type, message_version, transport_metadata,
 # message_type, transport_type
 
+metric_labels = [
+    'inbound', 'outbound', 'submitted', 'rejected', 'delivery_succeeded',
+    'delivery_failed', 'delivery_pending']
+
 
 class Channel(object):
     OUTBOUND_QUEUE = '%s.outbound'
@@ -65,30 +88,43 @@ class Channel(object):
     STATUS_APPLICATION_CLS_NAME = 'junebug.workers.ChannelStatusWorker'
     JUNEBUG_LOGGING_SERVICE_CLS = JunebugLoggerService
 
-    def __init__(self, redis_manager, config, properties, plugins=[], id=None):
+    def __init__(self, redis_manager, config, properties, plugins=[], id=None,
+                 cache=None):
         '''Creates a new channel. ``redis_manager`` is the redis manager, from
         which a sub manager is created using the channel id. If the channel id
         is not supplied, a UUID one is generated. Call ``save`` to save the
-        channel data. It can be started using the ``start`` function.'''
+        channel data. It can be started using the ``start`` function.
+        ``cache`` is an optional :class:`junebug.cache.ConfigCache` for the
+        channel properties, which is kept up to date when the channel is
+        saved or deleted.'''
         self._properties = properties
         self.redis = redis_manager
         self.id = id
         self.config = config
+        self.cache = cache
         if self.id is None:
             self.id = str(uuid.uuid4())
 
-        self.options = deepcopy(VumiOptions.default_vumi_options)
-        self.options.update(self.config.amqp)
+        self._options = None
 
         self.transport_worker = None
         self.application_worker = None
         self.status_application_worker = None
 
         self.sstore = StatusStore(self.redis)
+        self.index = ChannelIndexStore(self.redis)
         self.plugins = plugins
 
         self.message_rates = MessageRateStore(self.redis)
 
+    @property
+    def options(self):
+        '''The vumi options used to create workers for this channel'''
+        if self._options is None:
+            self._options = deepcopy(VumiOptions.default_vumi_options)
+            self._options.update(self.config.amqp)
+        return self._options
+
     @property
     def application_id(self):
         return self.APPLICATION_ID % (self.id,)
@@ -101,6 +137,26 @@ class Channel(object):
     def character_limit(self):
         return self._properties.get('character_limit')
 
+    @property
+    def rate_limit_count(self):
+        return self._properties.get('rate_limit_count')
+
+    @property
+    def rate_limit_window(self):
+        return self._properties.get('rate_limit_window')
+
+    @property
+    def rate_limited(self):
+        '''Whether or not the rate of messages sent on this channel is
+        limited'''
+        return bool(self.rate_limit_count and self.rate_limit_window)
+
+    @property
+    def event_stream(self):
+        '''Whether or not the events of this channel are kept in its event
+        log, to be streamed to clients'''
+        return bool(self._properties.get('event_stream'))
+
     @property
     def has_destination(self):
         """
@@ -111,7 +167,12 @@ class Channel(object):
     @inlineCallbacks
     def start(self, service, transport_worker=None):
         '''Starts the relevant workers for the channel. ``service`` is the
-        parent of under which the workers should be started.'''
+        parent of under which the workers should be started. In API only
+        processes, the supervising process is asked to start the workers
+        instead.'''
+        if self.config.api_only:
+            yield request_restart(self.redis, CHANNEL_WORKERS, self.id)
+            return
         self._start_transport(service, transport_worker)
         # Only start the application worker if we have somewhere to send the
         # messages.
@@ -133,10 +194,17 @@ class Channel(object):
     @inlineCallbacks
     def save(self):
         '''Saves the channel data into redis.'''
-        properties = json.dumps(self._properties)
+        properties = json_codec.dumps(self._properties)
         channel_redis = yield self.redis.sub_manager(self.id)
+        old_properties = yield channel_redis.get('properties')
         yield channel_redis.set('properties', properties)
         yield self.redis.sadd('channels', self.id)
+        yield self.index.add(
+            self.id, self._properties,
+            old_properties and json_codec.loads(old_properties))
+        if self.cache is not None:
+            yield self.cache.invalidate(self.id)
+            self.cache.set(self.id, self._properties)
 
     @inlineCallbacks
     def update(self, properties):
@@ -145,6 +213,11 @@ class Channel(object):
         Returns the updated configuration and status.'''
         self._properties.update(properties)
         yield self.save()
+        if self.config.api_only:
+            # The workers run in the supervising process
+            if RESTART_PROPERTIES.intersection(properties):
+                yield request_restart(self.redis, CHANNEL_WORKERS, self.id)
+            returnValue((yield self.status()))
         service = self.transport_worker.parent
 
         # Only restart if the channel config has changed
@@ -152,7 +225,8 @@ class Channel(object):
             yield self._stop_transport()
             yield self._start_transport(service)
 
-        if 'mo_url' in properties or 'amqp_queue' in properties:
+        if RESTART_PROPERTIES.difference(['config']).intersection(
+                properties):
             yield self._stop_application()
             yield self._start_application(service)
 
@@ -162,8 +236,17 @@ class Channel(object):
     def delete(self):
         '''Removes the channel data from redis'''
         channel_redis = yield self.redis.sub_manager(self.id)
+        properties = yield channel_redis.get('properties')
         yield channel_redis.delete('properties')
         yield self.redis.srem('channels', self.id)
+        yield self.index.remove(
+            self.id,
+            json_codec.loads(properties) if properties else self._properties)
+        yield RetryQueueStore(self.redis).clear(self.id)
+        if self.cache is not None:
+            yield self.cache.invalidate(self.id)
+        if self.config.api_only:
+            yield request_restart(self.redis, CHANNEL_WORKERS, self.id)
 
     @inlineCallbacks
     def status(self):
@@ -177,6 +260,32 @@ class Channel(object):
         return self.message_rates.get_messages_per_second(
             self.id, label, self.config.metric_window)
 
+    @inlineCallbacks
+    def get_metrics(self, labels, resolution):
+        '''Returns the message count series of the given resolution for each
+        of the given labels, or for all labels if none are given.'''
+        resolutions = self.message_rates.series_resolutions
+        if resolution not in resolutions:
+            raise InvalidMetric(
+                'Invalid resolution %r, must be one of %s' % (
+                    resolution, ', '.join(sorted(resolutions))))
+        labels = labels or metric_labels
+        for label in labels:
+            if label not in metric_labels:
+                raise InvalidMetric(
+                    'Invalid label %r, must be one of %s' % (
+                        label, ', '.join(metric_labels)))
+
+        series = yield gatherResults([
+            self.message_rates.get_series(self.id, label, resolution)
+            for label in labels])
+        bucket_size, _ = resolutions[resolution]
+        returnValue({
+            'resolution': resolution,
+            'bucket_size': bucket_size,
+            'series': dict(zip(labels, series)),
+        })
+
     @inlineCallbacks
     def _get_status(self):
         components = yield self.sstore.get_statuses(self.id)
@@ -215,20 +324,32 @@ class Channel(object):
                 yield self._get_message_rate('delivery_failed')),
             'delivery_pending_rate': (
                 yield self._get_message_rate('delivery_pending')),
+            'retry_depth': (
+                yield RetryQueueStore(self.redis).get_depth(self.id)),
+            'retry_dead_letters': (
+                yield RetryQueueStore(self.redis).get_dead_letter_count(
+                    self.id)),
         })
 
     @classmethod
     @inlineCallbacks
-    def from_id(cls, redis, config, id, parent, plugins=[]):
+    def from_id(cls, redis, config, id, parent, plugins=[], cache=None):
         '''Creates a channel by loading the data from redis, given the
-        channel's id, and the parent service of the channel'''
-        channel_redis = yield redis.sub_manager(id)
-        properties = yield channel_redis.get('properties')
+        channel's id, and the parent service of the channel. If ``cache`` is
+        given, the channel data is loaded from the cache if it is there.'''
+        properties = cache.get(id) if cache is not None else None
         if properties is None:
-            raise ChannelNotFound()
-        properties = json.loads(properties)
-
-        obj = cls(redis, config, properties, plugins, id=id)
+            if cache is not None:
+                generation = cache.generation(id)
+            channel_redis = yield redis.sub_manager(id)
+            properties = yield channel_redis.get('properties')
+            if properties is None:
+                raise ChannelNotFound()
+            properties = json_codec.loads(properties)
+            if cache is not None:
+                cache.set(id, properties, generation)
+
+        obj = cls(redis, config, properties, plugins, id=id, cache=cache)
         obj._restore(parent)
 
         returnValue(obj)
@@ -240,22 +361,61 @@ class Channel(object):
         channels = yield redis.smembers('channels')
         returnValue(channels)
 
+    @classmethod
+    def index_all(cls, redis):
+        '''Indexes the stored channels that were created before channels
+        were indexed'''
+        def load_properties(id):
+            d = redis.get('%s:properties' % id)
+            d.addCallback(lambda p: p and json_codec.loads(p))
+            return d
+
+        return ChannelIndexStore(redis).add_missing(load_properties)
+
     @classmethod
     @inlineCallbacks
     def start_all_channels(cls, redis, config, parent, plugins=[]):
         '''Ensures that all of the stored channels are running'''
         for id in (yield cls.get_all(redis)):
             if id not in parent.namedServices:
-                properties = json.loads((
+                properties = json_codec.loads((
                     yield redis.get('%s:properties' % id)))
                 channel = cls(redis, config, properties, plugins, id=id)
                 yield channel.start(parent)
 
+    @classmethod
+    @inlineCallbacks
+    def restart_workers(cls, redis, config, parent, id, plugins=[]):
+        '''Stops the workers of the channel ``id`` if they are running under
+        ``parent``, and starts them again if the channel still exists'''
+        if id in parent.namedServices:
+            channel = cls(redis, config, {}, plugins, id=id)
+            channel._restore(parent)
+            yield channel.stop()
+        properties = yield redis.get('%s:properties' % id)
+        if properties is not None:
+            channel = cls(
+                redis, config, json_codec.loads(properties), plugins, id=id)
+            yield channel.start(parent)
+
+    @classmethod
+    @inlineCallbacks
+    def sync_workers(cls, redis, config, parent, plugins=[]):
+        '''Stops the workers running under ``parent`` of channels that no
+        longer exist, and starts the workers of all stored channels that are
+        not running'''
+        ids = yield cls.get_all(redis)
+        prefix = cls.STATUS_APPLICATION_ID % ('',)
+        for name in parent.namedServices.keys():
+            id = name[len(prefix):]
+            if name.startswith(prefix) and id not in ids:
+                yield cls.restart_workers(redis, config, parent, id, plugins)
+        yield cls.start_all_channels(redis, config, parent, plugins)
+
     @inlineCallbacks
     def send_message(self, sender, outbounds, msg):
         '''Sends a message.'''
-        vumi_msg = message_from_api(self.id, msg)
-        vumi_msg = TransportUserMessage.send(**vumi_msg)
+        vumi_msg = self._prepare_message(msg)
         vumi_msg = yield self._send_message(sender, outbounds, vumi_msg, msg)
         returnValue(api_from_message(vumi_msg))
 
@@ -263,24 +423,47 @@ class Channel(object):
     def send_reply_message(self, sender, outbounds, inbounds, msg,
                            allow_expired_replies=False, in_msg=None):
         '''Sends a reply message.'''
-        if not in_msg:
-            in_msg = yield inbounds.load_vumi_message(self.id, msg['reply_to'])
-        # NOTE: If we have a `reply_to` that cannot be found but also are
-        #       given a `to` and the config says we can send expired
-        #       replies then pop the `reply_to` from the message
-        #       and handle it like a normal outbound message.
-        if in_msg is None and msg.get('to') and allow_expired_replies:
-            msg.pop('reply_to')
-            returnValue((yield self.send_message(sender, outbounds, msg)))
-        elif in_msg is None:
-            raise MessageNotFound(
-                "Inbound message with id %s not found" % (msg['reply_to'],))
-
-        vumi_msg = message_from_api(self.id, msg)
-        vumi_msg = in_msg.reply(**vumi_msg)
+        vumi_msg = yield self._prepare_reply_message(
+            inbounds, msg, allow_expired_replies, in_msg)
         vumi_msg = yield self._send_message(sender, outbounds, vumi_msg, msg)
         returnValue(api_from_message(vumi_msg))
 
+    @inlineCallbacks
+    def send_messages(self, sender, outbounds, inbounds, msgs,
+                      allow_expired_replies=False):
+        '''Sends a batch of messages and replies. All of the messages are
+        stored together, and then published back-to-back. Returns a list of
+        ``(success, result)`` pairs for the messages, where ``result`` is
+        the sent message, or the failure to send it.'''
+        results = yield DeferredList([
+            maybeDeferred(
+                self._prepare_any_message, inbounds, msg,
+                allow_expired_replies)
+            for msg in msgs], consumeErrors=True)
+
+        prepared = [
+            (i, vumi_msg) for i, (success, vumi_msg) in enumerate(results)
+            if success]
+        stored = yield DeferredList([
+            outbounds.store_message(self.id, msgs[i]) for i, _ in prepared],
+            consumeErrors=True)
+
+        publishing = []
+        for (i, vumi_msg), (success, result) in zip(prepared, stored):
+            if success:
+                publishing.append((i, sender.send_message(
+                    vumi_msg, routing_key=self._outbound_queue(msgs[i]))))
+            else:
+                results[i] = (success, result)
+
+        published = yield DeferredList(
+            [d for _, d in publishing], consumeErrors=True)
+        for (i, _), (success, result) in zip(publishing, published):
+            if success:
+                result = api_from_message(result)
+            results[i] = (success, result)
+        returnValue(results)
+
     def get_logs(self, n):
         '''Returns the last `n` logs. If `n` is greater than the configured
         limit, only returns the configured limit amount of logs. If `n` is
@@ -303,7 +486,7 @@ class Channel(object):
 
     @property
     def _application_config(self):
-        return {
+        config = {
             'transport_name': self.id,
             'mo_message_url': self._properties.get('mo_url'),
             'mo_message_url_auth_token': self._properties.get(
@@ -313,7 +496,36 @@ class Channel(object):
             'inbound_ttl': self.config.inbound_message_ttl,
             'outbound_ttl': self.config.outbound_message_ttl,
             'metric_window': self.config.metric_window,
+            'metric_flush_interval': self.config.metric_flush_interval,
+            'event_route_cache_size': self.config.event_route_cache_size,
+            'message_codec': self.config.message_codec,
+            'project_stored_messages': self.config.project_stored_messages,
+            'redis_pool_size': self.config.redis_pool_size,
+            'priority_window': self.config.priority_window,
+            'event_log_size': (
+                self.config.event_log_size if self.event_stream else 0),
+            'webhook_max_persistent_per_host': (
+                self.config.webhook_max_persistent_per_host),
+            'webhook_idle_timeout': self.config.webhook_idle_timeout,
+            'webhook_tls_session_reuse': self.config.webhook_tls_session_reuse,
+            'webhook_breaker_error_rate': (
+                self.config.webhook_breaker_error_rate),
+            'webhook_breaker_slow_threshold': (
+                self.config.webhook_breaker_slow_threshold),
+            'webhook_breaker_reset_timeout': (
+                self.config.webhook_breaker_reset_timeout),
+            'webhook_retry_rate': self.config.webhook_retry_rate,
+            'webhook_retry_base_delay': self.config.webhook_retry_base_delay,
+            'webhook_retry_max_delay': self.config.webhook_retry_max_delay,
+            'webhook_retry_max_attempts': (
+                self.config.webhook_retry_max_attempts),
         }
+        config.update(forwarding_concurrency_config(
+            self._properties.get('mo_batch_size'),
+            self._properties.get(
+                'mo_batch_max_delay_ms', DEFAULT_BATCH_MAX_DELAY_MS),
+            self.config.max_in_flight))
+        return config
 
     @property
     def _status_application_config(self):
@@ -321,6 +533,17 @@ class Channel(object):
             'redis_manager': self.config.redis,
             'channel_id': self.id,
             'status_url': self._properties.get('status_url'),
+            'redis_pool_size': self.config.redis_pool_size,
+            'webhook_max_persistent_per_host': (
+                self.config.webhook_max_persistent_per_host),
+            'webhook_idle_timeout': self.config.webhook_idle_timeout,
+            'webhook_tls_session_reuse': self.config.webhook_tls_session_reuse,
+            'webhook_breaker_error_rate': (
+                self.config.webhook_breaker_error_rate),
+            'webhook_breaker_slow_threshold': (
+                self.config.webhook_breaker_slow_threshold),
+            'webhook_breaker_reset_timeout': (
+                self.config.webhook_breaker_reset_timeout),
         }
 
     @property
@@ -416,14 +639,13 @@ class Channel(object):
             self.status_application_worker = None
 
     def _restore(self, service):
-        self.transport_worker = service.getServiceNamed(self.id)
-        try:
-            self.application_worker = service.getServiceNamed(
-                self.application_id)
-        except KeyError:
-            # Doesn't have an application worker if no destination specified
-            pass
-        self.status_application_worker = service.getServiceNamed(
+        # The workers only run in the supervising process, not in API only
+        # processes, and there is no application worker if no destination is
+        # specified
+        self.transport_worker = service.namedServices.get(self.id)
+        self.application_worker = service.namedServices.get(
+            self.application_id)
+        self.status_application_worker = service.namedServices.get(
             self.status_application_id)
 
     def _check_character_limit(self, content):
@@ -435,13 +657,56 @@ class Channel(object):
                     content, count, self.character_limit)
                 )
 
+    def _prepare_any_message(self, inbounds, msg, allow_expired_replies):
+        if 'reply_to' in msg:
+            return self._prepare_reply_message(
+                inbounds, msg, allow_expired_replies)
+        return self._prepare_message(msg)
+
+    def _prepare_message(self, msg):
+        vumi_msg = message_from_api(self.id, msg)
+        vumi_msg = TransportUserMessage.send(**vumi_msg)
+        return self._prepare_vumi_message(vumi_msg, msg)
+
     @inlineCallbacks
-    def _send_message(self, sender, outbounds, msg, msg_api):
-        self._check_character_limit(msg['content'])
+    def _prepare_reply_message(self, inbounds, msg,
+                               allow_expired_replies=False, in_msg=None):
+        if not in_msg:
+            in_msg = yield inbounds.load_vumi_message(self.id, msg['reply_to'])
+        # NOTE: If we have a `reply_to` that cannot be found but also are
+        #       given a `to` and the config says we can send expired
+        #       replies then pop the `reply_to` from the message
+        #       and handle it like a normal outbound message.
+        if in_msg is None and msg.get('to') and allow_expired_replies:
+            msg.pop('reply_to')
+            returnValue(self._prepare_message(msg))
+        elif in_msg is None:
+            raise MessageNotFound(
+                "Inbound message with id %s not found" % (msg['reply_to'],))
+
+        vumi_msg = message_from_api(self.id, msg)
+        vumi_msg = in_msg.reply(**vumi_msg)
+        returnValue(self._prepare_vumi_message(vumi_msg, msg))
 
-        msg_api.update(api_from_message(msg))
+    def _prepare_vumi_message(self, vumi_msg, msg_api):
+        self._check_character_limit(vumi_msg['content'])
+        msg_api.update(api_from_message(vumi_msg))
+        return vumi_msg
+
+    @inlineCallbacks
+    def _send_message(self, sender, outbounds, msg, msg_api):
         yield outbounds.store_message(self.id, msg_api)
 
-        queue = self.OUTBOUND_QUEUE % (self.id,)
-        msg = yield sender.send_message(msg, routing_key=queue)
+        msg = yield sender.send_message(
+            msg, routing_key=self._outbound_queue(msg_api))
         returnValue(msg)
+
+    def _outbound_queue(self, msg_api):
+        '''Returns the routing key to publish the outbound message to. If
+        priority lanes are enabled, messages are published to the lane for
+        their priority, from which the channel's application worker sends
+        them on to the transport.'''
+        if not self.config.priority_window:
+            return self.OUTBOUND_QUEUE % (self.id,)
+        return lane_routing_key(
+            self.id, priority_level(msg_api.get('priority')))
@@ -33,6 +33,15 @@ def create_parser():
     parser.add_argument(
         '--port', '-p', dest='port', type=int,
         help='The port to expose the API on, defaults to "8080"')
+    parser.add_argument(
+        '--api-workers', '-aw', dest='api_workers', type=int,
+        help='The amount of processes to serve the API from, sharing the '
+        'port. The channel and router workers run in a separate supervising '
+        'process. Defaults to 0, which serves the API and runs the workers '
+        'in a single process.')
+    parser.add_argument(
+        '--api-only', dest='api_only', action='store_true', default=False,
+        help=argparse.SUPPRESS)
     parser.add_argument(
         '--log-file', '-l', dest='logfile', type=str,
         help='The file to log to. Defaults to not logging to a file')
@@ -107,6 +116,123 @@ def create_parser():
         '--metric-window', '-mw', type=float,
         dest='metric_window', help='The size of each bucket '
         '(in seconds) to use for metrics. Defaults to 10 seconds.')
+    parser.add_argument(
+        '--metric-flush-interval', '-mfi', type=float,
+        dest='metric_flush_interval', help='If set, message rate counters '
+        'are aggregated in memory and written to redis every this many '
+        'seconds, so message rates can lag behind by up to this long. '
+        'Defaults to writing the counters for every message.')
+    parser.add_argument(
+        '--config-cache-ttl', '-cct', type=float,
+        dest='config_cache_ttl', help='The maximum time (in seconds) that '
+        'channel and router configuration is cached for in memory. '
+        'Defaults to 60 seconds. 0 disables the cache.')
+    parser.add_argument(
+        '--event-route-cache-size', '-ercs', type=int,
+        dest='event_route_cache_size', help='The maximum amount of outbound '
+        'messages to keep the event url and event auth token of in memory. '
+        'Defaults to 10000. 0 disables the cache.')
+    parser.add_argument(
+        '--message-codec', '-mc', type=str,
+        choices=['json', 'zlib', 'msgpack'],
+        dest='message_codec', help='The codec that messages and events are '
+        'stored in redis with. "msgpack" falls back to "zlib" if msgpack is '
+        'not installed. Defaults to "json".')
+    parser.add_argument(
+        '--project-stored-messages', '-psm', action='store_true',
+        dest='project_stored_messages', default=False, help='Only store the '
+        'fields of messages and events that Junebug needs.')
+    parser.add_argument(
+        '--redis-pool-size', '-rps', type=int,
+        dest='redis_pool_size', help='The maximum amount of redis '
+        'connections shared by the API, channels and routers. Defaults to '
+        '10.')
+    parser.add_argument(
+        '--max-message-batch-size', '-mmbs', type=int,
+        dest='max_message_batch_size', help='The maximum amount of messages '
+        'that can be sent in a single batch send request. Defaults to 1000.')
+    parser.add_argument(
+        '--message-stream-window', '-msw', type=int,
+        dest='message_stream_window', help='The maximum amount of messages '
+        'of a streamed send request that are sent at the same time. '
+        'Defaults to 100.')
+    parser.add_argument(
+        '--priority-window', '-pw', type=int,
+        dest='priority_window', help='If set, outbound messages are sent to '
+        'the transport from a lane for their priority, with at most this '
+        'many messages waiting for the transport to ack or nack them. '
+        'Defaults to 0, which disables priority lanes.')
+    parser.add_argument(
+        '--event-log-size', '-els', type=int,
+        dest='event_log_size', help='The maximum amount of events kept in '
+        'the event log of each channel that has event streaming enabled. '
+        'Defaults to 1000.')
+    parser.add_argument(
+        '--event-stream-poll-interval', '-espi', type=float,
+        dest='event_stream_poll_interval', help='The interval (in seconds) '
+        'at which the event log of a channel is polled for new events while '
+        'clients are streaming its events. Defaults to 0.5.')
+    parser.add_argument(
+        '--webhook-max-persistent-per-host', '-wmph', type=int,
+        dest='webhook_max_persistent_per_host', help='The maximum amount of '
+        'idle connections kept open to each webhook host. Defaults to 10.')
+    parser.add_argument(
+        '--webhook-idle-timeout', '-wit', type=int,
+        dest='webhook_idle_timeout', help='The amount of seconds that an '
+        'idle connection to a webhook host is kept open for. Defaults to '
+        '240.')
+    parser.add_argument(
+        '--no-webhook-tls-session-reuse', '-nwtsr', action='store_false',
+        dest='webhook_tls_session_reuse', default=None, help='Do a full TLS '
+        'handshake for every new connection to a webhook host, instead of '
+        'resuming the session of an earlier connection.')
+    parser.add_argument(
+        '--webhook-breaker-error-rate', '-wber', type=float,
+        dest='webhook_breaker_error_rate', help='The fraction of failed or '
+        'slow posts to a webhook host that opens the circuit breaker of the '
+        'host. Defaults to 0.5. 0 disables circuit breaking.')
+    parser.add_argument(
+        '--webhook-breaker-slow-threshold', '-wbst', type=float,
+        dest='webhook_breaker_slow_threshold', help='The amount of seconds '
+        'after which a post to a webhook host counts as failed, and after '
+        'which the first attempt of a delivery is retried later instead. '
+        'Defaults to 5.')
+    parser.add_argument(
+        '--webhook-breaker-reset-timeout', '-wbrt', type=float,
+        dest='webhook_breaker_reset_timeout', help='The amount of seconds '
+        'the circuit breaker of a webhook host stays open for. Defaults to '
+        '30.')
+    parser.add_argument(
+        '--max-in-flight', '-mif', type=int,
+        dest='max_in_flight', help='The maximum amount of inbound messages '
+        'and events that each channel forwards at the same time. Defaults '
+        'to 0, which forwards them one after another.')
+    parser.add_argument(
+        '--webhook-retry-rate', '-wrr', type=int,
+        dest='webhook_retry_rate', help='The maximum amount of failed '
+        'webhook deliveries retried per second. Defaults to 100. 0 disables '
+        'retrying.')
+    parser.add_argument(
+        '--webhook-retry-base-delay', '-wrbd', type=float,
+        dest='webhook_retry_base_delay', help='The amount of seconds to wait '
+        'before the first retry of a failed webhook delivery. Defaults to '
+        '1.')
+    parser.add_argument(
+        '--webhook-retry-max-delay', '-wrmd', type=float,
+        dest='webhook_retry_max_delay', help='The maximum amount of seconds '
+        'to wait between retries of a failed webhook delivery. Defaults to '
+        '3600.')
+    parser.add_argument(
+        '--webhook-retry-max-attempts', '-wrma', type=int,
+        dest='webhook_retry_max_attempts', help='The amount of attempts '
+        'after which a failed webhook delivery is given up on, and kept with '
+        'the dead letters of its channel. Defaults to 20.')
+    parser.add_argument(
+        '--rate-limit-lease-size', '-rlls', type=int,
+        dest='rate_limit_lease_size', help='The amount of extra tokens to '
+        'take from the rate limit of a channel whenever the channel is well '
+        'under its limit, to be used without a redis call. Defaults to 0, '
+        'which disables leasing.')
     parser.add_argument(
         '--logging-path', '-lp', type=str,
         dest='logging_path', help='The path to place log files for each '
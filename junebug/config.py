@@ -12,6 +12,19 @@ class JunebugConfig(Config):
         "Port to expose the API on",
         default=8080)
 
+    api_workers = ConfigInt(
+        "The amount of API only processes to serve the API from, sharing "
+        "the port with SO_REUSEPORT. The channel and router workers run in "
+        "the supervising process, which does not serve the API. 0 serves "
+        "the API and runs the workers in a single process. Requires redis "
+        "pub/sub.",
+        default=0)
+
+    api_only = ConfigBool(
+        "Set for the API only processes started by the supervising process. "
+        "API only processes serve the API, but do not run any workers.",
+        default=False)
+
     logfile = ConfigText(
         "File to log to or `None` for no logging",
         default=None)
@@ -80,6 +93,136 @@ class JunebugConfig(Config):
     metric_window = ConfigFloat(
         "The size of the buckets (in seconds) used for metrics.", default=10.0)
 
+    metric_flush_interval = ConfigFloat(
+        "If set, message rate counters are aggregated in memory and written "
+        "to redis in a single batch every `metric_flush_interval` seconds, "
+        "instead of once for every message. Message rates read by the API "
+        "lag behind by up to this interval, since the counts of the workers "
+        "are only read once they are written. Should be much smaller than "
+        "`metric_window`.", default=None)
+
+    config_cache_ttl = ConfigFloat(
+        "The maximum time (in seconds) that channel and router configuration "
+        "is cached for in memory. Changes are propagated between Junebug "
+        "processes using redis pub/sub, this is the upper bound for how long "
+        "a missed change can go unnoticed. 0 disables the cache.",
+        default=60.0)
+
+    event_route_cache_size = ConfigInt(
+        "The maximum amount of outbound messages to keep the event url and "
+        "event auth token of in memory, so that events for those messages "
+        "can be forwarded without looking the message up in redis. 0 "
+        "disables the cache.", default=10000)
+
+    message_codec = ConfigText(
+        "The codec that inbound messages, outbound messages and events are "
+        "stored in redis with. One of `json`, `zlib` (zlib compressed JSON) "
+        "or `msgpack` (zlib compressed msgpack, which falls back to `zlib` "
+        "if msgpack is not installed). Messages stored with any codec can "
+        "always be read.", default='json')
+
+    project_stored_messages = ConfigBool(
+        "If `True`, only the fields of inbound messages, outbound messages "
+        "and events that are needed to construct replies, route events and "
+        "show message statuses are stored.", default=False)
+
+    redis_pool_size = ConfigInt(
+        "The maximum amount of redis connections that are shared by the API "
+        "and all of the channels and routers in this process. Connections "
+        "are only opened once the existing connections are busy.",
+        default=10)
+
+    max_message_batch_size = ConfigInt(
+        "The maximum amount of messages that can be sent in a single batch "
+        "send request.", default=1000)
+
+    message_stream_window = ConfigInt(
+        "The maximum amount of messages of a streamed send request that are "
+        "sent at the same time. Reading the request body is paused while "
+        "this many messages are being sent.", default=100)
+
+    priority_window = ConfigInt(
+        "If set, outbound messages are queued in a lane for their priority, "
+        "and are sent to the transport from the lanes with at most this many "
+        "messages waiting for the transport to ack or nack them. Higher "
+        "priority lanes are drained first. 0 disables priority lanes.",
+        default=0)
+
+    event_log_size = ConfigInt(
+        "The maximum amount of events kept in the event log of each channel "
+        "that has `event_stream` enabled, for clients of the event stream "
+        "endpoint to resume from.", default=1000)
+
+    event_stream_poll_interval = ConfigFloat(
+        "The interval (in seconds) at which the event log of a channel is "
+        "polled for new events while clients are streaming its events.",
+        default=0.5)
+
+    webhook_max_persistent_per_host = ConfigInt(
+        "The maximum amount of idle connections kept open to each webhook "
+        "host. The connections are shared by all of the channels in this "
+        "process, and reused for later messages, events and statuses.",
+        default=10)
+
+    webhook_idle_timeout = ConfigInt(
+        "The amount of seconds that an idle connection to a webhook host is "
+        "kept open for.", default=240)
+
+    webhook_tls_session_reuse = ConfigBool(
+        "If `True`, new TLS connections to a webhook host resume the TLS "
+        "session of an earlier connection to the host, skipping the full "
+        "handshake.", default=True)
+
+    webhook_breaker_error_rate = ConfigFloat(
+        "The fraction of the posts to a webhook host over the last minute "
+        "that need to have failed or been slow for the circuit breaker of "
+        "the host to open. While a breaker is open, posts to its host fail "
+        "immediately, and are sent to the retry queue of their channel. 0 "
+        "disables circuit breaking.", default=0.5)
+
+    webhook_breaker_slow_threshold = ConfigFloat(
+        "The amount of seconds after which a post to a webhook host counts "
+        "as failed for the circuit breaker of the host. If failed deliveries "
+        "are retried, the first attempt of a delivery is given up on after "
+        "this long, and it is retried with its full timeout.", default=5.0)
+
+    webhook_breaker_reset_timeout = ConfigFloat(
+        "The amount of seconds the circuit breaker of a webhook host stays "
+        "open for, before a trial post is made to the host.", default=30.0)
+
+    max_in_flight = ConfigInt(
+        "The maximum amount of inbound messages and events that each channel "
+        "forwards at the same time. The events of a message are still "
+        "forwarded in the order they were received. Inbound messages may be "
+        "posted to their URL in a different order than they were received. "
+        "0 or 1 forwards them one after another.", default=0)
+
+    webhook_retry_rate = ConfigInt(
+        "The maximum amount of failed webhook deliveries retried per second "
+        "by this process. Failed messages and events are kept in a redis "
+        "backed retry queue for each channel until they are delivered. 0 "
+        "disables retrying.", default=100)
+
+    webhook_retry_base_delay = ConfigFloat(
+        "The amount of seconds to wait before the first retry of a failed "
+        "webhook delivery. The delay doubles with each further retry.",
+        default=1.0)
+
+    webhook_retry_max_delay = ConfigFloat(
+        "The maximum amount of seconds to wait between retries of a failed "
+        "webhook delivery.", default=3600.0)
+
+    webhook_retry_max_attempts = ConfigInt(
+        "The amount of attempts after which a failed webhook delivery is "
+        "given up on. Deliveries that are given up on are kept with the "
+        "dead letters of their channel.", default=20)
+
+    rate_limit_lease_size = ConfigInt(
+        "The amount of extra tokens to take from the rate limit of a channel "
+        "whenever the channel is well under its limit, to be used for the "
+        "channel's next messages without a redis call. 0 disables leasing.",
+        default=0)
+
     logging_path = ConfigText(
         "The path to place log files in.", default="logs/")
 
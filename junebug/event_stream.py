@@ -0,0 +1,188 @@
+'''Streaming the events of channels to clients over long lived HTTP
+connections, as an alternative to posting each event to the event URL of its
+message.
+
+The message forwarding worker of a channel appends each event to the event
+log of the channel (see :class:`junebug.stores.EventLogStore`). Each API
+process polls the log of each channel that has clients connected, once per
+poll interval no matter how many clients are connected, and writes the new
+events to the clients. Clients resume from the offset of the last event they
+have seen, as long as it is still in the log.'''
+import logging
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.task import LoopingCall
+
+from junebug import json_codec
+
+
+# The maximum amount of events read from a log at a time
+READ_LIMIT = 1000
+
+# The amount of seconds without events after which a keepalive is written to
+# a client, so that proxies do not close the connection
+KEEPALIVE_INTERVAL = 15
+
+
+class EventSubscriber(object):
+    '''A client that events are streamed to.
+
+    :param request: The request of the client
+    :type request: :class:`twisted.web.server.Request`
+    :param offset: The offset of the last event the client has seen
+    :type offset: int
+    '''
+    CONTENT_TYPE = None
+    KEEPALIVE = None
+
+    def __init__(self, request, offset, clock=reactor):
+        self.request = request
+        self.offset = offset
+        self.clock = clock
+        self.last_write = clock.seconds()
+
+    def send(self, offset, event):
+        self.offset = offset
+        self._write(self.format(offset, event))
+
+    def keepalive(self):
+        if self.clock.seconds() - self.last_write >= KEEPALIVE_INTERVAL:
+            self._write(self.KEEPALIVE)
+
+    def format(self, offset, event):
+        raise NotImplementedError()
+
+    def _write(self, data):
+        self.last_write = self.clock.seconds()
+        self.request.write(data)
+
+
+class SSESubscriber(EventSubscriber):
+    '''Streams events as server-sent events, with the offset as the event
+    id, so that browsers resume from it when they reconnect'''
+    CONTENT_TYPE = 'text/event-stream'
+    KEEPALIVE = ': keepalive\n\n'
+
+    def format(self, offset, event):
+        frame = 'id: %d\nevent: %s\ndata: %s\n\n' % (
+            offset, event['event_type'], json_codec.dumps(event))
+        return frame.encode('utf-8')
+
+
+class NDJSONSubscriber(EventSubscriber):
+    '''Streams events as newline delimited JSON objects, with the offset of
+    each event in ``offset``, and the event in ``event``. Keepalives are
+    empty lines.'''
+    CONTENT_TYPE = 'application/x-ndjson'
+    KEEPALIVE = '\n'
+
+    def format(self, offset, event):
+        return json_codec.dumps({'offset': offset, 'event': event}) + '\n'
+
+
+SUBSCRIBERS = {
+    'sse': SSESubscriber,
+    'ndjson': NDJSONSubscriber,
+}
+
+
+class ChannelEventFeed(object):
+    '''Polls the event log of a channel every ``interval`` seconds while it
+    has subscribers, and sends the new events to each of them. The log is
+    read from the oldest offset of the subscribers, so that subscribers that
+    are resuming catch up without a read of their own.'''
+
+    def __init__(self, store, channel_id, interval, clock=reactor):
+        self.store = store
+        self.channel_id = channel_id
+        self.interval = interval
+        self.subscribers = set()
+        self.loop = LoopingCall(self.poll)
+        self.loop.clock = clock
+
+    def add(self, subscriber):
+        self.subscribers.add(subscriber)
+        if not self.loop.running:
+            self.loop.start(self.interval)
+
+    def remove(self, subscriber):
+        self.subscribers.discard(subscriber)
+        if not self.subscribers:
+            self.stop()
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    @inlineCallbacks
+    def poll(self):
+        try:
+            yield self._read_events()
+        except Exception:
+            logging.exception(
+                'Error reading the event log of %s' % (self.channel_id,))
+
+        for subscriber in list(self.subscribers):
+            subscriber.keepalive()
+
+    @inlineCallbacks
+    def _read_events(self):
+        while self.subscribers:
+            offset = min(s.offset for s in self.subscribers)
+            events = yield self.store.read(
+                self.channel_id, offset, READ_LIMIT)
+            for subscriber in list(self.subscribers):
+                for event_offset, event in events:
+                    if event_offset > subscriber.offset:
+                        subscriber.send(event_offset, event)
+            if len(events) < READ_LIMIT:
+                break
+
+
+class EventStreams(object):
+    '''Streams the events of channels to their subscribers.
+
+    :param store: The store of the event logs
+    :type store: :class:`junebug.stores.EventLogStore`
+    :param interval: The amount of seconds between polls of an event log
+    :type interval: float
+    '''
+
+    def __init__(self, store, interval, clock=reactor):
+        self.store = store
+        self.interval = interval
+        self.clock = clock
+        self.feeds = {}
+
+    def subscribe(self, channel_id, subscriber):
+        '''Sends the events of the channel to ``subscriber``. Returns a
+        deferred that never fires, and that unsubscribes the subscriber when
+        it is cancelled.'''
+        feed = self.feeds.get(channel_id)
+        if feed is None:
+            feed = ChannelEventFeed(
+                self.store, channel_id, self.interval, self.clock)
+            self.feeds[channel_id] = feed
+        feed.add(subscriber)
+        return Deferred(lambda _: self.unsubscribe(channel_id, subscriber))
+
+    def unsubscribe(self, channel_id, subscriber):
+        feed = self.feeds.get(channel_id)
+        if feed is None:
+            return
+        feed.remove(subscriber)
+        if not feed.subscribers:
+            del self.feeds[channel_id]
+
+    def stop(self):
+        '''Stops polling the event logs'''
+        for feed in self.feeds.values():
+            feed.stop()
+        self.feeds.clear()
+
+    def stats(self):
+        '''Returns the amount of subscribers for each channel'''
+        return dict(
+            (channel_id, len(feed.subscribers))
+            for channel_id, feed in self.feeds.iteritems())
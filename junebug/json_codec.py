@@ -0,0 +1,136 @@
+'''The JSON encoding and decoding used by the API, the stores and the
+webhook client. The fastest encoder and decoder that are installed are
+selected when this module is imported, falling back to the standard library
+``json`` module.
+
+Datetimes are encoded in the vumi date format, as
+:class:`vumi.message.JSONMessageEncoder` encodes them.'''
+import json
+from datetime import datetime
+
+from vumi.message import JSONMessageEncoder, format_vumi_date
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return format_vumi_date(obj)
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+
+def _apply_object_hook(obj, object_hook):
+    '''Applies ``object_hook`` to each object in ``obj``, innermost objects
+    first, as the decoders of the standard library do.'''
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            if isinstance(value, (dict, list)):
+                obj[key] = _apply_object_hook(value, object_hook)
+        return object_hook(obj)
+    if isinstance(obj, list):
+        for i, value in enumerate(obj):
+            if isinstance(value, (dict, list)):
+                obj[i] = _apply_object_hook(value, object_hook)
+    return obj
+
+
+class JSONBackend(object):
+    '''Base class for the libraries that JSON can be encoded and decoded
+    with'''
+    NAME = None
+
+    @classmethod
+    def available(cls):
+        '''Returns ``True`` if the library of this backend is installed'''
+        return True
+
+    def dumps(self, obj):
+        raise NotImplementedError()
+
+    def loads(self, data, object_hook=None):
+        raise NotImplementedError()
+
+
+class StdlibBackend(JSONBackend):
+    '''The ``json`` module of the standard library'''
+    NAME = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj, cls=JSONMessageEncoder)
+
+    def loads(self, data, object_hook=None):
+        return json.loads(data, object_hook=object_hook)
+
+
+class SimplejsonBackend(JSONBackend):
+    '''simplejson, which is only used for encoding, since it decodes ASCII
+    strings to byte strings instead of unicode'''
+    NAME = 'simplejson'
+
+    @classmethod
+    def available(cls):
+        return simplejson is not None
+
+    def dumps(self, obj):
+        return simplejson.dumps(obj, default=_default)
+
+
+class UjsonBackend(JSONBackend):
+    '''ujson, which is only used for decoding, since its encoding of
+    datetimes cannot be changed'''
+    NAME = 'ujson'
+
+    @classmethod
+    def available(cls):
+        return ujson is not None
+
+    def loads(self, data, object_hook=None):
+        obj = ujson.loads(data, precise_float=True)
+        if object_hook is not None:
+            obj = _apply_object_hook(obj, object_hook)
+        return obj
+
+
+# The backends to select from, fastest first
+ENCODERS = [SimplejsonBackend, StdlibBackend]
+DECODERS = [UjsonBackend, StdlibBackend]
+
+
+def select_backend(backends):
+    '''Returns an instance of the first available backend of ``backends``'''
+    for backend in backends:
+        if backend.available():
+            return backend()
+    return StdlibBackend()
+
+
+encoder = select_backend(ENCODERS)
+decoder = select_backend(DECODERS)
+
+
+def dumps(obj):
+    '''Encodes ``obj`` as JSON, encoding datetimes in the vumi date format'''
+    return encoder.dumps(obj)
+
+
+def loads(data, object_hook=None):
+    '''Decodes the JSON string ``data``, calling ``object_hook`` with each
+    decoded object if it is given. Raises :class:`ValueError` for invalid
+    JSON.'''
+    return decoder.loads(data, object_hook=object_hook)
+
+
+def get_backends():
+    '''Returns the names of the active encoder and decoder'''
+    return {
+        'encoder': encoder.NAME,
+        'decoder': decoder.NAME,
+    }
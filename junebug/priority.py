@@ -0,0 +1,149 @@
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
+
+
+PRIORITY_LEVELS = (1, 2, 3, 4, 5)
+DEFAULT_PRIORITY = 1
+
+# Priority names that are accepted in place of a level, since the priority
+# field of sent messages used to be an arbitrary string
+PRIORITY_NAMES = {
+    'lowest': 1,
+    'low': 2,
+    'normal': 3,
+    'medium': 3,
+    'high': 4,
+    'highest': 5,
+    'urgent': 5,
+}
+
+# The amount of seconds after which a sent message no longer counts towards
+# the messages in flight, for transports that do not ack or nack messages
+SLOT_TIMEOUT = 10
+
+
+def priority_level(priority):
+    '''Returns the priority level for the ``priority`` of a sent message.
+    Levels may be given as integers or numeric strings, or as one of the
+    ``PRIORITY_NAMES``. Missing, unknown and out of range priorities are
+    given the default level.'''
+    if isinstance(priority, basestring):
+        priority = priority.strip().lower()
+        if priority in PRIORITY_NAMES:
+            return PRIORITY_NAMES[priority]
+        try:
+            priority = int(priority)
+        except ValueError:
+            return DEFAULT_PRIORITY
+    if priority in PRIORITY_LEVELS:
+        return priority
+    return DEFAULT_PRIORITY
+
+
+def lane_routing_key(channel_id, priority):
+    '''Returns the routing key of the outbound priority lane of the channel
+    for messages of the given priority'''
+    return '%s.outbound.priority.%d' % (channel_id, priority)
+
+
+class PriorityScheduler(object):
+    '''Sends the messages queued in the priority lanes of a channel to its
+    transport, keeping at most ``window`` messages in flight at a time. A
+    message is in flight from when it is published until the transport acks
+    or nacks it, or until ``slot_timeout`` seconds have passed. Since the
+    transport is never more than ``window`` messages behind, a high priority
+    message only has to wait for those messages.
+
+    The lane to send the next message from is chosen with a smooth weighted
+    round robin over the lanes that have messages waiting, where the weight
+    of each lane is ``2 ** (priority - 1)``. Higher priority lanes drain
+    first, but lower priority lanes still get their share of the window, so
+    that they are never starved.
+
+    :param publish: Called with each message to publish it to the transport
+    :type publish: callable
+    :param window: The maximum amount of messages in flight
+    :type window: int
+    '''
+
+    def __init__(self, publish, window, slot_timeout=SLOT_TIMEOUT,
+                 clock=reactor):
+        self.publish = publish
+        self.window = window
+        self.slot_timeout = slot_timeout
+        self.clock = clock
+        self.lanes = dict((p, deque()) for p in PRIORITY_LEVELS)
+        self.weights = dict((p, 2 ** (p - 1)) for p in PRIORITY_LEVELS)
+        self.credit = dict((p, 0) for p in PRIORITY_LEVELS)
+        self.sent = dict((p, 0) for p in PRIORITY_LEVELS)
+        self.in_flight = {}
+
+    def enqueue(self, priority, message):
+        '''Queues ``message`` in the lane for ``priority``. Returns a deferred
+        that fires once the message has been published.'''
+        d = Deferred()
+        self.lanes[priority].append((message, d))
+        self._send_next()
+        return d
+
+    def message_done(self, message_id):
+        '''Frees the slot of the message with the given id, once the
+        transport has acked or nacked it'''
+        call = self.in_flight.pop(message_id, None)
+        if call is None:
+            return
+        if call.active():
+            call.cancel()
+        self._send_next()
+
+    def stop(self):
+        '''Stops waiting for the messages in flight'''
+        in_flight, self.in_flight = self.in_flight, {}
+        for call in in_flight.values():
+            if call.active():
+                call.cancel()
+
+    def stats(self):
+        '''Returns the amount of messages in flight, waiting in each lane,
+        and sent from each lane'''
+        return {
+            'in_flight': len(self.in_flight),
+            'waiting': dict(
+                (p, len(lane)) for p, lane in self.lanes.iteritems()),
+            'sent': dict(self.sent),
+        }
+
+    def _next_lane(self):
+        lanes = [p for p in PRIORITY_LEVELS if self.lanes[p]]
+        if not lanes:
+            return None
+        total = 0
+        for priority in lanes:
+            self.credit[priority] += self.weights[priority]
+            total += self.weights[priority]
+        lane = max(lanes, key=lambda p: (self.credit[p], p))
+        self.credit[lane] -= total
+        return lane
+
+    def _send_next(self):
+        while len(self.in_flight) < self.window:
+            priority = self._next_lane()
+            if priority is None:
+                return
+            message, d = self.lanes[priority].popleft()
+            message_id = message['message_id']
+            previous = self.in_flight.pop(message_id, None)
+            if previous is not None and previous.active():
+                previous.cancel()
+            self.in_flight[message_id] = self.clock.callLater(
+                self.slot_timeout, self.message_done, message_id)
+            self.sent[priority] += 1
+            published = maybeDeferred(self.publish, message)
+            published.addErrback(self._publish_failed, message_id)
+            published.chainDeferred(d)
+
+    def _publish_failed(self, failure, message_id):
+        self.message_done(message_id)
+        return failure
@@ -0,0 +1,251 @@
+import logging
+
+from twisted.internet.defer import (
+    Deferred, gatherResults, inlineCallbacks, maybeDeferred, returnValue,
+    succeed)
+from vumi.persist.fake_redis import FakeRedis
+from vumi.persist.txredis_manager import TxRedisManager
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_IN_FLIGHT = 8
+
+
+class RedisPoolClosed(Exception):
+    '''Raised when a redis call is made through a pool that has been closed'''
+
+
+class PoolClientProxy(object):
+    '''Client proxy for :class:`PooledRedisManager`, which returns the client
+    of the least busy connection in ``pool`` each time it is used.'''
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    @property
+    def client(self):
+        return self.pool.get_connection()._client
+
+
+class PooledRedisManager(TxRedisManager):
+    '''A redis manager that makes its calls over the connections of a
+    :class:`RedisPool`. Closing the manager releases it back to the pool,
+    which closes its connections once no managers are using it anymore.'''
+
+    _leased = False
+
+    def _make_redis_call(self, call, *args, **kw):
+        pool = self._client_proxy.pool
+        connection = pool.get_connection()
+        pool.request_started(connection)
+        d = maybeDeferred(
+            getattr(connection._client, call), *args, **kw)
+        d.addBoth(pool.request_finished, connection)
+        return d
+
+    def sub_manager(self, sub_prefix):
+        sub_man = super(PooledRedisManager, self).sub_manager(sub_prefix)
+        sub_man.RESPONSE_ERROR = self.RESPONSE_ERROR
+        return sub_man
+
+    @inlineCallbacks
+    def _purge_all(self):
+        '''Deletes all keys with this manager's key prefix, over a connection
+        of its own, since the pool might already be closed. Use only in
+        tests.'''
+        manager = yield TxRedisManager.from_config(self._config)
+        manager._key_prefix = self._key_prefix
+        yield manager._do_purge()
+        yield manager._close()
+
+    def _close(self):
+        if not self._leased:
+            return succeed(None)
+        self._leased = False
+        return self._client_proxy.pool.release()
+
+
+class RedisPool(object):
+    '''A size-bounded pool of redis connections that is shared by every
+    redis manager acquired from it. Connections are opened as they are
+    needed: a new connection is only opened once every open connection has
+    ``max_in_flight`` requests waiting for a response, so that the amount of
+    connections grows with the load instead of with the amount of managers.
+
+    :param config: The redis config, without the key prefix
+    :type config: dict
+    :param max_size: The maximum amount of connections to open
+    :type max_size: int
+    :param max_in_flight: The amount of requests waiting on a connection
+        after which a new connection is opened, if the pool is not full
+    :type max_in_flight: int
+    '''
+
+    def __init__(self, config, max_size=DEFAULT_POOL_SIZE,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.config = config
+        self.max_size = max(max_size, 1)
+        self.max_in_flight = max_in_flight
+        self.connections = []
+        self.in_flight = {}
+        self.leases = 0
+        self.requests = 0
+        self.peak_in_flight = 0
+        self.closed = False
+        self._connecting = False
+        self._waiters = []
+
+    def acquire(self, config):
+        '''Returns a deferred :class:`PooledRedisManager` for ``config``, which
+        uses the connections of this pool. The manager should be closed once
+        it is no longer needed.'''
+        self.leases += 1
+        if self.connections:
+            d = succeed(None)
+        else:
+            d = self._connect()
+        d.addCallback(lambda _: self._make_manager(config))
+        d.addErrback(self._acquire_failed)
+        return d
+
+    def _make_manager(self, config):
+        manager = PooledRedisManager(
+            None, dict(config), config.get('key_prefix'),
+            config.get('key_separator', ':'),
+            client_proxy=PoolClientProxy(self))
+        manager.RESPONSE_ERROR = self.connections[0].RESPONSE_ERROR
+        manager._leased = True
+        return manager
+
+    def _acquire_failed(self, failure):
+        self.release()
+        return failure
+
+    def release(self):
+        '''Releases a manager acquired from this pool, closing the pool if
+        no managers are using it anymore.'''
+        self.leases -= 1
+        if self.leases > 0:
+            return succeed(None)
+        return self.close()
+
+    def close(self):
+        '''Closes all of the connections of this pool'''
+        self.closed = True
+        _remove_pool(self)
+        connections, self.connections = self.connections, []
+        self.in_flight.clear()
+        return gatherResults([
+            maybeDeferred(connection.close_manager)
+            for connection in connections])
+
+    def _connect(self):
+        d = Deferred()
+        self._waiters.append(d)
+        if not self._connecting:
+            self._connecting = True
+            connection = TxRedisManager.from_config(self.config)
+            connection.addCallbacks(self._connected, self._connect_failed)
+        return d
+
+    def _connected(self, connection):
+        self._connecting = False
+        if self.closed:
+            return connection.close_manager()
+        self.connections.append(connection)
+        self.in_flight[connection] = 0
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def _connect_failed(self, failure):
+        self._connecting = False
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.errback(failure)
+
+    def _grow_failed(self, failure):
+        logging.warning(
+            'Could not open a new redis connection: %s' %
+            (failure.getErrorMessage(),))
+
+    def get_connection(self):
+        '''Returns the connection with the least requests in flight, opening
+        a new connection in the background if that connection is busy and the
+        pool is not full.'''
+        if not self.connections:
+            raise RedisPoolClosed('The redis pool has been closed')
+        connection = min(self.connections, key=self.in_flight.get)
+        if (self.in_flight[connection] >= self.max_in_flight and
+                len(self.connections) < self.max_size and
+                not self._connecting):
+            self._connect().addErrback(self._grow_failed)
+        return connection
+
+    def request_started(self, connection):
+        self.requests += 1
+        self.in_flight[connection] += 1
+        self.peak_in_flight = max(
+            self.peak_in_flight, sum(self.in_flight.values()))
+
+    def request_finished(self, result, connection):
+        if connection in self.in_flight:
+            self.in_flight[connection] -= 1
+        return result
+
+    def stats(self):
+        '''Returns a dictionary of the utilisation of this pool'''
+        return {
+            'host': self.config.get('host', '127.0.0.1'),
+            'port': self.config.get('port', 6379),
+            'db': self.config.get('db', 0),
+            'max_size': self.max_size,
+            'connections': len(self.connections),
+            'managers': self.leases,
+            'in_flight': sum(self.in_flight.values()),
+            'peak_in_flight': self.peak_in_flight,
+            'requests': self.requests,
+        }
+
+
+_pools = {}
+
+
+def _pool_key(config):
+    return repr(sorted(config.items()))
+
+
+def _remove_pool(pool):
+    key = _pool_key(pool.config)
+    if _pools.get(key) is pool:
+        del _pools[key]
+
+
+@inlineCallbacks
+def acquire_redis_manager(config, pool_size=DEFAULT_POOL_SIZE):
+    '''Returns a deferred redis manager for ``config`` that shares the
+    connections of this process' redis pool for the same redis server,
+    creating the pool with at most ``pool_size`` connections if it does not
+    exist yet.'''
+    config = dict(config)
+    fake_redis = config.get('FAKE_REDIS')
+    if fake_redis is not None and not isinstance(
+            fake_redis, (FakeRedis, TxRedisManager)):
+        # Like a plain redis manager, a config that asks for a fake redis
+        # without providing one gets a new fake redis of its own
+        config['FAKE_REDIS'] = yield TxRedisManager.from_config(
+            {'FAKE_REDIS': fake_redis})
+    client_config = dict(config)
+    client_config.pop('key_prefix', None)
+    client_config.pop('key_separator', None)
+    key = _pool_key(client_config)
+    pool = _pools.get(key)
+    if pool is None:
+        pool = _pools[key] = RedisPool(client_config, pool_size)
+    manager = yield pool.acquire(config)
+    returnValue(manager)
+
+
+def get_redis_pools():
+    '''Returns the redis pools that are currently open in this process'''
+    return list(_pools.values())
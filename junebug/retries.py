@@ -0,0 +1,260 @@
+'''Retrying the webhook deliveries that failed, so that a failing or slow
+webhook does not hold up the messages of its channel, and the messages and
+events that could not be delivered are not lost.
+
+A delivery that fails is kept in the redis backed retry queue of its
+channel, scheduled for a later attempt with an exponential backoff. Each
+process has a :class:`RetryScheduler` for each redis config and retry
+settings, shared by the message forwarding workers of the process with
+those settings, that takes the deliveries that are due from the queues of
+their channels and posts them again, at a bounded rate. A delivery that
+has failed too many times is moved to the dead letters of its channel.
+
+Credentials are not kept with the deliveries. They are looked up by the
+worker of the channel whenever a delivery is retried.'''
+import logging
+import random
+import uuid
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    gatherResults, inlineCallbacks, maybeDeferred)
+from twisted.internet.task import LoopingCall
+
+from junebug.stores import RetryQueueStore
+from junebug.webhooks import request_failed, token_auth_headers
+
+
+DEFAULT_RETRY_RATE = 100
+DEFAULT_RETRY_BASE_DELAY = 1.0
+DEFAULT_RETRY_MAX_DELAY = 3600.0
+DEFAULT_RETRY_MAX_ATTEMPTS = 20
+
+# The amount of seconds between polls of the retry queues
+RETRY_POLL_INTERVAL = 1
+
+# The amount of seconds that a delivery taken from a retry queue is hidden
+# from other schedulers for, while it is being retried
+RETRY_LEASE = 300
+
+
+def backoff_delay(attempts, base_delay, max_delay, random=random.random):
+    '''Returns the amount of seconds to wait before the next attempt of a
+    delivery that has failed ``attempts`` times. The delay doubles with each
+    attempt up to ``max_delay``, and is jittered by up to half, so that
+    deliveries that failed together are not all retried together.'''
+    delay = min(max_delay, base_delay * 2 ** (attempts - 1))
+    return delay / 2 + random() * delay / 2
+
+
+class RetryScheduler(object):
+    '''Retries the failed webhook deliveries of all of the channels that use
+    the same redis config and retry settings. Every ``RETRY_POLL_INTERVAL``
+    seconds, up to ``rate * RETRY_POLL_INTERVAL`` of the deliveries that are
+    due are posted again. Deliveries that fail again are rescheduled, until
+    they have failed ``max_attempts`` times, after which they are dead
+    lettered.
+
+    It is leased by the message forwarding workers of the process, and only
+    retries the deliveries of the channels that have a lease, using the
+    redis manager, webhook client and credentials of their lease.
+
+    :param rate: The maximum amount of deliveries retried per second
+    :type rate: int
+    :param base_delay: The amount of seconds to wait before the first retry
+    :type base_delay: float
+    :param max_delay: The maximum amount of seconds between retries
+    :type max_delay: float
+    :param max_attempts: The amount of attempts after which a delivery is
+        given up on
+    :type max_attempts: int
+    '''
+
+    def __init__(self, rate=DEFAULT_RETRY_RATE,
+                 base_delay=DEFAULT_RETRY_BASE_DELAY,
+                 max_delay=DEFAULT_RETRY_MAX_DELAY,
+                 max_attempts=DEFAULT_RETRY_MAX_ATTEMPTS, clock=reactor):
+        self.rate = rate
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self.leases = []
+        self._retrying = {}
+        self.parked = 0
+        self.retried = 0
+        self.delivered = 0
+        self.dead_lettered = 0
+        self.loop = LoopingCall(self.poll)
+        self.loop.clock = clock
+
+    @property
+    def store(self):
+        _, redis, _, _ = self.leases[0]
+        return RetryQueueStore(redis)
+
+    def acquire(self, channel_id, redis, webhooks, credentials):
+        '''Adds a lease on the scheduler for the worker of the channel
+        ``channel_id``, with the redis manager ``redis`` and the webhook
+        client ``webhooks``, starting the scheduler if it is not running yet.
+        ``credentials`` is called with each delivery of the channel that is
+        retried, and returns the ``(auth, auth_token)`` pair to post it
+        with, or a deferred that fires with the pair.'''
+        self.leases.append((channel_id, redis, webhooks, credentials))
+        if not self.loop.running:
+            self.loop.start(RETRY_POLL_INTERVAL, now=False)
+
+    def release(self, channel_id):
+        '''Removes the lease of the worker of the channel ``channel_id``,
+        stopping the scheduler if no workers are using it anymore. Returns a
+        deferred that fires once the retries using the lease are done.'''
+        [released] = [
+            lease for lease in self.leases if lease[0] == channel_id][:1]
+        self.leases = [lease for lease in self.leases if lease is not released]
+        if not self.leases:
+            _remove_scheduler(self)
+            if self.loop.running:
+                self.loop.stop()
+        return gatherResults([
+            d for d, lease in self._retrying.items() if lease is released])
+
+    def park(self, channel_id, kind, url, data, timeout):
+        '''Keeps a delivery of the channel that failed, to be retried
+        later. ``kind`` is the kind of data that was delivered, eg.
+        ``'message'`` or ``'event'``.'''
+        delivery = {
+            'kind': kind,
+            'url': url,
+            'data': data,
+            'timeout': timeout,
+            'attempts': 1,
+        }
+        self.parked += 1
+        return self._schedule(
+            self.store, channel_id, uuid.uuid4().hex, delivery)
+
+    def _schedule(self, store, channel_id, delivery_id, delivery):
+        delay = backoff_delay(
+            delivery['attempts'], self.base_delay, self.max_delay)
+        return store.add(
+            channel_id, delivery_id, delivery, self.clock.seconds() + delay)
+
+    @inlineCallbacks
+    def poll(self):
+        '''Retries the deliveries that are due, up to the rate limit'''
+        if not self.leases:
+            return
+        store = self.store
+        now = self.clock.seconds()
+        limit = int(self.rate * RETRY_POLL_INTERVAL)
+        leases = dict((lease[0], lease) for lease in self.leases)
+        try:
+            channel_ids = yield store.get_channels()
+            for channel_id in sorted(channel_ids):
+                if limit <= 0:
+                    break
+                # The deliveries of channels without a lease are retried by
+                # the process that runs the worker of the channel
+                lease = leases.get(channel_id)
+                if lease is None:
+                    continue
+                due = yield store.take_due(
+                    channel_id, now, now + RETRY_LEASE, limit)
+                limit -= len(due)
+                for delivery_id, delivery in due:
+                    d = self.retry(lease, delivery_id, delivery)
+                    self._retrying[d] = lease
+                    d.addBoth(self._retried, d)
+        except Exception:
+            logging.exception('Error polling the webhook retry queues')
+
+    def _retried(self, result, d):
+        self._retrying.pop(d, None)
+        return result
+
+    @inlineCallbacks
+    def retry(self, lease, delivery_id, delivery):
+        '''Posts the delivery again, removing it from the retry queue if it
+        succeeds, and rescheduling it if it fails. Once it has failed
+        ``max_attempts`` times, it is moved to the dead letters of its
+        channel instead.'''
+        channel_id, redis, webhooks, credentials = lease
+        store = RetryQueueStore(redis)
+        self.retried += 1
+        try:
+            (auth, auth_token) = yield maybeDeferred(credentials, delivery)
+            resp = yield webhooks.post(
+                delivery['url'], delivery['data'], delivery['timeout'],
+                auth=auth, headers=token_auth_headers(auth_token))
+            if resp is not None and not request_failed(resp):
+                self.delivered += 1
+                yield store.remove(channel_id, delivery_id)
+                return
+            delivery['attempts'] += 1
+            if delivery['attempts'] >= self.max_attempts:
+                logging.warning(
+                    'Giving up on %s delivery %s of channel %s to %s after '
+                    '%d attempts' % (
+                        delivery['kind'], delivery_id, channel_id,
+                        delivery['url'], delivery['attempts']))
+                self.dead_lettered += 1
+                yield store.dead_letter(channel_id, delivery_id, delivery)
+                return
+            yield self._schedule(store, channel_id, delivery_id, delivery)
+        except Exception:
+            logging.exception(
+                'Error retrying %s delivery %s of channel %s' % (
+                    delivery['kind'], delivery_id, channel_id))
+
+    def stats(self):
+        '''Returns a dictionary of the deliveries this scheduler has parked
+        and retried'''
+        return {
+            'rate': self.rate,
+            'workers': len(self.leases),
+            'parked': self.parked,
+            'retried': self.retried,
+            'delivered': self.delivered,
+            'dead_lettered': self.dead_lettered,
+            'in_flight': len(self._retrying),
+        }
+
+
+_schedulers = {}
+
+
+def _scheduler_key(redis, *settings):
+    return repr((sorted(redis._config.items()), settings))
+
+
+def _remove_scheduler(scheduler):
+    for key, value in _schedulers.items():
+        if value is scheduler:
+            del _schedulers[key]
+
+
+def acquire_retry_scheduler(
+        channel_id, redis, webhooks, credentials, rate=DEFAULT_RETRY_RATE,
+        base_delay=DEFAULT_RETRY_BASE_DELAY,
+        max_delay=DEFAULT_RETRY_MAX_DELAY,
+        max_attempts=DEFAULT_RETRY_MAX_ATTEMPTS):
+    '''Returns this process' :class:`RetryScheduler` for the redis config of
+    the redis manager ``redis`` and the given retry settings, creating it if
+    it does not exist yet, and adds a lease on it for the worker of the
+    channel ``channel_id``. Workers with different retry settings, eg.
+    routers that configure their own, get separate schedulers. The lease
+    should be released with :meth:`RetryScheduler.release` once it is no
+    longer needed.'''
+    key = _scheduler_key(redis, rate, base_delay, max_delay, max_attempts)
+    scheduler = _schedulers.get(key)
+    if scheduler is None:
+        scheduler = _schedulers[key] = RetryScheduler(
+            rate, base_delay, max_delay, max_attempts)
+    scheduler.acquire(channel_id, redis, webhooks, credentials)
+    return scheduler
+
+
+def get_retry_schedulers():
+    '''Returns the retry schedulers that are currently running in this
+    process'''
+    return list(_schedulers.values())
@@ -1,11 +1,23 @@
-from confmodel.fields import ConfigDict, ConfigFloat, ConfigInt, ConfigList
+from confmodel.fields import (
+    ConfigBool, ConfigDict, ConfigFloat, ConfigInt, ConfigList, ConfigText)
 from copy import deepcopy
 from functools import partial
 from uuid import uuid4
 
 from junebug.error import JunebugError
+from junebug.redis_pool import DEFAULT_POOL_SIZE
+from junebug.retries import (
+    DEFAULT_RETRY_BASE_DELAY, DEFAULT_RETRY_MAX_ATTEMPTS,
+    DEFAULT_RETRY_MAX_DELAY, DEFAULT_RETRY_RATE)
+from junebug.stores import RetryQueueStore
+from junebug.supervisor import ROUTER_WORKERS, request_restart
 from junebug.utils import convert_unicode
-from junebug.workers import MessageForwardingWorker
+from junebug.webhooks import (
+    DEFAULT_BATCH_MAX_DELAY_MS, DEFAULT_BREAKER_ERROR_RATE,
+    DEFAULT_BREAKER_RESET_TIMEOUT, DEFAULT_BREAKER_SLOW_THRESHOLD,
+    DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_PERSISTENT_PER_HOST)
+from junebug.workers import (
+    MessageForwardingWorker, forwarding_concurrency_config)
 from junebug.logging_service import JunebugLoggerService, read_logs
 from twisted.internet.defer import (
     DeferredList, gatherResults, succeed, maybeDeferred, inlineCallbacks)
@@ -97,9 +109,18 @@ class Router(object):
 
     def delete(self):
         """
-        Removes the router data from the router store
-        """
-        return self.api.router_store.delete_router(self.id)
+        Removes the router data from the router store, and the retry queues
+        of its destinations
+        """
+        d = self.api.router_store.delete_router(self.id)
+        store = RetryQueueStore(self.api.redis)
+        d.addCallback(lambda _: gatherResults([
+            store.clear(destination_id)
+            for destination_id in self.destinations]))
+        if self.api.config.api_only:
+            d.addCallback(lambda _: request_restart(
+                self.api.redis, ROUTER_WORKERS, self.id))
+        return d
 
     def _create_junebug_logger_service(self):
         return self.JUNEBUG_LOGGING_SERVICE_CLS(
@@ -142,6 +163,16 @@ class Router(object):
         config['inbound_ttl'] = self.api.config.inbound_message_ttl
         config['outbound_ttl'] = self.api.config.outbound_message_ttl
         config['metric_window'] = self.api.config.metric_window
+        config['metric_flush_interval'] = self.api.config.metric_flush_interval
+        config['event_route_cache_size'] = (
+            self.api.config.event_route_cache_size)
+        config['message_codec'] = self.api.config.message_codec
+        config['project_stored_messages'] = (
+            self.api.config.project_stored_messages)
+        config['redis_pool_size'] = self.api.config.redis_pool_size
+        config['max_in_flight'] = self.api.config.max_in_flight
+        for key in WEBHOOK_CONFIG_KEYS:
+            config[key] = getattr(self.api.config, key)
         config['worker_name'] = self.id
         config = convert_unicode(config)
         return config
@@ -165,8 +196,13 @@ class Router(object):
 
     def start(self, service):
         """
-        Starts running the router worker as a child of ``service``.
+        Starts running the router worker as a child of ``service``. In API
+        only processes, the supervising process is asked to start the worker
+        instead.
         """
+        if self.api.config.api_only:
+            return request_restart(self.api.redis, ROUTER_WORKERS, self.id)
+
         creator = WorkerCreator(self.vumi_options)
         worker = creator.create_worker(
             self._worker_class_name, self._worker_config)
@@ -207,6 +243,35 @@ class Router(object):
                 router = yield cls.from_id(api, r_id)
                 yield router.start(api.service)
 
+    @classmethod
+    @inlineCallbacks
+    def restart_worker(cls, api, router_id):
+        """
+        Stops the worker of the router ``router_id`` if it is running, and
+        starts it again if the router still exists
+        """
+        router = cls(api, {'id': router_id})._restore(api.service)
+        yield router.stop()
+        api.router_cache.discard(router_id)
+        try:
+            router = yield cls.from_id(api, router_id)
+        except RouterNotFound:
+            return
+        yield router.start(api.service)
+
+    @classmethod
+    @inlineCallbacks
+    def sync_workers(cls, api):
+        """
+        Stops the workers of routers that no longer exist, and starts the
+        workers of all stored routers that are not running
+        """
+        ids = yield api.router_store.get_router_list()
+        for name, service in api.service.namedServices.items():
+            if isinstance(service, BaseRouterWorker) and name not in ids:
+                yield cls.restart_worker(api, name)
+        yield cls.start_all_routers(api)
+
     @classmethod
     def from_id(cls, api, router_id):
         """
@@ -220,15 +285,7 @@ class Router(object):
                     "Router with ID {} cannot be found".format(router_id))
             return cls(api, router_config, destination_configs)
 
-        d_router = api.router_store.get_router_config(router_id)
-
-        d_dests = api.router_store.get_router_destination_list(router_id)
-        d_dests.addCallback(partial(
-            map, partial(
-                api.router_store.get_router_destination_config, router_id)))
-        d_dests.addCallback(gatherResults)
-
-        d = gatherResults([d_router, d_dests])
+        d = api.router_store.get_router_and_destination_configs(router_id)
         d.addCallback(create_router)
         d.addCallback(lambda router: router._restore(api.service))
         return d
@@ -297,11 +354,15 @@ class Destination(object):
 
     def delete(self):
         """
-        Removes this destination from the store and from the router.
+        Removes this destination from the store and from the router, along
+        with its retry queue.
         """
         self.router.destinations.pop(self.id)
-        return self.router.api.router_store.delete_router_destination(
+        d = self.router.api.router_store.delete_router_destination(
             self.router.id, self.id)
+        d.addCallback(lambda _: RetryQueueStore(
+            self.router.api.redis).clear(self.id))
+        return d
 
 
 class BaseRouterWorkerConfig(BaseWorker.CONFIG_CLASS):
@@ -320,6 +381,83 @@ class BaseRouterWorkerConfig(BaseWorker.CONFIG_CLASS):
     metric_window = ConfigFloat(
         "Size of the buckets to use (in seconds) for metrics",
         required=True, static=True)
+    metric_flush_interval = ConfigFloat(
+        "If set, the interval (in seconds) at which aggregated metrics are "
+        "written to redis",
+        default=None, static=True)
+    event_route_cache_size = ConfigInt(
+        "The maximum amount of messages to cache the event url and auth "
+        "token of",
+        default=10000, static=True)
+    message_codec = ConfigText(
+        "The codec that messages and events are stored with",
+        default='json', static=True)
+    project_stored_messages = ConfigBool(
+        "Whether to only store the fields of messages and events that are "
+        "needed",
+        default=False, static=True)
+    redis_pool_size = ConfigInt(
+        "The maximum amount of connections in the shared redis pool",
+        default=DEFAULT_POOL_SIZE, static=True)
+    webhook_max_persistent_per_host = ConfigInt(
+        "The maximum amount of idle connections kept open to each webhook "
+        "host",
+        default=DEFAULT_MAX_PERSISTENT_PER_HOST, static=True)
+    webhook_idle_timeout = ConfigInt(
+        "The amount of seconds an idle connection to a webhook host is kept "
+        "open for",
+        default=DEFAULT_IDLE_TIMEOUT, static=True)
+    webhook_tls_session_reuse = ConfigBool(
+        "Whether new TLS connections to a webhook host resume the session of "
+        "an earlier connection to the host",
+        default=True, static=True)
+    webhook_breaker_error_rate = ConfigFloat(
+        "The fraction of failed or slow posts to a webhook host that opens "
+        "its circuit breaker",
+        default=DEFAULT_BREAKER_ERROR_RATE, static=True)
+    webhook_breaker_slow_threshold = ConfigFloat(
+        "The amount of seconds after which a post to a webhook host counts "
+        "as failed for its circuit breaker",
+        default=DEFAULT_BREAKER_SLOW_THRESHOLD, static=True)
+    webhook_breaker_reset_timeout = ConfigFloat(
+        "The amount of seconds the circuit breaker of a webhook host stays "
+        "open for",
+        default=DEFAULT_BREAKER_RESET_TIMEOUT, static=True)
+    webhook_retry_rate = ConfigInt(
+        "The maximum amount of failed webhook deliveries retried per second",
+        default=DEFAULT_RETRY_RATE, static=True)
+    webhook_retry_base_delay = ConfigFloat(
+        "The amount of seconds to wait before the first retry of a failed "
+        "webhook delivery",
+        default=DEFAULT_RETRY_BASE_DELAY, static=True)
+    webhook_retry_max_delay = ConfigFloat(
+        "The maximum amount of seconds to wait between retries of a failed "
+        "webhook delivery",
+        default=DEFAULT_RETRY_MAX_DELAY, static=True)
+    webhook_retry_max_attempts = ConfigInt(
+        "The amount of attempts after which a failed webhook delivery is "
+        "given up on",
+        default=DEFAULT_RETRY_MAX_ATTEMPTS, static=True)
+    max_in_flight = ConfigInt(
+        "If greater than 1, the destination workers consume messages and "
+        "events concurrently, with at most this many in flight",
+        default=0, static=True)
+
+
+# The webhook settings of the Junebug config that are passed on to the
+# message forwarding workers of the destinations
+WEBHOOK_CONFIG_KEYS = (
+    'webhook_max_persistent_per_host',
+    'webhook_idle_timeout',
+    'webhook_tls_session_reuse',
+    'webhook_breaker_error_rate',
+    'webhook_breaker_slow_threshold',
+    'webhook_breaker_reset_timeout',
+    'webhook_retry_rate',
+    'webhook_retry_base_delay',
+    'webhook_retry_max_delay',
+    'webhook_retry_max_attempts',
+)
 
 
 class BaseRouterWorker(BaseWorker):
@@ -374,7 +512,7 @@ class BaseRouterWorker(BaseWorker):
 
     def _destination_worker_config(self, config):
         router_config = self.get_static_config()
-        return {
+        worker_config = {
             'transport_name': config['id'],
             'mo_message_url': config.get('mo_url'),
             'mo_message_auth_token': config.get('mo_url_auth_token'),
@@ -383,7 +521,19 @@ class BaseRouterWorker(BaseWorker):
             'inbound_ttl': router_config.inbound_ttl,
             'outbound_ttl': router_config.outbound_ttl,
             'metric_window': router_config.metric_window,
+            'metric_flush_interval': router_config.metric_flush_interval,
+            'event_route_cache_size': router_config.event_route_cache_size,
+            'message_codec': router_config.message_codec,
+            'project_stored_messages': router_config.project_stored_messages,
+            'redis_pool_size': router_config.redis_pool_size,
         }
+        for key in WEBHOOK_CONFIG_KEYS:
+            worker_config[key] = getattr(router_config, key)
+        worker_config.update(forwarding_concurrency_config(
+            config.get('mo_batch_size'),
+            config.get('mo_batch_max_delay_ms', DEFAULT_BATCH_MAX_DELAY_MS),
+            router_config.max_in_flight))
+        return worker_config
 
     def _start_destinations(self, destinations):
         destination_connectors = []
@@ -6,12 +6,13 @@ import re
 from twisted.internet.defer import (
     gatherResults, inlineCallbacks, returnValue, succeed)
 from uuid import UUID
-from vumi.persist.txredis_manager import TxRedisManager
 
+from junebug.cache import get_shared_cache
+from junebug.redis_pool import acquire_redis_manager
 from junebug.channel import Channel, ChannelNotFound
 from junebug.router import (
     BaseRouterWorker, InvalidRouterConfig, InvalidRouterDestinationConfig)
-from junebug.stores import OutboundMessageStore
+from junebug.stores import OutboundMessageStore, get_codec
 from junebug.utils import api_from_message
 
 
@@ -124,10 +125,15 @@ class FromAddressRouter(BaseRouterWorker):
     @inlineCallbacks
     def setup_router(self):
         config = self.get_static_config()
-        self.redis = yield TxRedisManager.from_config(
-            self.config['redis_manager'])
+        self.redis = yield acquire_redis_manager(
+            self.config['redis_manager'], config.redis_pool_size)
         self.outbounds = OutboundMessageStore(
-            self.redis, self.config['outbound_ttl'])
+            self.redis, self.config['outbound_ttl'],
+            event_routes=get_shared_cache(
+                self.redis, 'event_routes', config.event_route_cache_size,
+                config.outbound_ttl),
+            codec=get_codec(
+                config.message_codec, config.project_stored_messages))
         yield self.consume_channel(
             str(config.channel),
             self.handle_inbound_message,
@@ -1,18 +1,24 @@
+import sys
+
 from twisted.application.service import MultiService
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks
 from twisted.python import log
-from twisted.web.server import Site
 
 from junebug import JunebugApi
+from junebug.supervisor import ApiProcesses, ParentWatcher, listen_reuseport
 
 
 class JunebugService(MultiService, object):
     '''Base service that runs the HTTP API, and contains transports as child
-    services'''
-    def __init__(self, config):
+    services. If ``api_workers`` is set, the HTTP API is served by that many
+    API only processes instead, and this service only supervises them and
+    runs the workers.'''
+    def __init__(self, config, args=None):
         super(JunebugService, self).__init__()
         self.config = config
+        self.args = sys.argv[1:] if args is None else args
+        self._port = None
 
     @inlineCallbacks
     def startService(self):
@@ -21,9 +27,28 @@ class JunebugService(MultiService, object):
         super(JunebugService, self).startService()
         self.api = JunebugApi(self, self.config)
         yield self.api.setup()
-        self._port = reactor.listenTCP(
-            self.config.port, Site(self.api.app.resource()),
-            interface=self.config.interface)
+
+        if self.config.api_workers and not self.config.api_only:
+            self.api_processes = ApiProcesses(
+                self.config.api_workers, self.args)
+            self.api_processes.setServiceParent(self)
+            reactor.addSystemEventTrigger(
+                'before', 'shutdown', self.api_processes.stopService)
+            log.msg(
+                'Junebug is serving %s:%s from %d API processes' %
+                (self.config.interface, self.config.port,
+                 self.config.api_workers))
+            return
+
+        if self.config.api_only:
+            ParentWatcher().setServiceParent(self)
+            self._port = listen_reuseport(
+                self.config.port, self.api.create_site(),
+                interface=self.config.interface)
+        else:
+            self._port = reactor.listenTCP(
+                self.config.port, self.api.create_site(),
+                interface=self.config.interface)
         log.msg(
             'Junebug is listening on %s:%s' %
             (self.config.interface, self.config.port))
@@ -32,5 +57,6 @@ class JunebugService(MultiService, object):
     def stopService(self):
         '''Stops the HTTP server.'''
         yield self.api.teardown()
-        yield self._port.stopListening()
-        super(JunebugService, self).stopService()
+        if self._port is not None:
+            yield self._port.stopListening()
+        yield super(JunebugService, self).stopService()
@@ -1,10 +1,677 @@
-import json
+from datetime import datetime
+import hashlib
+import logging
+from functools import partial
 from math import ceil
 import time
-from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
+import zlib
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, maybeDeferred, succeed)
+from twisted.internet.task import LoopingCall
 
 from vumi.message import (
-    TransportEvent, TransportUserMessage, TransportStatus, to_json, from_json)
+    VUMI_DATE_FORMAT, TransportEvent, TransportUserMessage, TransportStatus,
+    date_time_decoder, format_vumi_date)
+from vumi.utils import to_kwargs
+
+from junebug import json_codec
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class RedisScript(object):
+    '''A Lua script that is loaded into redis once, and is then called by its
+    SHA1 digest, so that compound operations only cost a single round trip.
+
+    :param source: The Lua source of the script
+    :type source: str
+    :param fallback: Called with the redis manager, keys and arguments to
+        perform the same operation using normal redis commands, for redis
+        clients that cannot run scripts (eg. the fake redis used in tests).
+    :type fallback: callable
+    '''
+
+    def __init__(self, source, fallback):
+        self.source = source
+        self.sha = hashlib.sha1(source).hexdigest()
+        self.fallback = fallback
+
+    def __call__(self, redis, keys=(), args=(), parse_result=None):
+        '''Runs the script. ``keys`` are prefixed by the redis manager.
+        ``parse_result`` is applied to the raw result returned by redis, and
+        is not applied to the result of the fallback.'''
+        client = redis._client
+        if getattr(client, 'evalsha', None) is None:
+            return maybeDeferred(self.fallback, redis, list(keys), list(args))
+
+        keys = [redis._key(k) for k in keys]
+        args = list(args)
+        d = client.evalsha(self.sha, keys, args)
+        d.addErrback(self._load_script, client, keys, args)
+        if parse_result is not None:
+            d.addCallback(parse_result)
+        return d
+
+    def _load_script(self, err, client, keys, args):
+        if 'NOSCRIPT' not in err.getErrorMessage():
+            return err
+        # EVAL adds the script to the script cache, so the next call can be
+        # made using EVALSHA again.
+        return client.eval(self.source, keys, args)
+
+
+def _pairs_to_dict(values):
+    return dict(zip(values[::2], values[1::2]))
+
+
+# Redis command names that differ from the redis manager method names
+SCRIPT_COMMANDS = {
+    'delete': 'del',
+    'incr': 'incrby',
+}
+MANAGER_COMMANDS = dict((v, k) for k, v in SCRIPT_COMMANDS.iteritems())
+
+
+@inlineCallbacks
+def _redis_op_with_expire(redis, keys, args):
+    [key] = keys
+    command, ttl, args = args[0], args[1], args[2:]
+    command = MANAGER_COMMANDS.get(command, command)
+    if command == 'hmset':
+        args = [_pairs_to_dict(args)]
+    val = yield getattr(redis, command)(key, *args)
+    yield redis.expire(key, ttl)
+    returnValue(val)
+
+
+REDIS_OP_WITH_EXPIRE = RedisScript('''
+local result = redis.call(ARGV[1], KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return result
+''', _redis_op_with_expire)
+
+
+@inlineCallbacks
+def _increment_series(redis, keys, args):
+    for i, key in enumerate(keys):
+        slot, bucket, count, ttl = args[i * 4:i * 4 + 4]
+        current = yield redis.hget(key, 'bucket:%s' % slot)
+        if current is not None and int(current) > int(bucket):
+            continue
+        if current is None or int(current) < int(bucket):
+            yield redis.hset(key, 'bucket:%s' % slot, bucket)
+            yield redis.hset(key, 'count:%s' % slot, 0)
+        yield redis.hincrby(key, 'count:%s' % slot, int(count))
+        yield redis.expire(key, ttl)
+
+
+# Each series is a ring buffer in a hash, with a count and the bucket that
+# the count is for in each slot. A slot is reset when a newer bucket is
+# written to it, and increments for buckets older than the slot's are late,
+# and are dropped. The keys of the series start at ``first_key``, and each
+# has a slot, bucket, count and ttl in the arguments starting at
+# ``first_arg``. Scripts that count messages include this function, so
+# that the series are incremented in the same call.
+SERIES_LUA = '''
+local function increment_series(first_key, first_arg)
+    for i = first_key, #KEYS do
+        local key = KEYS[i]
+        local arg = first_arg + (i - first_key) * 4
+        local slot = ARGV[arg]
+        local bucket = tonumber(ARGV[arg + 1])
+        local current = tonumber(redis.call('HGET', key, 'bucket:' .. slot))
+        if current == nil or current <= bucket then
+            if current ~= bucket then
+                redis.call('HSET', key, 'bucket:' .. slot, bucket)
+                redis.call('HSET', key, 'count:' .. slot, 0)
+            end
+            redis.call('HINCRBY', key, 'count:' .. slot, ARGV[arg + 2])
+            redis.call('EXPIRE', key, ARGV[arg + 3])
+        end
+    end
+end
+'''
+
+
+INCREMENT_SERIES = RedisScript(SERIES_LUA + '''
+increment_series(1, 1)
+''', _increment_series)
+
+
+def _counter_keys_and_args(counter):
+    '''Returns the keys and arguments of a counter given to a store, a
+    ``(key, ttl)`` pair or a ``(key, ttl, series)`` triple as returned by
+    :meth:`MessageRateStore.get_counter`, for the scripts that increment
+    it'''
+    key, ttl = counter[:2]
+    series = counter[2] if len(counter) > 2 else ()
+    keys, args = [key], [ttl]
+    for series_key, slot, bucket, series_ttl in series:
+        keys.append(series_key)
+        args.extend([slot, bucket, 1, series_ttl])
+    return keys, args
+
+
+@inlineCallbacks
+def _store_property_and_increment(redis, keys, args):
+    key, counter_key = keys[:2]
+    field, value, ttl, counter_ttl = args[:4]
+    yield redis.hset(key, field, value)
+    if ttl != '':
+        yield redis.expire(key, ttl)
+    count = yield redis.incr(counter_key, 1)
+    yield redis.expire(counter_key, counter_ttl)
+    yield _increment_series(redis, keys[2:], args[4:])
+    returnValue(count)
+
+
+# Stores a property in a hash, and increments a counter and the series that
+# follow it in the keys
+STORE_PROPERTY_AND_INCREMENT = RedisScript(SERIES_LUA + '''
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+if ARGV[3] ~= '' then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+local count = redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+increment_series(3, 5)
+return count
+''', _store_property_and_increment)
+
+
+@inlineCallbacks
+def _increment_all_with_expire(redis, keys, args):
+    for i, key in enumerate(keys):
+        yield redis.incr(key, args[i * 2])
+        yield redis.expire(key, args[i * 2 + 1])
+
+
+INCREMENT_ALL_WITH_EXPIRE = RedisScript('''
+for i, key in ipairs(KEYS) do
+    redis.call('INCRBY', key, ARGV[i * 2 - 1])
+    redis.call('EXPIRE', key, ARGV[i * 2])
+end
+''', _increment_all_with_expire)
+
+
+def _take_tokens(tokens, updated, capacity, window, now, requested, extra,
+                 partial):
+    if tokens is None or updated is None:
+        tokens, updated = capacity, now
+    rate = float(capacity) / window
+    tokens = min(capacity, tokens + max(0, now - updated) * rate)
+    if tokens - requested >= extra and tokens >= capacity / 2.0:
+        granted = requested + extra
+    elif tokens >= requested:
+        granted = requested
+    elif partial:
+        granted = int(tokens)
+    else:
+        granted = 0
+    tokens -= granted
+    retry_after = 0
+    if granted < requested:
+        retry_after = (min(requested - granted, capacity) - tokens) / rate
+    return granted, tokens, retry_after
+
+
+@inlineCallbacks
+def _take_rate_limit_tokens(redis, keys, args):
+    [key] = keys
+    capacity, window, now = [float(arg) for arg in args[:3]]
+    requested, extra = [int(arg) for arg in args[3:5]]
+    bucket = yield redis.hgetall(key)
+    tokens = bucket.get('tokens')
+    updated = bucket.get('updated')
+    granted, tokens, retry_after = _take_tokens(
+        None if tokens is None else float(tokens),
+        None if updated is None else float(updated),
+        capacity, window, now, requested, extra, args[5] == '1')
+    # Redis converts the numbers given to it by Lua scripts to strings with
+    # 17 significant digits
+    yield redis.hmset(
+        key, {'tokens': '%.17g' % tokens, 'updated': '%.17g' % now})
+    yield redis.expire(key, int(ceil(window)))
+    returnValue((granted, retry_after))
+
+
+# A token bucket that holds up to ARGV[1] tokens, and is refilled at a rate
+# of ARGV[1] tokens every ARGV[2] seconds. Takes ARGV[4] tokens from the
+# bucket, and ARGV[5] extra tokens if the bucket is at least half full. If
+# there are not enough tokens, none are taken, or as many as there are if
+# ARGV[6] is 1. Returns the amount of tokens taken, and the amount of seconds
+# until the rest of the requested tokens are available if they were not all
+# taken.
+TAKE_RATE_LIMIT_TOKENS = RedisScript('''
+local capacity = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local extra = tonumber(ARGV[5])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1])
+local updated = tonumber(bucket[2])
+if tokens == nil or updated == nil then
+    tokens = capacity
+    updated = now
+end
+local rate = capacity / window
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local granted = 0
+if tokens - requested >= extra and tokens >= capacity / 2 then
+    granted = requested + extra
+elseif tokens >= requested then
+    granted = requested
+elseif ARGV[6] == '1' then
+    granted = math.floor(tokens)
+end
+tokens = tokens - granted
+local retry_after = 0
+if granted < requested then
+    retry_after = (math.min(requested - granted, capacity) - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(window))
+return {granted, tostring(retry_after)}
+''', _take_rate_limit_tokens)
+
+
+@inlineCallbacks
+def _append_to_log(redis, keys, args):
+    [key, offset_key] = keys
+    [value, size] = args
+    offset = yield redis.incr(offset_key, 1)
+    yield redis.zadd(key, **{value: offset})
+    yield redis.zremrangebyrank(key, 0, -(int(size) + 1))
+    returnValue(offset)
+
+
+APPEND_TO_LOG = RedisScript('''
+local offset = redis.call('INCR', KEYS[2])
+redis.call('ZADD', KEYS[1], offset, ARGV[1])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -(tonumber(ARGV[2]) + 1))
+return offset
+''', _append_to_log)
+
+
+@inlineCallbacks
+def _store_event(redis, keys, args):
+    key, index_key = keys[:2]
+    [event_id, data, score, ttl] = args[:4]
+    yield redis.hset(key, event_id, data)
+    yield redis.zadd(index_key, **{event_id: float(score)})
+    if ttl != '':
+        yield redis.expire(key, ttl)
+        yield redis.expire(index_key, ttl)
+    if len(keys) > 2:
+        count = yield redis.incr(keys[2], 1)
+        yield redis.expire(keys[2], args[4])
+        yield _increment_series(redis, keys[3:], args[5:])
+        returnValue(count)
+
+
+# Stores an event in the hash of its message, and adds its id to the event
+# index of the message, scored by its timestamp. If a counter key is given,
+# the counter and the series that follow it in the keys are incremented.
+STORE_EVENT = RedisScript(SERIES_LUA + '''
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+if ARGV[4] ~= '' then
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    redis.call('EXPIRE', KEYS[2], ARGV[4])
+end
+if KEYS[3] then
+    local count = redis.call('INCR', KEYS[3])
+    redis.call('EXPIRE', KEYS[3], ARGV[5])
+    increment_series(4, 6)
+    return count
+end
+''', _store_event)
+
+
+@inlineCallbacks
+def _load_events(redis, keys, args):
+    last_only, ttl, property_keys = args[0], args[1], args[2:]
+    results = []
+    for key, index_key in zip(keys[::2], keys[1::2]):
+        indexed = yield redis.zcard(index_key)
+        stored = yield redis.hlen(key)
+        for property_key in property_keys:
+            if (yield redis.hexists(key, property_key)):
+                stored -= 1
+        if indexed > 0 and indexed >= stored:
+            if last_only:
+                ids = yield redis.zrange(index_key, 0, 0, desc=True)
+            else:
+                ids = yield redis.zrange(index_key, 0, -1)
+            events = []
+            for id in ids:
+                events.append((yield redis.hget(key, id)))
+            results.append(['index'] + events)
+        else:
+            values = yield redis.hgetall(key)
+            results.append(['hash'] + [
+                v for item in (values or {}).iteritems() for v in item])
+        if ttl != '':
+            yield redis.expire(key, ttl)
+            yield redis.expire(index_key, ttl)
+    returnValue(results)
+
+
+# Loads the events of each message, oldest first, from the message hash
+# using the event index of the message, without loading the message itself.
+# The whole hash is returned instead for messages with events that are not
+# in the index, which were stored before messages had an event index. The
+# property keys of the hash are given as arguments, so that they are not
+# counted as events.
+LOAD_EVENTS = RedisScript('''
+local results = {}
+for i = 1, #KEYS, 2 do
+    local indexed = redis.call('ZCARD', KEYS[i + 1])
+    local stored = redis.call('HLEN', KEYS[i])
+    for j = 3, #ARGV do
+        stored = stored - redis.call('HEXISTS', KEYS[i], ARGV[j])
+    end
+    if indexed > 0 and indexed >= stored then
+        local ids
+        if ARGV[1] == '1' then
+            ids = redis.call('ZREVRANGE', KEYS[i + 1], 0, 0)
+        else
+            ids = redis.call('ZRANGE', KEYS[i + 1], 0, -1)
+        end
+        local events = redis.call('HMGET', KEYS[i], unpack(ids))
+        table.insert(events, 1, 'index')
+        table.insert(results, events)
+    else
+        local values = redis.call('HGETALL', KEYS[i])
+        table.insert(values, 1, 'hash')
+        table.insert(results, values)
+    end
+    if ARGV[2] ~= '' then
+        redis.call('EXPIRE', KEYS[i], ARGV[2])
+        redis.call('EXPIRE', KEYS[i + 1], ARGV[2])
+    end
+end
+return results
+''', _load_events)
+
+
+@inlineCallbacks
+def _index_events(redis, keys, args):
+    [index_key] = keys
+    ttl, scores = args[0], args[1:]
+    yield redis.zadd(index_key, **dict(
+        (id, float(score)) for id, score in zip(scores[::2], scores[1::2])))
+    if ttl != '':
+        yield redis.expire(index_key, ttl)
+
+
+# Adds events to the event index of their message, for events that were
+# stored before messages had an event index
+INDEX_EVENTS = RedisScript('''
+for i = 2, #ARGV, 2 do
+    redis.call('ZADD', KEYS[1], ARGV[i + 1], ARGV[i])
+end
+if ARGV[1] ~= '' then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+''', _index_events)
+
+# Encoded messages that start with this byte are followed by a byte with the
+# version of the codec that encoded them. JSON, which is how messages were
+# stored before codecs were added, can never start with it.
+CODEC_HEADER = '\x00'
+
+
+class MessageCodec(object):
+    '''Base class for the encodings that messages are stored in redis with.
+
+    :param project: If ``True``, only the fields that Junebug needs are kept
+        when a message is encoded with a projection.
+    :type project: bool
+    '''
+    NAME = None
+    VERSION = None
+
+    def __init__(self, project=False):
+        self.project = project
+
+    def encode(self, payload, projection=None):
+        '''Encodes the message payload ``payload``, applying ``projection``
+        to it first if the codec projects messages.'''
+        if self.project and projection is not None:
+            payload = projection(payload)
+        data = self.encode_payload(payload)
+        if self.VERSION is None:
+            return data
+        return CODEC_HEADER + chr(self.VERSION) + data
+
+    def encode_payload(self, payload):
+        raise NotImplementedError()
+
+    def decode_payload(self, data):
+        raise NotImplementedError()
+
+
+class JSONCodec(MessageCodec):
+    '''Stores messages as JSON without a header, as Junebug always has'''
+    NAME = 'json'
+
+    def encode_payload(self, payload):
+        return json_codec.dumps(payload)
+
+    def decode_payload(self, data):
+        return json_codec.loads(data, object_hook=date_time_decoder)
+
+
+class ZlibJSONCodec(MessageCodec):
+    '''Stores messages as zlib compressed JSON'''
+    NAME = 'zlib'
+    VERSION = 1
+
+    def encode_payload(self, payload):
+        return zlib.compress(json_codec.dumps(payload))
+
+    def decode_payload(self, data):
+        return json_codec.loads(
+            zlib.decompress(data), object_hook=date_time_decoder)
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, datetime):
+        return format_vumi_date(obj)
+    raise TypeError('%r is not msgpack serializable' % (obj,))
+
+
+class MsgpackCodec(MessageCodec):
+    '''Stores messages as zlib compressed msgpack. Requires the optional
+    msgpack package.'''
+    NAME = 'msgpack'
+    VERSION = 2
+
+    def encode_payload(self, payload):
+        return zlib.compress(msgpack.packb(
+            payload, default=_msgpack_default, use_bin_type=True))
+
+    def decode_payload(self, data):
+        if msgpack is None:
+            raise ValueError(
+                'Cannot decode msgpack encoded message, msgpack is not '
+                'installed')
+        return msgpack.unpackb(
+            zlib.decompress(data), object_hook=date_time_decoder, raw=False)
+
+
+CODECS = dict((c.NAME, c) for c in [JSONCodec, ZlibJSONCodec, MsgpackCodec])
+CODEC_VERSIONS = dict(
+    (c.VERSION, c) for c in CODECS.values() if c.VERSION is not None)
+
+
+def get_codec(name, project=False):
+    '''Returns the codec called ``name``. The msgpack codec falls back to the
+    zlib codec if msgpack is not installed.'''
+    if name == MsgpackCodec.NAME and msgpack is None:
+        logging.warning(
+            'msgpack is not installed, storing messages with the zlib codec')
+        name = ZlibJSONCodec.NAME
+    if name not in CODECS:
+        raise ValueError('Unknown message codec %r' % (name,))
+    return CODECS[name](project=project)
+
+
+def decode_payload(data):
+    '''Decodes a message payload stored by any codec'''
+    if data.startswith(CODEC_HEADER):
+        codec = CODEC_VERSIONS[ord(data[1])]()
+        return codec.decode_payload(data[2:])
+    return JSONCodec().decode_payload(data)
+
+
+def _projection(fields, **defaults):
+    def project(payload):
+        projected = dict(defaults)
+        projected.update((k, payload[k]) for k in fields if k in payload)
+        return projected
+    return project
+
+
+# Inbound messages are stored to construct replies, which need everything but
+# the content. The content is a required field, so it is kept as None.
+project_inbound_message = _projection([
+    'message_version', 'message_type', 'timestamp', 'message_id', 'to_addr',
+    'from_addr', 'group', 'provider', 'in_reply_to', 'session_event',
+    'transport_name', 'transport_type', 'transport_metadata',
+    'helper_metadata', 'routing_metadata',
+], content=None)
+
+# Outbound messages are stored to route their events
+project_outbound_message = _projection([
+    'message_id', 'event_url', 'event_auth_token', 'from',
+])
+
+# Events are stored to construct the event payloads of message statuses
+project_event = _projection([
+    'message_version', 'message_type', 'timestamp', 'event_id', 'event_type',
+    'user_message_id', 'sent_message_id', 'nack_reason', 'delivery_status',
+    'helper_metadata',
+])
+
+
+@inlineCallbacks
+def _add_retry(redis, keys, args):
+    [queue_key, deliveries_key, channels_key] = keys
+    [delivery_id, data, attempt_at, channel_id] = args
+    yield redis.hset(deliveries_key, delivery_id, data)
+    yield redis.zadd(queue_key, **{delivery_id: float(attempt_at)})
+    yield redis.sadd(channels_key, channel_id)
+
+
+# Stores a delivery to retry, schedules it in the retry queue of its channel,
+# and adds the channel to the set of channels with deliveries to retry
+ADD_RETRY = RedisScript('''
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+redis.call('SADD', KEYS[3], ARGV[4])
+''', _add_retry)
+
+
+@inlineCallbacks
+def _take_due_retries(redis, keys, args):
+    [queue_key, deliveries_key, channels_key] = keys
+    [now, lease_until, limit, channel_id] = args
+    delivery_ids = yield redis.zrangebyscore(
+        queue_key, '-inf', float(now), start=0, num=int(limit))
+    result = []
+    for delivery_id in delivery_ids:
+        data = yield redis.hget(deliveries_key, delivery_id)
+        if data is None:
+            yield redis.zrem(queue_key, delivery_id)
+        else:
+            yield redis.zadd(queue_key, **{delivery_id: float(lease_until)})
+            result.extend([delivery_id, data])
+    if not (yield redis.zcard(queue_key)):
+        yield redis.srem(channels_key, channel_id)
+    returnValue(result)
+
+
+# Takes the deliveries of a channel that are due to be retried, and
+# reschedules them for when their lease runs out, so that they are retried
+# again if the process retrying them stops before it is done. The channel is
+# removed from the set of channels with deliveries once it has none left.
+TAKE_DUE_RETRIES = RedisScript('''
+local ids = redis.call(
+    'ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+local result = {}
+for _, id in ipairs(ids) do
+    local data = redis.call('HGET', KEYS[2], id)
+    if data then
+        redis.call('ZADD', KEYS[1], ARGV[2], id)
+        table.insert(result, id)
+        table.insert(result, data)
+    else
+        redis.call('ZREM', KEYS[1], id)
+    end
+end
+if redis.call('ZCARD', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[3], ARGV[4])
+end
+return result
+''', _take_due_retries)
+
+
+@inlineCallbacks
+def _remove_retry(redis, keys, args):
+    [queue_key, deliveries_key] = keys
+    [delivery_id] = args
+    yield redis.zrem(queue_key, delivery_id)
+    yield redis.hdel(deliveries_key, delivery_id)
+
+
+REMOVE_RETRY = RedisScript('''
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+''', _remove_retry)
+
+
+@inlineCallbacks
+def _dead_letter_retry(redis, keys, args):
+    [queue_key, deliveries_key, dead_letters_key] = keys
+    [delivery_id, data, limit] = args
+    yield redis.zrem(queue_key, delivery_id)
+    yield redis.hdel(deliveries_key, delivery_id)
+    yield redis.lpush(dead_letters_key, data)
+    yield redis.ltrim(dead_letters_key, 0, int(limit) - 1)
+
+
+# Removes a delivery that is given up on from the retry queue of its
+# channel, and keeps it with the most recent dead letters of the channel
+DEAD_LETTER_RETRY = RedisScript('''
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('LPUSH', KEYS[3], ARGV[2])
+redis.call('LTRIM', KEYS[3], 0, ARGV[3] - 1)
+''', _dead_letter_retry)
+
+
+@inlineCallbacks
+def _clear_retries(redis, keys, args):
+    [queue_key, deliveries_key, channels_key, dead_letters_key] = keys
+    [channel_id] = args
+    yield redis.delete(queue_key)
+    yield redis.delete(deliveries_key)
+    yield redis.delete(dead_letters_key)
+    yield redis.srem(channels_key, channel_id)
+
+
+# Removes the retry queue and dead letters of a channel
+CLEAR_RETRIES = RedisScript('''
+redis.call('DEL', KEYS[1], KEYS[2], KEYS[4])
+redis.call('SREM', KEYS[3], ARGV[1])
+''', _clear_retries)
 
 
 class BaseStore(object):
@@ -15,23 +682,45 @@ class BaseStore(object):
     :type redis: :class:`vumi.persist.redis_manager.RedisManager`
     :param ttl: Expiry time for keys in the store
     :type ttl: integer
+
+    Operations that need to set an expiry time on their key are run as a
+    single server side script, so that the operation and the expiry cost a
+    single redis round trip.
     '''
 
     USE_DEFAULT_TTL = object()
 
+    # The maximum amount of hashes read by a single script call when loading
+    # many at once, so that redis is not blocked for too long by any one call
+    LOAD_BATCH_SIZE = 500
+
+    RESULT_PARSERS = {
+        'hgetall': _pairs_to_dict,
+        'smembers': set,
+    }
+
     def __init__(self, redis, ttl=None):
         self.redis = redis
         self.ttl = ttl
 
-    @inlineCallbacks
-    def _redis_op(self, func, id, *args, **kwargs):
-        ttl = kwargs.pop('ttl')
+    def _get_ttl(self, ttl):
         if ttl is self.USE_DEFAULT_TTL:
-            ttl = self.ttl
-        val = yield func(id, *args, **kwargs)
-        if ttl is not None:
-            yield self.redis.expire(id, ttl)
-        returnValue(val)
+            return self.ttl
+        return ttl
+
+    def _redis_op(self, command, id, *args, **kwargs):
+        ttl = self._get_ttl(kwargs.pop('ttl'))
+        if ttl is None:
+            return getattr(self.redis, command)(id, *args)
+
+        if command == 'hmset':
+            [mapping] = args
+            args = [v for item in mapping.iteritems() for v in item]
+
+        return REDIS_OP_WITH_EXPIRE(
+            self.redis, [id],
+            [SCRIPT_COMMANDS.get(command, command), ttl] + list(args),
+            parse_result=self.RESULT_PARSERS.get(command))
 
     def get_key(self, *args):
         '''Returns a key given strings'''
@@ -40,145 +729,308 @@ class BaseStore(object):
     def store_all(self, id, properties, ttl=USE_DEFAULT_TTL):
         '''Stores all of the keys and values given in the dict `properties` as
         a hash at the key `id`'''
-        return self._redis_op(self.redis.hmset, id, properties, ttl=ttl)
+        return self._redis_op('hmset', id, properties, ttl=ttl)
 
     def store_property(self, id, key, value, ttl=USE_DEFAULT_TTL):
         '''Stores a single key with a value as a hash at the key `id`'''
-        return self._redis_op(self.redis.hset, id, key, value, ttl=ttl)
+        return self._redis_op('hset', id, key, value, ttl=ttl)
 
     def remove_property(self, id, key, ttl=USE_DEFAULT_TTL):
         '''Removes the property specified key from `id`'''
-        return self._redis_op(self.redis.hdel, id, key, ttl=ttl)
+        return self._redis_op('hdel', id, key, ttl=ttl)
 
     @inlineCallbacks
     def load_all(self, id, ttl=USE_DEFAULT_TTL):
         '''Retrieves all the keys and values stored as a hash at the key
         `id`'''
         returnValue((
-            yield self._redis_op(self.redis.hgetall, id, ttl=ttl)) or {})
+            yield self._redis_op('hgetall', id, ttl=ttl)) or {})
 
     def load_property(self, id, key, ttl=USE_DEFAULT_TTL):
-        return self._redis_op(self.redis.hget, id, key, ttl=ttl)
-
-    def increment_id(self, id, ttl=USE_DEFAULT_TTL):
-        '''Increments the value stored at `id` by 1.'''
-        return self._redis_op(self.redis.incr, id, 1, ttl=ttl)
+        return self._redis_op('hget', id, key, ttl=ttl)
+
+    def store_property_and_increment(
+            self, id, key, value, counter_id, counter_ttl,
+            ttl=USE_DEFAULT_TTL, series=()):
+        '''Stores a single key with a value as a hash at the key `id`, and
+        increments the counter at `counter_id`, setting its expiry time to
+        `counter_ttl`. The `series` slots of a counter from
+        :meth:`MessageRateStore.get_counter` are also incremented. All are
+        done in a single atomic operation.'''
+        ttl = self._get_ttl(ttl)
+        counter_keys, counter_args = _counter_keys_and_args(
+            (counter_id, counter_ttl, series))
+        return STORE_PROPERTY_AND_INCREMENT(
+            self.redis, [id] + counter_keys,
+            [key, value, '' if ttl is None else ttl] + counter_args)
+
+    def increment_id(self, id, ttl=USE_DEFAULT_TTL, amount=1):
+        '''Increments the value stored at `id` by `amount`.'''
+        return self._redis_op('incr', id, amount, ttl=ttl)
 
     def get_id(self, id, ttl=USE_DEFAULT_TTL):
         '''Returns the value stored at `id`.'''
-        return self._redis_op(self.redis.get, id, ttl=ttl)
+        return self._redis_op('get', id, ttl=ttl)
 
     def get_set(self, id, ttl=USE_DEFAULT_TTL):
         '''Returns all elements of the set stored at `id`.'''
-        return self._redis_op(self.redis.smembers, id, ttl=ttl)
+        return self._redis_op('smembers', id, ttl=ttl)
 
     def add_set_item(self, id, value, ttl=USE_DEFAULT_TTL):
         '''Adds an item to a set'''
-        return self._redis_op(self.redis.sadd, id, value, ttl=ttl)
+        return self._redis_op('sadd', id, value, ttl=ttl)
 
     def remove_set_item(self, id, value, ttl=USE_DEFAULT_TTL):
         '''Removes the item `value` from the set at `id`'''
-        return self._redis_op(self.redis.srem, id, value, ttl=ttl)
+        return self._redis_op('srem', id, value, ttl=ttl)
 
     def store_value(self, id, value, ttl=USE_DEFAULT_TTL):
         '''Stores `value` at `id`'''
-        return self._redis_op(self.redis.set, id, value, ttl=ttl)
+        return self._redis_op('set', id, value, ttl=ttl)
 
     def load_value(self, id, ttl=USE_DEFAULT_TTL):
         '''Gets the value stored at `id`'''
-        return self._redis_op(self.redis.get, id, ttl=ttl)
+        return self._redis_op('get', id, ttl=ttl)
 
     def remove_value(self, id, ttl=USE_DEFAULT_TTL):
         '''Deletes the value stored at `id`'''
-        return self._redis_op(self.redis.delete, id, ttl=ttl)
+        return self._redis_op('delete', id, ttl=ttl)
 
 
 class InboundMessageStore(BaseStore):
     '''Stores the entire inbound message, in order to later construct
-    replies'''
+    replies
+
+    :param codec: The codec to store messages with, JSON by default
+    :type codec: :class:`MessageCodec`
+    '''
+
+    def __init__(self, redis, ttl=None, codec=None):
+        super(InboundMessageStore, self).__init__(redis, ttl)
+        self.codec = codec if codec is not None else JSONCodec()
 
     def get_key(self, channel_id, message_id):
         return super(InboundMessageStore, self).get_key(
             channel_id, 'inbound_messages', message_id)
 
-    def store_vumi_message(self, channel_id, message):
-        '''Stores the given vumi message'''
+    def store_vumi_message(self, channel_id, message, counter=None):
+        '''Stores the given vumi message. If ``counter``, a ``(key, ttl)``
+        pair or a ``(key, ttl, series)`` triple, is given, that counter is
+        incremented in the same operation.'''
         key = self.get_key(channel_id, message.get('message_id'))
-        return self.store_property(key, 'message', message.to_json())
+        data = self.codec.encode(message.payload, project_inbound_message)
+        if counter is not None:
+            counter_id, counter_ttl = counter[:2]
+            series = counter[2] if len(counter) > 2 else ()
+            return self.store_property_and_increment(
+                key, 'message', data, counter_id, counter_ttl,
+                series=series)
+        return self.store_property(key, 'message', data)
 
     @inlineCallbacks
     def load_vumi_message(self, channel_id, message_id):
         '''Retrieves the stored vumi message, given its unique id'''
         key = self.get_key(channel_id, message_id)
-        msg_json = yield self.load_property(key, 'message')
-        if msg_json is None:
+        data = yield self.load_property(key, 'message')
+        if data is None:
             returnValue(None)
-        returnValue(TransportUserMessage.from_json(msg_json))
+        returnValue(TransportUserMessage(
+            _process_fields=False, **to_kwargs(decode_payload(data))))
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _timestamp_score(timestamp):
+    '''Returns the score of a UTC timestamp in an event index, the amount
+    of seconds since the epoch. Timestamps may also be strings in the vumi
+    date format.'''
+    if not isinstance(timestamp, datetime):
+        try:
+            timestamp = datetime.strptime(timestamp, VUMI_DATE_FORMAT)
+        except ValueError:
+            timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
+    return (timestamp - EPOCH).total_seconds()
 
 
 class OutboundMessageStore(BaseStore):
     '''Stores the event url, in order to look it up when deciding where events
-    should go'''
+    should go
+
+    :param event_routes: Optional cache of the event url and auth token of
+        each stored message, keyed by channel and message id
+    :type event_routes: :class:`junebug.cache.LRUCache`
+    :param codec: The codec to store messages and events with, JSON by
+        default
+    :type codec: :class:`MessageCodec`
+    '''
     PROPERTY_KEYS = ['message']
 
+    def __init__(self, redis, ttl=None, event_routes=None, codec=None):
+        super(OutboundMessageStore, self).__init__(redis, ttl)
+        self.event_routes = event_routes
+        self.codec = codec if codec is not None else JSONCodec()
+
     def get_key(self, channel_id, message_id):
         return super(OutboundMessageStore, self).get_key(
             channel_id, 'outbound_messages', message_id)
 
     def load_event_url(self, channel_id, message_id):
         '''Retrieves a stored event url, given the channel and message ids'''
-        key = self.get_key(channel_id, message_id)
-        d = self.load_property(key, 'message')
-        d.addCallback(from_json)
-        d.addErrback(lambda _: {})
-        d.addCallback(lambda m: m.get('event_url', None))
+        d = self.load_event_route(channel_id, message_id)
+        d.addCallback(lambda route: route[0])
         return d
 
     def load_event_auth_token(self, channel_id, message_id):
         '''Retrieves a stored event auth token, given the channel and message
         ids'''
+        d = self.load_event_route(channel_id, message_id)
+        d.addCallback(lambda route: route[1])
+        return d
+
+    def load_event_route(self, channel_id, message_id):
+        '''Retrieves the stored event url and event auth token, given the
+        channel and message ids, as an ``(event_url, event_auth_token)``
+        pair. Served from the event routes cache if possible.'''
+        if self.event_routes is not None:
+            route = self.event_routes.get((channel_id, message_id))
+            if route is not None:
+                return succeed(route)
         key = self.get_key(channel_id, message_id)
         d = self.load_property(key, 'message')
-        d.addCallback(from_json)
-        d.addErrback(lambda _: {})
-        d.addCallback(lambda m: m.get('event_auth_token', None))
+        d.addCallback(decode_payload)
+        d.addCallback(self._cache_event_route, channel_id)
+        d.addErrback(lambda _: (None, None))
         return d
 
+    def _cache_event_route(self, message, channel_id):
+        route = (message.get('event_url'), message.get('event_auth_token'))
+        if self.event_routes is not None:
+            self.event_routes.set((channel_id, message['message_id']), route)
+        return route
+
     def store_message(self, channel_id, message):
         '''Stores an outbound message'''
         key = self.get_key(channel_id, message['message_id'])
-        return self.store_property(key, 'message', to_json(message))
-
-    def store_event(self, channel_id, message_id, event):
-        '''Stores an event for a message'''
-        key = self.get_key(channel_id, message_id)
-        event_id = event['event_id']
-        return self.store_property(key, event_id, event.to_json())
+        self._cache_event_route(message, channel_id)
+        return self.store_property(
+            key, 'message',
+            self.codec.encode(message, project_outbound_message))
+
+    def get_event_index_key(self, channel_id, message_id):
+        return self.get_key(channel_id, message_id) + ':events'
+
+    def store_event(self, channel_id, message_id, event, counter=None):
+        '''Stores an event for a message, and adds it to the event index of
+        the message. If ``counter``, a ``(key, ttl)`` pair or a ``(key,
+        ttl, series)`` triple, is given, that counter is incremented in the
+        same operation.'''
+        keys = [
+            self.get_key(channel_id, message_id),
+            self.get_event_index_key(channel_id, message_id)]
+        ttl = self._get_ttl(self.USE_DEFAULT_TTL)
+        args = [
+            event['event_id'],
+            self.codec.encode(event.payload, project_event),
+            repr(_timestamp_score(event['timestamp'])),
+            '' if ttl is None else ttl]
+        if counter is not None:
+            counter_keys, counter_args = _counter_keys_and_args(counter)
+            keys.extend(counter_keys)
+            args.extend(counter_args)
+        return STORE_EVENT(self.redis, keys, args)
 
     def load_message(self, channel_id, message_id):
         key = self.get_key(channel_id, message_id)
         d = self.load_property(key, 'message')
-        d.addCallback(from_json)
+        d.addCallback(decode_payload)
         d.addErrback(lambda _: None)
         return d
 
+    def _decode_event(self, data):
+        return TransportEvent(
+            _process_fields=False, **to_kwargs(decode_payload(data)))
+
     @inlineCallbacks
     def load_event(self, channel_id, message_id, event_id):
         '''Loads the event with id event_id'''
         key = self.get_key(channel_id, message_id)
-        event_json = yield self.load_property(key, event_id)
-        if event_json is None:
+        data = yield self.load_property(key, event_id)
+        if data is None:
             returnValue(None)
-        returnValue(TransportEvent.from_json(event_json))
+        returnValue(self._decode_event(data))
 
     @inlineCallbacks
     def load_all_events(self, channel_id, message_id):
-        '''Returns a list of all the stored events'''
-        key = self.get_key(channel_id, message_id)
-        events_json = yield self.load_all(key)
-        self._remove_property_keys(events_json)
-        returnValue([
-            TransportEvent.from_json(e) for e in events_json.values()])
+        '''Returns a list of all the stored events, oldest first'''
+        [events] = yield self.load_all_events_many(channel_id, [message_id])
+        returnValue(events)
+
+    @inlineCallbacks
+    def load_last_event(self, channel_id, message_id):
+        '''Returns the most recent stored event, or ``None`` if there are
+        no events'''
+        [events] = yield self.load_all_events_many(
+            channel_id, [message_id], last_only=True)
+        returnValue(events[-1] if events else None)
+
+    def load_all_events_many(self, channel_id, message_ids, last_only=False):
+        '''Returns a list with a list of all the stored events of each of
+        the messages, oldest first, in the same order as ``message_ids``. If
+        ``last_only`` is ``True``, each list only contains the most recent
+        event. The events are read in a single round trip for every
+        ``LOAD_BATCH_SIZE`` messages.
+
+        Messages with events that were stored before messages had an event
+        index have all of their events read from the message hash, and the
+        missing events are then added to the index.'''
+        ttl = self._get_ttl(self.USE_DEFAULT_TTL)
+        ttl = '' if ttl is None else ttl
+        args = ['1' if last_only else '', ttl] + self.PROPERTY_KEYS
+        batches = []
+        for i in range(0, len(message_ids), self.LOAD_BATCH_SIZE):
+            keys = []
+            for message_id in message_ids[i:i + self.LOAD_BATCH_SIZE]:
+                keys.append(self.get_key(channel_id, message_id))
+                keys.append(self.get_event_index_key(channel_id, message_id))
+            batches.append(LOAD_EVENTS(self.redis, keys, args))
+        d = gatherResults(batches)
+        d.addCallback(lambda batches: [
+            result for batch in batches for result in batch])
+        d.addCallback(
+            self._parse_all_events, channel_id, message_ids, last_only, ttl)
+        return d
+
+    @inlineCallbacks
+    def _parse_all_events(self, results, channel_id, message_ids, last_only,
+                          ttl):
+        all_events = []
+        for message_id, result in zip(message_ids, results):
+            source, values = result[0], result[1:]
+            if source == 'index':
+                all_events.append([
+                    self._decode_event(e) for e in values if e is not None])
+                continue
+
+            # Messages with events stored before events were indexed
+            values = _pairs_to_dict(values)
+            self._remove_property_keys(values)
+            events = sorted(
+                (self._decode_event(e) for e in values.itervalues()),
+                key=lambda e: e['timestamp'])
+            if events:
+                yield self._index_events(channel_id, message_id, events, ttl)
+            all_events.append(events[-1:] if last_only else events)
+        returnValue(all_events)
+
+    def _index_events(self, channel_id, message_id, events, ttl):
+        args = [ttl]
+        for event in events:
+            args.extend([
+                event['event_id'], repr(_timestamp_score(event['timestamp']))])
+        return INDEX_EVENTS(
+            self.redis, [self.get_event_index_key(channel_id, message_id)],
+            args)
 
     def _remove_property_keys(self, dct):
         '''If we remove all other property keys, we will be left with just the
@@ -213,7 +1065,39 @@ class StatusStore(BaseStore):
 
 class MessageRateStore(BaseStore):
     '''Gets called everytime a message should be counted, and can return the
-    current messages per second.'''
+    current messages per second.
+
+    If ``flush_interval`` (in seconds) is given, increments are aggregated in
+    memory, and written to redis in a single batch every ``flush_interval``
+    seconds. Message rates read from this store include the increments that
+    have not yet been written. :meth:`close` should be called to write any
+    remaining increments once the store is no longer needed.
+
+    Each increment also counts towards a series of message counts for each
+    of the ``series_resolutions``, a dictionary of the bucket size (in
+    seconds) and the amount of buckets of each resolution by name. Series
+    are kept in fixed size ring buffers.'''
+
+    SERIES_RESOLUTIONS = {
+        '1s': (1, 60),
+        '1m': (60, 60),
+        '1h': (60 * 60, 48),
+    }
+
+    def __init__(self, redis, ttl=None, flush_interval=None, clock=reactor,
+                 series_resolutions=SERIES_RESOLUTIONS):
+        super(MessageRateStore, self).__init__(redis, ttl)
+        self.flush_interval = flush_interval
+        self.series_resolutions = series_resolutions
+        self.clock = clock
+        self._pending = {}
+        self._pending_series = {}
+        self._flush_loop = None
+
+    @property
+    def aggregating(self):
+        '''Whether or not increments are aggregated before being written'''
+        return bool(self.flush_interval)
 
     def get_seconds(self):
         return time.time()
@@ -222,6 +1106,10 @@ class MessageRateStore(BaseStore):
         return super(MessageRateStore, self).get_key(
             channel_id, label, str(bucket))
 
+    def get_series_key(self, channel_id, label, resolution):
+        return super(MessageRateStore, self).get_key(
+            channel_id, label, 'series', resolution)
+
     def _get_current_key(self, channel_id, label, bucket_size):
         bucket = int(self.get_seconds() / bucket_size)
         return self.get_key(channel_id, label, bucket)
@@ -230,30 +1118,549 @@ class MessageRateStore(BaseStore):
         bucket = int(self.get_seconds() / bucket_size) - 1
         return self.get_key(channel_id, label, bucket)
 
-    def increment(self, channel_id, label, bucket_size):
-        '''Increments the correct counter. Should be called whenever a message
-        that should be counted is received.
+    def get_counter(self, channel_id, label, bucket_size):
+        '''Returns the ``(key, ttl, series)`` triple of the counter that
+        should currently be incremented, for stores that increment the
+        counter as part of another operation. ``series`` are the ``(key,
+        slot, bucket, ttl)`` slots of the message count series that the
+        store should increment along with it.'''
+        key = self._get_current_key(channel_id, label, bucket_size)
+        return (
+            key, int(ceil(bucket_size * 2)),
+            list(self._get_series_slots(channel_id, label)))
+
+    def increment(self, channel_id, label, bucket_size, count=1):
+        '''Increments the correct counter by ``count``. Should be called
+        whenever messages that should be counted are received.
 
         Note: bucket_size should be kept constant for each channel_id and label
         combination. Changing bucket sizes results in undefined behaviour.'''
         key = self._get_current_key(channel_id, label, bucket_size)
-        return self.increment_id(key, ttl=int(ceil(bucket_size * 2)))
+        ttl = int(ceil(bucket_size * 2))
+        if not self.aggregating:
+            return gatherResults([
+                self.increment_id(key, ttl=ttl, amount=count),
+                self.increment_series(channel_id, label, count),
+            ])
+
+        current, _ = self._pending.get(key, (0, ttl))
+        self._pending[key] = (current + count, ttl)
+        self.increment_series(channel_id, label, count)
+        return succeed(None)
+
+    def _get_series_slots(self, channel_id, label):
+        now = self.get_seconds()
+        for resolution, (size, amount) in (
+                self.series_resolutions.iteritems()):
+            bucket = int(now / size)
+            yield (
+                self.get_series_key(channel_id, label, resolution),
+                bucket % amount, bucket, size * amount)
+
+    def increment_series(self, channel_id, label, count=1):
+        '''Increments the message count series of every resolution. This is
+        done by :meth:`increment`, and by the stores that increment the
+        counters from :meth:`get_counter`.'''
+        if not self.aggregating:
+            keys, args = [], []
+            for key, slot, bucket, ttl in self._get_series_slots(
+                    channel_id, label):
+                keys.append(key)
+                args.extend([slot, bucket, count, ttl])
+            if not keys:
+                return succeed(None)
+            return INCREMENT_SERIES(self.redis, keys, args)
+
+        for key, slot, bucket, ttl in self._get_series_slots(
+                channel_id, label):
+            current, _ = self._pending_series.get((key, slot, bucket), (0, 0))
+            self._pending_series[(key, slot, bucket)] = (current + count, ttl)
+        self._start_flushing()
+        return succeed(None)
+
+    def _start_flushing(self):
+        if self._flush_loop is None:
+            self._flush_loop = LoopingCall(self.flush)
+            self._flush_loop.clock = self.clock
+            self._flush_loop.start(self.flush_interval, now=False)
+
+    def flush(self):
+        '''Writes all of the aggregated increments to redis. If the write
+        fails, the increments are kept to be written with the next flush.'''
+        return gatherResults([self._flush_counters(), self._flush_series()])
+
+    def _flush_counters(self):
+        if not self._pending:
+            return succeed(None)
+
+        pending, self._pending = self._pending, {}
+        keys = pending.keys()
+        args = []
+        for key in keys:
+            args.extend(pending[key])
+
+        d = INCREMENT_ALL_WITH_EXPIRE(self.redis, keys, args)
+        d.addErrback(self._flush_failed, '_pending', pending)
+        return d
+
+    def _flush_series(self):
+        if not self._pending_series:
+            return succeed(None)
+
+        pending, self._pending_series = self._pending_series, {}
+        keys, args = [], []
+        for (key, slot, bucket), (count, ttl) in pending.iteritems():
+            keys.append(key)
+            args.extend([slot, bucket, count, ttl])
+
+        d = INCREMENT_SERIES(self.redis, keys, args)
+        d.addErrback(self._flush_failed, '_pending_series', pending)
+        return d
+
+    def _flush_failed(self, err, attr, pending):
+        logging.warning(
+            'Failed to write message rate counters: %s' % (
+                err.getErrorMessage(),))
+        current_pending = getattr(self, attr)
+        for key, (count, ttl) in pending.iteritems():
+            current, _ = current_pending.get(key, (0, ttl))
+            current_pending[key] = (current + count, ttl)
+
+    def close(self):
+        '''Stops the periodic flushing, and writes any remaining increments
+        to redis.'''
+        if self._flush_loop is not None:
+            if self._flush_loop.running:
+                self._flush_loop.stop()
+            self._flush_loop = None
+        return self.flush()
 
     @inlineCallbacks
     def get_messages_per_second(self, channel_id, label, bucket_size):
-        '''Gets the current message rate in messages per second.
+        '''Gets the current message rate in messages per second, from the
+        counts of the last complete bucket.
+
+        Only the increments aggregated by this store are included before
+        they are written. Increments aggregated by other stores, such as
+        those of the workers, are only included once they are flushed, so
+        rates can lag behind by up to their ``flush_interval`` after each
+        bucket ends.
 
         Note: bucket_size should be kept constant for each channel_id and label
         combination. Changing bucket sizes results in undefined behaviour.'''
         key = self._get_last_key(channel_id, label, bucket_size)
         rate = yield self.get_id(key, ttl=None)
-        if rate is None:
+        pending, _ = self._pending.get(key, (0, None))
+        if rate is None and not pending:
             returnValue(0)
-        returnValue(float(rate) / bucket_size)
+        returnValue(float(int(rate or 0) + pending) / bucket_size)
+
+    @inlineCallbacks
+    def get_series(self, channel_id, label, resolution):
+        '''Returns the message counts of the series of the given resolution,
+        oldest first, as a list of ``(timestamp, count)`` pairs, where
+        ``timestamp`` is the start of the bucket. The last bucket is the
+        current, incomplete one.'''
+        size, amount = self.series_resolutions[resolution]
+        key = self.get_series_key(channel_id, label, resolution)
+        stored = yield self.redis.hgetall(key)
+        current = int(self.get_seconds() / size)
+
+        series = []
+        for bucket in range(current - amount + 1, current + 1):
+            slot = bucket % amount
+            count = 0
+            if stored.get('bucket:%d' % slot) == str(bucket):
+                count = int(stored['count:%d' % slot])
+            pending, _ = self._pending_series.get(
+                (key, slot, bucket), (0, None))
+            series.append((bucket * size, count + pending))
+        returnValue(series)
+
+
+class RateLimitStore(BaseStore):
+    '''Limits the rate of messages for each channel with a token bucket in
+    redis, which is shared by every Junebug process using the same redis.
+    Each bucket holds up to ``count`` tokens, and is refilled at a rate of
+    ``count`` tokens every ``window`` seconds.
+
+    If ``lease_size`` is given, up to that amount of extra tokens are taken
+    from the bucket whenever it is at least half full, and are kept in
+    memory for the next messages of the channel, so that not every message
+    needs a redis call while there is plenty of room under the limit. Leased
+    tokens that are not used within the window are dropped.'''
+
+    def __init__(self, redis, lease_size=0):
+        super(RateLimitStore, self).__init__(redis)
+        self.lease_size = lease_size
+        self._leases = {}
+
+    def get_seconds(self):
+        return time.time()
+
+    def get_bucket_key(self, channel_id):
+        return self.get_key(channel_id, 'rate_limit')
+
+    def _lease(self, channel_id, amount, expires):
+        if amount > 0:
+            leased, _ = self._leases.get(channel_id, (0, expires))
+            self._leases[channel_id] = (leased + amount, expires)
+
+    @inlineCallbacks
+    def take(self, channel_id, count, window, amount=1, partial=False):
+        '''Takes ``amount`` tokens from the bucket of the channel. If there
+        are not enough tokens, none are taken, or as many as there are if
+        ``partial`` is ``True``.
+
+        Returns a ``(taken, retry_after)`` pair, with the amount of tokens
+        taken, and the amount of seconds until the rest of the tokens will be
+        available if they were not all taken.'''
+        now = self.get_seconds()
+        leased, expires = self._leases.pop(channel_id, (0, now))
+        if expires <= now:
+            leased = 0
+        if leased >= amount:
+            self._lease(channel_id, leased - amount, expires)
+            returnValue((amount, 0))
+
+        needed = amount - leased
+        taken, retry_after = yield TAKE_RATE_LIMIT_TOKENS(
+            self.redis, [self.get_bucket_key(channel_id)],
+            [count, window, repr(now), needed, self.lease_size,
+             '1' if partial else '0'],
+            parse_result=lambda r: (int(r[0]), float(r[1])))
+
+        if taken >= needed:
+            self._lease(channel_id, taken - needed, now + window)
+            returnValue((amount, 0))
+        if partial:
+            returnValue((leased + taken, retry_after))
+        self._lease(channel_id, leased, expires)
+        returnValue((0, retry_after))
+
+    def give_back(self, channel_id, window, amount=1):
+        '''Gives back ``amount`` tokens that were taken for messages that
+        could not be sent. The tokens are leased to this store for the next
+        messages of the channel, rather than returned to the bucket, so that
+        giving them back does not need a redis call.'''
+        self._lease(channel_id, amount, self.get_seconds() + window)
+
+
+@inlineCallbacks
+def _index_channel(redis, keys, args):
+    index_key, sequence_key = keys[:2]
+    channel_id, removals = args[0], int(args[1])
+    score = yield redis.zscore(index_key, channel_id)
+    if score is None:
+        score = yield redis.incr(sequence_key)
+        yield redis.zadd(index_key, **{channel_id: score})
+    for key in keys[2:2 + removals]:
+        yield redis.zrem(key, channel_id)
+    for key in keys[2 + removals:]:
+        yield redis.zadd(key, **{channel_id: score})
+    returnValue(int(score))
+
+
+INDEX_CHANNEL = RedisScript('''
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not score then
+    score = redis.call('INCR', KEYS[2])
+    redis.call('ZADD', KEYS[1], score, ARGV[1])
+end
+local removals = tonumber(ARGV[2])
+for i = 3, removals + 2 do
+    redis.call('ZREM', KEYS[i], ARGV[1])
+end
+for i = removals + 3, #KEYS do
+    redis.call('ZADD', KEYS[i], score, ARGV[1])
+end
+return score
+''', _index_channel)
+
+
+class ChannelIndexStore(BaseStore):
+    '''Indexes channels in the order that they were created, so that they
+    can be listed a page at a time, and filtered by their type and label.
+
+    Each channel is given an increasing sequence number when it is first
+    indexed. The sequence number is its score in a sorted set of all
+    channels, and in sorted sets of the channels with each type and each
+    label. The sequence number of the last channel of a page is the cursor
+    for the next page.'''
+
+    FILTERS = ('type', 'label')
+
+    # The version of the index. Stored channels are indexed again whenever
+    # it is increased.
+    VERSION = 1
+
+    def get_index_key(self, field=None, value=None):
+        '''Returns the key of the index of all channels, or of the channels
+        where ``field`` is ``value``'''
+        if field is None:
+            return 'channel_index'
+        return self.get_key('channel_index', field, value)
+
+    def get_sequence_key(self):
+        return self.get_key('channel_index', 'sequence')
+
+    def get_version_key(self):
+        return self.get_key('channel_index', 'version')
+
+    def add(self, channel_id, properties, old_properties=None):
+        '''Indexes the channel with the given properties. If the channel
+        was indexed with ``old_properties``, it is removed from the indexes
+        of the filters that have changed. The channel is given its sequence
+        number and added to every index in a single script, so that
+        concurrent adds of the same channel cannot give it two sequence
+        numbers.'''
+        old_properties = old_properties or {}
+        removed, added = [], []
+        for field in self.FILTERS:
+            old = old_properties.get(field)
+            new = properties.get(field)
+            if old is not None and old != new:
+                removed.append(self.get_index_key(field, old))
+            if new is not None:
+                added.append(self.get_index_key(field, new))
+
+        return INDEX_CHANNEL(
+            self.redis,
+            [self.get_index_key(), self.get_sequence_key()] + removed + added,
+            [channel_id, len(removed)], parse_result=int)
+
+    @inlineCallbacks
+    def remove(self, channel_id, properties):
+        '''Removes the channel with the given properties from the
+        indexes'''
+        yield self.redis.zrem(self.get_index_key(), channel_id)
+        for field in self.FILTERS:
+            if properties.get(field) is not None:
+                yield self.redis.zrem(
+                    self.get_index_key(field, properties[field]), channel_id)
+
+    @inlineCallbacks
+    def list(self, limit, cursor=None, **filters):
+        '''Returns a page of up to ``limit`` channel ids, after the channel
+        with the sequence number ``cursor``, and the cursor for the next
+        page, which is ``None`` if this is the last page.
+
+        The channels can be filtered by the values of the fields in
+        ``FILTERS``. Only the index of the first filter is read, and the
+        other filters are checked for each channel in that page, so that a
+        page never reads more than ``limit`` channels. Pages of filtered
+        channels can therefore have less than ``limit`` channels.'''
+        filters = [
+            (field, filters[field]) for field in self.FILTERS
+            if filters.get(field) is not None]
+        if filters:
+            key = self.get_index_key(*filters[0])
+        else:
+            key = self.get_index_key()
+
+        start = '-inf' if cursor is None else '(%d' % (cursor,)
+        page = yield self.redis.zrangebyscore(
+            key, start, '+inf', start=0, num=limit, withscores=True)
+
+        ids = []
+        for channel_id, score in page:
+            for field, value in filters[1:]:
+                in_index = yield self.redis.zscore(
+                    self.get_index_key(field, value), channel_id)
+                if in_index is None:
+                    break
+            else:
+                ids.append(channel_id)
+
+        if len(page) < limit:
+            returnValue((ids, None))
+        returnValue((ids, int(page[-1][1])))
+
+    @inlineCallbacks
+    def is_indexed(self):
+        '''Returns whether the channels stored before the current version of
+        the index have been indexed'''
+        version = yield self.redis.get(self.get_version_key())
+        returnValue(version is not None and int(version) >= self.VERSION)
+
+    @inlineCallbacks
+    def add_missing(self, load_properties):
+        '''Indexes the stored channels that are not indexed yet, for
+        channels that were created before the current version of the index.
+        Channels that are already indexed keep their sequence numbers. Does
+        nothing once the index has been marked with the current version.
+
+        The version marker is separate from the sequence number, since
+        channels created by processes with the index add to the sequence
+        before the channels that were stored before the index are
+        indexed.'''
+        if (yield self.is_indexed()):
+            return
+        for channel_id in sorted((yield self.redis.smembers('channels'))):
+            properties = yield load_properties(channel_id)
+            if properties is not None:
+                yield self.add(channel_id, properties)
+        yield self.redis.set(self.get_version_key(), self.VERSION)
+
+
+class EventLogStore(BaseStore):
+    '''Keeps the most recent events of each channel in a log, for streaming
+    them to clients. Each event is given an increasing offset when it is
+    appended, so that clients can resume from the last offset they have
+    seen. Only the last ``size`` events of each channel are kept.
+
+    :param size: The amount of events to keep for each channel
+    :type size: int
+    '''
+
+    def __init__(self, redis, size):
+        super(EventLogStore, self).__init__(redis)
+        self.size = size
+
+    def get_log_key(self, channel_id):
+        return self.get_key(channel_id, 'event_log')
+
+    def get_offset_key(self, channel_id):
+        return self.get_key(channel_id, 'event_log', 'offset')
+
+    def append(self, channel_id, event):
+        '''Appends the API representation of an event to the log of the
+        channel, and returns its offset'''
+        return APPEND_TO_LOG(
+            self.redis,
+            [self.get_log_key(channel_id), self.get_offset_key(channel_id)],
+            [json_codec.dumps(event), self.size], parse_result=int)
+
+    @inlineCallbacks
+    def get_offset(self, channel_id):
+        '''Returns the offset of the last event appended to the log of the
+        channel, or 0 if there are none'''
+        offset = yield self.redis.get(self.get_offset_key(channel_id))
+        returnValue(int(offset or 0))
+
+    @inlineCallbacks
+    def read(self, channel_id, offset, limit):
+        '''Returns up to ``limit`` ``(offset, event)`` pairs for the events
+        after ``offset`` in the log of the channel, oldest first'''
+        events = yield self.redis.zrangebyscore(
+            self.get_log_key(channel_id), '(%d' % (offset,), '+inf',
+            start=0, num=limit, withscores=True)
+        returnValue([
+            (int(score), json_codec.loads(event))
+            for event, score in events])
+
+
+class RetryQueueStore(BaseStore):
+    '''Keeps the webhook deliveries that failed, until they are retried
+    successfully. The deliveries of each channel are kept in a hash, and
+    their ids in a sorted set scored by the time of their next attempt. The
+    channels that have deliveries to retry are kept in a set, so that the
+    retry schedulers can find them. The ``DEAD_LETTER_LIMIT`` most recent
+    deliveries of each channel that were given up on are kept in a list.'''
+
+    DEAD_LETTER_LIMIT = 1000
+
+    def get_channels_key(self):
+        return self.get_key('webhook_retry_channels')
+
+    def get_queue_key(self, channel_id):
+        return self.get_key(channel_id, 'webhook_retries')
+
+    def get_deliveries_key(self, channel_id):
+        return self.get_key(channel_id, 'webhook_retries', 'deliveries')
+
+    def get_dead_letters_key(self, channel_id):
+        return self.get_key(channel_id, 'webhook_retries', 'dead_letters')
+
+    def _keys(self, channel_id):
+        return [
+            self.get_queue_key(channel_id),
+            self.get_deliveries_key(channel_id),
+            self.get_channels_key(),
+        ]
+
+    def add(self, channel_id, delivery_id, delivery, attempt_at):
+        '''Stores the delivery, to be retried once it is ``attempt_at``
+        seconds since the epoch. Replaces the delivery if it already
+        exists.'''
+        return ADD_RETRY(
+            self.redis, self._keys(channel_id),
+            [delivery_id, json_codec.dumps(delivery), repr(attempt_at),
+             channel_id])
+
+    @inlineCallbacks
+    def take_due(self, channel_id, now, lease_until, limit):
+        '''Returns up to ``limit`` ``(delivery_id, delivery)`` pairs for the
+        deliveries of the channel that are due at ``now``. They are
+        rescheduled for ``lease_until``, so that they are only taken again
+        if they are not removed or rescheduled before then.'''
+        result = yield TAKE_DUE_RETRIES(
+            self.redis, self._keys(channel_id),
+            [repr(now), repr(lease_until), limit, channel_id])
+        returnValue([
+            (delivery_id, json_codec.loads(data))
+            for delivery_id, data in zip(result[::2], result[1::2])])
+
+    def remove(self, channel_id, delivery_id):
+        '''Removes a delivery that no longer needs to be retried'''
+        return REMOVE_RETRY(
+            self.redis, self._keys(channel_id)[:2], [delivery_id])
+
+    def dead_letter(self, channel_id, delivery_id, delivery):
+        '''Removes a delivery that is given up on from the retry queue, and
+        adds it to the dead letters of the channel'''
+        return DEAD_LETTER_RETRY(
+            self.redis,
+            self._keys(channel_id)[:2] + [
+                self.get_dead_letters_key(channel_id)],
+            [delivery_id, json_codec.dumps(delivery),
+             self.DEAD_LETTER_LIMIT])
+
+    @inlineCallbacks
+    def get_dead_letters(self, channel_id):
+        '''Returns the most recent deliveries of the channel that were given
+        up on, most recent first'''
+        data = yield self.redis.lrange(
+            self.get_dead_letters_key(channel_id), 0, -1)
+        returnValue([json_codec.loads(d) for d in data])
+
+    @inlineCallbacks
+    def get_dead_letter_count(self, channel_id):
+        '''Returns the amount of deliveries of the channel that were given up
+        on, up to ``DEAD_LETTER_LIMIT``'''
+        returnValue(int((yield self.redis.llen(
+            self.get_dead_letters_key(channel_id))) or 0))
+
+    def clear(self, channel_id):
+        '''Removes all of the deliveries and dead letters of the channel'''
+        return CLEAR_RETRIES(
+            self.redis,
+            self._keys(channel_id) + [self.get_dead_letters_key(channel_id)],
+            [channel_id])
+
+    def get_channels(self):
+        '''Returns the ids of the channels with deliveries to retry'''
+        return self.get_set(self.get_channels_key(), ttl=None)
+
+    @inlineCallbacks
+    def get_depth(self, channel_id):
+        '''Returns the amount of deliveries of the channel waiting to be
+        retried'''
+        returnValue(int(
+            (yield self.redis.zcard(self.get_queue_key(channel_id))) or 0))
 
 
 class RouterStore(BaseStore):
-    '''Stores all configuration for routers'''
+    '''Stores all configuration for routers.
+
+    If ``cache``, a :class:`junebug.cache.ConfigCache`, is given, the
+    configuration of each router and its destinations is kept in it when
+    loaded with :meth:`get_router_and_destination_configs`, and is updated
+    whenever the router or its destinations are saved or deleted.'''
+
+    def __init__(self, redis, ttl=None, cache=None):
+        super(RouterStore, self).__init__(redis, ttl)
+        self.cache = cache
 
     def get_router_set_key(self):
         """Gets the key for the set of routers"""
@@ -279,12 +1686,40 @@ class RouterStore(BaseStore):
         d.addCallback(sorted)
         return d
 
+    def _update_cache(self, router_id, update):
+        '''Invalidates the cached configuration of the router in other
+        processes, and applies ``update`` to the cached configuration in this
+        process, or removes it if ``update`` returns ``None``.'''
+        if self.cache is None:
+            return succeed(None)
+        entry = self.cache.get(router_id)
+        d = self.cache.invalidate(router_id)
+        if entry is not None:
+            entry = update(entry)
+            if entry is not None:
+                self.cache.set(router_id, entry)
+        return d
+
+    def _cache_router(self, config, entry):
+        entry['config'] = config
+        return entry
+
+    def _cache_destination(self, config, entry):
+        entry['destinations'][config['id']] = config
+        return entry
+
+    def _uncache_destination(self, destination_id, entry):
+        entry['destinations'].pop(destination_id, None)
+        return entry
+
     def save_router(self, config):
         '''Saves the configuration of a router'''
         d1 = self.store_value(
-            self.get_router_key(config['id']), json.dumps(config))
+            self.get_router_key(config['id']), json_codec.dumps(config))
         d2 = self.add_set_item(self.get_router_set_key(), config['id'])
-        return gatherResults([d1, d2])
+        d3 = self._update_cache(
+            config['id'], partial(self._cache_router, config))
+        return gatherResults([d1, d2, d3])
 
     def _handle_read_router_error(self, err):
         if err.type == TypeError:
@@ -295,7 +1730,7 @@ class RouterStore(BaseStore):
     def get_router_config(self, router_id):
         """Gets the configuration of a router with the id ``router_id``"""
         d = self.load_value(self.get_router_key(router_id))
-        d.addCallback(json.loads)
+        d.addCallback(json_codec.loads)
         d.addErrback(self._handle_read_router_error)
         return d
 
@@ -303,18 +1738,21 @@ class RouterStore(BaseStore):
         """Removes the configuration of the router with id ``router_id``"""
         d1 = self.remove_value(self.get_router_key(router_id))
         d2 = self.remove_set_item(self.get_router_set_key(), router_id)
-        return gatherResults([d1, d2])
+        d3 = self._update_cache(router_id, lambda entry: None)
+        return gatherResults([d1, d2, d3])
 
     def save_router_destination(self, router_id, destination_config):
         """Saves the configuration of a destination of a router"""
         destination_id = destination_config['id']
         d1 = self.store_value(
             self.get_router_destination_key(router_id, destination_id),
-            json.dumps(destination_config)
+            json_codec.dumps(destination_config)
         )
         d2 = self.add_set_item(
             self.get_router_destination_set_key(router_id), destination_id)
-        return gatherResults([d1, d2])
+        d3 = self._update_cache(
+            router_id, partial(self._cache_destination, destination_config))
+        return gatherResults([d1, d2, d3])
 
     def get_router_destination_list(self, router_id):
         """Returns the list of destinations for a router"""
@@ -332,7 +1770,7 @@ class RouterStore(BaseStore):
         """Returns the stored configuration of a router's destination"""
         d = self.load_value(
             self.get_router_destination_key(router_id, destination_id))
-        d.addCallback(json.loads)
+        d.addCallback(json_codec.loads)
         d.addErrback(self._handle_read_router_destination_error)
         return d
 
@@ -341,4 +1779,36 @@ class RouterStore(BaseStore):
             self.get_router_destination_key(router_id, destination_id))
         d2 = self.remove_set_item(
             self.get_router_destination_set_key(router_id), destination_id)
-        return gatherResults([d1, d2])
+        d3 = self._update_cache(
+            router_id, partial(self._uncache_destination, destination_id))
+        return gatherResults([d1, d2, d3])
+
+    @inlineCallbacks
+    def get_router_and_destination_configs(self, router_id):
+        """Returns the configuration of the router with id ``router_id``, or
+        ``None`` if there is no such router, and the list of configurations
+        of its destinations. Uses the cache if there is one."""
+        entry = self.cache.get(router_id) if self.cache is not None else None
+        if entry is not None:
+            returnValue((entry['config'], [
+                entry['destinations'][d]
+                for d in sorted(entry['destinations'])]))
+        if self.cache is not None:
+            generation = self.cache.generation(router_id)
+
+        router_config, destination_ids = yield gatherResults([
+            self.get_router_config(router_id),
+            self.get_router_destination_list(router_id),
+        ])
+        destination_configs = yield gatherResults([
+            self.get_router_destination_config(router_id, d)
+            for d in destination_ids])
+
+        if self.cache is not None and router_config is not None:
+            self.cache.set(router_id, {
+                'config': router_config,
+                'destinations': dict(
+                    (d['id'], d) for d in destination_configs
+                    if d is not None),
+            }, generation)
+        returnValue((router_config, destination_configs))
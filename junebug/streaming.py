@@ -0,0 +1,303 @@
+import re
+import tempfile
+from collections import deque
+from urlparse import urlparse
+
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.web.http import HTTPChannel
+from twisted.web.server import Request, Site
+
+
+MAX_LINE_LENGTH = 64 * 1024
+
+# The amount of bytes of results that are kept in memory before they are
+# written to a temporary file instead
+MAX_RESULTS_IN_MEMORY = 100000
+
+
+class LineTooLong(Exception):
+    '''Raised for lines of a stream that are longer than the maximum line
+    length'''
+
+    def __init__(self, line_number, max_line_length):
+        super(LineTooLong, self).__init__(
+            'Line %d is longer than %d characters' % (
+                line_number, max_line_length))
+        self.line_number = line_number
+
+
+class LineStream(object):
+    '''Request content that splits the request body into lines as it is
+    received, instead of buffering the whole body. Each non-empty line is
+    passed to ``handle_line`` along with its line number, which returns the
+    (deferred) result for the line.
+
+    As soon as the result of a line and the results of the lines before it
+    are ready, it is passed to ``format_result``, and the string that it
+    returns is written to :attr:`output`, so the results are in the order of
+    the lines. :attr:`output` is a temporary file that is only kept in
+    memory while it is small, so that neither the body nor the results are
+    held in memory as a whole.
+
+    Lines are only handled once :meth:`start` has been called. While
+    ``max_pending`` lines are waiting to be handled or for their results to
+    be written, ``producer`` is paused, so that no more of the body is read
+    until the results have caught up.
+
+    :param handle_line: Called with the line number and the line
+    :type handle_line: callable
+    :param format_result: Called with the result of each line, or the
+        failure if handling it failed, and returns the string to write for
+        it
+    :type format_result: callable
+    :param producer: The producer of the request body
+    :type producer: :class:`twisted.internet.interfaces.IPushProducer`
+    :param max_pending: The maximum amount of lines to read ahead of their
+        results
+    :type max_pending: int
+    '''
+
+    def __init__(self, handle_line, format_result=None, producer=None,
+                 max_pending=100, max_line_length=MAX_LINE_LENGTH):
+        self.handle_line = handle_line
+        self.format_result = format_result or (lambda result: '%s\n' % (
+            result,))
+        self.producer = producer
+        self.max_pending = max_pending
+        self.max_line_length = max_line_length
+        self.output = tempfile.SpooledTemporaryFile(MAX_RESULTS_IN_MEMORY)
+        self.line_number = 0
+        self.pending = 0
+        self.paused = False
+        self.started = False
+        self.stopped = False
+        self.finished = False
+        self._queued = []
+        self._results = deque()
+        self._waiting = []
+        self._partial = ''
+        self._skipping = False
+        self._size = 0
+
+    def write(self, data):
+        '''Receives the next chunk of the request body'''
+        self._size += len(data)
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._line_received(line)
+        if len(self._partial) > self.max_line_length:
+            self._line_received(self._partial)
+            self._partial = ''
+            self._skipping = True
+        self._update_producer()
+
+    def finish(self):
+        '''Handles the last line of the body, once all of the body has been
+        received. The producer is no longer paused, since the body has been
+        read.'''
+        if not self.finished:
+            self.finished = True
+            self._line_received(self._partial)
+            self._partial = ''
+            self._update_producer()
+            self._check_done()
+
+    def start(self):
+        '''Starts handling the lines that have been received, and all lines
+        that are received after this'''
+        self.started = True
+        queued, self._queued = self._queued, []
+        for line_number, line in queued:
+            self._handle_line(line_number, line)
+        self._update_producer()
+
+    def stop(self):
+        '''Stops handling lines. The lines that have not been handled yet,
+        and all lines that are received after this, are dropped, so that the
+        rest of the body is read without being kept or paused for.'''
+        self.stopped = True
+        self.pending -= len(self._queued)
+        self._queued = []
+        self._update_producer()
+        self._check_done()
+
+    def wait(self):
+        '''Returns a deferred that fires once the body has been finished,
+        and the results of all of its lines have been written to
+        :attr:`output`'''
+        d = Deferred()
+        self._waiting.append(d)
+        self._check_done()
+        return d
+
+    def _line_received(self, line):
+        if self._skipping:
+            # The rest of a line that was too long to be handled
+            self._skipping = False
+            return
+        self.line_number += 1
+        line = line.strip()
+        if not line or self.stopped:
+            return
+        self.pending += 1
+        if self.started:
+            self._handle_line(self.line_number, line)
+        else:
+            self._queued.append((self.line_number, line))
+
+    def _handle_line(self, line_number, line):
+        result = [False, None]
+        self._results.append(result)
+        if len(line) > self.max_line_length:
+            d = maybeDeferred(self._line_too_long, line_number)
+        else:
+            d = maybeDeferred(self.handle_line, line_number, line)
+        d.addBoth(self._line_handled, result)
+
+    def _line_too_long(self, line_number):
+        raise LineTooLong(line_number, self.max_line_length)
+
+    def _line_handled(self, value, result):
+        result[:] = [True, value]
+        while self._results and self._results[0][0]:
+            [_, value] = self._results.popleft()
+            self.output.write(self.format_result(value))
+            self.pending -= 1
+        self._update_producer()
+        self._check_done()
+
+    def _check_done(self):
+        if (self.finished and (self.started or self.stopped) and
+                not self.pending):
+            waiting, self._waiting = self._waiting, []
+            for d in waiting:
+                d.callback(None)
+
+    def _update_producer(self):
+        pause = not self.finished and self.pending >= self.max_pending
+        if self.producer is None or pause == self.paused:
+            return
+        self.paused = pause
+        if pause:
+            self.producer.pauseProducing()
+        else:
+            self.producer.resumeProducing()
+
+    # The file interface used by twisted.web for request content. The body
+    # is never read back, since it has already been handled.
+    def tell(self):
+        return self._size
+
+    def seek(self, offset, whence=0):
+        pass
+
+    def read(self, size=-1):
+        return ''
+
+    def close(self):
+        pass
+
+
+class RequestBodyProducer(object):
+    '''Pauses and resumes reading the body of a :class:`StreamingRequest`
+    from its connection. Reading is only resumed if the channel is not
+    waiting for its own responses to be sent, and only until the whole body
+    has been received, after which the channel decides when to read
+    again.'''
+
+    def __init__(self, request):
+        self.request = request
+        self.paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+        self.request.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.paused = False
+        if (not self.request.body_received and
+                not self.request.channel.sending_paused):
+            self.request.transport.resumeProducing()
+
+
+class StreamingRequest(Request):
+    '''A request whose body is written to a stream as it is received, if the
+    site has a stream for the request's method and path.'''
+
+    request_line = None
+    body_received = False
+    body_producer = None
+
+    def requestLineReceived(self, method, path):
+        '''Called by :class:`StreamingHTTPChannel` with the method and path
+        of the request as soon as they are received, since they are only
+        given to the request once its body has been received'''
+        self.request_line = (method, path)
+
+    def gotLength(self, length):
+        Request.gotLength(self, length)
+        if self.request_line is not None:
+            (method, path) = self.request_line
+            self.body_producer = RequestBodyProducer(self)
+            stream = self.channel.site.get_stream(self, method, path)
+            if stream is not None:
+                self.content = stream
+
+    def requestReceived(self, command, path, version):
+        self.body_received = True
+        return Request.requestReceived(self, command, path, version)
+
+
+class StreamingHTTPChannel(HTTPChannel):
+    '''An HTTP channel that tells its requests their method and path as soon
+    as the request line is received, and keeps the reading of a streamed
+    request body paused while its responses are being sent.'''
+
+    sending_paused = False
+
+    def lineReceived(self, line):
+        request = self.requests[-1] if self.requests else None
+        HTTPChannel.lineReceived(self, line)
+        if self.requests and self.requests[-1] is not request:
+            parts = line.split()
+            if len(parts) == 3:
+                self.requests[-1].requestLineReceived(parts[0], parts[1])
+
+    def pauseProducing(self):
+        self.sending_paused = True
+        HTTPChannel.pauseProducing(self)
+
+    def resumeProducing(self):
+        self.sending_paused = False
+        HTTPChannel.resumeProducing(self)
+        request = self.requests[-1] if self.requests else None
+        producer = getattr(request, 'body_producer', None)
+        if (producer is not None and producer.paused and
+                not request.body_received):
+            # The body of the request is still being read slowly
+            self.transport.pauseProducing()
+
+
+class StreamingSite(Site):
+    '''A site that processes the bodies of requests as they are received,
+    for requests that match one of ``streams``. ``streams`` is a list of
+    ``(method, path pattern, factory)``, where the factory is called with
+    the request and the groups of the pattern that matched the path, and
+    returns the :class:`LineStream` to write the body to.'''
+    protocol = StreamingHTTPChannel
+    requestFactory = StreamingRequest
+
+    def __init__(self, resource, streams=(), **kwargs):
+        Site.__init__(self, resource, **kwargs)
+        self.streams = [
+            (method, re.compile(pattern), factory)
+            for method, pattern, factory in streams]
+
+    def get_stream(self, request, method, path):
+        path = urlparse(path).path
+        for stream_method, pattern, factory in self.streams:
+            match = pattern.match(path)
+            if match is not None and method.upper() == stream_method:
+                return factory(request, *match.groups())
+        return None
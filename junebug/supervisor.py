@@ -0,0 +1,190 @@
+'''Serving the HTTP API from several processes. The supervising process runs
+the channel and router workers, and starts API only processes that share the
+listening port using ``SO_REUSEPORT``. The processes share state only through
+redis and AMQP.
+
+API only processes do not run any workers. When a channel or router is
+created, changed or deleted in one of them, it requests a restart of the
+workers of the channel or router from the supervising process over the same
+redis pub/sub channel that config cache invalidations are published on.'''
+import logging
+import os
+import socket
+import sys
+
+from twisted.application.internet import TimerService
+from twisted.application.service import Service
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredLock, gatherResults
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python import log
+
+from junebug.cache import publish_invalidation
+
+
+# The names that restart requests are published under, for channel workers
+# and router workers
+CHANNEL_WORKERS = 'channel-workers'
+ROUTER_WORKERS = 'router-workers'
+
+# The amount of seconds to wait before starting an API process again after
+# it has exited
+RESPAWN_DELAY = 1
+
+# The interval in seconds at which API only processes check whether their
+# supervising process is still running
+PARENT_CHECK_INTERVAL = 1
+
+LISTEN_BACKLOG = 50
+
+
+def request_restart(redis, name, id):
+    '''Requests that the supervising process restarts the workers of the
+    channel or router ``id``. ``name`` is either ``CHANNEL_WORKERS`` or
+    ``ROUTER_WORKERS``.'''
+    return publish_invalidation(redis, name, id)
+
+
+def listen_reuseport(port, factory, interface=''):
+    '''Listens on ``port`` with ``SO_REUSEPORT`` set, so that several
+    processes can listen on the same port, with the kernel balancing the
+    connections between them. Returns the listening port.'''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((interface, port))
+        sock.listen(LISTEN_BACKLOG)
+        sock.setblocking(False)
+        return reactor.adoptStreamPort(
+            sock.fileno(), socket.AF_INET, factory)
+    finally:
+        # The reactor listens on a duplicate of the socket
+        sock.close()
+
+
+class WorkerReconciler(object):
+    '''Restarts workers in the supervising process when an API only process
+    requests it. It is added to the
+    :class:`junebug.cache.CacheInvalidationListener` of the supervising
+    process like a :class:`junebug.cache.ConfigCache`, so restart requests
+    arrive in the same order as the cache invalidations published before
+    them. Whenever the listener (re)connects, all workers are synced with
+    the stored configs, since requests could have been missed while it was
+    disconnected.
+
+    :param name: The name that restart requests are published under
+    :type name: str
+    :param restart: Called with an id to restart the workers for that id
+    :type restart: callable
+    :param sync: Called to sync all workers with the stored configs
+    :type sync: callable
+    '''
+
+    def __init__(self, name, restart, sync):
+        self.name = name
+        self.restart = restart
+        self.sync = sync
+        self.lock = DeferredLock()
+
+    def discard(self, id):
+        return self._run(self.restart, id)
+
+    def clear(self):
+        return self._run(self.sync)
+
+    def _run(self, f, *args):
+        d = self.lock.run(f, *args)
+        d.addErrback(log.err)
+        return d
+
+
+class ParentWatcher(TimerService):
+    '''Stops the reactor of an API only process once its supervising process
+    has exited, so that it does not keep serving the API without workers.'''
+
+    def __init__(self, interval=PARENT_CHECK_INTERVAL, stop=reactor.stop):
+        TimerService.__init__(self, interval, self.check)
+        self.stop = stop
+        self.ppid = os.getppid()
+
+    def check(self):
+        if os.getppid() != self.ppid:
+            logging.warning('The supervising process has exited, stopping')
+            self.stop()
+
+
+class ApiProcessProtocol(ProcessProtocol):
+    def __init__(self, processes, index):
+        self.processes = processes
+        self.index = index
+        self.ended = Deferred()
+
+    def processEnded(self, reason):
+        self.processes.process_ended(self.index, reason)
+        self.ended.callback(None)
+
+
+class ApiProcesses(Service, object):
+    '''Runs ``count`` API only processes, starting them again whenever they
+    exit. Each process is started with the command line arguments ``args``,
+    so that it has the same config as the supervising process.'''
+
+    def __init__(self, count, args, clock=reactor):
+        super(ApiProcesses, self).__init__()
+        self.count = count
+        self.args = args
+        self.clock = clock
+        self.protocols = {}
+        self.stopping = None
+
+    def startService(self):
+        super(ApiProcesses, self).startService()
+        self.stopping = None
+        for index in range(self.count):
+            self.spawn(index)
+
+    def stopService(self):
+        '''Signals each of the processes to exit. Returns a deferred that
+        fires once they all have. Stopping again while the processes are
+        exiting waits for the same processes, without signalling them
+        again.'''
+        if self.stopping is not None:
+            return gatherResults(self.stopping)
+        super(ApiProcesses, self).stopService()
+        ended = []
+        for protocol in self.protocols.values():
+            if protocol.transport is not None:
+                try:
+                    protocol.transport.signalProcess('TERM')
+                except ProcessExitedAlready:
+                    # processEnded will still be called for the process
+                    pass
+            ended.append(protocol.ended)
+        self.stopping = ended
+        return gatherResults(ended)
+
+    def command(self):
+        '''Returns the command that the API processes are started with'''
+        return [
+            sys.executable, '-m', 'junebug.command_line',
+            '--api-only'] + list(self.args)
+
+    def spawn(self, index):
+        if not self.running:
+            return
+        protocol = ApiProcessProtocol(self, index)
+        self.protocols[index] = protocol
+        command = self.command()
+        reactor.spawnProcess(
+            protocol, command[0], command, env=os.environ,
+            childFDs={0: 'w', 1: 1, 2: 2})
+
+    def process_ended(self, index, reason):
+        self.protocols.pop(index, None)
+        if self.running:
+            logging.warning(
+                'API process %d exited (%s), restarting it' %
+                (index, reason.getErrorMessage()))
+            self.clock.callLater(RESPAWN_DELAY, self.spawn, index)
@@ -2,6 +2,7 @@ import json
 from copy import deepcopy
 import logging
 import logging.handlers
+import os
 
 from twisted.python.logfile import LogFile
 from twisted.python.failure import Failure
@@ -322,6 +323,77 @@ class JunebugTestBase(TestCase):
         self.addCleanup(persistencehelper.cleanup)
         returnValue(self.redis)
 
+    @inlineCallbacks
+    def get_real_redis(self):
+        '''Returns a redis manager for a real redis server, which runs Lua
+        scripts instead of their fallbacks. The test is skipped unless
+        ``VUMITEST_REDIS_DB`` is set to the redis database to test with.'''
+        if 'VUMITEST_REDIS_DB' not in os.environ:
+            self.skipTest(
+                'Set VUMITEST_REDIS_DB to run scripts against a real redis')
+        redis = yield self.get_redis()
+        returnValue(redis)
+
+    @inlineCallbacks
+    def dump_redis(self, redis, keys):
+        '''Returns the type, value and ttl of each of ``keys`` that exists'''
+        readers = {
+            'string': redis.get,
+            'hash': redis.hgetall,
+            'set': redis.smembers,
+            'list': lambda key: redis.lrange(key, 0, -1),
+            'zset': lambda key: redis.zrange(key, 0, -1, withscores=True),
+        }
+        state = {}
+        for key in keys:
+            kind = yield redis.type(key)
+            if kind == 'none':
+                continue
+            value = yield readers[kind](key)
+            ttl = yield redis.ttl(key)
+            state[key] = (kind, value, ttl)
+        returnValue(state)
+
+    @inlineCallbacks
+    def run_script_and_fallback(self, script, keys, args, setup=None,
+                                parse_result=None):
+        '''Runs the Lua source of ``script`` and its fallback against the
+        same real redis, each under their own key prefix, and asserts that
+        they leave ``keys`` in the same state. ``keys`` are deleted first,
+        and ``setup`` is then called with each redis manager to store the
+        data that the script runs on. ``parse_result`` is applied to the
+        result of the Lua source, as the callers of the script do. Returns
+        the results of the Lua source and of the fallback.'''
+        redis = yield self.get_real_redis()
+        lua_redis = redis.sub_manager('lua')
+        fallback_redis = redis.sub_manager('fallback')
+        for key in keys:
+            yield lua_redis.delete(key)
+            yield fallback_redis.delete(key)
+        if setup is not None:
+            yield setup(lua_redis)
+            yield setup(fallback_redis)
+
+        lua_result = yield script(
+            lua_redis, keys, args, parse_result=parse_result)
+        fallback_result = yield script.fallback(
+            fallback_redis, list(keys), list(args))
+
+        lua_state = yield self.dump_redis(lua_redis, keys)
+        fallback_state = yield self.dump_redis(fallback_redis, keys)
+        self.assertEqual(sorted(lua_state), sorted(fallback_state))
+        for key, (kind, value, ttl) in lua_state.iteritems():
+            fallback_kind, fallback_value, fallback_ttl = fallback_state[key]
+            self.assertEqual(
+                (key, kind, value), (key, fallback_kind, fallback_value))
+            # The ttls can be a second apart, since they are set at
+            # different times
+            self.assertTrue(
+                abs((ttl or -1) - (fallback_ttl or -1)) <= 1,
+                'The ttl of %r is %r, but %r for the fallback' % (
+                    key, ttl, fallback_ttl))
+        returnValue((lua_result, fallback_result))
+
     @inlineCallbacks
     def start_server(self, config=None):
         '''Starts a junebug server. Stores the service to "self.service", and
@@ -346,7 +418,7 @@ class JunebugTestBase(TestCase):
         self.message_sender = self.api.message_sender
 
         port = reactor.listenTCP(
-            0, Site(self.api.app.resource()),
+            0, self.api.create_site(),
             interface='127.0.0.1')
         self.service._port = port
         self.addCleanup(self.stop_server)
@@ -415,7 +487,8 @@ class JunebugTestBase(TestCase):
             self, level=None, components={}, inbound_message_rate=0,
             outbound_message_rate=0, submitted_event_rate=0,
             rejected_event_rate=0, delivery_succeeded_rate=0,
-            delivery_failed_rate=0, delivery_pending_rate=0):
+            delivery_failed_rate=0, delivery_pending_rate=0, retry_depth=0,
+            retry_dead_letters=0):
         '''Generates a status that the http API would respond with, given the
         same parameters'''
         return {
@@ -428,6 +501,8 @@ class JunebugTestBase(TestCase):
             'delivery_succeeded_rate': delivery_succeeded_rate,
             'delivery_failed_rate': delivery_failed_rate,
             'delivery_pending_rate': delivery_pending_rate,
+            'retry_depth': retry_depth,
+            'retry_dead_letters': retry_dead_letters,
         }
 
     def assert_status(self, status, **kwargs):
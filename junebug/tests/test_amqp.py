@@ -1,9 +1,11 @@
 import json
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.trial.unittest import TestCase
 from vumi.message import TransportUserMessage
 
 from junebug.amqp import (
-    AmqpConnectionError, AmqpFactory, JunebugAMQClient, RoutingKeyError)
+    AmqpConnectionError, AmqpFactory, JunebugAMQClient, KeyedSequencer,
+    RoutingKeyError)
 from junebug.tests.helpers import JunebugTestBase
 
 
@@ -118,3 +120,53 @@ class TestMessageSender(JunebugTestBase):
             self.message_sender.send_message(msg, routing_key='Foo'),
             RoutingKeyError)
         self.assertTrue('Foo' in str(err))
+
+
+class TestKeyedSequencer(TestCase):
+    def setUp(self):
+        self.sequencer = KeyedSequencer()
+        self.calls = []
+        self.waiting = {}
+
+    def call(self, name):
+        self.calls.append(name)
+        d = self.waiting[name] = Deferred()
+        return d
+
+    def test_same_key_in_order(self):
+        '''Calls with the same key should wait for the earlier calls'''
+        d1 = self.sequencer.run('key', self.call, 'a')
+        d2 = self.sequencer.run('key', self.call, 'b')
+        self.assertEqual(self.calls, ['a'])
+
+        self.waiting['a'].callback('result-a')
+        self.assertEqual(self.successResultOf(d1), 'result-a')
+        self.assertEqual(self.calls, ['a', 'b'])
+        self.assertNoResult(d2)
+        self.assertEqual(self.sequencer.pending(), 1)
+
+        self.waiting['b'].callback('result-b')
+        self.assertEqual(self.successResultOf(d2), 'result-b')
+        self.assertEqual(self.sequencer.pending(), 0)
+
+    def test_other_keys_concurrent(self):
+        '''Calls with different keys, or no key, should not wait for each
+        other'''
+        self.sequencer.run('key1', self.call, 'a')
+        self.sequencer.run('key2', self.call, 'b')
+        self.sequencer.run(None, self.call, 'c')
+        self.sequencer.run(None, self.call, 'd')
+        self.assertEqual(self.calls, ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.sequencer.pending(), 2)
+
+    def test_failure(self):
+        '''A call that fails should fail its own deferred, and not stop the
+        calls after it'''
+        d1 = self.sequencer.run('key', self.call, 'a')
+        d2 = self.sequencer.run('key', self.call, 'b')
+
+        self.waiting['a'].errback(ZeroDivisionError())
+        self.failureResultOf(d1, ZeroDivisionError)
+        self.assertEqual(self.calls, ['a', 'b'])
+        self.waiting['b'].callback('result-b')
+        self.assertEqual(self.successResultOf(d2), 'result-b')
@@ -1,10 +1,16 @@
 from copy import deepcopy
+from datetime import timedelta
 import logging
 import json
 import mock
 import treq
-from twisted.internet.defer import inlineCallbacks
+from StringIO import StringIO
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
+from twisted.internet.protocol import Protocol
+from twisted.internet.task import Clock, deferLater
 from twisted.web import http
+from twisted.web.test.requesthelper import DummyRequest
 
 from treq.testing import StubTreq
 from treq.testing import RequestSequence, StringStubbingResource
@@ -12,11 +18,33 @@ from treq.testing import RequestSequence, StringStubbingResource
 from vumi.message import TransportEvent, TransportUserMessage
 from vumi.tests.helpers import MessageHelper
 
+from junebug import json_codec
 from junebug.channel import Channel
 from junebug.router.base import Router
+from junebug.redis_pool import get_redis_pools
+from junebug.retries import get_retry_schedulers
+from junebug.stores import RateLimitStore
+from junebug.streaming import MAX_LINE_LENGTH
 from junebug.utils import api_from_message
 from junebug.tests.helpers import JunebugTestBase, FakeJunebugPlugin
 from junebug.utils import api_from_event, conjoin, omit
+from junebug.waiters import notify_event
+from junebug.webhooks import get_webhook_clients
+
+
+class StreamReader(Protocol):
+    '''Collects the body of a streamed response until ``predicate`` is
+    true of it'''
+
+    def __init__(self, predicate):
+        self.predicate = predicate
+        self.data = ''
+        self.done = Deferred()
+
+    def dataReceived(self, data):
+        self.data += data
+        if not self.done.called and self.predicate(self.data):
+            self.done.callback(self.data)
 
 
 class TestJunebugApi(JunebugTestBase):
@@ -69,19 +97,22 @@ class TestJunebugApi(JunebugTestBase):
         return treq.delete("%s%s" % (self.url, url), persistent=False)
 
     @inlineCallbacks
-    def assert_response(self, response, code, description, result, ignore=[]):
+    def assert_response(self, response, code, description, result, ignore=[],
+                        extra={}):
         data = yield response.json()
         self.assertEqual(response.code, code)
 
         for field in ignore:
             data['result'].pop(field)
 
-        self.assertEqual(data, {
+        expected = {
             'status': code,
             'code': http.RESPONSES.get(code, code),
             'description': description,
             'result': result,
-        })
+        }
+        expected.update(extra)
+        self.assertEqual(data, expected)
 
     @inlineCallbacks
     def test_http_error(self):
@@ -122,7 +153,7 @@ class TestJunebugApi(JunebugTestBase):
         resp = yield self.raw_post('/channels/', '{')
 
         try:
-            json.loads('{')
+            json_codec.loads('{')
         except ValueError as e:
             msg = e.message
 
@@ -153,6 +184,35 @@ class TestJunebugApi(JunebugTestBase):
             'type': 'junebug.tests.helpers.FakeJunebugPlugin'})
         self.assertEqual(junebug_conf, config)
 
+    @inlineCallbacks
+    def test_startup_api_only(self):
+        '''API only processes should not start any plugins or workers'''
+        yield self.stop_server()
+        config = yield self.create_channel_config(
+            api_only=True,
+            plugins=[{
+                'type': 'junebug.tests.helpers.FakeJunebugPlugin'
+            }]
+        )
+        yield self.start_server(config=config)
+        self.assertEqual(self.api.plugins, [])
+
+        resp = yield self.post('/channels/', self.create_channel_properties())
+        self.assertEqual(resp.code, http.CREATED)
+        id = (yield resp.json())['result']['id']
+        self.assertFalse(id in self.service.namedServices)
+
+        resp = yield self.get('/channels/%s' % (id,))
+        self.assertEqual(resp.code, http.OK)
+
+    @inlineCallbacks
+    def test_startup_api_workers_without_pubsub(self):
+        '''Serving the API from API processes should fail to start if redis
+        does not support pub/sub'''
+        yield self.stop_server()
+        config = yield self.create_channel_config(api_workers=2)
+        yield self.assertFailure(self.start_server(config=config), ValueError)
+
     @inlineCallbacks
     def test_shutdown_plugins_stopped(self):
         '''When the API stops, all the configured plugins should stop'''
@@ -223,6 +283,75 @@ class TestJunebugApi(JunebugTestBase):
             u'test-channel-2',
         ])
 
+    @inlineCallbacks
+    def test_get_channel_list_pages(self):
+        '''Channels should be listed a page at a time if a limit or cursor
+        is given'''
+        redis = yield self.get_redis()
+        properties = self.create_channel_properties()
+        config = yield self.create_channel_config()
+        for i in range(3):
+            yield Channel(
+                redis, config, properties, id=u'test-channel-%d' % i).save()
+
+        resp = yield self.get('/channels/', params={'limit': 2})
+        yield self.assert_response(resp, http.OK, 'channels listed', {
+            'channels': [u'test-channel-0', u'test-channel-1'],
+            'next_cursor': 2,
+        })
+
+        resp = yield self.get(
+            '/channels/', params={'limit': 2, 'cursor': 2})
+        yield self.assert_response(resp, http.OK, 'channels listed', {
+            'channels': [u'test-channel-2'],
+            'next_cursor': None,
+        })
+
+    @inlineCallbacks
+    def test_get_channel_list_filters(self):
+        '''Channels should be able to be filtered by type and label'''
+        redis = yield self.get_redis()
+        config = yield self.create_channel_config()
+        yield Channel(
+            redis, config, self.create_channel_properties(label='foo'),
+            id=u'test-channel-1').save()
+        yield Channel(
+            redis, config, self.create_channel_properties(
+                type='smpp', label='foo'),
+            id=u'test-channel-2').save()
+
+        resp = yield self.get('/channels/', params={'label': 'foo'})
+        yield self.assert_response(resp, http.OK, 'channels listed', {
+            'channels': [u'test-channel-1', u'test-channel-2'],
+            'next_cursor': None,
+        })
+
+        resp = yield self.get(
+            '/channels/', params={'label': 'foo', 'type': 'smpp'})
+        yield self.assert_response(resp, http.OK, 'channels listed', {
+            'channels': [u'test-channel-2'],
+            'next_cursor': None,
+        })
+
+    @inlineCallbacks
+    def test_get_channel_list_invalid_limit(self):
+        '''Limits that are not integers within the allowed range should be
+        rejected'''
+        resp = yield self.get('/channels/', params={'limit': 'foo'})
+        yield self.assert_response(resp, http.BAD_REQUEST, 'api usage error', {
+            'errors': [{
+                'type': 'invalid_query',
+                'message': "'foo' is not an integer",
+                'parameter': 'limit',
+            }],
+        })
+
+        resp = yield self.get('/channels/', params={'limit': 0})
+        self.assertEqual(resp.code, http.BAD_REQUEST)
+
+        resp = yield self.get('/channels/', params={'limit': 1001})
+        self.assertEqual(resp.code, http.BAD_REQUEST)
+
     @inlineCallbacks
     def test_create_channel(self):
         properties = self.create_channel_properties()
@@ -552,6 +681,91 @@ class TestJunebugApi(JunebugTestBase):
             'test-channel', message['message_id'])
         self.assertEqual(event_url, None)
 
+    @inlineCallbacks
+    def test_send_message_priority(self):
+        '''Priorities should be accepted as levels, or as the strings that
+        were accepted before priority lanes'''
+        properties = self.create_channel_properties()
+        config = yield self.create_channel_config()
+        redis = yield self.get_redis()
+        channel = Channel(redis, config, properties, id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+
+        for priority in [5, '5', 'high', 'foo']:
+            resp = yield self.post('/channels/test-channel/messages/', {
+                'to': '+1234', 'content': 'foo', 'priority': priority})
+            self.assertEqual(resp.code, http.CREATED)
+
+        resp = yield self.post('/channels/test-channel/messages/', {
+            'to': '+1234', 'content': 'foo', 'priority': 6})
+        self.assertEqual(resp.code, http.BAD_REQUEST)
+
+    @inlineCallbacks
+    def test_send_message_rate_limited(self):
+        '''Messages sent over the rate limit of the channel should be
+        rejected, with the time until they can be sent'''
+        clock = Clock()
+        self.patch(RateLimitStore, 'get_seconds', lambda _: clock.seconds())
+        properties = self.create_channel_properties(
+            rate_limit_count=2, rate_limit_window=60)
+        channel = Channel(
+            (yield self.get_redis()), (yield self.create_channel_config()),
+            properties, id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+
+        for _ in range(2):
+            resp = yield self.post('/channels/test-channel/messages/', {
+                'to': '+1234', 'content': 'foo'})
+            self.assertEqual(resp.code, http.CREATED)
+
+        clock.advance(15)
+        resp = yield self.post('/channels/test-channel/messages/', {
+            'to': '+1234', 'content': 'foo'})
+        self.assertEqual(resp.code, 429)
+        self.assertEqual(resp.headers.getRawHeaders('Retry-After'), ['15'])
+        self.assertEqual((yield resp.json()), {
+            'status': 429,
+            'code': 'Too Many Requests',
+            'description': 'rate limit exceeded',
+            'result': {
+                'errors': [{
+                    'type': 'RateLimitExceeded',
+                    'message': (
+                        'Channel test-channel is limited to 2 messages '
+                        'every 60 seconds'),
+                }],
+            },
+        })
+        self.assertEqual(
+            len(self.get_dispatched_messages('test-channel.outbound')), 2)
+
+        clock.advance(15)
+        resp = yield self.post('/channels/test-channel/messages/', {
+            'to': '+1234', 'content': 'foo'})
+        self.assertEqual(resp.code, http.CREATED)
+
+    @inlineCallbacks
+    def test_send_message_rate_limit_failed(self):
+        '''Messages that fail to send should not count towards the rate
+        limit of the channel'''
+        properties = self.create_channel_properties(
+            rate_limit_count=1, rate_limit_window=60)
+        channel = Channel(
+            (yield self.get_redis()), (yield self.create_channel_config()),
+            properties, id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+
+        resp = yield self.post('/channels/test-channel/messages/', {
+            'reply_to': 'missing-id', 'content': 'foo'})
+        self.assertEqual(resp.code, http.BAD_REQUEST)
+
+        resp = yield self.post('/channels/test-channel/messages/', {
+            'to': '+1234', 'content': 'foo'})
+        self.assertEqual(resp.code, http.CREATED)
+
     @inlineCallbacks
     def test_send_group_message(self):
         '''Sending a group message should place the message on the queue for the
@@ -914,6 +1128,399 @@ class TestJunebugApi(JunebugTestBase):
                 }],
             })
 
+    @inlineCallbacks
+    def test_send_message_batch(self):
+        '''Sending a batch of messages should place all of the messages on
+        the queue for the channel, and return the result of each message'''
+        clock = yield self.patch_message_rate_clock()
+        channel = Channel(
+            (yield self.get_redis()), (yield self.create_channel_config()),
+            self.create_channel_properties(), id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+
+        in_msg = TransportUserMessage(
+            from_addr='+2789',
+            to_addr='+1234',
+            transport_name='test-channel',
+            transport_type='_')
+        yield self.api.inbounds.store_vumi_message('test-channel', in_msg)
+
+        resp = yield self.post('/channels/test-channel/messages/batch', [
+            {'to': '+1234', 'content': 'foo', 'event_url': 'http://foo.org'},
+            {'reply_to': in_msg['message_id'], 'content': 'bar'},
+        ])
+        self.assertEqual(resp.code, http.OK)
+        [result1, result2] = (yield resp.json())['result']['messages']
+        self.assertEqual(result1['status'], http.CREATED)
+        self.assertEqual(result1['description'], 'message submitted')
+        self.assertEqual(result1['result']['to'], '+1234')
+        self.assertEqual(result2['status'], http.CREATED)
+        self.assertEqual(result2['result']['to'], '+2789')
+        self.assertEqual(
+            result2['result']['reply_to'], in_msg['message_id'])
+
+        [message1, message2] = self.get_dispatched_messages(
+            'test-channel.outbound')
+        self.assertEqual(
+            message1['message_id'], result1['result']['message_id'])
+        self.assertEqual(
+            message2['message_id'], result2['result']['message_id'])
+
+        event_url = yield self.api.outbounds.load_event_url(
+            'test-channel', message1['message_id'])
+        self.assertEqual(event_url, 'http://foo.org')
+
+        clock.advance(channel.config.metric_window)
+        rate = yield self.api.message_rate.get_messages_per_second(
+            'test-channel', 'outbound', channel.config.metric_window)
+        self.assertEqual(rate, 2.0 / channel.config.metric_window)
+
+    @inlineCallbacks
+    def test_send_message_batch_item_errors(self):
+        '''Messages in a batch that cannot be sent should have their errors
+        returned, without stopping the other messages from being sent'''
+        channel = Channel(
+            (yield self.get_redis()), (yield self.create_channel_config()),
+            self.create_channel_properties(character_limit=10),
+            id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+
+        resp = yield self.post('/channels/test-channel/messages/batch', [
+            {'content': 'foo'},
+            {'to': '+1234', 'content': 'Over the character limit.'},
+            {'reply_to': 'missing-id', 'content': 'foo'},
+            {'to': '+1234', 'content': 'foo'},
+        ])
+        [result1, result2, result3, result4] = (
+            yield resp.json())['result']['messages']
+        self.assertEqual(result1, {
+            'status': http.BAD_REQUEST,
+            'code': 'Bad Request',
+            'description': 'api usage error',
+            'result': {
+                'errors': [{
+                    'message': 'Either "to" or "reply_to" must be specified',
+                    'type': 'ApiUsageError',
+                }],
+            },
+        })
+        self.assertEqual(result2['status'], http.BAD_REQUEST)
+        self.assertEqual(result2['description'], 'message too long')
+        self.assertEqual(result3, {
+            'status': http.BAD_REQUEST,
+            'code': 'Bad Request',
+            'description': 'message not found',
+            'result': {
+                'errors': [{
+                    'message': 'Inbound message with id missing-id not found',
+                    'type': 'MessageNotFound',
+                }],
+            },
+        })
+        self.assertEqual(result4['status'], http.CREATED)
+
+        [message] = self.get_dispatched_messages('test-channel.outbound')
+        self.assertEqual(
+            message["message_id"], result4["result"]["message_id"])
+
+    @inlineCallbacks
+    def test_send_message_batch_rate_limited(self):
+        '''Messages of a batch should be sent until the rate limit of the
+        channel is reached, and the rest should be rejected'''
+        channel = Channel(
+            (yield self.get_redis()), (yield self.create_channel_config()),
+            self.create_channel_properties(
+                rate_limit_count=2, rate_limit_window=60),
+            id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+
+        resp = yield self.post('/channels/test-channel/messages/batch', [
+            {'content': 'foo'},
+            {'to': '+1234', 'content': 'foo'},
+            {'to': '+1234', 'content': 'foo'},
+            {'to': '+1234', 'content': 'foo'},
+        ])
+        results = (yield resp.json())['result']['messages']
+        self.assertEqual(
+            [result['status'] for result in results],
+            [http.BAD_REQUEST, http.CREATED, http.CREATED, 429])
+        self.assertEqual(
+            results[3]['result']['errors'][0]['type'], 'RateLimitExceeded')
+        self.assertEqual(
+            len(self.get_dispatched_messages('test-channel.outbound')), 2)
+
+    @inlineCallbacks
+    def test_send_message_batch_rate_limit_failed(self):
+        '''Messages of a batch that fail to send should not count towards
+        the rate limit of the channel'''
+        channel = Channel(
+            (yield self.get_redis()), (yield self.create_channel_config()),
+            self.create_channel_properties(
+                rate_limit_count=2, rate_limit_window=60),
+            id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+
+        resp = yield self.post('/channels/test-channel/messages/batch', [
+            {'reply_to': 'missing-id', 'content': 'foo'},
+            {'to': '+1234', 'content': 'foo'},
+        ])
+        results = (yield resp.json())['result']['messages']
+        self.assertEqual(
+            [result['status'] for result in results],
+            [http.BAD_REQUEST, http.CREATED])
+
+        resp = yield self.post('/channels/test-channel/messages/', {
+            'to': '+1234', 'content': 'foo'})
+        self.assertEqual(resp.code, http.CREATED)
+
+    @inlineCallbacks
+    def test_send_message_batch_invalid_body(self):
+        '''The whole batch should be rejected if any of its messages do not
+        match the message schema'''
+        resp = yield self.post('/channels/foo-bar/messages/batch', [
+            {'to': '+1234', 'content': 'foo'},
+            {'to': '+1234', 'content': 'foo', 'foo': 'bar'},
+        ])
+        yield self.assert_response(
+            resp, http.BAD_REQUEST, 'api usage error', {
+                'errors': [{
+                    'message': "Additional properties are not allowed (u'foo' "
+                    "was unexpected)",
+                    'type': 'invalid_body',
+                    'schema_path': ['items', 'additionalProperties'],
+                }]
+            })
+
+        resp = yield self.post('/channels/foo-bar/messages/batch', [])
+        self.assertEqual(resp.code, http.BAD_REQUEST)
+
+    @inlineCallbacks
+    def test_send_message_batch_too_large(self):
+        '''Batches larger than the configured maximum should be rejected'''
+        yield self.stop_server()
+        yield self.start_server(config=(
+            yield self.create_channel_config(max_message_batch_size=1)))
+
+        resp = yield self.post('/channels/foo-bar/messages/batch', [
+            {'to': '+1234', 'content': 'foo'},
+            {'to': '+1234', 'content': 'bar'},
+        ])
+        yield self.assert_response(
+            resp, http.BAD_REQUEST, 'api usage error', {
+                'errors': [{
+                    'message': 'A batch may contain at most 1 messages',
+                    'type': 'ApiUsageError',
+                }]
+            })
+
+    @inlineCallbacks
+    def test_send_message_batch_no_destination(self):
+        '''Sending a batch on a channel without a destination should raise
+        an ApiUsageError'''
+        properties = self.create_channel_properties()
+        del properties['mo_url']
+        channel = Channel(
+            (yield self.get_redis()), (yield self.create_channel_config()),
+            properties, id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+
+        resp = yield self.post('/channels/test-channel/messages/batch', [
+            {'to': '+1234', 'content': 'foo'}])
+        yield self.assert_response(
+            resp, http.BAD_REQUEST, 'api usage error', {
+                'errors': [{
+                    'message': 'This channel has no "mo_url" or "amqp_queue"',
+                    'type': 'ApiUsageError',
+                }]
+            })
+
+    @inlineCallbacks
+    def test_send_message_stream(self):
+        '''Sending a stream of messages should send each message, and
+        return a line with the result of each message'''
+        channel = Channel(
+            (yield self.get_redis()), (yield self.create_channel_config()),
+            self.create_channel_properties(), id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+
+        resp = yield self.raw_post(
+            '/channels/test-channel/messages/stream', '\n'.join([
+                json.dumps({'to': '+1234', 'content': 'foo'}),
+                '',
+                '{"to": ',
+                json.dumps({'to': '+1234', 'content': 'bar', 'foo': 'bar'}),
+                json.dumps({'content': 'baz'}),
+                json.dumps({'to': '+5678', 'content': 'baz'}),
+            ]))
+        self.assertEqual(resp.code, http.OK)
+        self.assertEqual(
+            resp.headers.getRawHeaders('Content-Type'),
+            ['application/x-ndjson'])
+
+        lines = (yield resp.content()).strip().split('\n')
+        [result1, result3, result4, result5, result6] = [
+            json.loads(line) for line in lines]
+
+        self.assertEqual(result1['line'], 1)
+        self.assertEqual(result1['status'], http.CREATED)
+        self.assertEqual(result1['result']['to'], '+1234')
+
+        self.assertEqual(result3['line'], 3)
+        self.assertEqual(result3['status'], http.BAD_REQUEST)
+        self.assertEqual(result3['description'], 'json decode error')
+
+        self.assertEqual(result4, {
+            'line': 4,
+            'status': http.BAD_REQUEST,
+            'code': 'Bad Request',
+            'description': 'api usage error',
+            'result': {
+                'errors': [{
+                    'message': "Additional properties are not allowed (u'foo' "
+                    "was unexpected)",
+                    'type': 'invalid_body',
+                    'schema_path': ['additionalProperties'],
+                }],
+            },
+        })
+
+        self.assertEqual(result5['line'], 5)
+        self.assertEqual(
+            result5['result']['errors'][0]['message'],
+            'Either "to" or "reply_to" must be specified')
+
+        self.assertEqual(result6['line'], 6)
+        self.assertEqual(result6['status'], http.CREATED)
+
+        [message1, message2] = self.get_dispatched_messages(
+            'test-channel.outbound')
+        self.assertEqual(
+            message1['message_id'], result1['result']['message_id'])
+        self.assertEqual(
+            message2['message_id'], result6['result']['message_id'])
+
+    @inlineCallbacks
+    def test_send_message_stream_buffered_body(self):
+        '''Streamed send requests should also work for sites that buffer
+        the request body'''
+        channel = Channel(
+            (yield self.get_redis()), (yield self.create_channel_config()),
+            self.create_channel_properties(), id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+
+        request = DummyRequest(['channels', 'test-channel', 'messages'])
+        request.content = StringIO(json.dumps(
+            {'to': '+1234', 'content': 'foo'}))
+        body = yield self.api.send_message_stream(request, 'test-channel')
+
+        self.assertEqual(body, '')
+        [result] = [json.loads(line) for line in request.written]
+        self.assertEqual(result['status'], http.CREATED)
+        self.assertEqual(len(self.get_dispatched_messages(
+            'test-channel.outbound')), 1)
+
+    @inlineCallbacks
+    def test_send_message_stream_line_too_long(self):
+        '''Lines longer than the maximum line length should not be sent,
+        and an error should be returned for them'''
+        channel = Channel(
+            (yield self.get_redis()), (yield self.create_channel_config()),
+            self.create_channel_properties(), id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+
+        resp = yield self.raw_post(
+            '/channels/test-channel/messages/stream', '\n'.join([
+                json.dumps({'to': '+1234', 'content': 'a' * MAX_LINE_LENGTH}),
+                json.dumps({'to': '+1234', 'content': 'foo'}),
+            ]))
+        self.assertEqual(resp.code, http.OK)
+
+        lines = (yield resp.content()).strip().split('\n')
+        [result1, result2] = [json.loads(line) for line in lines]
+        self.assertEqual(result1, {
+            'line': 1,
+            'status': http.BAD_REQUEST,
+            'code': 'Bad Request',
+            'description': 'api usage error',
+            'result': {
+                'errors': [{
+                    'message': 'Line 1 is longer than %d characters' % (
+                        MAX_LINE_LENGTH,),
+                    'type': 'ApiUsageError',
+                }],
+            },
+        })
+        self.assertEqual(result2['line'], 2)
+        self.assertEqual(result2['status'], http.CREATED)
+        self.assertEqual(len(self.get_dispatched_messages(
+            'test-channel.outbound')), 1)
+
+    @inlineCallbacks
+    def test_send_message_stream_channel_not_found(self):
+        '''If the channel does not exist, no messages should be sent, and
+        an error should be returned'''
+        resp = yield self.raw_post(
+            '/channels/foo-bar/messages/stream',
+            json.dumps({'to': '+1234', 'content': 'foo'}))
+        yield self.assert_response(
+            resp, http.NOT_FOUND, 'channel not found', {
+                'errors': [{
+                    'message': '',
+                    'type': 'ChannelNotFound',
+                }]
+            })
+
+    @inlineCallbacks
+    def test_send_message_stream_channel_not_found_long_body(self):
+        '''If the channel does not exist, the rest of a body that is longer
+        than the stream window should still be read, so that the error can
+        be returned'''
+        resp = yield self.raw_post(
+            '/channels/foo-bar/messages/stream', '\n'.join([
+                json.dumps({'to': '+1234', 'content': 'foo'})
+            ] * 5000))
+        yield self.assert_response(
+            resp, http.NOT_FOUND, 'channel not found', {
+                'errors': [{
+                    'message': '',
+                    'type': 'ChannelNotFound',
+                }]
+            })
+
+    @inlineCallbacks
+    def test_send_message_stream_no_destination(self):
+        '''If the channel has no destination, no messages should be sent,
+        and an error should be returned'''
+        properties = self.create_channel_properties()
+        del properties['mo_url']
+        channel = Channel(
+            (yield self.get_redis()), (yield self.create_channel_config()),
+            properties, id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+
+        resp = yield self.raw_post(
+            '/channels/test-channel/messages/stream', '\n'.join([
+                json.dumps({'to': '+1234', 'content': 'foo'})
+            ] * 5000))
+        yield self.assert_response(
+            resp, http.BAD_REQUEST, 'api usage error', {
+                'errors': [{
+                    'message': 'This channel has no "mo_url" or "amqp_queue"',
+                    'type': 'ApiUsageError',
+                }]
+            })
+        self.assertEqual(
+            self.get_dispatched_messages('test-channel.outbound'), [])
+
     @inlineCallbacks
     def test_get_message_status_no_events(self):
         '''Returns `None` for last event fields, and empty list for events'''
@@ -985,6 +1592,217 @@ class TestJunebugApi(JunebugTestBase):
                 'events': [event_dict],
             })
 
+    @inlineCallbacks
+    def test_get_message_status_last_only(self):
+        '''Only the last event should be returned if last_only is given'''
+        properties = self.create_channel_properties()
+        config = yield self.create_channel_config()
+        redis = yield self.get_redis()
+        channel = Channel(redis, config, properties, id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+
+        ack = TransportEvent(
+            user_message_id='message-id', sent_message_id='message-id',
+            event_type='ack')
+        dr = TransportEvent(
+            user_message_id='message-id', sent_message_id='message-id',
+            event_type='delivery_report', delivery_status='delivered',
+            timestamp=ack['timestamp'] + timedelta(seconds=1))
+        yield self.outbounds.store_event(channel.id, 'message-id', dr)
+        yield self.outbounds.store_event(channel.id, 'message-id', ack)
+
+        resp = yield self.get(
+            '/channels/test-channel/messages/message-id',
+            {'last_only': 'true'})
+        event_dict = api_from_event(channel.id, dr)
+        event_dict['timestamp'] = str(event_dict['timestamp'])
+        yield self.assert_response(
+            resp, http.OK, 'message status', {
+                'id': 'message-id',
+                'last_event_type': 'delivery_succeeded',
+                'last_event_timestamp': str(dr['timestamp']),
+                'events': [event_dict],
+            })
+
+        resp = yield self.get(
+            '/channels/test-channel/messages/message-id',
+            {'last_only': 'maybe'})
+        self.assertEqual(resp.code, http.BAD_REQUEST)
+
+    @inlineCallbacks
+    def test_get_message_statuses(self):
+        '''The statuses of all of the messages should be returned in the
+        order they were asked for'''
+        properties = self.create_channel_properties()
+        config = yield self.create_channel_config()
+        redis = yield self.get_redis()
+        channel = Channel(redis, config, properties, id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+
+        event1 = TransportEvent(
+            user_message_id='message-1', sent_message_id='message-1',
+            event_type='ack')
+        event2 = TransportEvent(
+            user_message_id='message-1', sent_message_id='message-1',
+            event_type='delivery_report', delivery_status='delivered',
+            timestamp=event1['timestamp'] + timedelta(seconds=1))
+        event3 = TransportEvent(
+            user_message_id='message-2', sent_message_id='message-2',
+            event_type='nack', nack_reason='error error')
+        for event in [event1, event2, event3]:
+            yield self.outbounds.store_event(
+                channel.id, event['user_message_id'], event)
+
+        resp = yield self.post('/channels/test-channel/messages/status', {
+            'message_ids': ['message-2', 'message-3', 'message-1'],
+        })
+
+        def event_dict(event):
+            event_dict = api_from_event(channel.id, event)
+            event_dict['timestamp'] = str(event_dict['timestamp'])
+            return event_dict
+
+        yield self.assert_response(
+            resp, http.OK, 'message statuses', {
+                'messages': [{
+                    'id': 'message-2',
+                    'last_event_type': 'rejected',
+                    'last_event_timestamp': str(event3['timestamp']),
+                    'events': [event_dict(event3)],
+                }, {
+                    'id': 'message-3',
+                    'last_event_type': None,
+                    'last_event_timestamp': None,
+                    'events': [],
+                }, {
+                    'id': 'message-1',
+                    'last_event_type': 'delivery_succeeded',
+                    'last_event_timestamp': str(event2['timestamp']),
+                    'events': [event_dict(event1), event_dict(event2)],
+                }],
+            })
+
+    @inlineCallbacks
+    def test_get_message_statuses_invalid(self):
+        '''At least one message id should be required'''
+        properties = self.create_channel_properties()
+        config = yield self.create_channel_config()
+        redis = yield self.get_redis()
+        channel = Channel(redis, config, properties, id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+
+        resp = yield self.post(
+            '/channels/test-channel/messages/status', {'message_ids': []})
+        self.assertEqual(resp.code, http.BAD_REQUEST)
+        [error] = (yield resp.json())['result']['errors']
+        self.assertEqual(error['type'], 'invalid_body')
+
+    @inlineCallbacks
+    def test_get_message_statuses_no_destination(self):
+        '''Returns error if the channel has no destination'''
+        properties = self.create_channel_properties()
+        del properties['mo_url']
+        config = yield self.create_channel_config()
+        redis = yield self.get_redis()
+        channel = Channel(redis, config, properties, id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+
+        resp = yield self.post(
+            '/channels/test-channel/messages/status',
+            {'message_ids': ['message-1']})
+        yield self.assert_response(
+            resp, http.BAD_REQUEST, 'api usage error', {
+                'errors': [{
+                    'message': 'This channel has no "mo_url" or "amqp_queue"',
+                    'type': 'ApiUsageError',
+                }]
+            })
+
+    @inlineCallbacks
+    def wait_for_waiters(self, count):
+        while len(self.api.event_waiters) < count:
+            yield deferLater(reactor, 0.01, lambda: None)
+
+    @inlineCallbacks
+    def test_get_message_status_wait(self):
+        '''If wait is given, the status should be returned once the next
+        event of the message is stored'''
+        properties = self.create_channel_properties()
+        config = yield self.create_channel_config()
+        redis = yield self.get_redis()
+        channel = Channel(redis, config, properties, id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+
+        d = self.get(
+            '/channels/test-channel/messages/message-id', {'wait': '30'})
+        yield self.wait_for_waiters(1)
+
+        event = TransportEvent(
+            user_message_id='message-id', sent_message_id='message-id',
+            event_type='ack')
+        yield self.outbounds.store_event(channel.id, 'message-id', event)
+        yield notify_event(self.api.redis, channel.id, 'message-id')
+
+        resp = yield d
+        data = yield resp.json()
+        self.assertEqual(data['result']['last_event_type'], 'submitted')
+        self.assertEqual(len(self.api.event_waiters), 0)
+
+    @inlineCallbacks
+    def test_get_message_status_wait_timeout(self):
+        '''If no event is stored within wait seconds, the status should be
+        returned as it is'''
+        properties = self.create_channel_properties()
+        config = yield self.create_channel_config()
+        redis = yield self.get_redis()
+        channel = Channel(redis, config, properties, id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+        clock = Clock()
+        self.patch(self.api.event_waiters, 'clock', clock)
+
+        d = self.get(
+            '/channels/test-channel/messages/message-id', {'wait': '30'})
+        yield self.wait_for_waiters(1)
+        clock.advance(29)
+        self.assertEqual(len(self.api.event_waiters), 1)
+        clock.advance(1)
+        self.assertEqual(len(self.api.event_waiters), 0)
+
+        resp = yield d
+        yield self.assert_response(
+            resp, http.OK, 'message status', {
+                'id': 'message-id',
+                'last_event_type': None,
+                'last_event_timestamp': None,
+                'events': [],
+            })
+
+    @inlineCallbacks
+    def test_get_message_status_invalid_wait(self):
+        '''Waits longer than the maximum should be rejected'''
+        properties = self.create_channel_properties()
+        config = yield self.create_channel_config()
+        redis = yield self.get_redis()
+        channel = Channel(redis, config, properties, id='test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+
+        resp = yield self.get(
+            '/channels/test-channel/messages/message-id', {'wait': '61'})
+        yield self.assert_response(resp, http.BAD_REQUEST, 'api usage error', {
+            'errors': [{
+                'type': 'invalid_query',
+                'message': '61 is greater than the maximum of 60',
+                'parameter': 'wait',
+            }],
+        })
+
     @inlineCallbacks
     def test_get_message_status_multiple_events(self):
         '''Returns the last event details for last event fields, and list with
@@ -1023,7 +1841,36 @@ class TestJunebugApi(JunebugTestBase):
     def test_get_health_check(self):
         resp = yield self.get('/health')
         yield self.assert_response(
-            resp, http.OK, 'health ok', {})
+            resp, http.OK, 'health ok', {
+                'json': json_codec.get_backends(),
+            })
+
+    @inlineCallbacks
+    def test_get_stats(self):
+        yield self.api.outbounds.store_message('channel-id', {
+            'message_id': 'message-id',
+            'event_url': 'http://test.org',
+        })
+        yield self.api.outbounds.load_event_route('channel-id', 'message-id')
+        yield self.api.outbounds.load_event_route('channel-id', 'other-id')
+
+        resp = yield self.get('/stats')
+        yield self.assert_response(resp, http.OK, 'stats', {
+            'event_route_cache': {
+                'size': 1,
+                'max_size': 10000,
+                'hits': 1,
+                'misses': 1,
+            },
+            'event_streams': {},
+            'message_status_waiters': 0,
+            'redis_pools': [pool.stats() for pool in get_redis_pools()],
+            'webhook_clients': [
+                client.stats() for client in get_webhook_clients()],
+            'webhook_retries': [
+                scheduler.stats() for scheduler in get_retry_schedulers()],
+            'json': json_codec.get_backends(),
+        })
 
     @inlineCallbacks
     def test_get_channels_health_check(self):
@@ -1075,7 +1922,7 @@ class TestJunebugApi(JunebugTestBase):
                         'name': '%s.event' % (channel.id),
                         'rate': 1.25,
                         'stuck': False
-                    }])
+                    }], extra={'json': json_codec.get_backends()})
 
     @inlineCallbacks
     def test_get_channels_and_destinations_health_check(self):
@@ -1129,7 +1976,9 @@ class TestJunebugApi(JunebugTestBase):
                 resp = yield self.request('GET', '/health')
 
             yield self.assertEqual(async_failures, [])
-            yield self.assert_response(resp, http.OK, 'queues ok', response)
+            yield self.assert_response(
+                resp, http.OK, 'queues ok', response,
+                extra={'json': json_codec.get_backends()})
 
     @inlineCallbacks
     def test_get_channels_health_check_stuck(self):
@@ -1181,7 +2030,7 @@ class TestJunebugApi(JunebugTestBase):
                         'name': '%s.event' % (channel.id),
                         'rate': 0,
                         'stuck': True
-                    }])
+                    }], extra={'json': json_codec.get_backends()})
 
     @inlineCallbacks
     def test_get_channels_health_check_stuck_no_message_stats(self):
@@ -1230,7 +2079,185 @@ class TestJunebugApi(JunebugTestBase):
                         'messages': 1256,
                         'name': '%s.event' % (channel.id),
                         'stuck': False
-                    }])
+                    }], extra={'json': json_codec.get_backends()})
+
+    @inlineCallbacks
+    def test_get_channel_metrics(self):
+        '''The message count series of the channel should be returned'''
+        clock = self.patch_message_rate_clock()
+        clock.advance(3600)
+        channel = yield self.create_channel(self.service, self.redis)
+        yield self.api.message_rate.increment(channel.id, 'inbound', 1.0)
+        yield self.api.message_rate.increment(channel.id, 'inbound', 1.0)
+
+        resp = yield self.get('/channels/%s/metrics' % channel.id, params={
+            'label': 'inbound',
+            'resolution': '1h',
+        })
+        yield self.assert_response(resp, http.OK, 'metrics retrieved', {
+            'resolution': '1h',
+            'bucket_size': 3600,
+            'series': {
+                'inbound': [[i * 3600, 0] for i in range(-46, 1)] + [
+                    [3600, 2]],
+            },
+        })
+
+    @inlineCallbacks
+    def test_get_channel_metrics_defaults(self):
+        '''All labels should be returned at a resolution of 1 minute by
+        default'''
+        channel = yield self.create_channel(self.service, self.redis)
+        resp = yield self.get('/channels/%s/metrics' % channel.id)
+        result = (yield resp.json())['result']
+        self.assertEqual(result['resolution'], '1m')
+        self.assertEqual(result['bucket_size'], 60)
+        self.assertEqual(sorted(result['series']), [
+            'delivery_failed', 'delivery_pending', 'delivery_succeeded',
+            'inbound', 'outbound', 'rejected', 'submitted'])
+        self.assertEqual(len(result['series']['inbound']), 60)
+
+    @inlineCallbacks
+    def test_get_channel_metrics_invalid(self):
+        '''Unknown labels and resolutions should result in an error'''
+        channel = yield self.create_channel(self.service, self.redis)
+
+        resp = yield self.get('/channels/%s/metrics' % channel.id, params={
+            'resolution': '1d',
+        })
+        yield self.assert_response(
+            resp, http.BAD_REQUEST, 'invalid metric', {
+                'errors': [{
+                    'message': "Invalid resolution '1d', must be one of 1h, "
+                               "1m, 1s",
+                    'type': 'InvalidMetric',
+                }]
+            })
+
+        resp = yield self.get('/channels/%s/metrics' % channel.id, params={
+            'label': 'foo',
+        })
+        yield self.assert_response(
+            resp, http.BAD_REQUEST, 'invalid metric', {}, ignore=['errors'])
+
+    @inlineCallbacks
+    def test_get_channel_metrics_channel_not_found(self):
+        resp = yield self.get('/channels/foo-bar/metrics')
+        yield self.assert_response(
+            resp, http.NOT_FOUND, 'channel not found', {}, ignore=['errors'])
+
+    @inlineCallbacks
+    def create_event_stream_channel(self, event_stream=True):
+        properties = self.create_channel_properties(event_stream=event_stream)
+        config = yield self.create_channel_config()
+        redis = yield self.get_redis()
+        channel = Channel(redis, config, properties, id=u'test-channel')
+        yield channel.save()
+        yield channel.start(self.service)
+        self.api.event_streams.interval = 0.01
+
+    @inlineCallbacks
+    def read_stream(self, resp, predicate):
+        '''Reads the streamed response until ``predicate`` is true of its
+        body, then disconnects, and waits for the API to unsubscribe'''
+        reader = StreamReader(predicate)
+        resp.deliverBody(reader)
+        data = yield reader.done
+        reader.transport.stopProducing()
+        while self.api.event_streams.stats():
+            yield deferLater(reactor, 0.01, lambda: None)
+        returnValue(data)
+
+    @inlineCallbacks
+    def test_stream_events_ndjson(self):
+        '''The events after the offset should be streamed as newline
+        delimited JSON'''
+        yield self.create_event_stream_channel()
+        for i in range(3):
+            yield self.api.event_logs.append(
+                'test-channel', {'event_id': 'e%d' % i})
+
+        resp = yield self.get('/channels/test-channel/events/stream', {
+            'format': 'ndjson',
+            'offset': '1',
+        })
+        self.assertEqual(resp.code, http.OK)
+        self.assertEqual(
+            resp.headers.getRawHeaders('Content-Type'),
+            ['application/x-ndjson'])
+        self.assertEqual(
+            self.api.event_streams.stats(), {'test-channel': 1})
+
+        data = yield self.read_stream(resp, lambda d: d.count('\n') == 2)
+        self.assertEqual([json.loads(line) for line in data.splitlines()], [
+            {'offset': 2, 'event': {'event_id': 'e1'}},
+            {'offset': 3, 'event': {'event_id': 'e2'}},
+        ])
+
+    @inlineCallbacks
+    def test_stream_events_sse(self):
+        '''Only new events should be streamed as server-sent events if
+        there is no offset or Last-Event-ID'''
+        yield self.create_event_stream_channel()
+        yield self.api.event_logs.append(
+            'test-channel', {'event_id': 'e0', 'event_type': 'ack'})
+
+        resp = yield self.get('/channels/test-channel/events/stream')
+        self.assertEqual(
+            resp.headers.getRawHeaders('Content-Type'),
+            ['text/event-stream'])
+        self.assertEqual(
+            resp.headers.getRawHeaders('Cache-Control'), ['no-cache'])
+
+        yield self.api.event_logs.append(
+            'test-channel', {'event_id': 'e1', 'event_type': 'nack'})
+        data = yield self.read_stream(resp, lambda d: d.endswith('\n\n'))
+        self.assertEqual(
+            data.split('\n')[:2], ['id: 2', 'event: nack'])
+
+    @inlineCallbacks
+    def test_stream_events_last_event_id(self):
+        '''Streaming should resume after the Last-Event-ID header'''
+        yield self.create_event_stream_channel()
+        for i in range(2):
+            yield self.api.event_logs.append(
+                'test-channel', {'event_id': 'e%d' % i, 'event_type': 'ack'})
+
+        resp = yield treq.get(
+            '%s/channels/test-channel/events/stream' % (self.url,),
+            headers={'Last-Event-ID': '1'}, persistent=False)
+        data = yield self.read_stream(resp, lambda d: d.endswith('\n\n'))
+        self.assertTrue(data.startswith('id: 2\n'))
+
+    @inlineCallbacks
+    def test_stream_events_not_enabled(self):
+        '''Streaming the events of a channel without the event stream
+        enabled should be an error'''
+        yield self.create_event_stream_channel(event_stream=False)
+        resp = yield self.get('/channels/test-channel/events/stream')
+        yield self.assert_response(
+            resp, http.BAD_REQUEST, 'api usage error', {
+                'errors': [{
+                    'message':
+                        'This channel does not have "event_stream" enabled',
+                    'type': 'ApiUsageError',
+                }]
+            })
+
+    @inlineCallbacks
+    def test_stream_events_unknown_format(self):
+        '''Streaming events in an unknown format should be an error'''
+        yield self.create_event_stream_channel()
+        resp = yield self.get(
+            '/channels/test-channel/events/stream', {'format': 'xml'})
+        yield self.assert_response(
+            resp, http.BAD_REQUEST, 'api usage error', {
+                'errors': [{
+                    'message': "Unknown stream format 'xml', expected one "
+                               "of ndjson, sse",
+                    'type': 'ApiUsageError',
+                }]
+            })
 
     @inlineCallbacks
     def test_get_channel_logs_no_logs(self):
@@ -2376,6 +3403,35 @@ class TestJunebugApi(JunebugTestBase):
                 'events': [event_dict],
             })
 
+    @inlineCallbacks
+    def test_get_destination_message_status_wait(self):
+        '''If wait is given, the status should be returned once the next
+        event of the message is stored for the destination'''
+        router_config = self.create_router_config()
+        resp = yield self.post('/routers/', router_config)
+        router_id = (yield resp.json())['result']['id']
+
+        dest_config = self.create_destination_config(
+            config={'channel': 'channel-id'})
+        resp = yield self.post(
+            '/routers/{}/destinations/'.format(router_id), dest_config)
+        destination_id = (yield resp.json())['result']['id']
+
+        d = self.get(
+            '/routers/{}/destinations/{}/messages/message-id'.format(
+                router_id, destination_id), {'wait': '30'})
+        yield self.wait_for_waiters(1)
+
+        event = TransportEvent(
+            user_message_id='message-id', sent_message_id='message-id',
+            event_type='nack', nack_reason='error error')
+        yield self.outbounds.store_event(destination_id, 'message-id', event)
+        yield notify_event(self.api.redis, destination_id, 'message-id')
+
+        resp = yield d
+        data = yield resp.json()
+        self.assertEqual(data['result']['last_event_type'], 'rejected')
+
     @inlineCallbacks
     def test_get_destination_message_status_multiple_events(self):
         '''Returns the last event details for last event fields, and list with
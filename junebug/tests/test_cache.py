@@ -0,0 +1,249 @@
+import json
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+from twisted.internet.task import Clock
+from vumi.persist.redis_base import ClientProxy
+
+from junebug.cache import (
+    CacheInvalidationListener, ConfigCache, INVALIDATION_CHANNEL, LRUCache,
+    get_shared_cache, supports_pubsub)
+from junebug.tests.helpers import JunebugTestBase
+
+
+class FakePublishingClient(object):
+    '''Redis client that records published messages'''
+    def __init__(self):
+        self.published = []
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+        return succeed(1)
+
+
+class TestConfigCache(JunebugTestBase):
+    @inlineCallbacks
+    def create_cache(self, ttl=60):
+        redis = yield self.get_redis()
+        self.clock = Clock()
+        returnValue(ConfigCache(redis, 'things', ttl, clock=self.clock))
+
+    @inlineCallbacks
+    def get_publishing_redis(self):
+        redis = yield self.get_redis()
+        redis = redis.sub_manager('publishing')
+        redis._client_proxy = ClientProxy(FakePublishingClient())
+        returnValue(redis)
+
+    @inlineCallbacks
+    def test_get_missing(self):
+        '''If there is no cached value, None should be returned'''
+        cache = yield self.create_cache()
+        self.assertEqual(cache.get('thing-id'), None)
+
+    @inlineCallbacks
+    def test_set_get(self):
+        '''Values that are set should be returned by get as copies'''
+        cache = yield self.create_cache()
+        value = {'foo': {'bar': 'baz'}}
+        cache.set('thing-id', value)
+        value['foo']['bar'] = 'changed'
+
+        cached = cache.get('thing-id')
+        self.assertEqual(cached, {'foo': {'bar': 'baz'}})
+        cached['foo']['bar'] = 'changed'
+        self.assertEqual(cache.get('thing-id'), {'foo': {'bar': 'baz'}})
+
+    @inlineCallbacks
+    def test_ttl(self):
+        '''Values should be removed once they have been cached for the ttl'''
+        cache = yield self.create_cache(ttl=10)
+        cache.set('thing-id', {'foo': 'bar'})
+        self.clock.advance(9)
+        self.assertEqual(cache.get('thing-id'), {'foo': 'bar'})
+        self.clock.advance(1)
+        self.assertEqual(cache.get('thing-id'), None)
+
+    @inlineCallbacks
+    def test_ttl_zero(self):
+        '''If the ttl is 0, nothing should be cached'''
+        cache = yield self.create_cache(ttl=0)
+        cache.set('thing-id', {'foo': 'bar'})
+        self.assertEqual(cache.get('thing-id'), None)
+
+    @inlineCallbacks
+    def test_discard_and_clear(self):
+        '''Values can be removed individually or all at once'''
+        cache = yield self.create_cache()
+        cache.set('thing-1', {})
+        cache.set('thing-2', {})
+        cache.set('thing-3', {})
+
+        cache.discard('thing-1')
+        self.assertEqual(cache.get('thing-1'), None)
+        self.assertEqual(cache.get('thing-2'), {})
+
+        cache.clear()
+        self.assertEqual(cache.get('thing-2'), None)
+        self.assertEqual(cache.get('thing-3'), None)
+
+    @inlineCallbacks
+    def test_set_generation(self):
+        '''Values should not be cached with a generation from before their
+        entry was discarded'''
+        cache = yield self.create_cache()
+        generation = cache.generation('thing-1')
+        cache.set('thing-1', {'foo': 'bar'}, generation)
+        self.assertEqual(cache.get('thing-1'), {'foo': 'bar'})
+
+        cache.discard('thing-1')
+        cache.set('thing-1', {'foo': 'stale'}, generation)
+        self.assertEqual(cache.get('thing-1'), None)
+        cache.set('thing-1', {'foo': 'baz'}, cache.generation('thing-1'))
+        self.assertEqual(cache.get('thing-1'), {'foo': 'baz'})
+
+        generation = cache.generation('thing-2')
+        cache.discard('thing-1')
+        cache.set('thing-2', {}, generation)
+        self.assertEqual(cache.get('thing-2'), {})
+
+        cache.clear()
+        cache.set('thing-2', {}, generation)
+        self.assertEqual(cache.get('thing-2'), None)
+
+    @inlineCallbacks
+    def test_invalidate_without_pubsub(self):
+        '''If the redis client cannot publish, invalidating should only remove
+        the value locally'''
+        cache = yield self.create_cache()
+        self.assertFalse(supports_pubsub(cache.redis))
+        cache.set('thing-id', {})
+        yield cache.invalidate('thing-id')
+        self.assertEqual(cache.get('thing-id'), None)
+
+    @inlineCallbacks
+    def test_invalidate_publishes(self):
+        '''Invalidating a value should publish the invalidation'''
+        redis = yield self.get_publishing_redis()
+        cache = ConfigCache(redis, 'things', 60)
+        cache.set('thing-id', {})
+        yield cache.invalidate('thing-id')
+        self.assertEqual(cache.get('thing-id'), None)
+        self.assertEqual(redis._client.published, [
+            (redis._key(INVALIDATION_CHANNEL),
+             json.dumps(['things', 'thing-id'])),
+        ])
+
+
+class TestLRUCache(JunebugTestBase):
+    def create_cache(self, max_size=10, ttl=None):
+        self.clock = Clock()
+        return LRUCache(max_size, ttl, clock=self.clock)
+
+    def test_get_missing(self):
+        '''Missing entries return None and count as misses'''
+        cache = self.create_cache()
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats(), {
+            'size': 0, 'max_size': 10, 'hits': 0, 'misses': 1})
+
+    def test_set_get(self):
+        '''Cached entries are returned and count as hits'''
+        cache = self.create_cache()
+        cache.set('a', ('url', 'token'))
+        self.assertEqual(cache.get('a'), ('url', 'token'))
+        self.assertEqual(cache.stats(), {
+            'size': 1, 'max_size': 10, 'hits': 1, 'misses': 0})
+
+    def test_max_size(self):
+        '''The least recently used entry is discarded once the cache is
+        full'''
+        cache = self.create_cache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_max_size_zero(self):
+        '''Nothing is cached if the max size is 0'''
+        cache = self.create_cache(max_size=0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), None)
+
+    def test_ttl(self):
+        '''Entries expire after the ttl'''
+        cache = self.create_cache(ttl=5)
+        cache.set('a', 1)
+        self.clock.advance(4)
+        self.assertEqual(cache.get('a'), 1)
+        self.clock.advance(1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+
+class TestGetSharedCache(JunebugTestBase):
+    @inlineCallbacks
+    def test_shared(self):
+        '''Managers with the same config share the cache with the same
+        name'''
+        redis = yield self.get_redis()
+        cache = get_shared_cache(redis, 'things', 10, 60)
+        self.assertEqual(cache.max_size, 10)
+        self.assertEqual(cache.ttl, 60)
+        self.assertIdentical(
+            get_shared_cache(redis.sub_manager('foo'), 'things', 20), cache)
+        self.assertNotIdentical(
+            get_shared_cache(redis, 'others', 10), cache)
+
+
+class TestCacheInvalidationListener(JunebugTestBase):
+    @inlineCallbacks
+    def create_listener(self):
+        redis = yield self.get_redis()
+        listener = CacheInvalidationListener({}, redis)
+        self.things = ConfigCache(redis, 'things', 60)
+        self.others = ConfigCache(redis, 'others', 60)
+        listener.add_cache(self.things)
+        listener.add_cache(self.others)
+        returnValue(listener)
+
+    @inlineCallbacks
+    def test_invalidation_received(self):
+        '''Received invalidations should remove the value from the correct
+        cache'''
+        listener = yield self.create_listener()
+        self.things.set('id', {})
+        self.others.set('id', {})
+
+        listener.invalidation_received(json.dumps(['things', 'id']))
+        self.assertEqual(self.things.get('id'), None)
+        self.assertEqual(self.others.get('id'), {})
+
+    @inlineCallbacks
+    def test_invalidation_received_unknown_cache(self):
+        '''Invalidations for unknown caches should be ignored'''
+        listener = yield self.create_listener()
+        self.things.set('id', {})
+        listener.invalidation_received(json.dumps(['unknown', 'id']))
+        self.assertEqual(self.things.get('id'), {})
+
+    @inlineCallbacks
+    def test_invalidation_received_invalid(self):
+        '''Invalid invalidations should be logged and ignored'''
+        self.patch_logger()
+        listener = yield self.create_listener()
+        listener.invalidation_received('not json')
+        self.assert_was_logged("Invalid cache invalidation 'not json'")
+
+    @inlineCallbacks
+    def test_connected(self):
+        '''All caches should be cleared on connection, as invalidations could
+        have been missed'''
+        listener = yield self.create_listener()
+        self.things.set('id', {})
+        self.others.set('id', {})
+        listener.connected()
+        self.assertEqual(self.things.get('id'), None)
+        self.assertEqual(self.others.get('id'), None)
@@ -1,14 +1,17 @@
 import logging
 import json
+import junebug
 from twisted.internet.defer import inlineCallbacks
 from vumi.message import TransportUserMessage, TransportStatus
 from vumi.transports.telnet import TelnetServerTransport
 
+from junebug.cache import ConfigCache
 from junebug.utils import api_from_message, api_from_status, conjoin
 from junebug.workers import ChannelStatusWorker, MessageForwardingWorker
 from junebug.channel import (
     Channel, ChannelNotFound, InvalidChannelType, MessageNotFound)
 from junebug.logging_service import JunebugLoggerService
+from junebug.stores import ChannelIndexStore, RetryQueueStore
 from junebug.tests.helpers import JunebugTestBase, FakeJunebugPlugin
 
 
@@ -55,6 +58,17 @@ class TestChannel(JunebugTestBase):
         channel_list = yield self.redis.get('channels')
         self.assertEqual(channel_list, set())
 
+    @inlineCallbacks
+    def test_delete_channel_retries(self):
+        '''Deleting a channel should remove its retry queue'''
+        channel = yield self.create_channel(self.service, self.redis)
+        store = RetryQueueStore(self.redis)
+        yield store.add(channel.id, 'd1', {'url': 'http://a'}, 10)
+
+        yield channel.delete()
+        self.assertEqual((yield store.get_depth(channel.id)), 0)
+        self.assertEqual((yield store.get_channels()), set())
+
     @inlineCallbacks
     def test_start_channel_transport(self):
         '''Starting the channel should start the transport, as well as the
@@ -174,6 +188,30 @@ class TestChannel(JunebugTestBase):
             'inbound_ttl': channel.config.inbound_message_ttl,
             'outbound_ttl': channel.config.outbound_message_ttl,
             'metric_window': channel.config.metric_window,
+            'metric_flush_interval': channel.config.metric_flush_interval,
+            'event_route_cache_size': channel.config.event_route_cache_size,
+            'message_codec': channel.config.message_codec,
+            'project_stored_messages': channel.config.project_stored_messages,
+            'redis_pool_size': channel.config.redis_pool_size,
+            'priority_window': channel.config.priority_window,
+            'event_log_size': 0,
+            'webhook_max_persistent_per_host': (
+                channel.config.webhook_max_persistent_per_host),
+            'webhook_idle_timeout': channel.config.webhook_idle_timeout,
+            'webhook_tls_session_reuse': (
+                channel.config.webhook_tls_session_reuse),
+            'webhook_breaker_error_rate': (
+                channel.config.webhook_breaker_error_rate),
+            'webhook_breaker_slow_threshold': (
+                channel.config.webhook_breaker_slow_threshold),
+            'webhook_breaker_reset_timeout': (
+                channel.config.webhook_breaker_reset_timeout),
+            'webhook_retry_rate': channel.config.webhook_retry_rate,
+            'webhook_retry_base_delay': (
+                channel.config.webhook_retry_base_delay),
+            'webhook_retry_max_delay': channel.config.webhook_retry_max_delay,
+            'webhook_retry_max_attempts': (
+                channel.config.webhook_retry_max_attempts),
         })
 
     @inlineCallbacks
@@ -192,6 +230,18 @@ class TestChannel(JunebugTestBase):
             'redis_manager': channel.config.redis,
             'channel_id': channel.id,
             'status_url': None,
+            'redis_pool_size': channel.config.redis_pool_size,
+            'webhook_max_persistent_per_host': (
+                channel.config.webhook_max_persistent_per_host),
+            'webhook_idle_timeout': channel.config.webhook_idle_timeout,
+            'webhook_tls_session_reuse': (
+                channel.config.webhook_tls_session_reuse),
+            'webhook_breaker_error_rate': (
+                channel.config.webhook_breaker_error_rate),
+            'webhook_breaker_slow_threshold': (
+                channel.config.webhook_breaker_slow_threshold),
+            'webhook_breaker_reset_timeout': (
+                channel.config.webhook_breaker_reset_timeout),
         })
 
     @inlineCallbacks
@@ -311,6 +361,67 @@ class TestChannel(JunebugTestBase):
         self.assertEqual(self.service.namedServices[id], worker2)
         self.assertTrue(worker1 not in self.service.services)
 
+    @inlineCallbacks
+    def test_update_channel_event_stream(self):
+        '''Enabling the event stream of a channel should restart its
+        application with an event log'''
+        channel = yield self.create_channel(
+            self.service, self.redis)
+        worker1 = channel.application_worker
+        self.assertEqual(worker1.config['event_log_size'], 0)
+        self.assertFalse(channel.event_stream)
+
+        yield channel.update({'event_stream': True})
+
+        worker2 = channel.application_worker
+        self.assertTrue(worker1 not in self.service.services)
+        self.assertTrue(channel.event_stream)
+        self.assertEqual(
+            worker2.config['event_log_size'], channel.config.event_log_size)
+
+    @inlineCallbacks
+    def test_update_channel_mo_batch_size(self):
+        '''Enabling batching should restart the application of the channel
+        with batching, and enough prefetched messages for two batches'''
+        channel = yield self.create_channel(
+            self.service, self.redis)
+        worker1 = channel.application_worker
+        self.assertEqual(worker1.config.get('mo_batch_size'), None)
+
+        yield channel.update({'mo_batch_size': 50})
+        worker2 = channel.application_worker
+        self.assertTrue(worker1 not in self.service.services)
+        self.assertEqual(worker2.config['mo_batch_size'], 50)
+        self.assertEqual(worker2.config['mo_batch_max_delay_ms'], 100)
+        self.assertEqual(worker2.config['amqp_prefetch_count'], 100)
+
+        yield channel.update({'mo_batch_size': 5, 'mo_batch_max_delay_ms': 20})
+        worker3 = channel.application_worker
+        self.assertEqual(worker3.config['mo_batch_size'], 5)
+        self.assertEqual(worker3.config['mo_batch_max_delay_ms'], 20)
+        self.assertEqual(worker3.config['amqp_prefetch_count'], 20)
+
+    @inlineCallbacks
+    def test_start_channel_max_in_flight(self):
+        '''If a maximum amount of messages in flight is set, the application
+        worker should consume that many messages at a time'''
+        config = yield self.create_channel_config(
+            channels={
+                'telnet': 'vumi.transports.telnet.TelnetServerTransport',
+            },
+            logging_path=self.mktemp(),
+            max_in_flight=50)
+        channel = yield self.create_channel(
+            self.service, self.redis, config=config)
+        worker = channel.application_worker
+        self.assertEqual(worker.config['max_in_flight'], 50)
+        self.assertEqual(worker.config['amqp_prefetch_count'], 50)
+
+        yield channel.update({'mo_batch_size': 40})
+        worker = channel.application_worker
+        self.assertEqual(worker.config['max_in_flight'], 50)
+        self.assertEqual(worker.config['amqp_prefetch_count'], 80)
+
     @inlineCallbacks
     def test_stop_channel(self):
         channel = yield self.create_channel(
@@ -350,6 +461,67 @@ class TestChannel(JunebugTestBase):
             channel1.status_application_worker,
             channel2.status_application_worker)
 
+    @inlineCallbacks
+    def test_create_channel_from_id_cached(self):
+        '''If a cache is given, the channel properties should be loaded from
+        the cache once they have been loaded from redis'''
+        channel1 = yield self.create_channel(
+            self.service, self.redis)
+        cache = ConfigCache(self.redis, 'channels', 60)
+
+        channel2 = yield Channel.from_id(
+            self.redis, self.config, channel1.id, self.service, cache=cache)
+        yield self.redis.delete('%s:properties' % channel1.id)
+        channel3 = yield Channel.from_id(
+            self.redis, self.config, channel1.id, self.service, cache=cache)
+
+        self.assertEqual(channel2._properties, channel3._properties)
+        self.assertEqual(channel3.cache, cache)
+
+    @inlineCallbacks
+    def test_create_channel_from_id_invalidated(self):
+        '''If the cached properties are invalidated while they are being
+        loaded, the loaded properties should not be cached'''
+        channel = yield self.create_channel(self.service, self.redis)
+        cache = ConfigCache(self.redis, 'channels', 60)
+
+        d = Channel.from_id(
+            self.redis, self.config, channel.id, self.service, cache=cache)
+        cache.discard(channel.id)
+        yield d
+        self.assertEqual(cache.get(channel.id), None)
+
+        yield Channel.from_id(
+            self.redis, self.config, channel.id, self.service, cache=cache)
+        self.assertEqual(cache.get(channel.id), channel._properties)
+
+    @inlineCallbacks
+    def test_save_channel_updates_cache(self):
+        '''Saving a channel should update its cached properties'''
+        cache = ConfigCache(self.redis, 'channels', 60)
+        channel = yield self.create_channel(self.service, self.redis)
+        channel.cache = cache
+        cache.set(channel.id, {'old': 'properties'})
+
+        yield channel.save()
+        self.assertEqual(cache.get(channel.id), channel._properties)
+
+    @inlineCallbacks
+    def test_delete_channel_invalidates_cache(self):
+        '''Deleting a channel should remove its cached properties'''
+        cache = ConfigCache(self.redis, 'channels', 60)
+        channel = yield self.create_channel(self.service, self.redis)
+        channel.cache = cache
+        yield channel.save()
+
+        yield channel.delete()
+        self.assertEqual(cache.get(channel.id), None)
+        yield self.assertFailure(
+            Channel.from_id(
+                self.redis, self.config, channel.id, self.service,
+                cache=cache),
+            ChannelNotFound)
+
     @inlineCallbacks
     def test_create_channel_from_unknown_id(self):
         yield self.assertFailure(
@@ -510,6 +682,107 @@ class TestChannel(JunebugTestBase):
         self.assertTrue(channel1.id in self.service.namedServices)
         self.assertTrue(channel2.id in self.service.namedServices)
 
+    @inlineCallbacks
+    def test_save_indexes_channel(self):
+        '''Saving a channel should index it, and deleting it should remove
+        it from the index'''
+        channel = Channel(
+            self.redis, self.config,
+            self.create_channel_properties(label='foo'), id='channel-id')
+        yield channel.save()
+        self.assertEqual(
+            (yield channel.index.list(10, label='foo')),
+            (['channel-id'], None))
+
+        channel._properties['label'] = 'bar'
+        yield channel.save()
+        self.assertEqual(
+            (yield channel.index.list(10, label='foo')), ([], None))
+        self.assertEqual(
+            (yield channel.index.list(10, label='bar')),
+            (['channel-id'], None))
+
+        yield channel.delete()
+        self.assertEqual((yield channel.index.list(10)), ([], None))
+
+    @inlineCallbacks
+    def test_index_all(self):
+        '''Channels stored before channels were indexed should be
+        indexed'''
+        properties = self.create_channel_properties(label='foo')
+        yield self.redis.set(
+            'channel-id:properties', json.dumps(properties))
+        yield self.redis.sadd('channels', 'channel-id')
+        yield self.redis.delete('channel_index:version')
+
+        yield Channel.index_all(self.redis)
+        self.assertEqual(
+            (yield ChannelIndexStore(self.redis).list(10, label='foo')),
+            (['channel-id'], None))
+
+    @inlineCallbacks
+    def test_restart_workers(self):
+        '''The workers of a channel should be restarted with its stored
+        properties, or stopped if it no longer exists'''
+        channel = yield self.create_channel(
+            self.service, self.redis, id='channel-id')
+        transport = self.service.getServiceNamed('channel-id')
+
+        yield Channel.restart_workers(
+            self.redis, self.config, self.service, 'channel-id')
+        self.assertTrue('channel-id' in self.service.namedServices)
+        self.assertNotEqual(
+            self.service.getServiceNamed('channel-id'), transport)
+
+        yield channel.delete()
+        yield Channel.restart_workers(
+            self.redis, self.config, self.service, 'channel-id')
+        channel._restore(self.service)
+        self.assertFalse('channel-id' in self.service.namedServices)
+        self.assertFalse('status:channel-id' in self.service.namedServices)
+
+    @inlineCallbacks
+    def test_sync_workers(self):
+        '''Workers should be stopped for deleted channels, and started for
+        stored channels that are not running'''
+        channel1 = yield self.create_channel(self.service, self.redis)
+        channel2 = yield self.create_channel(self.service, self.redis)
+        yield channel1.stop()
+        yield channel2.delete()
+
+        yield Channel.sync_workers(self.redis, self.config, self.service)
+        channel1._restore(self.service)
+        channel2._restore(self.service)
+        self.assertTrue(channel1.id in self.service.namedServices)
+        self.assertFalse(channel2.id in self.service.namedServices)
+
+    @inlineCallbacks
+    def test_api_only(self):
+        '''In API only processes, the supervising process should be asked to
+        restart the workers of a channel instead of running them'''
+        requests = []
+        self.patch(
+            junebug.channel, 'request_restart',
+            lambda redis, name, id: requests.append((name, id)))
+        config = yield self.create_channel_config(api_only=True)
+        channel = Channel(
+            self.redis, config, self.create_channel_properties(),
+            id='channel-id')
+
+        yield channel.save()
+        yield channel.start(self.service)
+        self.assertFalse('channel-id' in self.service.namedServices)
+
+        restored = yield Channel.from_id(
+            self.redis, config, 'channel-id', self.service)
+        self.assertEqual(restored.transport_worker, None)
+        yield restored.update({'mo_url': 'http://example.org'})
+        yield restored.update({'label': 'foo'})
+        yield restored.stop()
+        yield restored.delete()
+
+        self.assertEqual(requests, [('channel-workers', 'channel-id')] * 3)
+
     @inlineCallbacks
     def test_send_message(self):
         '''The send_message function should place the message on the correct
@@ -529,6 +802,48 @@ class TestChannel(JunebugTestBase):
             'channel-id.outbound')
         self.assertEqual(msg['message_id'], dispatched_message['message_id'])
 
+    @inlineCallbacks
+    def test_send_message_priority_lanes(self):
+        '''If priority lanes are enabled, the send_message function should
+        place the message on the lane for its priority'''
+        config = yield self.create_channel_config(
+            channels={
+                'telnet': 'vumi.transports.telnet.TelnetServerTransport',
+            },
+            logging_path=self.mktemp(),
+            priority_window=2)
+        channel = yield self.create_channel(
+            self.service, self.redis, id='channel-id', config=config)
+        msg1 = yield channel.send_message(
+            self.message_sender, self.outbounds, {
+                'from': '+1234',
+                'content': 'testcontent',
+                'priority': 5,
+            })
+        msg2 = yield channel.send_message(
+            self.message_sender, self.outbounds, {
+                'from': '+1234',
+                'content': 'testcontent',
+            })
+        msg3 = yield channel.send_message(
+            self.message_sender, self.outbounds, {
+                'from': '+1234',
+                'content': 'testcontent',
+                'priority': 'high',
+            })
+
+        [dispatched1] = self.get_dispatched_messages(
+            'channel-id.outbound.priority.5')
+        self.assertEqual(msg1['message_id'], dispatched1['message_id'])
+        [dispatched2] = self.get_dispatched_messages(
+            'channel-id.outbound.priority.1')
+        self.assertEqual(msg2['message_id'], dispatched2['message_id'])
+        [dispatched3] = self.get_dispatched_messages(
+            'channel-id.outbound.priority.4')
+        self.assertEqual(msg3['message_id'], dispatched3['message_id'])
+        self.assertEqual(
+            self.get_dispatched_messages('channel-id.outbound'), [])
+
     @inlineCallbacks
     def test_send_message_event_url(self):
         '''Sending a message with a specified event url should store the event
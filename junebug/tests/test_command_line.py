@@ -306,6 +306,299 @@ class TestCommandLine(JunebugTestBase):
         config = parse_arguments(['-mw', '2.0'])
         self.assertEqual(config.metric_window, 2.0)
 
+    def test_parse_arguments_metric_flush_interval(self):
+        '''The metric flush interval can be specified by
+        "--metric-flush-interval" or "-mfi"'''
+        config = parse_arguments([])
+        self.assertEqual(config.metric_flush_interval, None)
+
+        config = parse_arguments(['--metric-flush-interval', '0.5'])
+        self.assertEqual(config.metric_flush_interval, 0.5)
+
+        config = parse_arguments(['-mfi', '0.5'])
+        self.assertEqual(config.metric_flush_interval, 0.5)
+
+    def test_parse_arguments_config_cache_ttl(self):
+        '''The config cache ttl can be specified by "--config-cache-ttl" or
+        "-cct"'''
+        config = parse_arguments([])
+        self.assertEqual(config.config_cache_ttl, 60.0)
+
+        config = parse_arguments(['--config-cache-ttl', '5'])
+        self.assertEqual(config.config_cache_ttl, 5.0)
+
+        config = parse_arguments(['-cct', '0'])
+        self.assertEqual(config.config_cache_ttl, 0.0)
+
+    def test_parse_arguments_event_route_cache_size(self):
+        '''The event route cache size can be specified by
+        "--event-route-cache-size" or "-ercs"'''
+        config = parse_arguments([])
+        self.assertEqual(config.event_route_cache_size, 10000)
+
+        config = parse_arguments(['--event-route-cache-size', '5'])
+        self.assertEqual(config.event_route_cache_size, 5)
+
+        config = parse_arguments(['-ercs', '0'])
+        self.assertEqual(config.event_route_cache_size, 0)
+
+    def test_parse_arguments_message_codec(self):
+        '''The message codec can be specified by "--message-codec" or
+        "-mc"'''
+        config = parse_arguments([])
+        self.assertEqual(config.message_codec, 'json')
+
+        config = parse_arguments(['--message-codec', 'zlib'])
+        self.assertEqual(config.message_codec, 'zlib')
+
+        config = parse_arguments(['-mc', 'msgpack'])
+        self.assertEqual(config.message_codec, 'msgpack')
+
+    def test_parse_arguments_project_stored_messages(self):
+        '''Projecting stored messages can be enabled by
+        "--project-stored-messages" or "-psm"'''
+        config = parse_arguments([])
+        self.assertEqual(config.project_stored_messages, False)
+
+        config = parse_arguments(['--project-stored-messages'])
+        self.assertEqual(config.project_stored_messages, True)
+
+        config = parse_arguments(['-psm'])
+        self.assertEqual(config.project_stored_messages, True)
+
+    def test_parse_arguments_redis_pool_size(self):
+        '''The redis pool size can be specified by "--redis-pool-size" or
+        "-rps"'''
+        config = parse_arguments([])
+        self.assertEqual(config.redis_pool_size, 10)
+
+        config = parse_arguments(['--redis-pool-size', '5'])
+        self.assertEqual(config.redis_pool_size, 5)
+
+        config = parse_arguments(['-rps', '1'])
+        self.assertEqual(config.redis_pool_size, 1)
+
+    def test_parse_arguments_max_message_batch_size(self):
+        '''The maximum message batch size can be specified by
+        "--max-message-batch-size" or "-mmbs"'''
+        config = parse_arguments([])
+        self.assertEqual(config.max_message_batch_size, 1000)
+
+        config = parse_arguments(['--max-message-batch-size', '50'])
+        self.assertEqual(config.max_message_batch_size, 50)
+
+        config = parse_arguments(['-mmbs', '5'])
+        self.assertEqual(config.max_message_batch_size, 5)
+
+    def test_parse_arguments_message_stream_window(self):
+        '''The message stream window can be specified by
+        "--message-stream-window" or "-msw"'''
+        config = parse_arguments([])
+        self.assertEqual(config.message_stream_window, 100)
+
+        config = parse_arguments(['--message-stream-window', '50'])
+        self.assertEqual(config.message_stream_window, 50)
+
+        config = parse_arguments(['-msw', '5'])
+        self.assertEqual(config.message_stream_window, 5)
+
+    def test_parse_arguments_priority_window(self):
+        '''The priority window can be specified by "--priority-window" or
+        "-pw"'''
+        config = parse_arguments([])
+        self.assertEqual(config.priority_window, 0)
+
+        config = parse_arguments(['--priority-window', '50'])
+        self.assertEqual(config.priority_window, 50)
+
+        config = parse_arguments(['-pw', '5'])
+        self.assertEqual(config.priority_window, 5)
+
+    def test_parse_arguments_event_log_size(self):
+        '''The event log size can be specified by "--event-log-size" or
+        "-els"'''
+        config = parse_arguments([])
+        self.assertEqual(config.event_log_size, 1000)
+
+        config = parse_arguments(['--event-log-size', '500'])
+        self.assertEqual(config.event_log_size, 500)
+
+        config = parse_arguments(['-els', '50'])
+        self.assertEqual(config.event_log_size, 50)
+
+    def test_parse_arguments_event_stream_poll_interval(self):
+        '''The event stream poll interval can be specified by
+        "--event-stream-poll-interval" or "-espi"'''
+        config = parse_arguments([])
+        self.assertEqual(config.event_stream_poll_interval, 0.5)
+
+        config = parse_arguments(['--event-stream-poll-interval', '2'])
+        self.assertEqual(config.event_stream_poll_interval, 2.0)
+
+        config = parse_arguments(['-espi', '0.1'])
+        self.assertEqual(config.event_stream_poll_interval, 0.1)
+
+    def test_parse_arguments_webhook_max_persistent_per_host(self):
+        '''The maximum amount of idle connections per webhook host can be
+        specified by "--webhook-max-persistent-per-host" or "-wmph"'''
+        config = parse_arguments([])
+        self.assertEqual(config.webhook_max_persistent_per_host, 10)
+
+        config = parse_arguments(['--webhook-max-persistent-per-host', '20'])
+        self.assertEqual(config.webhook_max_persistent_per_host, 20)
+
+        config = parse_arguments(['-wmph', '2'])
+        self.assertEqual(config.webhook_max_persistent_per_host, 2)
+
+    def test_parse_arguments_webhook_idle_timeout(self):
+        '''The webhook idle timeout can be specified by
+        "--webhook-idle-timeout" or "-wit"'''
+        config = parse_arguments([])
+        self.assertEqual(config.webhook_idle_timeout, 240)
+
+        config = parse_arguments(['--webhook-idle-timeout', '60'])
+        self.assertEqual(config.webhook_idle_timeout, 60)
+
+        config = parse_arguments(['-wit', '5'])
+        self.assertEqual(config.webhook_idle_timeout, 5)
+
+    def test_parse_arguments_webhook_tls_session_reuse(self):
+        '''TLS session reuse for webhooks can be disabled by
+        "--no-webhook-tls-session-reuse" or "-nwtsr"'''
+        config = parse_arguments([])
+        self.assertEqual(config.webhook_tls_session_reuse, True)
+
+        config = parse_arguments(['--no-webhook-tls-session-reuse'])
+        self.assertEqual(config.webhook_tls_session_reuse, False)
+
+        config = parse_arguments(['-nwtsr'])
+        self.assertEqual(config.webhook_tls_session_reuse, False)
+
+    def test_parse_arguments_webhook_breaker_error_rate(self):
+        '''The error rate that opens a webhook circuit breaker can be
+        specified by "--webhook-breaker-error-rate" or "-wber"'''
+        config = parse_arguments([])
+        self.assertEqual(config.webhook_breaker_error_rate, 0.5)
+
+        config = parse_arguments(['--webhook-breaker-error-rate', '0.2'])
+        self.assertEqual(config.webhook_breaker_error_rate, 0.2)
+
+        config = parse_arguments(['-wber', '0'])
+        self.assertEqual(config.webhook_breaker_error_rate, 0)
+
+    def test_parse_arguments_webhook_breaker_slow_threshold(self):
+        '''The latency that counts as a failure for a webhook circuit breaker
+        can be specified by "--webhook-breaker-slow-threshold" or
+        "-wbst"'''
+        config = parse_arguments([])
+        self.assertEqual(config.webhook_breaker_slow_threshold, 5.0)
+
+        config = parse_arguments(['--webhook-breaker-slow-threshold', '2'])
+        self.assertEqual(config.webhook_breaker_slow_threshold, 2.0)
+
+        config = parse_arguments(['-wbst', '0.5'])
+        self.assertEqual(config.webhook_breaker_slow_threshold, 0.5)
+
+    def test_parse_arguments_webhook_breaker_reset_timeout(self):
+        '''The time a webhook circuit breaker stays open for can be
+        specified by "--webhook-breaker-reset-timeout" or "-wbrt"'''
+        config = parse_arguments([])
+        self.assertEqual(config.webhook_breaker_reset_timeout, 30.0)
+
+        config = parse_arguments(['--webhook-breaker-reset-timeout', '60'])
+        self.assertEqual(config.webhook_breaker_reset_timeout, 60.0)
+
+        config = parse_arguments(['-wbrt', '5'])
+        self.assertEqual(config.webhook_breaker_reset_timeout, 5.0)
+
+    def test_parse_arguments_max_in_flight(self):
+        '''The maximum amount of messages in flight for each channel can be
+        specified by "--max-in-flight" or "-mif"'''
+        config = parse_arguments([])
+        self.assertEqual(config.max_in_flight, 0)
+
+        config = parse_arguments(['--max-in-flight', '50'])
+        self.assertEqual(config.max_in_flight, 50)
+
+        config = parse_arguments(['-mif', '5'])
+        self.assertEqual(config.max_in_flight, 5)
+
+    def test_parse_arguments_webhook_retry_rate(self):
+        '''The webhook retry rate can be specified by "--webhook-retry-rate"
+        or "-wrr"'''
+        config = parse_arguments([])
+        self.assertEqual(config.webhook_retry_rate, 100)
+
+        config = parse_arguments(['--webhook-retry-rate', '10'])
+        self.assertEqual(config.webhook_retry_rate, 10)
+
+        config = parse_arguments(['-wrr', '0'])
+        self.assertEqual(config.webhook_retry_rate, 0)
+
+    def test_parse_arguments_webhook_retry_base_delay(self):
+        '''The delay before the first webhook retry can be specified by
+        "--webhook-retry-base-delay" or "-wrbd"'''
+        config = parse_arguments([])
+        self.assertEqual(config.webhook_retry_base_delay, 1.0)
+
+        config = parse_arguments(['--webhook-retry-base-delay', '5'])
+        self.assertEqual(config.webhook_retry_base_delay, 5.0)
+
+        config = parse_arguments(['-wrbd', '0.5'])
+        self.assertEqual(config.webhook_retry_base_delay, 0.5)
+
+    def test_parse_arguments_webhook_retry_max_delay(self):
+        '''The maximum delay between webhook retries can be specified by
+        "--webhook-retry-max-delay" or "-wrmd"'''
+        config = parse_arguments([])
+        self.assertEqual(config.webhook_retry_max_delay, 3600.0)
+
+        config = parse_arguments(['--webhook-retry-max-delay', '60'])
+        self.assertEqual(config.webhook_retry_max_delay, 60.0)
+
+        config = parse_arguments(['-wrmd', '1.5'])
+        self.assertEqual(config.webhook_retry_max_delay, 1.5)
+
+    def test_parse_arguments_webhook_retry_max_attempts(self):
+        '''The amount of attempts after which a webhook delivery is given up
+        on can be specified by "--webhook-retry-max-attempts" or "-wrma"'''
+        config = parse_arguments([])
+        self.assertEqual(config.webhook_retry_max_attempts, 20)
+
+        config = parse_arguments(['--webhook-retry-max-attempts', '5'])
+        self.assertEqual(config.webhook_retry_max_attempts, 5)
+
+        config = parse_arguments(['-wrma', '3'])
+        self.assertEqual(config.webhook_retry_max_attempts, 3)
+
+    def test_parse_arguments_api_workers(self):
+        '''The amount of API processes can be specified by "--api-workers" or
+        "-aw"'''
+        config = parse_arguments([])
+        self.assertEqual(config.api_workers, 0)
+        self.assertEqual(config.api_only, False)
+
+        config = parse_arguments(['--api-workers', '4'])
+        self.assertEqual(config.api_workers, 4)
+
+        config = parse_arguments(['-aw', '2'])
+        self.assertEqual(config.api_workers, 2)
+
+        config = parse_arguments(['--api-only'])
+        self.assertEqual(config.api_only, True)
+
+    def test_parse_arguments_rate_limit_lease_size(self):
+        '''The rate limit lease size can be specified by
+        "--rate-limit-lease-size" or "-rlls"'''
+        config = parse_arguments([])
+        self.assertEqual(config.rate_limit_lease_size, 0)
+
+        config = parse_arguments(['--rate-limit-lease-size', '50'])
+        self.assertEqual(config.rate_limit_lease_size, 50)
+
+        config = parse_arguments(['-rlls', '5'])
+        self.assertEqual(config.rate_limit_lease_size, 5)
+
     def test_parse_arguments_logging_path(self):
         '''The logging path can be specified by "--logging-path" or "-lp"'''
         config = parse_arguments([])
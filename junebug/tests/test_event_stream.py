@@ -0,0 +1,198 @@
+import json
+
+from twisted.internet.defer import CancelledError, fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from junebug import event_stream
+from junebug.event_stream import (
+    EventStreams, NDJSONSubscriber, SSESubscriber)
+
+
+class FakeEventLog(object):
+    def __init__(self):
+        self.events = {}
+        self.reads = []
+
+    def append(self, channel_id, event):
+        events = self.events.setdefault(channel_id, [])
+        events.append((len(events) + 1, event))
+
+    def read(self, channel_id, offset, limit):
+        self.reads.append((channel_id, offset))
+        events = self.events.get(channel_id, [])
+        return succeed([e for e in events if e[0] > offset][:limit])
+
+
+class FakeRequest(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+
+class TestSubscribers(TestCase):
+    def test_sse(self):
+        '''Events should be written as server-sent events, with the offset
+        as the event id'''
+        request = FakeRequest()
+        subscriber = SSESubscriber(request, 0, Clock())
+        subscriber.send(3, {u'event_type': u'ack', u'event_id': u'e1'})
+
+        [data] = request.written
+        self.assertTrue(isinstance(data, str))
+        lines = data.split('\n')
+        self.assertEqual(lines[:2], ['id: 3', 'event: ack'])
+        self.assertTrue(lines[2].startswith('data: '))
+        self.assertEqual(
+            json.loads(lines[2][len('data: '):]),
+            {'event_type': 'ack', 'event_id': 'e1'})
+        self.assertEqual(lines[3:], ['', ''])
+        self.assertEqual(subscriber.offset, 3)
+
+    def test_ndjson(self):
+        '''Events should be written as a line of JSON with the offset'''
+        request = FakeRequest()
+        subscriber = NDJSONSubscriber(request, 0, Clock())
+        subscriber.send(3, {'event_type': 'ack'})
+
+        [data] = request.written
+        self.assertTrue(data.endswith('\n'))
+        self.assertEqual(json.loads(data), {
+            'offset': 3,
+            'event': {'event_type': 'ack'},
+        })
+
+    def test_keepalive(self):
+        '''A keepalive should only be written once nothing has been written
+        for the keepalive interval'''
+        clock = Clock()
+        request = FakeRequest()
+        subscriber = SSESubscriber(request, 0, clock)
+
+        clock.advance(event_stream.KEEPALIVE_INTERVAL - 1)
+        subscriber.keepalive()
+        self.assertEqual(request.written, [])
+
+        clock.advance(1)
+        subscriber.keepalive()
+        self.assertEqual(request.written, [': keepalive\n\n'])
+
+        subscriber.keepalive()
+        self.assertEqual(request.written, [': keepalive\n\n'])
+
+
+class TestEventStreams(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.log = FakeEventLog()
+        self.streams = EventStreams(self.log, 1, self.clock)
+
+    def subscribe(self, channel_id, offset=0):
+        request = FakeRequest()
+        subscriber = NDJSONSubscriber(request, offset, self.clock)
+        d = self.streams.subscribe(channel_id, subscriber)
+        d.addErrback(lambda f: f.trap(CancelledError))
+        return request, d
+
+    def offsets(self, request):
+        return [json.loads(line)['offset'] for line in request.written]
+
+    def test_subscribe(self):
+        '''New events should be sent to subscribers on every poll'''
+        self.log.append('chan1', {'event_type': 'ack'})
+        request, _ = self.subscribe('chan1', offset=1)
+        self.assertEqual(request.written, [])
+
+        self.log.append('chan1', {'event_type': 'ack'})
+        self.log.append('chan1', {'event_type': 'nack'})
+        self.clock.advance(1)
+        self.assertEqual(self.offsets(request), [2, 3])
+
+        self.clock.advance(1)
+        self.assertEqual(self.offsets(request), [2, 3])
+
+    def test_resume(self):
+        '''Subscribers should be sent the events after their own offset'''
+        for _ in range(3):
+            self.log.append('chan1', {'event_type': 'ack'})
+        request1, _ = self.subscribe('chan1', offset=3)
+        request2, _ = self.subscribe('chan1', offset=1)
+        self.assertEqual(self.offsets(request1), [])
+
+        # Subscribers joining a running feed catch up on its next poll
+        self.clock.advance(1)
+        self.assertEqual(self.offsets(request1), [])
+        self.assertEqual(self.offsets(request2), [2, 3])
+
+        self.log.append('chan1', {'event_type': 'ack'})
+        self.clock.advance(1)
+        self.assertEqual(self.offsets(request1), [4])
+        self.assertEqual(self.offsets(request2), [2, 3, 4])
+
+    def test_one_read_per_poll(self):
+        '''The log of a channel should be read once per poll, no matter how
+        many subscribers it has'''
+        self.subscribe('chan1')
+        self.subscribe('chan1')
+        self.subscribe('chan2')
+        self.assertEqual(sorted(self.log.reads), [('chan1', 0), ('chan2', 0)])
+
+        self.clock.advance(1)
+        self.assertEqual(len(self.log.reads), 4)
+
+    def test_read_limit(self):
+        '''Logs with more than the read limit of new events should be read
+        until all of the events have been sent'''
+        self.patch(event_stream, 'READ_LIMIT', 2)
+        for _ in range(5):
+            self.log.append('chan1', {'event_type': 'ack'})
+        request, _ = self.subscribe('chan1')
+        self.assertEqual(self.offsets(request), [1, 2, 3, 4, 5])
+
+    def test_read_error(self):
+        '''Errors reading the log should be logged, and polling should
+        continue'''
+        errors = []
+        self.patch(
+            event_stream.logging, 'exception',
+            lambda msg: errors.append(msg))
+        read = self.log.read
+        self.log.read = lambda *a: fail(Exception('oops'))
+        request, _ = self.subscribe('chan1')
+        self.assertEqual(len(errors), 1)
+
+        self.log.read = read
+        self.log.append('chan1', {'event_type': 'ack'})
+        self.clock.advance(1)
+        self.assertEqual(self.offsets(request), [1])
+
+    def test_unsubscribe(self):
+        '''Cancelling the deferred of a subscriber should stop the events
+        being sent to it, and stop polling once there are no subscribers'''
+        request1, d1 = self.subscribe('chan1')
+        request2, d2 = self.subscribe('chan1')
+        self.assertEqual(self.streams.stats(), {'chan1': 2})
+
+        d1.cancel()
+        self.assertEqual(self.streams.stats(), {'chan1': 1})
+        self.log.append('chan1', {'event_type': 'ack'})
+        self.clock.advance(1)
+        self.assertEqual(self.offsets(request1), [])
+        self.assertEqual(self.offsets(request2), [1])
+
+        d2.cancel()
+        self.assertEqual(self.streams.stats(), {})
+        reads = len(self.log.reads)
+        self.clock.advance(1)
+        self.assertEqual(len(self.log.reads), reads)
+
+    def test_stop(self):
+        '''Stopping should stop polling all of the logs'''
+        self.subscribe('chan1')
+        self.streams.stop()
+        self.assertEqual(self.streams.stats(), {})
+        reads = len(self.log.reads)
+        self.clock.advance(1)
+        self.assertEqual(len(self.log.reads), reads)
@@ -0,0 +1,93 @@
+import json
+from datetime import datetime
+
+from twisted.trial.unittest import TestCase
+from vumi.message import date_time_decoder
+
+from junebug import json_codec
+from junebug.json_codec import (
+    JSONBackend, StdlibBackend, UjsonBackend, select_backend)
+
+
+class UnavailableBackend(JSONBackend):
+    NAME = 'unavailable'
+
+    @classmethod
+    def available(cls):
+        return False
+
+
+class TestJSONCodec(TestCase):
+    def test_dumps_datetime(self):
+        '''Datetimes should be encoded in the vumi date format'''
+        data = json_codec.dumps({'timestamp': datetime(2016, 1, 2, 3, 4, 5)})
+        self.assertEqual(
+            json.loads(data), {'timestamp': '2016-01-02 03:04:05.000000'})
+
+    def test_dumps_unserializable(self):
+        '''Objects that cannot be encoded should raise a TypeError'''
+        self.assertRaises(TypeError, json_codec.dumps, {'foo': object()})
+
+    def test_loads(self):
+        '''JSON should be decoded to unicode strings'''
+        self.assertEqual(
+            json_codec.loads('{"foo": ["bar", 1.5, null]}'),
+            {u'foo': [u'bar', 1.5, None]})
+
+    def test_loads_object_hook(self):
+        '''The object hook should be applied to every decoded object'''
+        data = json_codec.loads(
+            '{"a": {"timestamp": "2016-01-02 03:04:05.000000"}, "b": [{}]}',
+            object_hook=date_time_decoder)
+        self.assertEqual(data, {
+            'a': {'timestamp': datetime(2016, 1, 2, 3, 4, 5)},
+            'b': [{}],
+        })
+
+    def test_loads_invalid(self):
+        '''Invalid JSON should raise a ValueError'''
+        self.assertRaises(ValueError, json_codec.loads, '{')
+
+    def test_apply_object_hook(self):
+        '''Object hooks should be applied to the innermost objects first,
+        for decoders that do not support object hooks'''
+        seen = []
+
+        def object_hook(obj):
+            seen.append(sorted(obj))
+            return dict(obj, hooked=True)
+
+        data = json_codec._apply_object_hook(
+            {'a': [{'b': {}}], 'c': 1}, object_hook)
+        self.assertEqual(seen, [[], ['b'], ['a', 'c']])
+        self.assertEqual(data, {
+            'a': [{'b': {'hooked': True}, 'hooked': True}],
+            'c': 1,
+            'hooked': True,
+        })
+
+    def test_select_backend(self):
+        '''The first available backend should be selected, falling back to
+        the standard library'''
+        self.assertTrue(isinstance(
+            select_backend([UnavailableBackend, StdlibBackend]),
+            StdlibBackend))
+        self.assertTrue(isinstance(
+            select_backend([UnavailableBackend]), StdlibBackend))
+
+    def test_select_missing_library(self):
+        '''Backends should only be available if their library is
+        installed'''
+        self.patch(json_codec, 'ujson', None)
+        self.assertFalse(UjsonBackend.available())
+        self.assertTrue(isinstance(
+            select_backend(json_codec.DECODERS), StdlibBackend))
+
+    def test_get_backends(self):
+        '''The names of the active backends should be returned'''
+        self.patch(json_codec, 'encoder', StdlibBackend())
+        self.patch(json_codec, 'decoder', StdlibBackend())
+        self.assertEqual(json_codec.get_backends(), {
+            'encoder': 'json',
+            'decoder': 'json',
+        })
@@ -0,0 +1,143 @@
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from junebug.priority import (
+    PriorityScheduler, lane_routing_key, priority_level)
+
+
+class TestPriorityScheduler(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.published = []
+
+    def publish(self, message):
+        self.published.append(message['message_id'])
+        return succeed(None)
+
+    def create_scheduler(self, window, publish=None, slot_timeout=10):
+        if publish is None:
+            publish = self.publish
+        return PriorityScheduler(
+            publish, window, slot_timeout=slot_timeout, clock=self.clock)
+
+    def msg(self, message_id):
+        return {'message_id': message_id}
+
+    def test_lane_routing_key(self):
+        '''The routing key of a lane should include the channel and the
+        priority'''
+        self.assertEqual(
+            lane_routing_key('channel-id', 3),
+            'channel-id.outbound.priority.3')
+
+    def test_priority_level(self):
+        '''Priorities should be mapped to levels from integers, numeric
+        strings and names, with the default level for anything else'''
+        self.assertEqual(priority_level(4), 4)
+        self.assertEqual(priority_level('2'), 2)
+        self.assertEqual(priority_level(' High '), 4)
+        self.assertEqual(priority_level('urgent'), 5)
+        self.assertEqual(priority_level('foo'), 1)
+        self.assertEqual(priority_level('9'), 1)
+        self.assertEqual(priority_level(None), 1)
+
+    def test_window(self):
+        '''At most window messages should be in flight at a time'''
+        scheduler = self.create_scheduler(2)
+        for i in range(4):
+            scheduler.enqueue(1, self.msg('m%d' % i))
+        self.assertEqual(self.published, ['m0', 'm1'])
+        self.assertEqual(scheduler.stats(), {
+            'in_flight': 2,
+            'waiting': {1: 2, 2: 0, 3: 0, 4: 0, 5: 0},
+            'sent': {1: 2, 2: 0, 3: 0, 4: 0, 5: 0},
+        })
+
+        scheduler.message_done('m1')
+        self.assertEqual(self.published, ['m0', 'm1', 'm2'])
+
+    def test_enqueue_fires_when_published(self):
+        '''The deferred returned by enqueue should only fire once the message
+        has been published'''
+        scheduler = self.create_scheduler(1)
+        d1 = scheduler.enqueue(1, self.msg('m1'))
+        d2 = scheduler.enqueue(1, self.msg('m2'))
+        self.assertTrue(d1.called)
+        self.assertFalse(d2.called)
+        scheduler.message_done('m1')
+        self.assertTrue(d2.called)
+
+    def test_higher_priority_first(self):
+        '''Higher priority lanes should get the larger share of the window'''
+        scheduler = self.create_scheduler(1)
+        scheduler.enqueue(1, self.msg('block'))
+        for i in range(4):
+            scheduler.enqueue(1, self.msg('low%d' % i))
+            scheduler.enqueue(3, self.msg('high%d' % i))
+
+        for message_id in list(self.published):
+            scheduler.message_done(message_id)
+        while len(self.published) < 9:
+            scheduler.message_done(self.published[-1])
+
+        self.assertEqual(self.published[:6], [
+            'block', 'high0', 'high1', 'low0', 'high2', 'high3'])
+        self.assertEqual(self.published[6:], ['low1', 'low2', 'low3'])
+
+    def test_no_starvation(self):
+        '''Lower priority lanes should still be sent from while higher
+        priority lanes have messages waiting'''
+        scheduler = self.create_scheduler(1)
+        scheduler.enqueue(1, self.msg('low'))
+        for i in range(40):
+            scheduler.enqueue(5, self.msg('high%d' % i))
+        for i in range(20):
+            scheduler.message_done(self.published[-1])
+        self.assertTrue('low' in self.published)
+
+    def test_slot_timeout(self):
+        '''Messages that are not acked or nacked should stop counting
+        towards the window after the slot timeout'''
+        scheduler = self.create_scheduler(1, slot_timeout=5)
+        scheduler.enqueue(1, self.msg('m1'))
+        scheduler.enqueue(1, self.msg('m2'))
+        self.clock.advance(4)
+        self.assertEqual(self.published, ['m1'])
+        self.clock.advance(1)
+        self.assertEqual(self.published, ['m1', 'm2'])
+
+    def test_message_done_unknown(self):
+        '''Unknown and repeated message ids should be ignored'''
+        scheduler = self.create_scheduler(1)
+        scheduler.enqueue(1, self.msg('m1'))
+        scheduler.message_done('unknown')
+        scheduler.message_done('m1')
+        scheduler.message_done('m1')
+        self.assertEqual(scheduler.stats()['in_flight'], 0)
+
+    def test_publish_failed(self):
+        '''A message that fails to publish should free its slot, and the
+        failure should be passed on'''
+        def publish(message):
+            self.published.append(message['message_id'])
+            if message['message_id'] == 'bad':
+                return fail(Exception('publish failed'))
+            return succeed(None)
+
+        scheduler = self.create_scheduler(1, publish=publish)
+        d = scheduler.enqueue(1, self.msg('bad'))
+        scheduler.enqueue(1, self.msg('good'))
+        self.assertFailure(d, Exception)
+        self.assertEqual(self.published, ['bad', 'good'])
+        return d
+
+    def test_stop(self):
+        '''Stopping should cancel the slot timeouts'''
+        scheduler = self.create_scheduler(1)
+        d = Deferred()
+        scheduler.publish = lambda message: d
+        scheduler.enqueue(1, self.msg('m1'))
+        scheduler.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(scheduler.stats()['in_flight'], 0)
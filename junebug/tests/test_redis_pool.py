@@ -0,0 +1,148 @@
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from junebug.redis_pool import (
+    RedisPool, RedisPoolClosed, acquire_redis_manager, get_redis_pools)
+from junebug.tests.helpers import JunebugTestBase
+
+
+class TestRedisPool(JunebugTestBase):
+    @inlineCallbacks
+    def get_redis_config(self, **kw):
+        redis = yield self.get_redis()
+        config = dict(redis._config)
+        config.update(kw)
+        returnValue(config)
+
+    @inlineCallbacks
+    def acquire(self, config, pool_size=10):
+        manager = yield acquire_redis_manager(config, pool_size)
+        self.addCleanup(manager.close_manager)
+        returnValue(manager)
+
+    def get_pool(self, manager):
+        return manager._client_proxy.pool
+
+    @inlineCallbacks
+    def test_acquire_manager(self):
+        '''The acquired manager should use the configured redis'''
+        config = yield self.get_redis_config()
+        manager = yield self.acquire(config)
+
+        yield manager.set('foo', 'bar')
+        self.assertEqual((yield self.redis.get('foo')), 'bar')
+        self.assertEqual(manager.get_key_prefix(), config['key_prefix'])
+
+    @inlineCallbacks
+    def test_managers_share_pool(self):
+        '''Managers for the same redis server should share a pool, even if
+        their key prefixes differ'''
+        config = yield self.get_redis_config()
+        manager1 = yield self.acquire(config)
+        manager2 = yield self.acquire(dict(config, key_prefix='other'))
+
+        pool = self.get_pool(manager1)
+        self.assertIdentical(self.get_pool(manager2), pool)
+        self.assertEqual(len(pool.connections), 1)
+        self.assertEqual(pool.stats()['managers'], 2)
+        self.assertIn(pool, get_redis_pools())
+
+        yield manager2.set('foo', 'bar')
+        self.assertEqual((yield manager1.get('foo')), None)
+        self.assertEqual((yield manager2.get('foo')), 'bar')
+
+    @inlineCallbacks
+    def test_close_last_manager(self):
+        '''The pool should only be closed once all of its managers have been
+        closed, and each manager should only be released once'''
+        config = yield self.get_redis_config()
+        manager1 = yield acquire_redis_manager(config)
+        manager2 = yield acquire_redis_manager(config)
+        pool = self.get_pool(manager1)
+
+        yield manager1.close_manager()
+        yield manager1.close_manager()
+        self.assertFalse(pool.closed)
+        self.assertEqual(pool.leases, 1)
+
+        yield manager2.close_manager()
+        self.assertTrue(pool.closed)
+        self.assertEqual(pool.connections, [])
+        self.assertNotIn(pool, get_redis_pools())
+        self.assertRaises(RedisPoolClosed, pool.get_connection)
+
+    @inlineCallbacks
+    def test_sub_manager_close(self):
+        '''Closing a sub manager should not release the pool'''
+        config = yield self.get_redis_config()
+        manager = yield self.acquire(config)
+        pool = self.get_pool(manager)
+
+        sub_manager = manager.sub_manager('sub')
+        self.assertEqual(sub_manager.RESPONSE_ERROR, manager.RESPONSE_ERROR)
+        yield sub_manager.set('foo', 'bar')
+        yield sub_manager.close_manager()
+
+        self.assertEqual(pool.leases, 1)
+        self.assertEqual((yield manager.get('sub:foo')), 'bar')
+
+    @inlineCallbacks
+    def test_grows_with_load(self):
+        '''A new connection should only be opened once the existing
+        connections are busy, up to the maximum size of the pool'''
+        config = yield self.get_redis_config()
+        client_config = dict(config)
+        del client_config['key_prefix']
+        pool = RedisPool(client_config, max_size=2, max_in_flight=2)
+        self.addCleanup(pool.close)
+        yield pool.acquire(config)
+
+        [connection] = pool.connections
+        pool.request_started(connection)
+        self.assertIdentical(pool.get_connection(), connection)
+        self.assertEqual(len(pool.connections), 1)
+
+        pool.request_started(connection)
+        self.assertIdentical(pool.get_connection(), connection)
+        self.assertEqual(len(pool.connections), 2)
+
+        [_, new_connection] = pool.connections
+        self.assertIdentical(pool.get_connection(), new_connection)
+        pool.request_started(new_connection)
+        pool.request_started(new_connection)
+        pool.get_connection()
+        self.assertEqual(len(pool.connections), 2)
+
+        pool.request_finished(None, connection)
+        self.assertIdentical(pool.get_connection(), connection)
+
+    @inlineCallbacks
+    def test_stats(self):
+        '''The stats should reflect the utilisation of the pool'''
+        config = yield self.get_redis_config()
+        manager = yield self.acquire(config, pool_size=3)
+        yield manager.set('foo', 'bar')
+        yield manager.get('foo')
+
+        self.assertEqual(self.get_pool(manager).stats(), {
+            'host': '127.0.0.1',
+            'port': 6379,
+            'db': 0,
+            'max_size': 3,
+            'connections': 1,
+            'managers': 1,
+            'in_flight': 0,
+            'peak_in_flight': 1,
+            'requests': 2,
+        })
+
+    @inlineCallbacks
+    def test_new_fake_redis(self):
+        '''Configs that ask for a new fake redis should not share a pool'''
+        config = {'FAKE_REDIS': 'yes', 'key_prefix': 'test'}
+        manager1 = yield self.acquire(config)
+        manager2 = yield self.acquire(config)
+        self.assertNotIdentical(
+            self.get_pool(manager1), self.get_pool(manager2))
+
+        yield manager1.set('foo', 'bar')
+        self.assertEqual((yield manager2.get('foo')), None)
@@ -0,0 +1,229 @@
+import json
+
+from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
+from twisted.internet.task import Clock
+
+from junebug.retries import (
+    DEFAULT_RETRY_MAX_ATTEMPTS, RetryScheduler, acquire_retry_scheduler,
+    backoff_delay, get_retry_schedulers)
+from junebug.stores import RetryQueueStore
+from junebug.tests.helpers import JunebugTestBase, RequestLoggingApi
+from junebug.webhooks import acquire_webhook_client
+
+
+class TestBackoffDelay(JunebugTestBase):
+    def test_backoff_delay(self):
+        '''The delay should double with each attempt, up to the maximum, and
+        be jittered by up to half'''
+        self.assertEqual(backoff_delay(1, 2, 60, random=lambda: 1), 2)
+        self.assertEqual(backoff_delay(1, 2, 60, random=lambda: 0), 1)
+        self.assertEqual(backoff_delay(2, 2, 60, random=lambda: 1), 4)
+        self.assertEqual(backoff_delay(4, 2, 60, random=lambda: 0.5), 12)
+        self.assertEqual(backoff_delay(10, 2, 60, random=lambda: 1), 60)
+        self.assertEqual(backoff_delay(10, 2, 60, random=lambda: 0), 30)
+
+
+class TestRetryScheduler(JunebugTestBase):
+    @inlineCallbacks
+    def setUp(self):
+        self.logging_api = RequestLoggingApi()
+        self.logging_api.setup()
+        self.addCleanup(self.logging_api.teardown)
+
+        self.redis = yield self.get_redis()
+        self.webhooks = acquire_webhook_client()
+        self.addCleanup(self.webhooks.release)
+        self.store = RetryQueueStore(self.redis)
+        self.clock = Clock()
+        self.credentials = (None, None)
+        self.credentials_looked_up = []
+
+    def get_credentials(self, delivery):
+        self.credentials_looked_up.append(delivery)
+        return self.credentials
+
+    def create_scheduler(self, rate=100, max_attempts=20):
+        scheduler = RetryScheduler(
+            rate, 0.5, 60, max_attempts, clock=self.clock)
+        scheduler.acquire(
+            'channel-id', self.redis, self.webhooks, self.get_credentials)
+        self.addCleanup(scheduler.release, 'channel-id')
+        return scheduler
+
+    @inlineCallbacks
+    def poll(self, scheduler):
+        '''Polls the scheduler, and waits for the retries it started'''
+        yield scheduler.poll()
+        yield gatherResults(list(scheduler._retrying))
+
+    @inlineCallbacks
+    def get_deliveries(self, channel_id):
+        due = yield self.store.take_due(channel_id, 1e10, 1e10, 100)
+        returnValue(sorted(delivery for _, delivery in due))
+
+    @inlineCallbacks
+    def test_park(self):
+        '''Parked deliveries should be kept in the retry queue of their
+        channel'''
+        scheduler = self.create_scheduler()
+        yield scheduler.park(
+            'channel-id', 'message', 'http://example.org', {'foo': 'bar'},
+            10)
+
+        self.assertEqual((yield self.store.get_depth('channel-id')), 1)
+        self.assertEqual((yield self.get_deliveries('channel-id')), [{
+            'kind': 'message',
+            'url': 'http://example.org',
+            'data': {'foo': 'bar'},
+            'timeout': 10,
+            'attempts': 1,
+        }])
+        self.assertEqual(scheduler.stats()['parked'], 1)
+
+    @inlineCallbacks
+    def test_retry_delivered(self):
+        '''Deliveries should be posted again once they are due, with the
+        credentials looked up for them, and removed from the retry queue
+        once they are delivered'''
+        scheduler = self.create_scheduler()
+        self.credentials = (None, 'token')
+        yield scheduler.park(
+            'channel-id', 'message', self.logging_api.url, {'foo': 'bar'}, 5)
+
+        yield self.poll(scheduler)
+        self.assertEqual(self.logging_api.requests, [])
+
+        self.clock.advance(0.6)
+        yield self.poll(scheduler)
+        [req] = self.logging_api.requests
+        self.assertEqual(json.loads(req['body']), {'foo': 'bar'})
+        self.assertEqual(
+            req['request'].requestHeaders.getRawHeaders('Authorization'),
+            ['Token token'])
+        [delivery] = self.credentials_looked_up
+        self.assertEqual(delivery['data'], {'foo': 'bar'})
+
+        self.assertEqual((yield self.store.get_depth('channel-id')), 0)
+        self.assertEqual(scheduler.stats(), {
+            'rate': 100,
+            'workers': 1,
+            'parked': 1,
+            'retried': 1,
+            'delivered': 1,
+            'dead_lettered': 0,
+            'in_flight': 0,
+        })
+
+    @inlineCallbacks
+    def test_retry_failed(self):
+        '''Deliveries that fail again should be rescheduled with a longer
+        delay'''
+        scheduler = self.create_scheduler()
+        url = '%s/bad/' % (self.logging_api.url,)
+        yield scheduler.park('channel-id', 'event', url, {'foo': 'bar'}, 5)
+
+        self.clock.advance(0.6)
+        yield self.poll(scheduler)
+        self.assertEqual(len(self.logging_api.requests), 1)
+
+        self.assertEqual((yield self.store.get_depth('channel-id')), 1)
+        due = yield self.store.take_due('channel-id', 1.1, 1e10, 10)
+        self.assertEqual(due, [])
+        [delivery] = yield self.get_deliveries('channel-id')
+        self.assertEqual(delivery['attempts'], 2)
+        self.assertEqual(scheduler.stats()['delivered'], 0)
+
+    @inlineCallbacks
+    def test_retry_dead_lettered(self):
+        '''Deliveries that have failed the maximum amount of times should be
+        moved to the dead letters of their channel'''
+        self.patch_logger()
+        scheduler = self.create_scheduler(max_attempts=2)
+        url = '%s/bad/' % (self.logging_api.url,)
+        yield scheduler.park('channel-id', 'event', url, {'foo': 'bar'}, 5)
+
+        self.clock.advance(0.6)
+        yield self.poll(scheduler)
+        self.assertEqual(len(self.logging_api.requests), 1)
+
+        self.assertEqual((yield self.store.get_depth('channel-id')), 0)
+        [delivery] = yield self.store.get_dead_letters('channel-id')
+        self.assertEqual(delivery['data'], {'foo': 'bar'})
+        self.assertEqual(delivery['attempts'], 2)
+        self.assertEqual(scheduler.stats()['dead_lettered'], 1)
+        self.assert_was_logged('Giving up on event delivery')
+
+    @inlineCallbacks
+    def test_retry_other_channels(self):
+        '''Only the deliveries of the channels with a lease on the scheduler
+        should be retried'''
+        scheduler = self.create_scheduler()
+        yield scheduler.park(
+            'other-channel', 'message', self.logging_api.url, {}, 5)
+
+        self.clock.advance(0.6)
+        yield self.poll(scheduler)
+        self.assertEqual(self.logging_api.requests, [])
+        self.assertEqual((yield self.store.get_depth('other-channel')), 1)
+
+    @inlineCallbacks
+    def test_rate_limit(self):
+        '''At most the rate of deliveries should be retried each poll'''
+        scheduler = self.create_scheduler(rate=2)
+        for i in range(3):
+            yield scheduler.park(
+                'channel-id', 'message', self.logging_api.url, {'i': i}, 5)
+
+        self.clock.advance(0.6)
+        yield self.poll(scheduler)
+        self.assertEqual(len(self.logging_api.requests), 2)
+        self.assertEqual((yield self.store.get_depth('channel-id')), 1)
+
+        yield self.poll(scheduler)
+        self.assertEqual(len(self.logging_api.requests), 3)
+        self.assertEqual((yield self.store.get_depth('channel-id')), 0)
+
+    @inlineCallbacks
+    def test_acquire_release(self):
+        '''Schedulers should be shared by the workers using the same redis
+        config, and stopped once they are all released'''
+        scheduler = acquire_retry_scheduler(
+            'channel-1', self.redis, self.webhooks, self.get_credentials)
+        self.assertIdentical(
+            acquire_retry_scheduler(
+                'channel-2', self.redis, self.webhooks, self.get_credentials),
+            scheduler)
+        self.assertEqual(get_retry_schedulers(), [scheduler])
+        self.assertEqual(scheduler.stats()['workers'], 2)
+        self.assertTrue(scheduler.loop.running)
+
+        yield scheduler.release('channel-1')
+        self.assertEqual(get_retry_schedulers(), [scheduler])
+        self.assertTrue(scheduler.loop.running)
+
+        yield scheduler.release('channel-2')
+        self.assertEqual(get_retry_schedulers(), [])
+        self.assertFalse(scheduler.loop.running)
+
+    @inlineCallbacks
+    def test_acquire_settings(self):
+        '''Workers with different retry settings should get separate
+        schedulers with their own settings'''
+        scheduler1 = acquire_retry_scheduler(
+            'channel-1', self.redis, self.webhooks, self.get_credentials)
+        scheduler2 = acquire_retry_scheduler(
+            'router-1', self.redis, self.webhooks, self.get_credentials,
+            rate=10, base_delay=5, max_delay=60, max_attempts=3)
+        self.assertNotIdentical(scheduler1, scheduler2)
+        self.assertEqual(
+            sorted(get_retry_schedulers()), sorted([scheduler1, scheduler2]))
+        self.assertEqual(
+            (scheduler2.rate, scheduler2.base_delay, scheduler2.max_delay,
+             scheduler2.max_attempts),
+            (10, 5, 60, 3))
+        self.assertEqual(scheduler1.max_attempts, DEFAULT_RETRY_MAX_ATTEMPTS)
+
+        yield scheduler1.release('channel-1')
+        self.assertEqual(get_retry_schedulers(), [scheduler2])
+        yield scheduler2.release('router-1')
+        self.assertEqual(get_retry_schedulers(), [])
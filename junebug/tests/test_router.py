@@ -10,6 +10,7 @@ from junebug.router import (
     Router, InvalidRouterConfig, InvalidRouterDestinationConfig, RouterNotFound
 )
 from junebug.router.base import InvalidRouterType
+from junebug.stores import RetryQueueStore
 from junebug.tests.helpers import JunebugTestBase, TestRouter, DummyLogFile
 
 
@@ -114,6 +115,22 @@ class RouterTests(JunebugTestBase):
         for k, v in router_worker_config.items():
             self.assertEqual(router_worker.config[k], v)
 
+    @inlineCallbacks
+    def test_start_webhook_config(self):
+        """start should pass the webhook settings of the Junebug config on to
+        the router worker"""
+        config = yield self.create_channel_config(
+            webhook_retry_rate=3, webhook_idle_timeout=7, max_in_flight=4)
+        yield self.stop_server()
+        yield self.start_server(config=config)
+        router = Router(self.api, self.create_router_config())
+        router.start(self.service)
+
+        router_worker = self.service.namedServices[router.id]
+        self.assertEqual(router_worker.config['webhook_retry_rate'], 3)
+        self.assertEqual(router_worker.config['webhook_idle_timeout'], 7)
+        self.assertEqual(router_worker.config['max_in_flight'], 4)
+
     @inlineCallbacks
     def test_start_all(self):
         """start_all should start all of the stored routers"""
@@ -257,6 +274,58 @@ class RouterTests(JunebugTestBase):
         yield router.delete()
         self.assertEqual((yield self.api.router_store.get_router_list()), [])
 
+    @inlineCallbacks
+    def test_restart_worker(self):
+        """The worker of a router should be restarted with its stored
+        config, or stopped if it no longer exists"""
+        config = self.create_router_config()
+        router = Router(self.api, config)
+        yield router.save()
+        router.start(self.service)
+        worker = router.router_worker
+
+        yield Router.restart_worker(self.api, router.id)
+        self.assertIn(router.id, self.service.namedServices)
+        self.assertNotEqual(
+            self.service.getServiceNamed(router.id), worker)
+
+        yield router.delete()
+        yield Router.restart_worker(self.api, router.id)
+        self.assertNotIn(router.id, self.service.namedServices)
+
+    @inlineCallbacks
+    def test_sync_workers(self):
+        """Workers should be stopped for deleted routers, and started for
+        stored routers that are not running"""
+        router1 = Router(self.api, self.create_router_config())
+        yield router1.save()
+        router2 = Router(self.api, self.create_router_config())
+        yield router2.save()
+        router2.start(self.service)
+        yield router2.delete()
+
+        yield Router.sync_workers(self.api)
+        self.assertIn(router1.id, self.service.namedServices)
+        self.assertNotIn(router2.id, self.service.namedServices)
+
+    @inlineCallbacks
+    def test_api_only(self):
+        """In API only processes, the supervising process should be asked
+        to restart the worker of a router instead of running it"""
+        requests = []
+        self.patch(
+            junebug.router.base, 'request_restart',
+            lambda redis, name, id: requests.append((name, id)))
+        self.patch(
+            self.api, 'config',
+            (yield self.create_channel_config(api_only=True)))
+        router = Router(self.api, self.create_router_config(id='test-uuid'))
+        yield router.save()
+        yield router.start(self.service)
+        self.assertNotIn(router.id, self.service.namedServices)
+        yield router.delete()
+        self.assertEqual(requests, [('router-workers', 'test-uuid')] * 2)
+
     @inlineCallbacks
     def test_delete_router_not_in_store(self):
         """Removing a non-existing router should not result in an error"""
@@ -377,6 +446,28 @@ class RouterTests(JunebugTestBase):
                 router.id))
         )
 
+    @inlineCallbacks
+    def test_remove_destination_retries(self):
+        """Removing a destination, or its router, should remove the retry
+        queue of the destination"""
+        router = Router(self.api, self.create_router_config())
+        destination1 = router.add_destination(
+            self.create_destination_config())
+        destination2 = router.add_destination(
+            self.create_destination_config())
+        yield router.save()
+        store = RetryQueueStore(self.api.redis)
+        yield store.add(destination1.id, 'd1', {'url': 'http://a'}, 10)
+        yield store.add(destination2.id, 'd2', {'url': 'http://b'}, 10)
+
+        yield destination1.delete()
+        self.assertEqual((yield store.get_depth(destination1.id)), 0)
+        self.assertEqual((yield store.get_depth(destination2.id)), 1)
+
+        yield router.delete()
+        self.assertEqual((yield store.get_depth(destination2.id)), 0)
+        self.assertEqual((yield store.get_channels()), set())
+
 
 class TestBaseRouterWorker(VumiTestCase, JunebugTestBase):
     DEFAULT_ROUTER_WORKER_CONFIG = {
@@ -445,6 +536,42 @@ class TestBaseRouterWorker(VumiTestCase, JunebugTestBase):
         for connector in worker.connectors.values():
             self.assertFalse(connector.paused)
 
+    @inlineCallbacks
+    def test_destination_worker_config(self):
+        """
+        The webhook, batching and concurrency settings should be passed on to
+        the destination workers.
+        """
+        worker = yield self.get_router_worker({
+            'webhook_retry_rate': 3,
+            'webhook_breaker_error_rate': 0.25,
+            'webhook_tls_session_reuse': False,
+            'max_in_flight': 4,
+            'destinations': [
+                {
+                    'id': 'test-destination1',
+                    'mo_batch_size': 10,
+                    'mo_batch_max_delay_ms': 50,
+                },
+                {
+                    'id': 'test-destination2',
+                },
+            ],
+        })
+
+        config = worker.namedServices['test-destination1'].config
+        self.assertEqual(config['webhook_retry_rate'], 3)
+        self.assertEqual(config['webhook_breaker_error_rate'], 0.25)
+        self.assertEqual(config['webhook_tls_session_reuse'], False)
+        self.assertEqual(config['max_in_flight'], 4)
+        self.assertEqual(config['mo_batch_size'], 10)
+        self.assertEqual(config['mo_batch_max_delay_ms'], 50)
+        self.assertEqual(config['amqp_prefetch_count'], 20)
+
+        config = worker.namedServices['test-destination2'].config
+        self.assertEqual(config['webhook_retry_rate'], 3)
+        self.assertNotIn('mo_batch_size', config)
+
     @inlineCallbacks
     def test_teardown_router(self):
         """
@@ -1,9 +1,11 @@
+from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks
 from twisted.trial.unittest import TestCase
 
 from junebug import JunebugApi
 from junebug.service import JunebugService
 from junebug.config import JunebugConfig
+from junebug.supervisor import ApiProcesses, ParentWatcher
 
 
 class TestJunebugService(TestCase):
@@ -34,3 +36,47 @@ class TestJunebugService(TestCase):
 
         yield service.stopService()
         self.assertFalse(server.connected)
+
+    @inlineCallbacks
+    def test_start_service_api_only(self):
+        '''API only processes should listen with SO_REUSEPORT, and stop once
+        the supervising process exits'''
+        service = JunebugService(JunebugConfig({
+            'interface': '127.0.0.1',
+            'port': 0,
+            'api_only': True,
+            'api_workers': 2,
+        }))
+
+        yield service.startService()
+        server = service._port
+        self.assertTrue(server.connected)
+        self.assertTrue(any(
+            isinstance(s, ParentWatcher) for s in service.services))
+
+        yield service.stopService()
+        self.assertFalse(server.connected)
+
+    @inlineCallbacks
+    def test_start_service_api_workers(self):
+        '''If there are API workers, the service should start the API
+        processes instead of listening itself'''
+        triggers = []
+        self.patch(
+            reactor, 'addSystemEventTrigger',
+            lambda *args: triggers.append(args))
+        self.patch(ApiProcesses, 'spawn', lambda self, index: None)
+        service = JunebugService(JunebugConfig({
+            'port': 0,
+            'api_workers': 2,
+        }), args=['-aw', '2'])
+
+        yield service.startService()
+        self.assertEqual(service._port, None)
+        self.assertEqual(service.api_processes.count, 2)
+        self.assertEqual(service.api_processes.args, ['-aw', '2'])
+        self.assertEqual(triggers, [
+            ('before', 'shutdown', service.api_processes.stopService)])
+
+        yield service.stopService()
+        self.assertFalse(service.api_processes.running)
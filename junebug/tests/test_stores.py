@@ -1,13 +1,403 @@
+from datetime import datetime, timedelta
 import json
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    gatherResults, inlineCallbacks, returnValue, succeed, fail)
+from twisted.internet.task import Clock
 from vumi.message import (
     TransportEvent, TransportUserMessage, TransportStatus, to_json)
+from vumi.persist.redis_base import ClientProxy
 
+import junebug.stores
+from junebug.cache import ConfigCache, LRUCache
 from junebug.stores import (
-    BaseStore, InboundMessageStore, OutboundMessageStore, StatusStore,
-    MessageRateStore, RouterStore)
+    BaseStore, ChannelIndexStore, EventLogStore, InboundMessageStore,
+    OutboundMessageStore, StatusStore,
+    MessageRateStore, RateLimitStore, RetryQueueStore, RouterStore,
+    RedisScript, JSONCodec,
+    ZlibJSONCodec, MsgpackCodec, decode_payload, get_codec, project_event)
 from junebug.tests.helpers import JunebugTestBase
-from junebug.utils import api_from_message
+from junebug.utils import api_from_event, api_from_message
+
+
+class FakeScriptingClient(object):
+    '''Redis client that records script calls, and returns ``result`` for
+    each of them. The first EVALSHA fails if ``loaded`` is False.'''
+    def __init__(self, result=None, loaded=True):
+        self.result = result
+        self.loaded = loaded
+        self.calls = []
+
+    def evalsha(self, sha, keys, args):
+        self.calls.append(('evalsha', sha, keys, args))
+        if not self.loaded:
+            return fail(Exception('NOSCRIPT No matching script.'))
+        return succeed(self.result)
+
+    def eval(self, source, keys, args):
+        self.calls.append(('eval', source, keys, args))
+        self.loaded = True
+        return succeed(self.result)
+
+
+class TestRedisScript(JunebugTestBase):
+    @inlineCallbacks
+    def get_scripting_redis(self, **kw):
+        redis = yield self.get_redis()
+        redis = redis.sub_manager('scripting')
+        redis._client_proxy = ClientProxy(FakeScriptingClient(**kw))
+        returnValue(redis)
+
+    @inlineCallbacks
+    def test_fallback(self):
+        '''If the redis client cannot run scripts, the fallback should be
+        called with the unprefixed keys'''
+        calls = []
+        script = RedisScript(
+            'return 1', lambda *a: calls.append(a) or 'result')
+        redis = yield self.get_redis()
+        result = yield script(redis, ['key'], ['arg'])
+        self.assertEqual(result, 'result')
+        self.assertEqual(calls, [(redis, ['key'], ['arg'])])
+
+    @inlineCallbacks
+    def test_evalsha(self):
+        '''If the redis client can run scripts, the script should be called
+        by its SHA1 with prefixed keys'''
+        script = RedisScript('return 1', None)
+        redis = yield self.get_scripting_redis(result=1)
+        result = yield script(redis, ['key'], ['arg'])
+        self.assertEqual(result, 1)
+        self.assertEqual(redis._client.calls, [
+            ('evalsha', script.sha, [redis._key('key')], ['arg']),
+        ])
+
+    @inlineCallbacks
+    def test_script_not_loaded(self):
+        '''If the script is not in the redis script cache, it should be
+        sent using EVAL'''
+        script = RedisScript('return 1', None)
+        redis = yield self.get_scripting_redis(result=1, loaded=False)
+        result = yield script(redis, ['key'], ['arg'])
+        self.assertEqual(result, 1)
+        self.assertEqual(redis._client.calls, [
+            ('evalsha', script.sha, [redis._key('key')], ['arg']),
+            ('eval', 'return 1', [redis._key('key')], ['arg']),
+        ])
+
+    @inlineCallbacks
+    def test_parse_result(self):
+        '''The raw result of the script should be parsed if a parser is
+        given'''
+        script = RedisScript('return 1', None)
+        redis = yield self.get_scripting_redis(result=['a', '1'])
+        result = yield script(redis, ['key'], parse_result=tuple)
+        self.assertEqual(result, ('a', '1'))
+
+    @inlineCallbacks
+    def test_store_op_single_script_call(self):
+        '''Store operations with a ttl should be a single script call, and
+        should parse the script result'''
+        redis = yield self.get_scripting_redis(result=['foo', 'bar'])
+        store = BaseStore(redis, 60)
+        properties = yield store.load_all('testid')
+        self.assertEqual(properties, {'foo': 'bar'})
+        [(_, _, keys, args)] = redis._client.calls
+        self.assertEqual(keys, [redis._key('testid')])
+        self.assertEqual(args, ['hgetall', 60])
+
+    @inlineCallbacks
+    def test_store_op_command_names(self):
+        '''Manager method names should be converted to redis commands for
+        scripts'''
+        redis = yield self.get_scripting_redis(result=1)
+        store = BaseStore(redis, 60)
+        yield store.increment_id('testid')
+        yield store.remove_value('testid')
+        yield store.store_all('testid', {'foo': 'bar'})
+        self.assertEqual([args for (_, _, _, args) in redis._client.calls], [
+            ['incrby', 60, 1],
+            ['del', 60],
+            ['hmset', 60, 'foo', 'bar'],
+        ])
+
+
+class TestScriptParity(JunebugTestBase):
+    '''Runs the Lua source of each script against a real redis, and checks
+    that its fallback does the same'''
+
+    def hmset(self, key, mapping):
+        return lambda redis: redis.hmset(key, mapping)
+
+    @inlineCallbacks
+    def assert_parity(self, script, keys, args, setup=None,
+                      parse_result=None):
+        lua_result, fallback_result = yield self.run_script_and_fallback(
+            script, keys, args, setup=setup, parse_result=parse_result)
+        self.assertEqual(lua_result, fallback_result)
+        returnValue(lua_result)
+
+    @inlineCallbacks
+    def test_redis_op_with_expire(self):
+        script = junebug.stores.REDIS_OP_WITH_EXPIRE
+        setup = self.hmset('key', {'foo': 'bar'})
+        yield self.assert_parity(
+            script, ['key'], ['hset', 60, 'baz', 'quux'], setup)
+        yield self.assert_parity(
+            script, ['key'], ['hmset', 60, 'baz', 'quux'], setup)
+        yield self.assert_parity(
+            script, ['key'], ['hgetall', 60], setup,
+            parse_result=BaseStore.RESULT_PARSERS['hgetall'])
+        yield self.assert_parity(
+            script, ['key'], ['hincrby', 60, 'count', 2], setup)
+        yield self.assert_parity(
+            script, ['key'], ['del', 60], setup)
+        yield self.assert_parity(script, ['key'], ['incrby', 60, 2])
+        yield self.assert_parity(script, ['key'], ['sadd', 60, 'foo'])
+        yield self.assert_parity(
+            script, ['key'], ['smembers', 60],
+            lambda redis: redis.sadd('key', 'foo', 'bar'),
+            parse_result=BaseStore.RESULT_PARSERS['smembers'])
+
+    @inlineCallbacks
+    def test_increment_series(self):
+        @inlineCallbacks
+        def setup(redis):
+            for key in ['current', 'newer', 'late']:
+                yield redis.hmset(key, {'bucket:1': '5', 'count:1': '3'})
+
+        yield self.assert_parity(
+            junebug.stores.INCREMENT_SERIES,
+            ['current', 'newer', 'late', 'new'], [
+                1, 5, 2, 60,
+                1, 6, 1, 60,
+                1, 4, 1, 60,
+                2, 7, 1, 120,
+            ], setup)
+
+    @inlineCallbacks
+    def test_store_property_and_increment(self):
+        script = junebug.stores.STORE_PROPERTY_AND_INCREMENT
+        setup = self.hmset('series', {'bucket:1': '10', 'count:1': '3'})
+        yield self.assert_parity(
+            script, ['hash', 'counter', 'series'],
+            ['field', 'value', 60, 120, 1, 10, 1, 60], setup)
+        yield self.assert_parity(
+            script, ['hash', 'counter'], ['field', 'value', '', 120])
+
+    @inlineCallbacks
+    def test_increment_all_with_expire(self):
+        yield self.assert_parity(
+            junebug.stores.INCREMENT_ALL_WITH_EXPIRE,
+            ['existing', 'new'], [2, 60, 3, 120],
+            lambda redis: redis.set('existing', '5'))
+
+    @inlineCallbacks
+    def test_take_rate_limit_tokens(self):
+        script = junebug.stores.TAKE_RATE_LIMIT_TOKENS
+
+        def parse_result(result):
+            return (int(result[0]), float(result[1]))
+
+        setup = self.hmset('bucket', {'tokens': '2', 'updated': '100'})
+
+        # A full bucket, with extra tokens taken
+        result = yield self.assert_parity(
+            script, ['bucket'], [10, 10, '100.5', 3, 2, '0'],
+            parse_result=parse_result)
+        self.assertEqual(result, (5, 0))
+        # Not enough tokens
+        result = yield self.assert_parity(
+            script, ['bucket'], [10, 10, '100', 5, 0, '0'], setup,
+            parse_result=parse_result)
+        self.assertEqual(result, (0, 3))
+        # As many tokens as there are
+        result = yield self.assert_parity(
+            script, ['bucket'], [10, 10, '100', 5, 0, '1'], setup,
+            parse_result=parse_result)
+        self.assertEqual(result, (2, 3))
+        # Refilled tokens
+        result = yield self.assert_parity(
+            script, ['bucket'], [10, 20, '104.25', 4, 0, '0'], setup,
+            parse_result=parse_result)
+        self.assertEqual(result, (4, 0))
+
+    @inlineCallbacks
+    def test_append_to_log(self):
+        @inlineCallbacks
+        def setup(redis):
+            yield redis.zadd('log', a=1, b=2)
+            yield redis.set('offset', '2')
+
+        result = yield self.assert_parity(
+            junebug.stores.APPEND_TO_LOG, ['log', 'offset'], ['c', 2],
+            setup, parse_result=int)
+        self.assertEqual(result, 3)
+
+    @inlineCallbacks
+    def test_store_event(self):
+        script = junebug.stores.STORE_EVENT
+        setup = self.hmset('message', {'message': '{}'})
+        yield self.assert_parity(
+            script, ['message', 'index'], ['event-1', '{}', '1.5', 60],
+            setup)
+        yield self.assert_parity(
+            script, ['message', 'index'], ['event-1', '{}', '1.5', ''])
+        yield self.assert_parity(
+            script, ['message', 'index', 'counter', 'series'],
+            ['event-1', '{}', '1.5', 60, 120, 1, 10, 1, 60], setup)
+
+    @inlineCallbacks
+    def test_load_events(self):
+        @inlineCallbacks
+        def setup(redis):
+            yield redis.hmset('indexed', {
+                'message': '{}', 'event-1': '{"a": 1}', 'event-2': '{}'})
+            yield redis.zadd('indexed:index', **{
+                'event-1': 1.0, 'event-2': 2.0})
+            yield redis.hmset('unindexed', {
+                'message': '{}', 'event-3': '{}', 'event-4': '{"b": 2}'})
+
+        def sort_hashes(results):
+            return [
+                result[:1] + sorted(zip(result[1::2], result[2::2]))
+                if result[0] == 'hash' else result
+                for result in results]
+
+        keys = [
+            'indexed', 'indexed:index', 'unindexed', 'unindexed:index',
+            'missing', 'missing:index']
+        for last_only in ['', '1']:
+            lua_result, fallback_result = yield self.run_script_and_fallback(
+                junebug.stores.LOAD_EVENTS, keys,
+                [last_only, 60, 'message'], setup)
+            self.assertEqual(
+                sort_hashes(lua_result), sort_hashes(fallback_result))
+
+    @inlineCallbacks
+    def test_index_events(self):
+        yield self.assert_parity(
+            junebug.stores.INDEX_EVENTS, ['index'],
+            [60, 'event-1', '1.5', 'event-2', '2.25'],
+            lambda redis: redis.zadd('index', **{'event-0': 1.0}))
+
+    def retry_setup(self, redis):
+        return gatherResults([
+            redis.hmset('deliveries', {'d1': '{"a": 1}', 'd2': '{}'}),
+            redis.zadd('queue', d1=10.0, d2=20.0, d3=5.0),
+            redis.sadd('channels', 'channel-id', 'other-channel'),
+            redis.lpush('dead_letters', '{"b": 2}'),
+            redis.lpush('dead_letters', '{"c": 3}'),
+        ])
+
+    @inlineCallbacks
+    def test_retry_scripts(self):
+        keys = ['queue', 'deliveries', 'channels']
+        setup = self.retry_setup
+        yield self.assert_parity(
+            junebug.stores.ADD_RETRY, keys,
+            ['d4', '{}', '15.5', 'new-channel'], setup)
+        result = yield self.assert_parity(
+            junebug.stores.TAKE_DUE_RETRIES, keys,
+            ['15.0', '100.0', 10, 'channel-id'], setup)
+        self.assertEqual(result, ['d1', '{"a": 1}'])
+        yield self.assert_parity(
+            junebug.stores.TAKE_DUE_RETRIES, keys,
+            ['25.0', '100.0', 1, 'channel-id'], setup)
+        yield self.assert_parity(
+            junebug.stores.TAKE_DUE_RETRIES, keys,
+            ['25.0', '30.0', 10, 'channel-id'],
+            lambda redis: gatherResults([
+                redis.zadd('queue', d3=5.0),
+                redis.sadd('channels', 'channel-id', 'other-channel'),
+            ]))
+        yield self.assert_parity(
+            junebug.stores.REMOVE_RETRY, keys[:2], ['d1'], setup)
+        yield self.assert_parity(
+            junebug.stores.DEAD_LETTER_RETRY,
+            keys[:2] + ['dead_letters'], ['d1', '{"a": 1}', 2], setup)
+        yield self.assert_parity(
+            junebug.stores.CLEAR_RETRIES, keys + ['dead_letters'],
+            ['channel-id'], setup)
+
+    @inlineCallbacks
+    def test_index_channel(self):
+        script = junebug.stores.INDEX_CHANNEL
+        keys = ['index', 'sequence', 'type:old', 'type:new']
+
+        @inlineCallbacks
+        def setup(redis):
+            yield redis.zadd('index', **{'channel-1': 1})
+            yield redis.zadd('type:old', **{'channel-1': 1})
+            yield redis.set('sequence', '1')
+
+        result = yield self.assert_parity(
+            script, keys, ['channel-1', 1], setup, parse_result=int)
+        self.assertEqual(result, 1)
+        result = yield self.assert_parity(
+            script, keys, ['channel-2', 0], setup, parse_result=int)
+        self.assertEqual(result, 2)
+
+
+class TestMessageCodecs(JunebugTestBase):
+    def assert_roundtrip(self, codec):
+        msg = TransportUserMessage.send(
+            to_addr='+213', content=u'f\xf6\xf6',
+            transport_metadata={'session': 'abc'})
+        data = codec.encode(msg.payload)
+        self.assertEqual(decode_payload(data), msg.payload)
+        return data
+
+    def test_json(self):
+        '''The JSON codec stores messages as plain JSON, the way they were
+        stored before codecs'''
+        msg = TransportUserMessage.send(to_addr='+213', content='foo')
+        self.assertEqual(JSONCodec().encode(msg.payload), msg.to_json())
+        self.assert_roundtrip(JSONCodec())
+
+    def test_zlib(self):
+        '''The zlib codec stores messages with a header'''
+        data = self.assert_roundtrip(ZlibJSONCodec())
+        self.assertEqual(data[:2], '\x00\x01')
+
+    def test_msgpack(self):
+        '''The msgpack codec stores messages with a header'''
+        data = self.assert_roundtrip(MsgpackCodec())
+        self.assertEqual(data[:2], '\x00\x02')
+
+    if junebug.stores.msgpack is None:
+        test_msgpack.skip = 'msgpack is not installed'
+
+    def test_get_codec(self):
+        '''Codecs are looked up by name'''
+        self.assertTrue(isinstance(get_codec('json'), JSONCodec))
+        self.assertTrue(isinstance(get_codec('zlib'), ZlibJSONCodec))
+        self.assertTrue(get_codec('zlib', project=True).project)
+        self.assertRaises(ValueError, get_codec, 'foo')
+
+    def test_get_codec_msgpack_not_installed(self):
+        '''The msgpack codec falls back to the zlib codec if msgpack is not
+        installed'''
+        self.patch(junebug.stores, 'msgpack', None)
+        warnings = []
+        self.patch(junebug.stores.logging, 'warning', warnings.append)
+        self.assertTrue(isinstance(get_codec('msgpack'), ZlibJSONCodec))
+        self.assertEqual(warnings, [
+            'msgpack is not installed, storing messages with the zlib codec'])
+
+    def test_projection(self):
+        '''Messages are only projected if the codec projects them'''
+        event = TransportEvent(
+            user_message_id='message_id', sent_message_id='message_id',
+            event_type='ack', transport_metadata={'foo': 'bar'})
+
+        payload = decode_payload(JSONCodec().encode(
+            event.payload, project_event))
+        self.assertEqual(payload['transport_metadata'], {'foo': 'bar'})
+
+        payload = decode_payload(JSONCodec(project=True).encode(
+            event.payload, project_event))
+        self.assertFalse('transport_metadata' in payload)
+        self.assertEqual(payload['event_id'], event['event_id'])
 
 
 class TestBaseStore(JunebugTestBase):
@@ -157,6 +547,28 @@ class TestBaseStore(JunebugTestBase):
         yield store.get_id('testid3', ttl=None)
         self.assertEqual((yield self.redis.ttl('testid3')), None)
 
+    @inlineCallbacks
+    def test_store_property_and_increment(self):
+        '''Stores the property, increments the counter, and sets the expiry
+        times of both'''
+        store = yield self.create_store()
+        count = yield store.store_property_and_increment(
+            'testid', 'foo', 'bar', 'counterid', 2)
+        self.assertEqual(count, 1)
+        self.assertEqual((yield self.redis.hget('testid', 'foo')), 'bar')
+        self.assertEqual((yield self.redis.ttl('testid')), 60)
+        self.assertEqual((yield self.redis.get('counterid')), '1')
+        self.assertEqual((yield self.redis.ttl('counterid')), 2)
+
+    @inlineCallbacks
+    def test_store_property_and_increment_none_ttl(self):
+        '''If the ttl is None, no ttl should be set on the property'''
+        store = yield self.create_store()
+        yield store.store_property_and_increment(
+            'testid', 'foo', 'bar', 'counterid', 2, ttl=None)
+        self.assertEqual((yield self.redis.ttl('testid')), None)
+        self.assertEqual((yield self.redis.ttl('counterid')), 2)
+
     @inlineCallbacks
     def test_get_set(self):
         '''get_set returns the set of values stored at the specified id'''
@@ -227,9 +639,9 @@ class TestBaseStore(JunebugTestBase):
 
 class TestInboundMessageStore(JunebugTestBase):
     @inlineCallbacks
-    def create_store(self, ttl=60):
+    def create_store(self, ttl=60, codec=None):
         redis = yield self.get_redis()
-        store = InboundMessageStore(redis, ttl)
+        store = InboundMessageStore(redis, ttl, codec=codec)
         returnValue(store)
 
     @inlineCallbacks
@@ -243,6 +655,34 @@ class TestInboundMessageStore(JunebugTestBase):
             'message')
         self.assertEqual(vumi_msg, TransportUserMessage.from_json(msg))
 
+    @inlineCallbacks
+    def test_store_vumi_message_with_counter(self):
+        '''Stores the vumi message, and increments the given counter.'''
+        store = yield self.create_store()
+        vumi_msg = TransportUserMessage.send(to_addr='+213', content='foo')
+        yield store.store_vumi_message(
+            'channel_id', vumi_msg, counter=('counterid', 2))
+        msg = yield self.redis.hget(
+            'channel_id:inbound_messages:%s' % vumi_msg.get('message_id'),
+            'message')
+        self.assertEqual(vumi_msg, TransportUserMessage.from_json(msg))
+        self.assertEqual((yield self.redis.get('counterid')), '1')
+
+    @inlineCallbacks
+    def test_store_vumi_message_with_counter_series(self):
+        '''The series of the counter should be incremented along with the
+        counter'''
+        store = yield self.create_store()
+        vumi_msg = TransportUserMessage.send(to_addr='+213', content='foo')
+        yield store.store_vumi_message(
+            'channel_id', vumi_msg,
+            counter=('counterid', 2, [('seriesid', 1, 4, 60)]))
+        self.assertEqual((yield self.redis.get('counterid')), '1')
+        self.assertEqual((yield self.redis.hgetall('seriesid')), {
+            'bucket:1': '4',
+            'count:1': '1',
+        })
+
     @inlineCallbacks
     def test_load_vumi_message(self):
         '''Returns a vumi message from the stored json'''
@@ -263,12 +703,52 @@ class TestInboundMessageStore(JunebugTestBase):
         self.assertEqual((yield store.load_vumi_message(
             'bad-channel', 'bad-id')), None)
 
+    @inlineCallbacks
+    def test_load_vumi_message_json(self):
+        '''Messages stored as JSON can be loaded by a store using another
+        codec'''
+        store = yield self.create_store(codec=ZlibJSONCodec())
+        vumi_msg = TransportUserMessage.send(to_addr='+213', content='foo')
+        yield self.redis.hset(
+            'channel_id:inbound_messages:%s' % vumi_msg.get('message_id'),
+            'message', vumi_msg.to_json())
+
+        message = yield store.load_vumi_message(
+            'channel_id', vumi_msg.get('message_id'))
+        self.assertEqual(message, vumi_msg)
+
+    @inlineCallbacks
+    def test_store_vumi_message_projected(self):
+        '''Projected messages keep everything needed for replies, but not
+        the content'''
+        store = yield self.create_store(codec=ZlibJSONCodec(project=True))
+        vumi_msg = TransportUserMessage.send(
+            to_addr='+213', content='foo' * 100,
+            transport_metadata={'session': 'abc'})
+        yield store.store_vumi_message('channel_id', vumi_msg)
+
+        data = yield self.redis.hget(
+            'channel_id:inbound_messages:%s' % vumi_msg.get('message_id'),
+            'message')
+        self.assertTrue(len(data) < len(vumi_msg.to_json()))
+
+        message = yield store.load_vumi_message(
+            'channel_id', vumi_msg.get('message_id'))
+        self.assertEqual(message['content'], None)
+
+        reply = message.reply('bar')
+        expected = vumi_msg.reply(
+            'bar', message_id=reply['message_id'],
+            timestamp=reply['timestamp'])
+        self.assertEqual(reply, expected)
+
 
 class TestOutboundMessageStore(JunebugTestBase):
     @inlineCallbacks
-    def create_store(self, ttl=60):
+    def create_store(self, ttl=60, event_routes=None, codec=None):
         redis = yield self.get_redis()
-        store = OutboundMessageStore(redis, ttl)
+        store = OutboundMessageStore(
+            redis, ttl, event_routes=event_routes, codec=codec)
         returnValue(store)
 
     @inlineCallbacks
@@ -311,6 +791,67 @@ class TestOutboundMessageStore(JunebugTestBase):
         self.assertEqual((yield store.load_event_auth_token(
             'bad-channel', 'bad-id')), None)
 
+    @inlineCallbacks
+    def test_load_event_route(self):
+        '''Returns the event url and auth token of the stored message'''
+        store = yield self.create_store()
+        vumi_msg = TransportUserMessage.send(to_addr='+213', content='foo')
+        msg = {
+            'event_url': 'http://test.org',
+            'event_auth_token': 'the-auth-token',
+        }
+        msg.update(api_from_message(vumi_msg))
+        yield store.store_message('channel_id', msg)
+
+        route = yield store.load_event_route(
+            'channel_id', vumi_msg.get('message_id'))
+        self.assertEqual(route, ('http://test.org', 'the-auth-token'))
+
+    @inlineCallbacks
+    def test_load_event_route_not_exist(self):
+        '''`(None, None)` should be returned if the message cannot be
+        found'''
+        store = yield self.create_store(event_routes=LRUCache(10))
+        self.assertEqual((yield store.load_event_route(
+            'bad-channel', 'bad-id')), (None, None))
+        self.assertEqual(len(store.event_routes), 0)
+
+    @inlineCallbacks
+    def test_store_message_caches_event_route(self):
+        '''Storing a message caches its event route, so that loading it
+        doesn't read from redis'''
+        store = yield self.create_store(event_routes=LRUCache(10))
+        vumi_msg = TransportUserMessage.send(to_addr='+213', content='foo')
+        msg = {'event_url': 'http://test.org'}
+        msg.update(api_from_message(vumi_msg))
+        yield store.store_message('channel_id', msg)
+        yield store.redis.delete(
+            store.get_key('channel_id', vumi_msg.get('message_id')))
+
+        route = yield store.load_event_route(
+            'channel_id', vumi_msg.get('message_id'))
+        self.assertEqual(route, ('http://test.org', None))
+        self.assertEqual(store.event_routes.hits, 1)
+
+    @inlineCallbacks
+    def test_load_event_route_caches_on_miss(self):
+        '''If the event route isn't cached, it is loaded from redis and
+        cached'''
+        redis = yield self.get_redis()
+        yield OutboundMessageStore(redis, 60).store_message('channel_id', {
+            'message_id': 'msg-id',
+            'event_url': 'http://test.org',
+        })
+        store = yield self.create_store(event_routes=LRUCache(10))
+
+        route = yield store.load_event_route('channel_id', 'msg-id')
+        self.assertEqual(route, ('http://test.org', None))
+        self.assertEqual(store.event_routes.misses, 1)
+
+        route = yield store.load_event_route('channel_id', 'msg-id')
+        self.assertEqual(route, ('http://test.org', None))
+        self.assertEqual(store.event_routes.hits, 1)
+
     @inlineCallbacks
     def test_store_message(self):
         '''Stores the message under the correct key'''
@@ -352,6 +893,53 @@ class TestOutboundMessageStore(JunebugTestBase):
             'channel_id:outbound_messages:message_id', event['event_id'])
         self.assertEqual(event_json, event.to_json())
 
+    @inlineCallbacks
+    def test_store_event_index(self):
+        '''The event should be added to the event index of the message,
+        scored by its timestamp'''
+        store = yield self.create_store()
+        event = TransportEvent(
+            user_message_id='message_id', sent_message_id='message_id',
+            event_type='ack', timestamp=datetime(2015, 9, 22, 15, 39, 44))
+        yield store.store_event('channel_id', 'message_id', event)
+
+        key = 'channel_id:outbound_messages:message_id:events'
+        self.assertEqual(
+            (yield self.redis.zscore(key, event['event_id'])), 1442936384.0)
+        self.assertTrue(0 < (yield self.redis.ttl(key)) <= 60)
+
+    @inlineCallbacks
+    def test_store_event_with_counter(self):
+        '''Stores the event, and increments the given counter'''
+        store = yield self.create_store()
+        event = TransportEvent(
+            user_message_id='message_id', sent_message_id='message_id',
+            event_type='ack')
+        yield store.store_event(
+            'channel_id', 'message_id', event, counter=('counterid', 2))
+
+        event_json = yield self.redis.hget(
+            'channel_id:outbound_messages:message_id', event['event_id'])
+        self.assertEqual(event_json, event.to_json())
+        self.assertEqual((yield self.redis.get('counterid')), '1')
+
+    @inlineCallbacks
+    def test_store_event_with_counter_series(self):
+        '''The series of the counter should be incremented along with the
+        counter'''
+        store = yield self.create_store()
+        event = TransportEvent(
+            user_message_id='message_id', sent_message_id='message_id',
+            event_type='ack')
+        yield store.store_event(
+            'channel_id', 'message_id', event,
+            counter=('counterid', 2, [('seriesid', 1, 4, 60)]))
+        self.assertEqual((yield self.redis.get('counterid')), '1')
+        self.assertEqual((yield self.redis.hgetall('seriesid')), {
+            'bucket:1': '4',
+            'count:1': '1',
+        })
+
     @inlineCallbacks
     def test_load_event(self):
         store = yield self.create_store()
@@ -374,6 +962,185 @@ class TestOutboundMessageStore(JunebugTestBase):
             'channel_id', 'message_id', 'bad_event_id')
         self.assertEqual(stored_event, None)
 
+    @inlineCallbacks
+    def test_store_event_projected(self):
+        '''Projected events keep everything needed for message statuses'''
+        store = yield self.create_store(codec=ZlibJSONCodec(project=True))
+        event = TransportEvent(
+            user_message_id='message_id', sent_message_id='message_id',
+            event_type='nack', nack_reason='too long',
+            transport_metadata={'foo': 'bar' * 100})
+        yield store.store_event('channel_id', 'message_id', event)
+
+        [stored] = yield store.load_all_events('channel_id', 'message_id')
+        self.assertFalse('transport_metadata' in stored.payload)
+        self.assertEqual(
+            api_from_event('channel_id', stored),
+            api_from_event('channel_id', event))
+
+    @inlineCallbacks
+    def test_store_message_projected(self):
+        '''Projected outbound messages keep everything needed to route
+        events'''
+        store = yield self.create_store(codec=ZlibJSONCodec(project=True))
+        yield store.store_message('channel_id', {
+            'message_id': 'message_id',
+            'from': '+1234',
+            'content': 'foo',
+            'event_url': 'http://test.org',
+        })
+
+        self.assertEqual(
+            (yield store.load_message('channel_id', 'message_id')), {
+                'message_id': 'message_id',
+                'from': '+1234',
+                'event_url': 'http://test.org',
+            })
+
+    @inlineCallbacks
+    def test_load_all_events_many(self):
+        '''Returns a list with the events of each message'''
+        store = yield self.create_store()
+        event1 = TransportEvent(
+            user_message_id='message_id1', sent_message_id='message_id1',
+            event_type='ack')
+        event2 = TransportEvent(
+            user_message_id='message_id2', sent_message_id='message_id2',
+            event_type='nack', nack_reason='error')
+        yield store.store_message('channel_id', {
+            'message_id': 'message_id1',
+            'event_url': 'http://test.org',
+        })
+        yield store.store_event('channel_id', 'message_id1', event1)
+        yield store.store_event('channel_id', 'message_id2', event2)
+
+        events = yield store.load_all_events_many(
+            'channel_id', ['message_id2', 'missing', 'message_id1'])
+        self.assertEqual(events, [[event2], [], [event1]])
+
+    def make_event(self, seconds, message_id='message_id'):
+        return TransportEvent(
+            user_message_id=message_id, sent_message_id=message_id,
+            event_type='ack',
+            timestamp=datetime(2015, 9, 22) + timedelta(seconds=seconds))
+
+    @inlineCallbacks
+    def test_load_all_events_ordered(self):
+        '''Events should be loaded in the order of their timestamps, not
+        the order they were stored in'''
+        store = yield self.create_store()
+        events = [self.make_event(i) for i in [3, 1, 2]]
+        for event in events:
+            yield store.store_event('channel_id', 'message_id', event)
+
+        loaded = yield store.load_all_events('channel_id', 'message_id')
+        self.assertEqual(loaded, [events[1], events[2], events[0]])
+        self.assertEqual(
+            (yield store.load_last_event('channel_id', 'message_id')),
+            events[0])
+
+    @inlineCallbacks
+    def test_load_last_event_none(self):
+        '''Returns None if there are no events'''
+        store = yield self.create_store()
+        self.assertEqual(
+            (yield store.load_last_event('channel_id', 'message_id')), None)
+
+    @inlineCallbacks
+    def test_load_all_events_unindexed(self):
+        '''Events stored before events were indexed should be loaded from
+        the message hash in the order of their timestamps'''
+        store = yield self.create_store()
+        yield store.store_message('channel_id', {'message_id': 'message_id'})
+        events = [self.make_event(i) for i in [3, 1, 2]]
+        for event in events:
+            yield self.redis.hset(
+                'channel_id:outbound_messages:message_id', event['event_id'],
+                event.to_json())
+
+        loaded = yield store.load_all_events('channel_id', 'message_id')
+        self.assertEqual(loaded, [events[1], events[2], events[0]])
+        self.assertEqual(
+            (yield store.load_last_event('channel_id', 'message_id')),
+            events[0])
+
+    @inlineCallbacks
+    def test_load_all_events_partially_indexed(self):
+        '''Events stored before events were indexed should be loaded along
+        with the indexed events of the message, and then be indexed'''
+        store = yield self.create_store()
+        yield store.store_message('channel_id', {'message_id': 'message_id'})
+        events = [self.make_event(i) for i in [1, 2, 3]]
+        for event in events[:2]:
+            yield self.redis.hset(
+                'channel_id:outbound_messages:message_id', event['event_id'],
+                event.to_json())
+        yield store.store_event('channel_id', 'message_id', events[2])
+
+        loaded = yield store.load_all_events('channel_id', 'message_id')
+        self.assertEqual(loaded, events)
+        index = yield self.redis.zrange(
+            'channel_id:outbound_messages:message_id:events', 0, -1)
+        self.assertEqual(index, [event['event_id'] for event in events])
+        self.assertEqual(
+            (yield store.load_last_event('channel_id', 'message_id')),
+            events[2])
+
+    @inlineCallbacks
+    def test_load_all_events_many_last_only(self):
+        '''Only the last event of each message should be loaded if
+        last_only is True'''
+        store = yield self.create_store()
+        events1 = [self.make_event(i, 'message_id1') for i in [2, 1]]
+        events2 = [self.make_event(i, 'message_id2') for i in [1, 2]]
+        for event in events1 + events2:
+            yield store.store_event(
+                'channel_id', event['user_message_id'], event)
+
+        loaded = yield store.load_all_events_many(
+            'channel_id', ['message_id1', 'missing', 'message_id2'],
+            last_only=True)
+        self.assertEqual(loaded, [[events1[0]], [], [events2[1]]])
+
+    @inlineCallbacks
+    def test_load_all_events_many_batches(self):
+        '''The events should be read by one script call for every batch of
+        messages, using the event index if it exists'''
+        event = self.make_event(1)
+        redis = yield self.get_redis()
+        redis = redis.sub_manager('scripting')
+        client = FakeScriptingClient(result=[
+            ['index', event.to_json()],
+            ['hash', 'message', '{}', event['event_id'], event.to_json()],
+        ])
+        redis._client_proxy = ClientProxy(client)
+        store = OutboundMessageStore(redis, 60)
+        self.patch(OutboundMessageStore, 'LOAD_BATCH_SIZE', 2)
+
+        loaded = yield store.load_all_events_many(
+            'channel_id', ['m1', 'm2', 'm3', 'm4'])
+        self.assertEqual(loaded, [[event], [event], [event], [event]])
+        self.assertEqual(
+            [(keys, args) for _, sha, keys, args in client.calls
+             if sha == junebug.stores.LOAD_EVENTS.sha], [
+                ([
+                    'vumitest:scripting:channel_id:outbound_messages:m1',
+                    'vumitest:scripting:channel_id:outbound_messages:m1:'
+                    'events',
+                    'vumitest:scripting:channel_id:outbound_messages:m2',
+                    'vumitest:scripting:channel_id:outbound_messages:m2:'
+                    'events',
+                ], ['', 60, 'message']),
+                ([
+                    'vumitest:scripting:channel_id:outbound_messages:m3',
+                    'vumitest:scripting:channel_id:outbound_messages:m3:'
+                    'events',
+                    'vumitest:scripting:channel_id:outbound_messages:m4',
+                    'vumitest:scripting:channel_id:outbound_messages:m4:'
+                    'events',
+                ], ['', 60, 'message']),
+            ])
+
     @inlineCallbacks
     def test_load_all_events_none(self):
         '''Returns an empty list'''
@@ -545,6 +1312,26 @@ class TestMessageRateStore(JunebugTestBase):
         rate = yield store.get_messages_per_second('channelid', 'inbound', 10)
         self.assertEqual(rate, N / 10.0)
 
+    @inlineCallbacks
+    def test_get_rate_increment_count(self):
+        '''Incrementing by a count should count that many messages, with and
+        without aggregation'''
+        clock = self.patch_message_rate_clock()
+        store = yield self.create_store()
+        aggregating_store = yield self.create_store(flush_interval=60)
+
+        yield store.increment('channelid', 'inbound', 10, count=5)
+        yield aggregating_store.increment('channelid', 'outbound', 10, count=3)
+        yield aggregating_store.close()
+
+        clock.advance(10)
+        rate = yield store.get_messages_per_second('channelid', 'inbound', 10)
+        self.assertEqual(rate, 5 / 10.0)
+        rate = yield store.get_messages_per_second('channelid', 'outbound', 10)
+        self.assertEqual(rate, 3 / 10.0)
+        self.assertEqual(
+            (yield store.get_series('channelid', 'inbound', '1m'))[-1][1], 5)
+
     @inlineCallbacks
     def test_get_rate_different_buckets(self):
         '''If there are n messages in the last time bucket, the message
@@ -566,11 +1353,189 @@ class TestMessageRateStore(JunebugTestBase):
         rate = yield store.get_messages_per_second('channelid', 'inbound', 10)
         self.assertEqual(rate, N / 10.0)
 
+    @inlineCallbacks
+    def test_aggregated_increments(self):
+        '''If a flush interval is given, increments should only be written to
+        redis on each flush, and should be included in the rate before they
+        are written.'''
+        clock = self.patch_message_rate_clock()
+        store = yield self.create_store(flush_interval=0.5, clock=clock)
+        self.addCleanup(store.close)
+        self.assertTrue(store.aggregating)
+
+        for i in range(3):
+            yield store.increment('channelid', 'inbound', 10)
+        yield store.increment('channelid', 'outbound', 10)
+
+        key = store.get_key('channelid', 'inbound', 0)
+        self.assertEqual((yield self.redis.get(key)), None)
+
+        clock.advance(10)
+        rate = yield store.get_messages_per_second('channelid', 'inbound', 10)
+        self.assertEqual(rate, 3 / 10.0)
+
+        yield store.flush()
+        self.assertEqual((yield self.redis.get(key)), '3')
+        self.assertEqual((yield self.redis.ttl(key)), 20)
+        self.assertEqual((yield self.redis.get(
+            store.get_key('channelid', 'outbound', 0))), '1')
+
+        rate = yield store.get_messages_per_second('channelid', 'inbound', 10)
+        self.assertEqual(rate, 3 / 10.0)
+
+    @inlineCallbacks
+    def test_aggregated_increments_flushed_periodically(self):
+        '''Aggregated increments should be written every flush interval'''
+        clock = self.patch_message_rate_clock()
+        store = yield self.create_store(flush_interval=0.5, clock=clock)
+        self.addCleanup(store.close)
+        flushes = []
+        self.patch(store, 'flush', lambda: flushes.append(clock.seconds()))
+
+        yield store.increment('channelid', 'inbound', 10)
+        clock.advance(0.5)
+        clock.advance(0.5)
+        self.assertEqual(flushes, [0.5, 1.0])
+
+    @inlineCallbacks
+    def test_aggregated_increments_flush_failed(self):
+        '''If writing the increments fails, they should be kept for the next
+        flush'''
+        self.patch_logger()
+        clock = self.patch_message_rate_clock()
+        store = yield self.create_store(flush_interval=0.5, clock=clock)
+        self.addCleanup(store.close)
+        yield store.increment('channelid', 'inbound', 10)
+
+        def failing_incr(*args):
+            raise Exception('redis error')
+        self.patch(self.redis, 'incr', failing_incr)
+        yield store.flush()
+        self.assert_was_logged('redis error')
+
+        yield store.increment('channelid', 'inbound', 10)
+        self.assertEqual(
+            store._pending[store.get_key('channelid', 'inbound', 0)], (2, 20))
+
+    @inlineCallbacks
+    def test_series(self):
+        '''Increments should be counted in the series of each resolution,
+        and the series should contain the last buckets, oldest first'''
+        clock = self.patch_message_rate_clock()
+        store = yield self.create_store(
+            series_resolutions={'2s': (2, 3), '10s': (10, 2)})
+        clock.advance(20)
+
+        yield store.increment('channelid', 'inbound', 10)
+        clock.advance(2)
+        yield store.increment('channelid', 'inbound', 10)
+        yield store.increment('channelid', 'inbound', 10)
+
+        self.assertEqual(
+            (yield store.get_series('channelid', 'inbound', '2s')),
+            [(18, 0), (20, 1), (22, 2)])
+        self.assertEqual(
+            (yield store.get_series('channelid', 'inbound', '10s')),
+            [(10, 0), (20, 3)])
+        self.assertEqual(
+            (yield store.get_series('channelid', 'outbound', '2s')),
+            [(18, 0), (20, 0), (22, 0)])
+
+    @inlineCallbacks
+    def test_series_ring_buffer(self):
+        '''Series should be kept in a fixed amount of slots, which are reset
+        when they are reused for a newer bucket'''
+        clock = self.patch_message_rate_clock()
+        store = yield self.create_store(series_resolutions={'2s': (2, 3)})
+        key = store.get_series_key('channelid', 'inbound', '2s')
+
+        for i in range(5):
+            yield store.increment_series('channelid', 'inbound')
+            clock.advance(2)
+
+        self.assertEqual(
+            (yield store.get_series('channelid', 'inbound', '2s')),
+            [(6, 1), (8, 1), (10, 0)])
+        self.assertEqual(len((yield self.redis.hgetall(key))), 6)
+        self.assertEqual((yield self.redis.ttl(key)), 6)
+
+    @inlineCallbacks
+    def test_series_late_increment(self):
+        '''Increments for a bucket that is older than the bucket in its slot
+        should be dropped'''
+        clock = self.patch_message_rate_clock()
+        store = yield self.create_store(
+            series_resolutions={'2s': (2, 3)}, flush_interval=60,
+            clock=clock)
+        self.addCleanup(store.close)
+
+        yield store.increment_series('channelid', 'inbound')
+        clock.advance(6)
+        store2 = yield self.create_store(series_resolutions={'2s': (2, 3)})
+        yield store2.increment_series('channelid', 'inbound')
+        yield store.flush()
+
+        self.assertEqual(
+            (yield store.get_series('channelid', 'inbound', '2s')),
+            [(2, 0), (4, 0), (6, 1)])
+
+    @inlineCallbacks
+    def test_series_aggregated(self):
+        '''If a flush interval is given, series increments should be written
+        on each flush, and should be included in the series before they are
+        written'''
+        clock = self.patch_message_rate_clock()
+        store = yield self.create_store(
+            series_resolutions={'2s': (2, 3)}, flush_interval=0.5,
+            clock=clock)
+        self.addCleanup(store.close)
+        key = store.get_series_key('channelid', 'inbound', '2s')
+
+        yield store.increment('channelid', 'inbound', 10)
+        yield store.increment('channelid', 'inbound', 10)
+        self.assertEqual((yield self.redis.hgetall(key)), {})
+        self.assertEqual(
+            (yield store.get_series('channelid', 'inbound', '2s')),
+            [(-4, 0), (-2, 0), (0, 2)])
+
+        yield store.flush()
+        self.assertEqual(
+            (yield self.redis.hgetall(key)),
+            {'bucket:0': '0', 'count:0': '2'})
+        self.assertEqual(
+            (yield store.get_series('channelid', 'inbound', '2s')),
+            [(-4, 0), (-2, 0), (0, 2)])
+
+    @inlineCallbacks
+    def test_close_writes_aggregated_increments(self):
+        '''Closing the store should write any remaining increments'''
+        clock = self.patch_message_rate_clock()
+        store = yield self.create_store(flush_interval=0.5, clock=clock)
+        yield store.increment('channelid', 'inbound', 10)
+        yield store.close()
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertEqual((yield self.redis.get(
+            store.get_key('channelid', 'inbound', 0))), '1')
+
+    @inlineCallbacks
+    def test_get_counter(self):
+        '''The counter should be the current bucket, expiring after two
+        buckets'''
+        clock = self.patch_message_rate_clock()
+        store = yield self.create_store(series_resolutions={'2s': (2, 3)})
+        clock.advance(25)
+        self.assertEqual(
+            store.get_counter('channelid', 'inbound', 10),
+            ('channelid:inbound:2', 20, [
+                ('channelid:inbound:series:2s', 0, 12, 6)]))
+
     @inlineCallbacks
     def test_old_redis_keys_are_expired(self):
         '''Redis keys that are no longer required should be expired.'''
         clock = self.patch_message_rate_clock()
-        store = yield self.create_store()
+        # Each fake redis operation advances the clock, so don't make the
+        # extra operations for the series
+        store = yield self.create_store(series_resolutions={})
 
         self.redis._client.clock = clock
 
@@ -594,11 +1559,410 @@ class TestMessageRateStore(JunebugTestBase):
         self.assertEqual((yield self.redis.get(bucket2)), '1')
 
 
-class TestRouterStore(JunebugTestBase):
+class TestRateLimitStore(JunebugTestBase):
+    @inlineCallbacks
+    def create_store(self, lease_size=0):
+        redis = yield self.get_redis()
+        self.clock = Clock()
+        self.patch(
+            RateLimitStore, 'get_seconds', lambda _: self.clock.seconds())
+        returnValue(RateLimitStore(redis, lease_size))
+
+    @inlineCallbacks
+    def test_take(self):
+        '''Tokens should be taken until the bucket is empty, after which
+        the time until the next token should be returned'''
+        store = yield self.create_store()
+        for _ in range(3):
+            taken = yield store.take('channel-id', 3, 6)
+            self.assertEqual(taken, (1, 0))
+
+        taken = yield store.take('channel-id', 3, 6)
+        self.assertEqual(taken, (0, 2))
+
+        bucket = yield store.redis.hgetall('channel-id:rate_limit')
+        self.assertEqual(float(bucket['tokens']), 0)
+        ttl = yield store.redis.ttl('channel-id:rate_limit')
+        self.assertTrue(0 < ttl <= 6)
+
+    @inlineCallbacks
+    def test_refill(self):
+        '''The bucket should be refilled at a steady rate, up to its
+        size'''
+        store = yield self.create_store()
+        yield store.take('channel-id', 3, 6, amount=3)
+
+        self.clock.advance(2)
+        self.assertEqual((yield store.take('channel-id', 3, 6)), (1, 0))
+        self.assertEqual((yield store.take('channel-id', 3, 6)), (0, 2))
+
+        self.clock.advance(60)
+        self.assertEqual(
+            (yield store.take('channel-id', 3, 6, amount=3)), (3, 0))
+
+    @inlineCallbacks
+    def test_take_partial(self):
+        '''If there are not enough tokens, as many as there are should be
+        taken for partial takes'''
+        store = yield self.create_store()
+        yield store.take('channel-id', 3, 6, amount=1)
+        taken = yield store.take('channel-id', 3, 6, amount=5, partial=True)
+        self.assertEqual(taken, (2, 6))
+        taken = yield store.take('channel-id', 3, 6, amount=5, partial=True)
+        self.assertEqual(taken, (0, 6))
+
+    @inlineCallbacks
+    def test_channels_separate(self):
+        '''Each channel should have its own bucket'''
+        store = yield self.create_store()
+        self.assertEqual((yield store.take('channel-1', 1, 1)), (1, 0))
+        self.assertEqual((yield store.take('channel-2', 1, 1)), (1, 0))
+        self.assertEqual((yield store.take('channel-1', 1, 1)), (0, 1))
+
+    @inlineCallbacks
+    def test_lease(self):
+        '''Extra tokens should be leased while the bucket is at least half
+        full, and leased tokens should be used without redis calls'''
+        store = yield self.create_store(lease_size=2)
+        calls = []
+        script = junebug.stores.TAKE_RATE_LIMIT_TOKENS
+        fallback = script.fallback
+        self.patch(
+            script, 'fallback', lambda *a: calls.append(a) or fallback(*a))
+
+        # 3 tokens are taken from the full bucket of 8 twice, after which
+        # the 2 tokens left are taken one by one
+        for _ in range(8):
+            self.assertEqual((yield store.take('channel-id', 8, 8)), (1, 0))
+        self.assertEqual(len(calls), 4)
+        self.assertEqual((yield store.take('channel-id', 8, 8)), (0, 1))
+        self.assertEqual(len(calls), 5)
+
+    @inlineCallbacks
+    def test_lease_expires(self):
+        '''Leased tokens that are not used within the window should be
+        dropped'''
+        store = yield self.create_store(lease_size=5)
+        yield store.take('channel-id', 10, 10)
+        self.assertEqual(store._leases['channel-id'], (5, 10))
+
+        self.clock.advance(10)
+        yield store.take('channel-id', 10, 10, amount=2)
+        self.assertEqual(store._leases['channel-id'], (5, 20))
+        bucket = yield store.redis.hgetall('channel-id:rate_limit')
+        self.assertEqual(float(bucket['tokens']), 3)
+
+    @inlineCallbacks
+    def test_lease_kept_when_limited(self):
+        '''Leased tokens should be kept if a take fails'''
+        store = yield self.create_store(lease_size=1)
+        yield store.take('channel-id', 2, 10)
+        self.assertEqual(store._leases['channel-id'], (1, 10))
+
+        taken = yield store.take('channel-id', 2, 10, amount=2)
+        self.assertEqual(taken, (0, 5))
+        self.assertEqual(store._leases['channel-id'], (1, 10))
+        self.assertEqual((yield store.take('channel-id', 2, 10)), (1, 0))
+
+    @inlineCallbacks
+    def test_give_back(self):
+        '''Tokens that are given back should be used for the next takes
+        until the window has passed'''
+        store = yield self.create_store()
+        yield store.take('channel-id', 2, 10, amount=2)
+        store.give_back('channel-id', 10)
+        self.assertEqual((yield store.take('channel-id', 2, 10)), (1, 0))
+        self.assertEqual((yield store.take('channel-id', 2, 10)), (0, 5))
+
+        store.give_back('channel-id', 10)
+        self.clock.advance(10)
+        self.assertEqual(
+            (yield store.take('channel-id', 2, 10, amount=2)), (2, 0))
+        self.assertEqual((yield store.take('channel-id', 2, 10)), (0, 5))
+
+
+class TestChannelIndexStore(JunebugTestBase):
     @inlineCallbacks
     def create_store(self):
         redis = yield self.get_redis()
-        store = RouterStore(redis)
+        returnValue(ChannelIndexStore(redis))
+
+    @inlineCallbacks
+    def test_list_pages(self):
+        '''Channels should be listed in the order they were indexed, a page
+        at a time'''
+        store = yield self.create_store()
+        for id in ['c', 'a', 'b']:
+            yield store.add(id, {'type': 'telnet'})
+
+        page = yield store.list(2)
+        self.assertEqual(page, (['c', 'a'], 2))
+        page = yield store.list(2, cursor=2)
+        self.assertEqual(page, (['b'], None))
+        page = yield store.list(3)
+        self.assertEqual(page, (['c', 'a', 'b'], 3))
+        page = yield store.list(3, cursor=3)
+        self.assertEqual(page, ([], None))
+
+    @inlineCallbacks
+    def test_add_existing(self):
+        '''Indexing a channel again should keep its place in the order'''
+        store = yield self.create_store()
+        yield store.add('a', {})
+        yield store.add('b', {})
+        yield store.add('a', {})
+        self.assertEqual((yield store.list(10)), (['a', 'b'], None))
+
+    @inlineCallbacks
+    def test_list_filters(self):
+        '''Channels should be able to be filtered by type and label'''
+        store = yield self.create_store()
+        yield store.add('a', {'type': 'telnet', 'label': 'foo'})
+        yield store.add('b', {'type': 'smpp', 'label': 'foo'})
+        yield store.add('c', {'type': 'telnet'})
+
+        self.assertEqual(
+            (yield store.list(10, type='telnet')), (['a', 'c'], None))
+        self.assertEqual(
+            (yield store.list(10, label='foo')), (['a', 'b'], None))
+        self.assertEqual(
+            (yield store.list(10, type='smpp', label='foo')), (['b'], None))
+        self.assertEqual((yield store.list(10, type='xmpp')), ([], None))
+
+    @inlineCallbacks
+    def test_list_filters_short_page(self):
+        '''Only a page of the index of the first filter should be read, so
+        pages with several filters can be short'''
+        store = yield self.create_store()
+        yield store.add('a', {'type': 'smpp', 'label': 'foo'})
+        yield store.add('b', {'type': 'telnet', 'label': 'foo'})
+        yield store.add('c', {'type': 'telnet', 'label': 'foo'})
+
+        page = yield store.list(2, type='telnet', label='foo')
+        self.assertEqual(page, (['b', 'c'], 3))
+        page = yield store.list(2, type='smpp', label='foo')
+        self.assertEqual(page, (['a'], None))
+
+    @inlineCallbacks
+    def test_add_changed_properties(self):
+        '''Channels should be removed from the indexes of filters whose
+        values have changed'''
+        store = yield self.create_store()
+        yield store.add('a', {'type': 'telnet', 'label': 'foo'})
+        yield store.add(
+            'a', {'type': 'telnet', 'label': 'bar'},
+            {'type': 'telnet', 'label': 'foo'})
+
+        self.assertEqual((yield store.list(10, label='foo')), ([], None))
+        self.assertEqual((yield store.list(10, label='bar')), (['a'], None))
+        self.assertEqual((yield store.list(10, type='telnet')), (['a'], None))
+
+    @inlineCallbacks
+    def test_remove(self):
+        '''Removed channels should be removed from all indexes'''
+        store = yield self.create_store()
+        yield store.add('a', {'type': 'telnet', 'label': 'foo'})
+        yield store.add('b', {'type': 'telnet'})
+        yield store.remove('a', {'type': 'telnet', 'label': 'foo'})
+
+        self.assertEqual((yield store.list(10)), (['b'], None))
+        self.assertEqual((yield store.list(10, type='telnet')), (['b'], None))
+        self.assertEqual((yield store.list(10, label='foo')), ([], None))
+
+    @inlineCallbacks
+    def test_add_missing(self):
+        '''Stored channels should be indexed if there is no index yet'''
+        store = yield self.create_store()
+        yield store.redis.sadd('channels', 'b')
+        yield store.redis.sadd('channels', 'a')
+        properties = {'a': {'label': 'foo'}, 'b': {}}
+
+        yield store.add_missing(lambda id: succeed(properties[id]))
+        self.assertEqual((yield store.list(10)), (['a', 'b'], None))
+        self.assertEqual((yield store.list(10, label='foo')), (['a'], None))
+
+        yield store.redis.sadd('channels', 'c')
+        properties['c'] = {}
+        yield store.add_missing(lambda id: succeed(properties[id]))
+        self.assertEqual((yield store.list(10)), (['a', 'b'], None))
+
+    @inlineCallbacks
+    def test_add_missing_partial_index(self):
+        '''Stored channels should be indexed if the index has not been
+        marked with its version, even if other channels were indexed
+        before'''
+        store = yield self.create_store()
+        yield store.add('c', {})
+        yield store.redis.sadd('channels', 'a')
+        yield store.redis.sadd('channels', 'c')
+        properties = {'a': {'label': 'foo'}, 'c': {}}
+
+        yield store.add_missing(lambda id: succeed(properties[id]))
+        self.assertEqual((yield store.list(10)), (['c', 'a'], None))
+        self.assertEqual((yield store.list(10, label='foo')), (['a'], None))
+        self.assertTrue((yield store.is_indexed()))
+
+    @inlineCallbacks
+    def test_add_missing_no_channels(self):
+        '''The index should be marked as created even if there are no
+        channels'''
+        store = yield self.create_store()
+        yield store.add_missing(None)
+        self.assertTrue((yield store.is_indexed()))
+
+
+class TestEventLogStore(JunebugTestBase):
+    @inlineCallbacks
+    def create_store(self, size=10):
+        redis = yield self.get_redis()
+        returnValue(EventLogStore(redis, size))
+
+    @inlineCallbacks
+    def test_append(self):
+        '''Appended events should be given increasing offsets'''
+        store = yield self.create_store()
+        self.assertEqual((yield store.get_offset('channel-id')), 0)
+
+        offset = yield store.append('channel-id', {'event_id': 'e1'})
+        self.assertEqual(offset, 1)
+        offset = yield store.append('channel-id', {'event_id': 'e2'})
+        self.assertEqual(offset, 2)
+        self.assertEqual((yield store.get_offset('channel-id')), 2)
+        self.assertEqual((yield store.get_offset('other-channel')), 0)
+
+    @inlineCallbacks
+    def test_read(self):
+        '''Reading should return the events after the offset, oldest
+        first, up to the limit'''
+        store = yield self.create_store()
+        for i in range(1, 5):
+            yield store.append('channel-id', {'event_id': 'e%d' % i})
+
+        events = yield store.read('channel-id', 1, 2)
+        self.assertEqual(events, [
+            (2, {'event_id': 'e2'}),
+            (3, {'event_id': 'e3'}),
+        ])
+        self.assertEqual((yield store.read('channel-id', 4, 10)), [])
+        self.assertEqual((yield store.read('other-channel', 0, 10)), [])
+
+    @inlineCallbacks
+    def test_size(self):
+        '''Only the most recent events should be kept'''
+        store = yield self.create_store(size=2)
+        for i in range(1, 5):
+            yield store.append('channel-id', {'event_id': 'e%d' % i})
+
+        events = yield store.read('channel-id', 0, 10)
+        self.assertEqual(events, [
+            (3, {'event_id': 'e3'}),
+            (4, {'event_id': 'e4'}),
+        ])
+
+
+class TestRetryQueueStore(JunebugTestBase):
+    @inlineCallbacks
+    def create_store(self):
+        redis = yield self.get_redis()
+        returnValue(RetryQueueStore(redis))
+
+    @inlineCallbacks
+    def test_add(self):
+        '''Added deliveries should be counted in the depth of the channel's
+        queue, and the channel should be listed'''
+        store = yield self.create_store()
+        yield store.add('channel-id', 'd1', {'url': 'http://a'}, 10)
+        yield store.add('channel-id', 'd2', {'url': 'http://b'}, 5)
+
+        self.assertEqual((yield store.get_depth('channel-id')), 2)
+        self.assertEqual((yield store.get_depth('other-channel')), 0)
+        self.assertEqual((yield store.get_channels()), set(['channel-id']))
+
+    @inlineCallbacks
+    def test_take_due(self):
+        '''Only deliveries that are due should be taken, oldest first, up
+        to the limit, and be hidden until the lease is over'''
+        store = yield self.create_store()
+        yield store.add('channel-id', 'd1', {'url': 'http://a'}, 10)
+        yield store.add('channel-id', 'd2', {'url': 'http://b'}, 5)
+        yield store.add('channel-id', 'd3', {'url': 'http://c'}, 30)
+
+        due = yield store.take_due('channel-id', 20, 100, 1)
+        self.assertEqual(due, [('d2', {'url': 'http://b'})])
+        due = yield store.take_due('channel-id', 20, 100, 10)
+        self.assertEqual(due, [('d1', {'url': 'http://a'})])
+        self.assertEqual((yield store.take_due('channel-id', 20, 100, 10)), [])
+
+        due = yield store.take_due('channel-id', 100, 200, 10)
+        self.assertEqual(
+            sorted(due),
+            [('d1', {'url': 'http://a'}), ('d2', {'url': 'http://b'}),
+             ('d3', {'url': 'http://c'})])
+        self.assertEqual((yield store.get_depth('channel-id')), 3)
+
+    @inlineCallbacks
+    def test_remove(self):
+        '''Removed deliveries should not be taken again, and the channel
+        should no longer be listed once its queue is empty'''
+        store = yield self.create_store()
+        yield store.add('channel-id', 'd1', {'url': 'http://a'}, 10)
+        yield store.add('channel-id', 'd2', {'url': 'http://b'}, 10)
+        yield store.remove('channel-id', 'd1')
+
+        due = yield store.take_due('channel-id', 20, 100, 10)
+        self.assertEqual(due, [('d2', {'url': 'http://b'})])
+        self.assertEqual((yield store.get_depth('channel-id')), 1)
+
+        yield store.remove('channel-id', 'd2')
+        self.assertEqual((yield store.get_depth('channel-id')), 0)
+        due = yield store.take_due('channel-id', 200, 300, 10)
+        self.assertEqual(due, [])
+        self.assertEqual((yield store.get_channels()), set())
+
+    @inlineCallbacks
+    def test_dead_letter(self):
+        '''Dead lettered deliveries should be removed from the queue, and
+        only the most recent ones should be kept'''
+        store = yield self.create_store()
+        self.patch(store, 'DEAD_LETTER_LIMIT', 2)
+        for i in range(3):
+            yield store.add('channel-id', 'd%d' % i, {'i': i}, 10)
+            yield store.dead_letter('channel-id', 'd%d' % i, {'i': i})
+
+        self.assertEqual((yield store.get_depth('channel-id')), 0)
+        self.assertEqual((yield store.get_dead_letter_count('channel-id')), 2)
+        self.assertEqual(
+            (yield store.get_dead_letters('channel-id')),
+            [{'i': 2}, {'i': 1}])
+
+    @inlineCallbacks
+    def test_clear(self):
+        '''Clearing a channel should remove its deliveries and dead letters,
+        and leave the other channels alone'''
+        store = yield self.create_store()
+        yield store.add('channel-id', 'd1', {'url': 'http://a'}, 10)
+        yield store.add('channel-id', 'd2', {'url': 'http://b'}, 10)
+        yield store.dead_letter('channel-id', 'd2', {'url': 'http://b'})
+        yield store.add('other-channel', 'd3', {'url': 'http://c'}, 10)
+
+        yield store.clear('channel-id')
+        self.assertEqual((yield store.get_depth('channel-id')), 0)
+        self.assertEqual((yield store.get_dead_letter_count('channel-id')), 0)
+        self.assertEqual(
+            (yield store.take_due('channel-id', 20, 100, 10)), [])
+        self.assertEqual((yield store.get_channels()), set(['other-channel']))
+        self.assertEqual((yield store.get_depth('other-channel')), 1)
+
+
+class TestRouterStore(JunebugTestBase):
+    @inlineCallbacks
+    def create_store(self, cache=False):
+        redis = yield self.get_redis()
+        if cache:
+            cache = ConfigCache(redis, 'routers', 60)
+        else:
+            cache = None
+        store = RouterStore(redis, cache=cache)
         returnValue(store)
 
     @inlineCallbacks
@@ -757,3 +2121,79 @@ class TestRouterStore(JunebugTestBase):
         self.assertEqual(
             (yield self.redis.smembers('routers:router-id:destinations')),
             set())
+
+    @inlineCallbacks
+    def test_get_router_and_destination_configs(self):
+        """Should return the router config and the list of destination
+        configs"""
+        store = yield self.create_store()
+        yield store.save_router({'id': 'router-id'})
+        yield store.save_router_destination('router-id', {'id': 'dest-2'})
+        yield store.save_router_destination('router-id', {'id': 'dest-1'})
+
+        self.assertEqual(
+            (yield store.get_router_and_destination_configs('router-id')),
+            ({'id': 'router-id'}, [{'id': 'dest-1'}, {'id': 'dest-2'}]))
+
+    @inlineCallbacks
+    def test_get_router_and_destination_configs_missing(self):
+        """If the router doesn't exist, the router config should be None, and
+        nothing should be cached"""
+        store = yield self.create_store(cache=True)
+        self.assertEqual(
+            (yield store.get_router_and_destination_configs('router-id')),
+            (None, []))
+        self.assertEqual(store.cache.get('router-id'), None)
+
+    @inlineCallbacks
+    def test_get_router_and_destination_configs_cached(self):
+        """Once loaded, the configs should be returned from the cache"""
+        store = yield self.create_store(cache=True)
+        yield store.save_router({'id': 'router-id'})
+        yield store.save_router_destination('router-id', {'id': 'dest-1'})
+
+        configs = yield store.get_router_and_destination_configs('router-id')
+        yield self.redis.delete('routers:router-id')
+        yield self.redis.delete('routers:router-id:destinations')
+        self.assertEqual(
+            (yield store.get_router_and_destination_configs('router-id')),
+            configs)
+
+    @inlineCallbacks
+    def test_get_router_and_destination_configs_invalidated(self):
+        """If the cached configs are invalidated while they are being
+        loaded, the loaded configs should not be cached"""
+        store = yield self.create_store(cache=True)
+        yield store.save_router({'id': 'router-id'})
+        store.cache.discard('router-id')
+
+        d = store.get_router_and_destination_configs('router-id')
+        store.cache.discard('router-id')
+        self.assertEqual((yield d), ({'id': 'router-id'}, []))
+        self.assertEqual(store.cache.get('router-id'), None)
+
+        yield store.get_router_and_destination_configs('router-id')
+        self.assertNotEqual(store.cache.get('router-id'), None)
+
+    @inlineCallbacks
+    def test_cache_updated(self):
+        """Saving and deleting routers and destinations should update the
+        cached configs"""
+        store = yield self.create_store(cache=True)
+        yield store.save_router({'id': 'router-id'})
+        yield store.save_router_destination('router-id', {'id': 'dest-1'})
+        yield store.get_router_and_destination_configs('router-id')
+
+        yield store.save_router({'id': 'router-id', 'label': 'new'})
+        yield store.save_router_destination('router-id', {'id': 'dest-2'})
+        yield store.delete_router_destination('router-id', 'dest-1')
+        self.assertEqual(store.cache.get('router-id'), {
+            'config': {'id': 'router-id', 'label': 'new'},
+            'destinations': {'dest-2': {'id': 'dest-2'}},
+        })
+
+        yield store.delete_router('router-id')
+        self.assertEqual(store.cache.get('router-id'), None)
+        self.assertEqual(
+            (yield store.get_router_and_destination_configs('router-id')),
+            (None, [{'id': 'dest-2'}]))
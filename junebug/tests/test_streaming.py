@@ -0,0 +1,314 @@
+import treq
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks, succeed
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+from twisted.web.resource import Resource
+
+from junebug.streaming import (
+    LineStream, LineTooLong, RequestBodyProducer, StreamingHTTPChannel,
+    StreamingSite)
+
+
+class FakeProducer(object):
+    def __init__(self):
+        self.paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class StreamOutputResource(Resource):
+    isLeaf = True
+
+    def render_POST(self, request):
+        request.content.finish()
+        request.content.output.seek(0)
+        return request.content.output.read()
+
+
+class FakeRequest(object):
+    body_received = False
+
+    def __init__(self):
+        self.transport = StringTransport()
+        self.channel = StreamingHTTPChannel()
+        self.channel.timeOut = None
+        self.channel.makeConnection(self.transport)
+        self.channel.requests = [self]
+        self.body_producer = RequestBodyProducer(self)
+
+    @property
+    def paused(self):
+        return self.transport.producerState == 'paused'
+
+
+class TestLineStream(TestCase):
+    def create_stream(self, handle_line=None, **kw):
+        self.lines = []
+
+        def record_line(line_number, line):
+            self.lines.append((line_number, line))
+            return succeed(line)
+
+        stream = LineStream(handle_line or record_line, **kw)
+        stream.start()
+        return stream
+
+    def test_lines_split_across_chunks(self):
+        '''Lines should be handled as soon as they are complete, even if they
+        are split across chunks of the body'''
+        stream = self.create_stream()
+        stream.write('{"a": 1}\n{"b"')
+        self.assertEqual(self.lines, [(1, '{"a": 1}')])
+        stream.write(': 2}\n')
+        self.assertEqual(self.lines, [(1, '{"a": 1}'), (2, '{"b": 2}')])
+
+    def test_finish_last_line(self):
+        '''The last line should be handled once the body is finished, even if
+        it does not end with a newline'''
+        stream = self.create_stream()
+        stream.write('foo\nbar')
+        stream.finish()
+        self.assertEqual(self.lines, [(1, 'foo'), (2, 'bar')])
+
+    def test_blank_lines(self):
+        '''Blank lines should be skipped, but counted as lines'''
+        stream = self.create_stream()
+        stream.write('foo\n\n  \r\nbar\n')
+        stream.finish()
+        self.assertEqual(self.lines, [(1, 'foo'), (4, 'bar')])
+
+    def read_output(self, stream):
+        position = stream.output.tell()
+        stream.output.seek(0)
+        output = stream.output.read()
+        stream.output.seek(position)
+        return output
+
+    def test_results_in_order(self):
+        '''Each result should be written as soon as it and the results
+        before it are ready, in the order of the lines'''
+        pending = {}
+
+        def handle_line(line_number, line):
+            pending[line] = Deferred()
+            return pending[line]
+
+        stream = self.create_stream(handle_line)
+        stream.write('foo\nbar\nbaz\n')
+        pending['bar'].callback('bar result')
+        self.assertEqual(self.read_output(stream), '')
+        pending['foo'].callback('foo result')
+        self.assertEqual(
+            self.read_output(stream), 'foo result\nbar result\n')
+        self.assertEqual(stream.pending, 1)
+        pending['baz'].callback('baz result')
+        self.assertEqual(
+            self.read_output(stream),
+            'foo result\nbar result\nbaz result\n')
+
+    def test_format_result(self):
+        '''Results should be written as formatted by ``format_result``'''
+        stream = self.create_stream(
+            format_result=lambda result: '<%s>' % (result,))
+        stream.write('foo\nbar\n')
+        self.assertEqual(self.read_output(stream), '<foo><bar>')
+
+    def test_wait(self):
+        '''Waiting should only fire once the body is finished and all of its
+        results have been written'''
+        pending = []
+        stream = self.create_stream(
+            lambda n, line: pending.append(Deferred()) or pending[-1])
+        stream.write('foo\n')
+        d = stream.wait()
+        pending[0].callback('foo')
+        self.assertNoResult(d)
+        stream.write('bar')
+        stream.finish()
+        self.assertNoResult(d)
+        pending[1].callback('bar')
+        self.successResultOf(d)
+        self.assertEqual(self.read_output(stream), 'foo\nbar\n')
+
+    def test_start(self):
+        '''Lines should only be handled once the stream is started'''
+        lines = []
+        stream = LineStream(lambda n, line: lines.append(line))
+        stream.write('foo\n')
+        self.assertEqual(lines, [])
+        stream.start()
+        self.assertEqual(lines, ['foo'])
+        stream.write('bar\n')
+        self.assertEqual(lines, ['foo', 'bar'])
+
+    def test_stop(self):
+        '''Stopping should drop the lines that have not been handled, and the
+        lines received after it, without pausing the producer for them'''
+        lines = []
+        producer = FakeProducer()
+        stream = LineStream(
+            lambda n, line: lines.append(line), producer=producer,
+            max_pending=2)
+        stream.write('foo\nbar\n')
+        self.assertTrue(producer.paused)
+
+        stream.stop()
+        self.assertFalse(producer.paused)
+        stream.write('baz\nquux\n')
+        self.assertFalse(producer.paused)
+        stream.finish()
+        self.successResultOf(stream.wait())
+        self.assertEqual(lines, [])
+        self.assertEqual(self.read_output(stream), '')
+
+    def test_backpressure(self):
+        '''The producer should be paused while the maximum amount of lines
+        are waiting for their results to be written, and resumed once they
+        are written'''
+        pending = []
+        producer = FakeProducer()
+        stream = LineStream(
+            lambda n, line: pending.append(Deferred()) or pending[-1],
+            producer=producer, max_pending=2)
+
+        stream.write('foo\n')
+        self.assertFalse(producer.paused)
+        stream.write('bar\n')
+        self.assertTrue(producer.paused)
+
+        stream.start()
+        self.assertTrue(producer.paused)
+        pending[1].callback(None)
+        self.assertTrue(producer.paused)
+        pending[0].callback(None)
+        self.assertFalse(producer.paused)
+
+    def test_finish_resumes_producer(self):
+        '''The producer should be resumed once the body is finished'''
+        producer = FakeProducer()
+        stream = LineStream(
+            lambda n, line: Deferred(), producer=producer, max_pending=1)
+        stream.write('foo\n')
+        self.assertTrue(producer.paused)
+        stream.finish()
+        self.assertFalse(producer.paused)
+
+    def test_line_too_long(self):
+        '''Lines longer than the maximum line length should fail, without
+        keeping them in memory'''
+        results = []
+
+        def format_result(result):
+            results.append(result)
+            return ''
+
+        stream = self.create_stream(
+            max_line_length=5, format_result=format_result)
+        stream.write('foo\n123')
+        stream.write('4567')
+        stream.write('89\nbar\n')
+        stream.finish()
+
+        self.assertEqual(self.lines, [(1, 'foo'), (3, 'bar')])
+        [foo, too_long, bar] = results
+        self.assertEqual(foo, 'foo')
+        too_long.trap(LineTooLong)
+        self.assertEqual(too_long.value.line_number, 2)
+        self.assertEqual(bar, 'bar')
+
+    def test_file_interface(self):
+        '''The stream should have the file interface that twisted expects of
+        request content'''
+        stream = self.create_stream()
+        stream.write('foo\n')
+        stream.write('bar\n')
+        stream.seek(0, 0)
+        self.assertEqual(stream.tell(), 8)
+        self.assertEqual(stream.read(), '')
+        stream.close()
+
+
+class TestRequestBodyProducer(TestCase):
+    def test_pause_resume(self):
+        '''Reading the body should be paused and resumed'''
+        request = FakeRequest()
+        request.body_producer.pauseProducing()
+        self.assertTrue(request.paused)
+        request.body_producer.resumeProducing()
+        self.assertFalse(request.paused)
+
+    def test_resume_body_received(self):
+        '''Reading should not be resumed once the body has been received,
+        since the channel then decides when to read again'''
+        request = FakeRequest()
+        request.body_producer.pauseProducing()
+        request.body_received = True
+        request.body_producer.resumeProducing()
+        self.assertTrue(request.paused)
+
+    def test_resume_sending_paused(self):
+        '''Reading should not be resumed while the channel is paused for
+        sending its responses'''
+        request = FakeRequest()
+        request.channel.pauseProducing()
+        request.body_producer.pauseProducing()
+        request.body_producer.resumeProducing()
+        self.assertTrue(request.paused)
+
+    def test_channel_resume_body_paused(self):
+        '''The channel should not resume reading a body that is paused once
+        its responses have been sent'''
+        request = FakeRequest()
+        request.channel.pauseProducing()
+        request.body_producer.pauseProducing()
+        request.channel.resumeProducing()
+        self.assertTrue(request.paused)
+        request.body_producer.resumeProducing()
+        self.assertFalse(request.paused)
+
+
+class TestStreamingSite(TestCase):
+    def test_get_stream(self):
+        '''The stream for the first matching method and path should be
+        returned'''
+        site = StreamingSite(Resource(), [
+            ('POST', r'^/things/([^/]+)/stream$',
+             lambda request, thing: ('stream', thing)),
+        ])
+        self.assertEqual(
+            site.get_stream(None, 'POST', '/things/foo/stream?a=b'),
+            ('stream', 'foo'))
+        self.assertEqual(
+            site.get_stream(None, 'GET', '/things/foo/stream'), None)
+        self.assertEqual(
+            site.get_stream(None, 'POST', '/things/foo/other'), None)
+
+    @inlineCallbacks
+    def test_request_body_streamed(self):
+        '''Bodies of matching requests should be written to the stream as
+        they are received'''
+        requests = []
+
+        def create_stream(request):
+            requests.append((request, request.channel))
+            stream = LineStream(lambda n, line: line.upper())
+            stream.start()
+            return stream
+
+        site = StreamingSite(StreamOutputResource(), [
+            ('POST', r'^/stream$', create_stream),
+        ])
+        port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        url = 'http://127.0.0.1:%d/stream' % (port.getHost().port,)
+
+        resp = yield treq.post(url, 'foo\nbar\n', persistent=False)
+        self.assertEqual((yield resp.content()), 'FOO\nBAR\n')
+        [(request, channel)] = requests
+        self.assertEqual(request.request_line, ('POST', '/stream'))
+        self.assertTrue(isinstance(channel, StreamingHTTPChannel))
@@ -0,0 +1,199 @@
+import os
+import sys
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase
+
+from junebug import supervisor
+from junebug.supervisor import (
+    ApiProcesses, ApiProcessProtocol, ParentWatcher, WorkerReconciler,
+    listen_reuseport)
+
+
+class TestListenReuseport(TestCase):
+    def test_listen_reuseport(self):
+        '''Several sockets should be able to listen on the same port'''
+        factory = Factory.forProtocol(Protocol)
+        port1 = listen_reuseport(0, factory, interface='127.0.0.1')
+        self.addCleanup(port1.stopListening)
+        number = port1.getHost().port
+
+        port2 = listen_reuseport(number, factory, interface='127.0.0.1')
+        self.addCleanup(port2.stopListening)
+        self.assertEqual(port2.getHost().port, number)
+
+
+class TestWorkerReconciler(TestCase):
+    def test_restart(self):
+        '''Restarts should be run one at a time, in the order that they were
+        requested'''
+        calls = []
+        waiting = Deferred()
+
+        def restart(id):
+            calls.append(id)
+            if id == 'a':
+                return waiting
+
+        reconciler = WorkerReconciler('name', restart, None)
+        reconciler.discard('a')
+        reconciler.discard('b')
+        self.assertEqual(calls, ['a'])
+        waiting.callback(None)
+        self.assertEqual(calls, ['a', 'b'])
+
+    def test_sync(self):
+        '''Clearing the reconciler should sync the workers'''
+        calls = []
+        reconciler = WorkerReconciler(
+            'name', None, lambda: calls.append('sync'))
+        reconciler.clear()
+        self.assertEqual(calls, ['sync'])
+
+    def test_error_logged(self):
+        '''Errors should be logged instead of stopping later restarts'''
+        calls = []
+
+        def restart(id):
+            calls.append(id)
+            if id == 'a':
+                raise ValueError('bad')
+
+        reconciler = WorkerReconciler('name', restart, None)
+        reconciler.discard('a')
+        reconciler.discard('b')
+        self.assertEqual(calls, ['a', 'b'])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+
+class TestParentWatcher(TestCase):
+    def test_parent_exited(self):
+        '''The process should be stopped once the parent process has
+        exited'''
+        stopped = []
+        watcher = ParentWatcher(stop=lambda: stopped.append(True))
+        watcher.check()
+        self.assertEqual(stopped, [])
+
+        self.patch(os, 'getppid', lambda: watcher.ppid + 1)
+        watcher.check()
+        self.assertEqual(stopped, [True])
+
+
+class TestApiProcesses(TestCase):
+    def create_processes(self, count=2):
+        self.clock = Clock()
+        processes = ApiProcesses(
+            count, ['-p', '8000', '-aw', str(count)], clock=self.clock)
+        self.spawned = []
+        self.patch(processes, 'spawn', self.spawned.append)
+        return processes
+
+    def test_command(self):
+        '''The processes should be started as API only processes, with the
+        arguments of the supervising process'''
+        processes = self.create_processes()
+        self.assertEqual(processes.command(), [
+            sys.executable, '-m', 'junebug.command_line', '--api-only',
+            '-p', '8000', '-aw', '2'])
+
+    def test_start(self):
+        '''Starting should start each of the processes'''
+        processes = self.create_processes(3)
+        processes.startService()
+        self.assertEqual(self.spawned, [0, 1, 2])
+
+    def test_process_ended(self):
+        '''Processes that exit should be started again after a delay'''
+        processes = self.create_processes()
+        processes.startService()
+        processes.process_ended(1, Failure(Exception('exited')))
+        self.assertEqual(self.spawned, [0, 1])
+        self.clock.advance(supervisor.RESPAWN_DELAY)
+        self.assertEqual(self.spawned, [0, 1, 1])
+
+    def test_process_ended_stopped(self):
+        '''Processes should not be started again once stopped'''
+        processes = self.create_processes()
+        processes.startService()
+        processes.stopService()
+        processes.process_ended(1, Failure(Exception('exited')))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def create_transport(self, exited=False):
+        signals = []
+
+        class FakeTransport(object):
+            def signalProcess(self, signal):
+                signals.append(signal)
+                if exited:
+                    raise ProcessExitedAlready()
+
+        return FakeTransport(), signals
+
+    def test_stop(self):
+        '''Stopping should signal each of the processes to exit, and wait
+        for them to end'''
+        processes = self.create_processes(1)
+        processes.startService()
+        protocol = ApiProcessProtocol(processes, 0)
+        protocol.transport, signals = self.create_transport()
+        processes.protocols[0] = protocol
+
+        d = processes.stopService()
+        self.assertEqual(signals, ['TERM'])
+        self.assertNoResult(d)
+        protocol.processEnded(Failure(Exception('exited')))
+        self.successResultOf(d)
+
+    def test_stop_idempotent(self):
+        '''Stopping again while the processes are exiting should wait for
+        the same processes without signalling them again'''
+        processes = self.create_processes(1)
+        processes.startService()
+        protocol = ApiProcessProtocol(processes, 0)
+        protocol.transport, signals = self.create_transport()
+        processes.protocols[0] = protocol
+
+        d1 = processes.stopService()
+        d2 = processes.stopService()
+        self.assertEqual(signals, ['TERM'])
+        self.assertNoResult(d2)
+        protocol.processEnded(Failure(Exception('exited')))
+        self.successResultOf(d1)
+        self.successResultOf(d2)
+        self.successResultOf(processes.stopService())
+
+    def test_stop_exited_already(self):
+        '''Processes that have already exited should not stop the others
+        from being signalled'''
+        processes = self.create_processes(2)
+        processes.startService()
+        protocol1 = ApiProcessProtocol(processes, 0)
+        protocol1.transport, signals1 = self.create_transport(exited=True)
+        protocol2 = ApiProcessProtocol(processes, 1)
+        protocol2.transport, signals2 = self.create_transport()
+        processes.protocols.update({0: protocol1, 1: protocol2})
+
+        d = processes.stopService()
+        self.assertEqual(signals1, ['TERM'])
+        self.assertEqual(signals2, ['TERM'])
+        protocol1.processEnded(Failure(Exception('exited')))
+        protocol2.processEnded(Failure(Exception('exited')))
+        self.successResultOf(d)
+
+    def test_spawn(self):
+        '''The processes should be spawned with the API only command'''
+        spawned = []
+        self.patch(
+            reactor, 'spawnProcess',
+            lambda protocol, executable, args, **kw: spawned.append(
+                (protocol.index, executable, args)))
+        processes = ApiProcesses(1, ['-p', '8000'])
+        processes.startService()
+        self.assertEqual(spawned, [(0, sys.executable, processes.command())])
@@ -33,6 +33,19 @@ class TestUtils(TestCase):
         self.assertEqual(content['status'], 200)
         self.assertEqual(content['description'], 'bar')
 
+    @inlineCallbacks
+    def test_response_extra(self):
+        srv = yield ToyServer.from_test(self)
+
+        @srv.app.route('/')
+        def route(req):
+            return response(req, 'bar', [23], extra={'foo': 'baz'})
+
+        resp = yield treq.get(srv.url, persistent=False)
+        content = yield resp.json()
+        self.assertEqual(content['result'], [23])
+        self.assertEqual(content['foo'], 'baz')
+
     @inlineCallbacks
     def test_response_content_type(self):
         srv = yield ToyServer.from_test(self)
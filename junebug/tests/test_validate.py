@@ -5,11 +5,14 @@ from twisted.trial.unittest import TestCase
 from twisted.internet.defer import inlineCallbacks
 
 import treq
+from jsonschema import Draft4Validator
 from klein import Klein
 
+from junebug.api import OUTBOUND_MESSAGE_SCHEMA
 from junebug.tests.utils import ToyServer
 from junebug.utils import json_body
-from junebug.validate import body_schema, validate
+from junebug.validate import (
+    body_schema, compile_schema, query_bool, query_int, validate)
 
 
 class TestValidate(TestCase):
@@ -99,3 +102,172 @@ class TestValidate(TestCase):
             data=json.dumps({'foo': 'bar'}))
 
         self.assertEqual(resp.code, http.OK)
+
+
+class TestQueryInt(TestCase):
+    def request(self, **args):
+        class Request(object):
+            pass
+
+        req = Request()
+        req.args = dict((k, [v]) for k, v in args.iteritems())
+        return req
+
+    def test_valid(self):
+        '''Integers within the bounds, and missing parameters, should be
+        valid'''
+        validator = query_int('n', 1, 10)
+        self.assertEqual(validator(self.request()), [])
+        self.assertEqual(validator(self.request(n='1')), [])
+        self.assertEqual(validator(self.request(n='10')), [])
+        self.assertEqual(query_int('n')(self.request(n='-5')), [])
+
+    def test_invalid(self):
+        '''Parameters that are not integers or are out of bounds should be
+        invalid'''
+        validator = query_int('n', 1, 10)
+        self.assertEqual(validator(self.request(n='foo')), [{
+            'type': 'invalid_query',
+            'message': "'foo' is not an integer",
+            'parameter': 'n',
+        }])
+        self.assertEqual(validator(self.request(n='0')), [{
+            'type': 'invalid_query',
+            'message': '0 is less than the minimum of 1',
+            'parameter': 'n',
+        }])
+        self.assertEqual(validator(self.request(n='11')), [{
+            'type': 'invalid_query',
+            'message': '11 is greater than the maximum of 10',
+            'parameter': 'n',
+        }])
+
+
+class TestQueryBool(TestQueryInt):
+    def test_valid(self):
+        '''Boolean values, and missing parameters, should be valid'''
+        validator = query_bool('b')
+        self.assertEqual(validator(self.request()), [])
+        for value in ['true', 'True', 'false', '1', '0']:
+            self.assertEqual(validator(self.request(b=value)), [])
+
+    def test_invalid(self):
+        '''Parameters that are not booleans should be invalid'''
+        validator = query_bool('b')
+        self.assertEqual(validator(self.request(b='yes')), [{
+            'type': 'invalid_query',
+            'message': "'yes' is not a boolean",
+            'parameter': 'b',
+        }])
+
+
+class TestCompileSchema(TestCase):
+    def assert_same_errors(self, schema, instances):
+        compiled = compile_schema(schema)
+        json_validator = Draft4Validator(schema)
+        for instance in instances:
+            self.assertEqual(
+                sorted(compiled(instance)),
+                sorted(
+                    (e.message, list(e.schema_path))
+                    for e in json_validator.iter_errors(instance)))
+
+    def test_outbound_message_schema(self):
+        '''The compiled outbound message schema should give the same errors
+        as the draft 4 validator'''
+        self.assert_same_errors(OUTBOUND_MESSAGE_SCHEMA, [
+            {'to': '+1234', 'content': 'foo'},
+            {'to': '+1234', 'content': None, 'from': None},
+            {'reply_to': 'abc', 'content': 'foo', 'channel_data': {}},
+            {'to': 23, 'content': 'foo', 'priority': 1},
+            {'to': '+1234'},
+            {'content': 'foo', 'bar': 1},
+            {'content': 'foo', 'bar': 1, 'baz': 2},
+            {'content': ['foo'], 'channel_data': [], 'from': True},
+            {'content': 1.5, 'event_url': None, 'group': 7L},
+            {},
+            [],
+            None,
+            'foo',
+            23,
+        ])
+
+    def test_batch_schema(self):
+        '''Compiled array schemas should give the same errors as the draft 4
+        validator'''
+        self.assert_same_errors({
+            'type': 'array',
+            'items': OUTBOUND_MESSAGE_SCHEMA,
+            'minItems': 1,
+            'maxItems': 2,
+        }, [
+            [{'to': '+1234', 'content': 'foo'}],
+            [{'to': '+1234'}, {'content': 1, 'foo': 'bar'}],
+            [{}, {}, {}],
+            [],
+            {},
+            None,
+        ])
+
+    def test_numbers(self):
+        '''Compiled number limits should give the same errors as the draft 4
+        validator'''
+        self.assert_same_errors({
+            'type': 'object',
+            'properties': {
+                'ttl': {'type': 'integer', 'minimum': 0},
+                'rate': {
+                    'type': 'number',
+                    'minimum': 1,
+                    'exclusiveMinimum': True,
+                    'maximum': 10,
+                    'exclusiveMaximum': True,
+                },
+                'size': {'type': 'number', 'maximum': 10},
+            },
+            'required': ['ttl'],
+        }, [
+            {'ttl': 0, 'rate': 5, 'size': 10},
+            {'ttl': -1, 'rate': 1, 'size': 10.5},
+            {'ttl': 1.0, 'rate': 10, 'size': True},
+            {'ttl': True, 'rate': 0.5, 'size': '11'},
+            {'ttl': None, 'rate': 11},
+            {},
+        ])
+
+    def test_strings(self):
+        '''Compiled string limits and additional property schemas should
+        give the same errors as the draft 4 validator'''
+        self.assert_same_errors({
+            'type': 'object',
+            'properties': {
+                'label': {'type': 'string', 'minLength': 2, 'maxLength': 4},
+            },
+            'additionalProperties': {'type': 'string', 'maxLength': 1},
+            'title': 'ignored',
+        }, [
+            {'label': 'foo', 'a': 'b'},
+            {'label': 'f', 'a': 'bc', 'b': 1},
+            {'label': 'fooba', 'a': None},
+            {'label': 23},
+        ])
+
+    def test_unsupported_keyword(self):
+        '''Schemas with keywords that cannot be compiled should be validated
+        by the draft 4 validator'''
+        schema = {
+            'type': 'object',
+            'properties': {
+                'to': {'type': 'string', 'pattern': '^\\+'},
+                'priority': {'enum': ['high', 'low']},
+            },
+        }
+        self.assert_same_errors(schema, [
+            {'to': '+1234', 'priority': 'high'},
+            {'to': '1234', 'priority': 'medium'},
+            {'to': 1234},
+        ])
+        self.assertEqual(compile_schema(schema)({'to': '1234'}), [
+            ("'1234' does not match '^\\\\+'",
+             ['properties', 'to', 'pattern']),
+        ])
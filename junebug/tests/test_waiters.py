@@ -0,0 +1,165 @@
+import json
+
+from twisted.internet.defer import (
+    CancelledError, inlineCallbacks, returnValue, succeed)
+from twisted.internet import reactor
+from twisted.internet.task import Clock, deferLater
+from twisted.trial.unittest import TestCase
+
+from junebug.tests.helpers import JunebugTestBase
+from junebug.waiters import (
+    ADD_WAITER, PUBLISH_IF_WAITING, REMOVE_WAITER, EventWaiters,
+    get_event_waiters, notify_event, wait_for_event)
+
+
+class TestEventWaiters(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.waiters = EventWaiters(self.clock)
+
+    def test_notify(self):
+        '''Waiters for a message should be woken when it is notified'''
+        d1 = self.waiters.wait('channel-id', 'msg-1', 10)
+        d2 = self.waiters.wait('channel-id', 'msg-1', 10)
+        d3 = self.waiters.wait('channel-id', 'msg-2', 10)
+        self.assertEqual(len(self.waiters), 3)
+
+        self.waiters.notify('channel-id', 'msg-1')
+        self.assertTrue(self.successResultOf(d1))
+        self.assertTrue(self.successResultOf(d2))
+        self.assertNoResult(d3)
+        self.assertEqual(len(self.waiters), 1)
+        self.assertEqual(self.clock.getDelayedCalls()[0].getTime(), 10)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_timeout(self):
+        '''Waiters should be woken with False after the timeout'''
+        d = self.waiters.wait('channel-id', 'msg-1', 10)
+        self.clock.advance(9)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.assertFalse(self.successResultOf(d))
+        self.assertEqual(len(self.waiters), 0)
+
+    def test_cancel(self):
+        '''Cancelled waiters should be removed'''
+        d = self.waiters.wait('channel-id', 'msg-1', 10)
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        self.assertEqual(len(self.waiters), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_discard(self):
+        '''Notifications published by other processes should wake the
+        waiters for the message'''
+        d = self.waiters.wait('channel-id', 'msg-1', 10)
+        self.waiters.discard(['channel-id', 'msg-1'])
+        self.assertTrue(self.successResultOf(d))
+
+    def test_clear(self):
+        '''Clearing should wake all of the waiters'''
+        d1 = self.waiters.wait('channel-id', 'msg-1', 10)
+        d2 = self.waiters.wait('other-id', 'msg-2', 10)
+        self.waiters.clear()
+        self.assertTrue(self.successResultOf(d1))
+        self.assertTrue(self.successResultOf(d2))
+        self.assertEqual(len(self.waiters), 0)
+
+
+class TestSharedEventWaiters(JunebugTestBase):
+    @inlineCallbacks
+    def test_shared(self):
+        '''Notifying an event should wake the waiters of the process that
+        share the redis config'''
+        redis = yield self.get_redis()
+        waiters = get_event_waiters(redis)
+        self.assertIdentical(get_event_waiters(redis), waiters)
+
+        d = waiters.wait('channel-id', 'msg-1', 10)
+        yield notify_event(redis, 'channel-id', 'msg-1')
+        self.assertTrue(self.successResultOf(d))
+
+    @inlineCallbacks
+    def get_publishing_redis(self):
+        '''Returns a redis manager whose client records the messages
+        published with it'''
+        redis = yield self.get_redis()
+        published = []
+        redis._client.publish = lambda channel, data: succeed(
+            published.append((channel, data)))
+        self.addCleanup(delattr, redis._client, 'publish')
+        returnValue((redis, published))
+
+    @inlineCallbacks
+    def test_wait_for_event(self):
+        '''Waiters should be counted in redis while they wait'''
+        redis = yield self.get_redis()
+        d = wait_for_event(redis, 'channel-id', 'msg-1', 10)
+        key = 'channel-id:message_status_waiters:msg-1'
+        while not get_event_waiters(redis):
+            yield deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual((yield redis.get(key)), '1')
+        self.assertTrue(0 < (yield redis.ttl(key)) <= 10)
+
+        yield notify_event(redis, 'channel-id', 'msg-1')
+        self.assertTrue((yield d))
+        self.assertEqual((yield redis.get(key)), None)
+
+    @inlineCallbacks
+    def test_notify_event_published_if_waiting(self):
+        '''Events should only be published to the other processes for
+        messages that have waiters'''
+        redis, published = yield self.get_publishing_redis()
+        yield notify_event(redis, 'channel-id', 'msg-1')
+        self.assertEqual(published, [])
+
+        yield redis.incr('channel-id:message_status_waiters:msg-1', 1)
+        yield notify_event(redis, 'channel-id', 'msg-1')
+        self.assertEqual(published, [(
+            redis._key('config-cache-invalidations'),
+            json.dumps(['message-events', ['channel-id', 'msg-1']]))])
+
+
+class TestWaiterScriptParity(JunebugTestBase):
+    '''Runs the Lua source of each waiter script against a real redis, and
+    checks that its fallback does the same'''
+
+    @inlineCallbacks
+    def assert_parity(self, script, keys, args, setup=None):
+        lua_result, fallback_result = yield self.run_script_and_fallback(
+            script, keys, args, setup=setup)
+        self.assertEqual(lua_result, fallback_result)
+        returnValue(lua_result)
+
+    def set(self, key, value, ttl=None):
+        @inlineCallbacks
+        def setup(redis):
+            yield redis.set(key, value)
+            if ttl is not None:
+                yield redis.expire(key, ttl)
+        return setup
+
+    @inlineCallbacks
+    def test_add_waiter(self):
+        result = yield self.assert_parity(ADD_WAITER, ['waiters'], [10])
+        self.assertEqual(result, 1)
+        result = yield self.assert_parity(
+            ADD_WAITER, ['waiters'], [10], self.set('waiters', '1', 100))
+        self.assertEqual(result, 2)
+        yield self.assert_parity(
+            ADD_WAITER, ['waiters'], [10], self.set('waiters', '1', 5))
+
+    @inlineCallbacks
+    def test_remove_waiter(self):
+        yield self.assert_parity(
+            REMOVE_WAITER, ['waiters'], [], self.set('waiters', '2', 10))
+        yield self.assert_parity(
+            REMOVE_WAITER, ['waiters'], [], self.set('waiters', '1', 10))
+
+    @inlineCallbacks
+    def test_publish_if_waiting(self):
+        yield self.assert_parity(
+            PUBLISH_IF_WAITING, ['waiters', 'channel'], ['data'],
+            self.set('waiters', '1', 10))
+        yield self.assert_parity(
+            PUBLISH_IF_WAITING, ['waiters', 'channel'], ['data'])
@@ -1,23 +1,35 @@
 import collections
-import json
 
 from twisted.web import http
 from functools import wraps
-from vumi.message import JSONMessageEncoder
 
+from junebug import json_codec
 from junebug.error import JunebugError
 
 
-def response(req, description, data, code=http.OK):
+TOO_MANY_REQUESTS = 429
+
+# Twisted does not have the messages of some of the status codes we use
+RESPONSES = dict(http.RESPONSES)
+RESPONSES[TOO_MANY_REQUESTS] = 'Too Many Requests'
+
+
+def response(req, description, data, code=http.OK, extra=None):
+    '''Responds with ``data`` as the result. ``extra`` are additional
+    top-level fields of the response, for responses whose result cannot be
+    extended without changing its type.'''
     req.setHeader('Content-Type', 'application/json')
-    req.setResponseCode(code)
+    req.setResponseCode(code, RESPONSES.get(code))
 
-    return json.dumps({
+    body = {
         'status': code,
-        'code': http.RESPONSES.get(code, code),
+        'code': RESPONSES.get(code, code),
         'description': description,
         'result': data,
-    }, cls=JSONMessageEncoder)
+    }
+    if extra is not None:
+        body.update(extra)
+    return json_codec.dumps(body)
 
 
 class JsonDecodeError(JunebugError):
@@ -33,7 +45,7 @@ def json_body(fn):
     @wraps(fn)
     def wrapper(api, req, *a, **kw):
         try:
-            body = json.loads(req.content.read())
+            body = json_codec.loads(req.content.read())
         except ValueError as e:
             raise JsonDecodeError(e.message)
         return fn(api, req, body, *a, **kw)
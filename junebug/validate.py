@@ -1,4 +1,5 @@
 from functools import wraps
+from numbers import Number
 
 from twisted.web import http
 
@@ -29,13 +30,310 @@ def validate(*validators):
 
 
 def body_schema(schema):
-    json_validator = Draft4Validator(schema)
+    json_validator = compile_schema(schema)
 
     def validator(req, body, *a, **kw):
         return [{
             'type': 'invalid_body',
-            'message': e.message,
-            'schema_path': list(e.schema_path),
-        } for e in json_validator.iter_errors(body)]
+            'message': message,
+            'schema_path': list(schema_path),
+        } for message, schema_path in json_validator(body)]
 
     return validator
+
+
+class UnsupportedSchema(Exception):
+    '''Raised when a schema uses a keyword that cannot be compiled'''
+
+
+def query_int(name, minimum=None, maximum=None):
+    '''Validates that the query parameter ``name``, if it is given, is an
+    integer between ``minimum`` and ``maximum``'''
+    def validator(req, *a, **kw):
+        values = req.args.get(name)
+        if not values:
+            return []
+        try:
+            value = int(values[0])
+        except ValueError:
+            message = '%r is not an integer' % (values[0],)
+        else:
+            if minimum is not None and value < minimum:
+                message = '%d is less than the minimum of %d' % (
+                    value, minimum)
+            elif maximum is not None and value > maximum:
+                message = '%d is greater than the maximum of %d' % (
+                    value, maximum)
+            else:
+                return []
+        return [{
+            'type': 'invalid_query',
+            'message': message,
+            'parameter': name,
+        }]
+
+    return validator
+
+
+# The values that boolean query parameters can have
+QUERY_BOOLEANS = {
+    'true': True,
+    '1': True,
+    'false': False,
+    '0': False,
+}
+
+
+def query_bool(name):
+    '''Validates that the query parameter ``name``, if it is given, is one
+    of ``true``, ``false``, ``1`` or ``0``'''
+    def validator(req, *a, **kw):
+        values = req.args.get(name)
+        if not values or values[0].lower() in QUERY_BOOLEANS:
+            return []
+        return [{
+            'type': 'invalid_query',
+            'message': '%r is not a boolean' % (values[0],),
+            'parameter': name,
+        }]
+
+    return validator
+
+
+def compile_schema(schema):
+    '''Returns a function that validates an instance against the draft 4
+    ``schema``, returning a list of ``(message, schema_path)`` for each error.
+
+    Schemas that only use the keywords that our API schemas need are compiled
+    into checks specialised for the schema, so that the schema does not need
+    to be interpreted for each instance. The messages and schema paths are
+    the same as those of the errors given by :class:`Draft4Validator`. Any
+    other schema is validated by :class:`Draft4Validator`.'''
+    try:
+        checks = _compile(schema, ())
+    except UnsupportedSchema:
+        return _uncompiled(schema)
+
+    def validator(instance):
+        errors = []
+        for check in checks:
+            check(instance, errors)
+        return errors
+
+    return validator
+
+
+def _uncompiled(schema):
+    json_validator = Draft4Validator(schema)
+
+    def validator(instance):
+        return [
+            (e.message, list(e.schema_path))
+            for e in json_validator.iter_errors(instance)]
+
+    return validator
+
+
+def _is_integer(instance):
+    return (
+        isinstance(instance, (int, long)) and not isinstance(instance, bool))
+
+
+def _is_number(instance):
+    return isinstance(instance, Number) and not isinstance(instance, bool)
+
+
+_TYPE_CHECKS = {
+    'array': lambda instance: isinstance(instance, list),
+    'boolean': lambda instance: isinstance(instance, bool),
+    'integer': _is_integer,
+    'null': lambda instance: instance is None,
+    'number': _is_number,
+    'object': lambda instance: isinstance(instance, dict),
+    'string': lambda instance: isinstance(instance, basestring),
+}
+
+
+def _compile(schema, path):
+    if not isinstance(schema, dict):
+        raise UnsupportedSchema('Schema %r is not an object' % (schema,))
+
+    checks = []
+    for keyword, value in schema.iteritems():
+        if keyword not in Draft4Validator.VALIDATORS:
+            # Draft4Validator ignores keywords that it does not know
+            continue
+        compiler = _COMPILERS.get(keyword)
+        if compiler is None:
+            raise UnsupportedSchema(
+                'Keyword %r cannot be compiled' % (keyword,))
+        check = compiler(value, schema, path + (keyword,))
+        if check is not None:
+            checks.append(check)
+    return checks
+
+
+def _run(checks, instance, errors):
+    for check in checks:
+        check(instance, errors)
+
+
+def _compile_type(types, schema, path):
+    if not isinstance(types, list):
+        types = [types]
+    if not all(t in _TYPE_CHECKS for t in types):
+        raise UnsupportedSchema('Type %r cannot be compiled' % (types,))
+
+    type_checks = [_TYPE_CHECKS[t] for t in types]
+    reprs = ', '.join(repr(t) for t in types)
+    schema_path = list(path)
+
+    def check(instance, errors):
+        for type_check in type_checks:
+            if type_check(instance):
+                return
+        errors.append((
+            '%r is not of type %s' % (instance, reprs), schema_path))
+
+    return check
+
+
+def _compile_properties(properties, schema, path):
+    properties = [
+        (name, _compile(subschema, path + (name,)))
+        for name, subschema in properties.iteritems()]
+
+    def check(instance, errors):
+        if not isinstance(instance, dict):
+            return
+        for name, checks in properties:
+            if name in instance:
+                _run(checks, instance[name], errors)
+
+    return check
+
+
+def _compile_required(required, schema, path):
+    schema_path = list(path)
+
+    def check(instance, errors):
+        if not isinstance(instance, dict):
+            return
+        for name in required:
+            if name not in instance:
+                errors.append(
+                    ('%r is a required property' % name, schema_path))
+
+    return check
+
+
+def _compile_additional_properties(additional, schema, path):
+    properties = schema.get('properties', {})
+
+    if isinstance(additional, dict):
+        checks = _compile(additional, path)
+
+        def check(instance, errors):
+            if not isinstance(instance, dict):
+                return
+            for name in set(p for p in instance if p not in properties):
+                _run(checks, instance[name], errors)
+
+        return check
+
+    if additional:
+        return None
+
+    schema_path = list(path)
+
+    def check(instance, errors):
+        if not isinstance(instance, dict):
+            return
+        extras = set(p for p in instance if p not in properties)
+        if extras:
+            errors.append((
+                'Additional properties are not allowed (%s %s unexpected)' % (
+                    ', '.join(repr(extra) for extra in extras),
+                    'was' if len(extras) == 1 else 'were'),
+                schema_path))
+
+    return check
+
+
+def _compile_items(items, schema, path):
+    if not isinstance(items, dict):
+        raise UnsupportedSchema('Only a single items schema can be compiled')
+
+    checks = _compile(items, path)
+
+    def check(instance, errors):
+        if not isinstance(instance, list):
+            return
+        for item in instance:
+            _run(checks, item, errors)
+
+    return check
+
+
+def _compile_length(is_type, too_short):
+    def compiler(limit, schema, path):
+        schema_path = list(path)
+
+        def check(instance, errors):
+            if not is_type(instance):
+                return
+            if too_short and len(instance) < limit:
+                errors.append(('%r is too short' % (instance,), schema_path))
+            elif not too_short and len(instance) > limit:
+                errors.append(('%r is too long' % (instance,), schema_path))
+
+        return check
+
+    return compiler
+
+
+def _compile_minimum(minimum, schema, path):
+    exclusive = schema.get('exclusiveMinimum', False)
+    cmp = 'less than or equal to' if exclusive else 'less than'
+    schema_path = list(path)
+
+    def check(instance, errors):
+        if not _is_number(instance):
+            return
+        if instance < minimum or (exclusive and instance == minimum):
+            errors.append((
+                '%r is %s the minimum of %r' % (instance, cmp, minimum),
+                schema_path))
+
+    return check
+
+
+def _compile_maximum(maximum, schema, path):
+    exclusive = schema.get('exclusiveMaximum', False)
+    cmp = 'greater than or equal to' if exclusive else 'greater than'
+    schema_path = list(path)
+
+    def check(instance, errors):
+        if not _is_number(instance):
+            return
+        if instance > maximum or (exclusive and instance == maximum):
+            errors.append((
+                '%r is %s the maximum of %r' % (instance, cmp, maximum),
+                schema_path))
+
+    return check
+
+
+_COMPILERS = {
+    'type': _compile_type,
+    'properties': _compile_properties,
+    'required': _compile_required,
+    'additionalProperties': _compile_additional_properties,
+    'items': _compile_items,
+    'minItems': _compile_length(_TYPE_CHECKS['array'], too_short=True),
+    'maxItems': _compile_length(_TYPE_CHECKS['array'], too_short=False),
+    'minLength': _compile_length(_TYPE_CHECKS['string'], too_short=True),
+    'maxLength': _compile_length(_TYPE_CHECKS['string'], too_short=False),
+    'minimum': _compile_minimum,
+    'maximum': _compile_maximum,
+}
@@ -0,0 +1,197 @@
+'''Waking up requests that are waiting for the next event of a message, so
+that clients can long poll for the status of a message instead of polling it
+repeatedly.
+
+The message forwarding worker that stores an event notifies the waiters in
+its own process directly, and publishes the notification to other processes
+on the same redis pub/sub channel that config cache invalidations are
+published on, where it is passed on to their waiters by a
+:class:`junebug.cache.CacheInvalidationListener`.
+
+Waiters are counted in redis for each message while they wait, so that the
+notification is only published for messages that some process is waiting
+for, rather than for every event.'''
+import json
+import weakref
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred, inlineCallbacks, returnValue, succeed)
+
+from junebug.cache import INVALIDATION_CHANNEL, supports_pubsub
+from junebug.stores import RedisScript
+
+
+# The name that event notifications are published under
+MESSAGE_EVENTS = 'message-events'
+
+
+class EventWaiters(object):
+    '''Requests waiting for the next event of messages, keyed by the channel
+    or destination id and the message id. It is added to the
+    :class:`junebug.cache.CacheInvalidationListener` of a process like a
+    :class:`junebug.cache.ConfigCache`, to be notified of events stored in
+    other processes.'''
+    name = MESSAGE_EVENTS
+
+    def __init__(self, clock=reactor):
+        self.clock = clock
+        self._waiters = {}
+
+    def __len__(self):
+        return sum(len(waiters) for waiters in self._waiters.itervalues())
+
+    def wait(self, location_id, message_id, timeout):
+        '''Returns a deferred that fires with ``True`` once an event is
+        stored for the message, or with ``False`` after ``timeout``
+        seconds.'''
+        key = (location_id, message_id)
+
+        def remove(d):
+            waiters = self._waiters.get(key)
+            if waiters is None:
+                return
+            waiters.discard(d)
+            if not waiters:
+                del self._waiters[key]
+
+        def cancel(d):
+            remove(d)
+            if delayed.active():
+                delayed.cancel()
+
+        def timed_out():
+            remove(d)
+            d.callback(False)
+
+        d = Deferred(cancel)
+        self._waiters.setdefault(key, set()).add(d)
+        delayed = self.clock.callLater(timeout, timed_out)
+        d.addBoth(self._cancel_timeout, delayed)
+        return d
+
+    def _cancel_timeout(self, result, delayed):
+        if delayed.active():
+            delayed.cancel()
+        return result
+
+    def notify(self, location_id, message_id):
+        '''Wakes the requests waiting for the next event of the message in
+        this process only.'''
+        for d in self._waiters.pop((location_id, message_id), ()):
+            d.callback(True)
+
+    def discard(self, id):
+        location_id, message_id = id
+        self.notify(location_id, message_id)
+
+    def clear(self):
+        '''Wakes all of the waiting requests, since notifications could have
+        been missed while the listener was disconnected.'''
+        for location_id, message_id in list(self._waiters):
+            self.notify(location_id, message_id)
+
+
+@inlineCallbacks
+def _add_waiter(redis, keys, args):
+    [key] = keys
+    [ttl] = args
+    count = yield redis.incr(key, 1)
+    if (yield redis.ttl(key)) < int(ttl):
+        yield redis.expire(key, ttl)
+    returnValue(count)
+
+
+# Counts a waiter for a message, keeping the count for at least as long as
+# the waiter waits
+ADD_WAITER = RedisScript('''
+local count = redis.call('INCR', KEYS[1])
+if redis.call('TTL', KEYS[1]) < tonumber(ARGV[1]) then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return count
+''', _add_waiter)
+
+
+@inlineCallbacks
+def _remove_waiter(redis, keys, args):
+    [key] = keys
+    count = yield redis.incr(key, -1)
+    if count <= 0:
+        yield redis.delete(key)
+
+
+REMOVE_WAITER = RedisScript('''
+if redis.call('DECR', KEYS[1]) <= 0 then
+    redis.call('DEL', KEYS[1])
+end
+''', _remove_waiter)
+
+
+@inlineCallbacks
+def _publish_if_waiting(redis, keys, args):
+    [key, channel] = keys
+    [data] = args
+    count = yield redis.get(key)
+    if count is not None and int(count) > 0:
+        yield redis._client.publish(redis._key(channel), data)
+
+
+# Publishes the notification of an event if there are waiters for the
+# message in any process
+PUBLISH_IF_WAITING = RedisScript('''
+local count = tonumber(redis.call('GET', KEYS[1]) or '0')
+if count > 0 then
+    redis.call('PUBLISH', KEYS[2], ARGV[1])
+end
+''', _publish_if_waiting)
+
+
+def get_waiters_key(location_id, message_id):
+    '''Returns the key of the count of waiters for the message'''
+    return '%s:message_status_waiters:%s' % (location_id, message_id)
+
+
+_shared_waiters = weakref.WeakValueDictionary()
+
+
+def get_event_waiters(redis):
+    '''Returns the :class:`EventWaiters` that is shared by everything in this
+    process that uses the same redis config as the redis manager ``redis``,
+    so that workers can wake the requests of the API that runs them.'''
+    key = repr(sorted(redis._config.items()))
+    waiters = _shared_waiters.get(key)
+    if waiters is None:
+        waiters = EventWaiters()
+        _shared_waiters[key] = waiters
+    return waiters
+
+
+@inlineCallbacks
+def wait_for_event(redis, location_id, message_id, timeout):
+    '''Waits for the next event of the message using the :class:`EventWaiters`
+    of this process, counting the waiter in redis while it waits, so that
+    events of the message are published to this process. Returns a deferred
+    that fires with ``True`` once an event is stored, or with ``False``
+    after ``timeout`` seconds.'''
+    key = get_waiters_key(location_id, message_id)
+    yield ADD_WAITER(redis, [key], [timeout])
+    try:
+        woken = yield get_event_waiters(redis).wait(
+            location_id, message_id, timeout)
+    finally:
+        yield REMOVE_WAITER(redis, [key])
+    returnValue(woken)
+
+
+def notify_event(redis, location_id, message_id):
+    '''Wakes the requests waiting for the next event of the message in this
+    process, and publishes the event to the other processes if any of them
+    have requests waiting for it.'''
+    get_event_waiters(redis).notify(location_id, message_id)
+    if not supports_pubsub(redis):
+        return succeed(None)
+    return PUBLISH_IF_WAITING(
+        redis,
+        [get_waiters_key(location_id, message_id), INVALIDATION_CHANNEL],
+        [json.dumps([MESSAGE_EVENTS, [location_id, message_id]])])
@@ -0,0 +1,576 @@
+'''The HTTP client that mobile originated messages, events and statuses are
+posted to their webhooks with. Each process has a client for each set of
+connection settings, which is shared by all of the workers in the process
+that use those settings, so that connections to the same webhook host are
+kept open and reused by all of them.
+
+Each client keeps a circuit breaker for each webhook host. Once too many of
+the recent posts to a host fail or are slow, the breaker opens, and posts to
+the host fail immediately instead of waiting for their timeout, until a trial
+post after ``reset_timeout`` seconds succeeds.'''
+import logging
+from collections import deque
+from urlparse import urlparse
+
+from OpenSSL.SSL import SSL_CB_HANDSHAKE_DONE
+from treq.client import HTTPClient
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    CancelledError, Deferred, gatherResults, maybeDeferred, succeed)
+from twisted.internet.error import (
+    ConnectingCancelledError, ConnectionDone, ConnectionRefusedError)
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+from twisted.internet.task import TaskStopped
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.web._newclient import RequestTransmissionFailed, ResponseFailed
+from twisted.web.client import (
+    Agent, BrowserLikePolicyForHTTPS, HTTPConnectionPool)
+from vumi.message import TransportStatus
+from zope.interface import implementer
+
+from junebug import json_codec
+
+
+DEFAULT_MAX_PERSISTENT_PER_HOST = 10
+DEFAULT_IDLE_TIMEOUT = 240
+DEFAULT_BATCH_MAX_DELAY_MS = 100
+
+DEFAULT_BREAKER_ERROR_RATE = 0.5
+DEFAULT_BREAKER_SLOW_THRESHOLD = 5.0
+DEFAULT_BREAKER_RESET_TIMEOUT = 30.0
+
+# The amount of seconds over which the connection rate is measured
+CONNECT_RATE_WINDOW = 60
+
+# The amount of seconds over which the error rate of a host is measured, and
+# the amount of posts in that time needed before its breaker can open
+BREAKER_WINDOW = 60
+BREAKER_MIN_REQUESTS = 10
+
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half_open'
+
+# The channel status level for each breaker state
+BREAKER_STATUSES = {
+    BREAKER_CLOSED: 'ok',
+    BREAKER_HALF_OPEN: 'degraded',
+    BREAKER_OPEN: 'down',
+}
+
+# The errors that are logged, rather than raised, when a post fails
+POST_ERRORS = (
+    ResponseFailed,
+    ConnectingCancelledError,
+    ConnectionDone,
+    ConnectionRefusedError,
+    TaskStopped,
+    # Raised when Deferred is cancelled because of timeouts
+    CancelledError,
+    RequestTransmissionFailed,
+)
+
+
+def request_failed(resp):
+    return resp.code < 200 or resp.code >= 300
+
+
+def token_auth_headers(auth_token):
+    '''Returns the headers for token authentication with ``auth_token``,
+    or no headers if there is no token'''
+    if auth_token:
+        return {'Authorization': ['Token %s' % (auth_token,)]}
+    return {}
+
+
+def url_host(url):
+    '''Returns the host and port of ``url``, without any credentials'''
+    return urlparse(url).netloc.rpartition('@')[2]
+
+
+def post_eb(reason, url):
+    err_class = reason.trap(*POST_ERRORS)
+    logging.exception('Post to %s failed because of %s: %s' % (
+        url, err_class, reason.getErrorMessage()))
+
+
+def _tolerate_errors(wrapped):
+    '''Wraps an info callback like Twisted wraps the info callbacks that it
+    sets, so that errors in it are logged and drop the connection, instead
+    of being ignored by pyOpenSSL'''
+    def info_callback(connection, where, ret):
+        try:
+            return wrapped(connection, where, ret)
+        except Exception:
+            f = Failure()
+            log.err(f, 'Error during info_callback')
+            connection.get_app_data().failVerification(f)
+    return info_callback
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class SessionReusingCreator(object):
+    '''Creates the TLS connections to a single host, resuming the TLS session
+    of the last connection to the host that completed a handshake, so that
+    new connections skip the full handshake.
+
+    Sessions are captured by replacing the info callback of the context of
+    ``creator``, which relies on Twisted's implementation of the creator.
+    If the creator does not have the context and the host verifying info
+    callback that are expected, sessions are not resumed, and connections
+    are created by ``creator`` unchanged.
+
+    :param creator: The connection creator to wrap, as returned by
+        :func:`twisted.internet.ssl.optionsForClientTLS`
+    '''
+
+    def __init__(self, creator):
+        self.creator = creator
+        self.session = None
+        # The context is shared by all of the connections that the creator
+        # makes, and already has an info callback that verifies the host
+        verify = getattr(creator, '_identityVerifyingInfoCallback', None)
+        ctx = getattr(creator, '_ctx', None)
+        self.reusing = verify is not None and ctx is not None
+        if self.reusing:
+            ctx.set_info_callback(_tolerate_errors(
+                lambda connection, where, ret: self._info_callback(
+                    verify, connection, where, ret)))
+
+    def _info_callback(self, verify, connection, where, ret):
+        verify(connection, where, ret)
+        if where & SSL_CB_HANDSHAKE_DONE:
+            self.session = connection.get_session()
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        connection = self.creator.clientConnectionForTLS(tlsProtocol)
+        if self.session is not None:
+            connection.set_session(self.session)
+        return connection
+
+
+class SessionReusingPolicy(BrowserLikePolicyForHTTPS):
+    '''Verifies HTTPS connections like a browser, and resumes the TLS
+    sessions of earlier connections to the same host.'''
+
+    def __init__(self, *args, **kwargs):
+        BrowserLikePolicyForHTTPS.__init__(self, *args, **kwargs)
+        self._creators = {}
+
+    def creatorForNetloc(self, hostname, port):
+        creator = self._creators.get((hostname, port))
+        if creator is None:
+            creator = SessionReusingCreator(
+                BrowserLikePolicyForHTTPS.creatorForNetloc(
+                    self, hostname, port))
+            self._creators[(hostname, port)] = creator
+        return creator
+
+
+class WebhookConnectionPool(HTTPConnectionPool):
+    '''A persistent connection pool that records when new connections are
+    made, for the stats of its client.'''
+
+    def __init__(self, client, reactor):
+        HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        self.client = client
+
+    def _newConnection(self, key, endpoint):
+        self.client.connection_made()
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+    def idle_connections(self):
+        return sum(len(c) for c in self._connections.itervalues())
+
+
+class CircuitBreaker(object):
+    '''Tracks the posts to a webhook host, and stops posts to the host once
+    it is failing.
+
+    The breaker starts closed. It opens once at least ``error_rate`` of the
+    posts over the last ``BREAKER_WINDOW`` seconds failed, or took longer
+    than ``slow_threshold`` seconds. ``reset_timeout`` seconds after it
+    opened, it is half open, and lets a single trial post through. The
+    breaker closes if the trial succeeds, and opens again if it fails.
+
+    :param host: The host and port of the webhooks
+    :type host: str
+    :param error_rate: The fraction of failed or slow posts that opens the
+        breaker
+    :type error_rate: float
+    :param slow_threshold: The amount of seconds after which a post counts
+        as failed
+    :type slow_threshold: float
+    :param reset_timeout: The amount of seconds the breaker stays open for
+    :type reset_timeout: float
+    '''
+
+    def __init__(self, host, error_rate=DEFAULT_BREAKER_ERROR_RATE,
+                 slow_threshold=DEFAULT_BREAKER_SLOW_THRESHOLD,
+                 reset_timeout=DEFAULT_BREAKER_RESET_TIMEOUT, clock=reactor):
+        self.host = host
+        self.error_rate = error_rate
+        self.slow_threshold = slow_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.opened_at = None
+        self.short_circuited = 0
+        self._state = BREAKER_CLOSED
+        self._trial = False
+        self._results = deque()
+        self._failures = 0
+
+    @property
+    def state(self):
+        if (self._state == BREAKER_OPEN and
+                self.clock.seconds() >= self.opened_at + self.reset_timeout):
+            self._state = BREAKER_HALF_OPEN
+        return self._state
+
+    def allow(self):
+        '''Returns whether a post to the host may be made. While the breaker
+        is half open, only the first post is allowed, as a trial, until its
+        outcome is recorded.'''
+        state = self.state
+        if state == BREAKER_CLOSED:
+            return True
+        if state == BREAKER_HALF_OPEN and not self._trial:
+            self._trial = True
+            return True
+        self.short_circuited += 1
+        return False
+
+    def record(self, failed, latency, trial=False):
+        '''Records the outcome of a post that was allowed. ``trial`` is
+        whether it was allowed as the trial post of the half open breaker.'''
+        failed = failed or latency > self.slow_threshold
+        if trial:
+            self._trial = False
+            if failed:
+                self._open()
+            else:
+                self._close()
+            return
+        if self._state != BREAKER_CLOSED:
+            return
+        self._results.append((self.clock.seconds(), failed))
+        self._failures += failed
+        self._prune()
+        if (len(self._results) >= BREAKER_MIN_REQUESTS and
+                self.current_error_rate() >= self.error_rate):
+            self._open()
+
+    def _prune(self):
+        start = self.clock.seconds() - BREAKER_WINDOW
+        while self._results and self._results[0][0] <= start:
+            _, failed = self._results.popleft()
+            self._failures -= failed
+
+    def current_error_rate(self):
+        '''Returns the fraction of the posts over the last
+        ``BREAKER_WINDOW`` seconds that failed or were slow'''
+        self._prune()
+        if not self._results:
+            return 0.0
+        return self._failures / float(len(self._results))
+
+    def _open(self):
+        if self._state == BREAKER_CLOSED:
+            logging.warning(
+                'Opened the circuit breaker for webhook host %s, %d of the '
+                'last %d posts failed or were slow' % (
+                    self.host, self._failures, len(self._results)))
+        self._state = BREAKER_OPEN
+        self.opened_at = self.clock.seconds()
+
+    def _close(self):
+        logging.info('Closed the circuit breaker for webhook host %s' % (
+            self.host,))
+        self._state = BREAKER_CLOSED
+        self.opened_at = None
+        self._results.clear()
+        self._failures = 0
+
+    def status(self):
+        '''Returns the state of the breaker as a status of the channels
+        that post to the host'''
+        state = self.state
+        if state == BREAKER_CLOSED:
+            message = 'Posting to webhook host %s' % (self.host,)
+        elif state == BREAKER_OPEN:
+            message = (
+                'Webhook host %s is failing, its posts are sent to the retry '
+                'queue' % (self.host,))
+        else:
+            message = 'Trying webhook host %s again' % (self.host,)
+        return TransportStatus(
+            component='webhook:%s' % (self.host,),
+            status=BREAKER_STATUSES[state],
+            type='webhook_breaker_%s' % (state,),
+            message=message,
+            details={'host': self.host, 'state': state})
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'error_rate': self.current_error_rate(),
+            'short_circuited': self.short_circuited,
+        }
+
+
+class WebhookClient(object):
+    '''Posts JSON to webhooks over a pool of persistent connections.
+
+    :param max_persistent_per_host: The maximum amount of idle connections
+        kept open to each host
+    :type max_persistent_per_host: int
+    :param idle_timeout: The amount of seconds an idle connection is kept
+        open for
+    :type idle_timeout: int
+    :param tls_session_reuse: Whether new TLS connections resume the session
+        of an earlier connection to the same host
+    :type tls_session_reuse: bool
+    :param breaker_error_rate: The fraction of failed or slow posts to a
+        host that opens its :class:`CircuitBreaker`. If 0, posts are never
+        stopped.
+    :type breaker_error_rate: float
+    :param breaker_slow_threshold: The amount of seconds after which a post
+        counts as failed for its breaker
+    :type breaker_slow_threshold: float
+    :param breaker_reset_timeout: The amount of seconds a breaker stays open
+        for
+    :type breaker_reset_timeout: float
+    '''
+
+    def __init__(self, max_persistent_per_host=DEFAULT_MAX_PERSISTENT_PER_HOST,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, tls_session_reuse=True,
+                 breaker_error_rate=DEFAULT_BREAKER_ERROR_RATE,
+                 breaker_slow_threshold=DEFAULT_BREAKER_SLOW_THRESHOLD,
+                 breaker_reset_timeout=DEFAULT_BREAKER_RESET_TIMEOUT,
+                 reactor=reactor):
+        self.max_persistent_per_host = max_persistent_per_host
+        self.idle_timeout = idle_timeout
+        self.tls_session_reuse = tls_session_reuse
+        self.breaker_error_rate = breaker_error_rate
+        self.breaker_slow_threshold = breaker_slow_threshold
+        self.breaker_reset_timeout = breaker_reset_timeout
+        self.breakers = {}
+        self.reactor = reactor
+        self.leases = 0
+        self.in_use = 0
+        self.requests = 0
+        self.connects = 0
+        self._connect_times = deque()
+
+        self.pool = WebhookConnectionPool(self, reactor)
+        self.pool.maxPersistentPerHost = max_persistent_per_host
+        self.pool.cachedConnectionTimeout = idle_timeout
+        if tls_session_reuse:
+            policy = SessionReusingPolicy()
+        else:
+            policy = BrowserLikePolicyForHTTPS()
+        self.http = HTTPClient(
+            Agent(reactor, contextFactory=policy, pool=self.pool))
+
+    @property
+    def settings(self):
+        return (
+            self.max_persistent_per_host, self.idle_timeout,
+            self.tls_session_reuse, self.breaker_error_rate,
+            self.breaker_slow_threshold, self.breaker_reset_timeout)
+
+    def get_breaker(self, url):
+        '''Returns the circuit breaker for the host of ``url``, or ``None``
+        if circuit breaking is disabled'''
+        if not self.breaker_error_rate:
+            return None
+        host = url_host(url)
+        breaker = self.breakers.get(host)
+        if breaker is None:
+            breaker = self.breakers[host] = CircuitBreaker(
+                host, self.breaker_error_rate, self.breaker_slow_threshold,
+                self.breaker_reset_timeout, self.reactor)
+        return breaker
+
+    def post(self, url, data, timeout, auth=None, headers={}):
+        '''Posts ``data`` as JSON to ``url``. Returns a deferred response,
+        or ``None`` if the post failed because of a connection error or
+        timeout, which is logged, or if the circuit breaker for the host is
+        open.'''
+        breaker = self.get_breaker(url)
+        if breaker is not None and not breaker.allow():
+            return succeed(None)
+        trial = breaker is not None and breaker.state == BREAKER_HALF_OPEN
+        request_headers = {'Content-Type': ['application/json']}
+        request_headers.update(headers)
+        self.requests += 1
+        self.in_use += 1
+        started = self.reactor.seconds()
+        d = self.http.post(
+            url.encode('utf-8'),
+            data=json_codec.dumps(data),
+            headers=request_headers,
+            timeout=timeout, auth=auth)
+        d.addBoth(self._request_finished, breaker, started, trial)
+        d.addErrback(post_eb, url)
+        return d
+
+    def _request_finished(self, result, breaker, started, trial):
+        self.in_use -= 1
+        if breaker is not None:
+            failed = isinstance(result, Failure) or result.code >= 500
+            breaker.record(failed, self.reactor.seconds() - started, trial)
+        return result
+
+    def connection_made(self):
+        self.connects += 1
+        self._connect_times.append(self.reactor.seconds())
+
+    def connect_rate(self):
+        '''Returns the amount of new connections per second, over the last
+        ``CONNECT_RATE_WINDOW`` seconds'''
+        start = self.reactor.seconds() - CONNECT_RATE_WINDOW
+        while self._connect_times and self._connect_times[0] <= start:
+            self._connect_times.popleft()
+        return len(self._connect_times) / float(CONNECT_RATE_WINDOW)
+
+    def release(self):
+        '''Releases a lease on this client, closing its idle connections if
+        no workers are using it anymore'''
+        self.leases -= 1
+        if self.leases > 0:
+            return succeed(None)
+        return self.close()
+
+    def close(self):
+        _remove_client(self)
+        return self.pool.closeCachedConnections()
+
+    def stats(self):
+        '''Returns a dictionary of the utilisation of this client's
+        connections'''
+        return {
+            'max_persistent_per_host': self.max_persistent_per_host,
+            'idle_timeout': self.idle_timeout,
+            'tls_session_reuse': self.tls_session_reuse,
+            'workers': self.leases,
+            'in_use': self.in_use,
+            'idle': self.pool.idle_connections(),
+            'requests': self.requests,
+            'connects': self.connects,
+            'connects_per_second': self.connect_rate(),
+            'breakers': dict(
+                (host, breaker.stats())
+                for host, breaker in self.breakers.iteritems()),
+        }
+
+
+class WebhookBatcher(object):
+    '''Collects the items that are posted to the same webhook, so that they
+    can be posted together as a single JSON array.
+
+    A batch is sent once it has ``size`` items, or ``max_delay`` seconds
+    after its first item was added, whichever comes first.
+
+    :param send: Called with the key and the list of items of each batch
+        to send it. May return a deferred.
+    :type send: callable
+    :param size: The maximum amount of items in a batch
+    :type size: int
+    :param max_delay: The maximum amount of seconds an item waits for its
+        batch to be sent
+    :type max_delay: float
+    '''
+
+    def __init__(self, send, size, max_delay, clock=reactor):
+        self.send = send
+        self.size = size
+        self.max_delay = max_delay
+        self.clock = clock
+        self._batches = {}
+        self._sending = set()
+
+    def add(self, key, item):
+        '''Adds ``item`` to the batch for ``key``. Returns a deferred that
+        fires with the result of sending the batch once it has been
+        sent.'''
+        batch = self._batches.get(key)
+        if batch is None:
+            delayed = self.clock.callLater(self.max_delay, self.flush, key)
+            batch = self._batches[key] = ([], [], delayed)
+        items, waiting, _ = batch
+        items.append(item)
+        d = Deferred()
+        waiting.append(d)
+        if len(items) >= self.size:
+            self.flush(key)
+        return d
+
+    def flush(self, key):
+        '''Sends the batch for ``key`` now. Returns a deferred that fires
+        once the batch has been sent.'''
+        batch = self._batches.pop(key, None)
+        if batch is None:
+            return succeed(None)
+        items, waiting, delayed = batch
+        if delayed.active():
+            delayed.cancel()
+        d = maybeDeferred(self.send, key, items)
+        self._sending.add(d)
+        d.addBoth(self._sent, d, waiting)
+        return d
+
+    def _sent(self, result, d, waiting):
+        self._sending.discard(d)
+        for item_d in waiting:
+            item_d.callback(result)
+        if isinstance(result, Failure):
+            # The failure is passed on to each of the items instead
+            return None
+        return result
+
+    def pending(self):
+        '''Returns the amount of items waiting for their batch to be
+        sent'''
+        return sum(len(items) for items, _, _ in self._batches.itervalues())
+
+    def stop(self):
+        '''Sends all of the batches, and returns a deferred that fires once
+        all of the batches have been sent'''
+        for key in list(self._batches):
+            self.flush(key)
+        return gatherResults(list(self._sending))
+
+
+_clients = {}
+
+
+def _remove_client(client):
+    if _clients.get(client.settings) is client:
+        del _clients[client.settings]
+
+
+def acquire_webhook_client(
+        max_persistent_per_host=DEFAULT_MAX_PERSISTENT_PER_HOST,
+        idle_timeout=DEFAULT_IDLE_TIMEOUT, tls_session_reuse=True,
+        breaker_error_rate=DEFAULT_BREAKER_ERROR_RATE,
+        breaker_slow_threshold=DEFAULT_BREAKER_SLOW_THRESHOLD,
+        breaker_reset_timeout=DEFAULT_BREAKER_RESET_TIMEOUT):
+    '''Returns this process' :class:`WebhookClient` for the given settings,
+    creating it if it does not exist yet. The client should be released
+    once it is no longer needed.'''
+    settings = (
+        max_persistent_per_host, idle_timeout, tls_session_reuse,
+        breaker_error_rate, breaker_slow_threshold, breaker_reset_timeout)
+    client = _clients.get(settings)
+    if client is None:
+        client = _clients[settings] = WebhookClient(*settings)
+    client.leases += 1
+    return client
+
+
+def get_webhook_clients():
+    '''Returns the webhook clients that are currently open in this
+    process'''
+    return list(_clients.values())
@@ -1,25 +1,57 @@
-import json
 import logging
+from functools import partial
 from urlparse import urlunparse, urlparse
 
-import treq
-
-from twisted.internet.defer import inlineCallbacks, CancelledError
-from twisted.web.client import ResponseFailed, RequestTransmissionFailed
-from twisted.internet.error import (
-    ConnectingCancelledError, ConnectionDone, ConnectionRefusedError)
-from twisted.internet.task import TaskStopped
+from twisted.internet.defer import (
+    inlineCallbacks, gatherResults, maybeDeferred, returnValue, succeed)
 
 from vumi.application.base import ApplicationConfig, ApplicationWorker
 from vumi.config import (
-    ConfigDict, ConfigInt, ConfigText, ConfigFloat, ConfigUrl)
-from vumi.message import JSONMessageEncoder
-from vumi.persist.txredis_manager import TxRedisManager
+    ConfigBool, ConfigDict, ConfigInt, ConfigText, ConfigFloat, ConfigUrl)
+from vumi.message import TransportUserMessage
 from vumi.worker import BaseConfig, BaseWorker
 
+from junebug.amqp import KeyedSequencer, concurrent_consumer_class
+from junebug.cache import get_shared_cache
+from junebug.priority import (
+    PRIORITY_LEVELS, PriorityScheduler, lane_routing_key)
+from junebug.redis_pool import DEFAULT_POOL_SIZE, acquire_redis_manager
+from junebug.retries import (
+    DEFAULT_RETRY_BASE_DELAY, DEFAULT_RETRY_MAX_ATTEMPTS,
+    DEFAULT_RETRY_MAX_DELAY, DEFAULT_RETRY_RATE, acquire_retry_scheduler)
 from junebug.utils import api_from_message, api_from_event, api_from_status
 from junebug.stores import (
-    InboundMessageStore, OutboundMessageStore, StatusStore, MessageRateStore)
+    InboundMessageStore, OutboundMessageStore, StatusStore, MessageRateStore,
+    EventLogStore, get_codec)
+from junebug.waiters import notify_event
+from junebug.webhooks import (
+    DEFAULT_BATCH_MAX_DELAY_MS, DEFAULT_BREAKER_ERROR_RATE,
+    DEFAULT_BREAKER_RESET_TIMEOUT, DEFAULT_BREAKER_SLOW_THRESHOLD,
+    DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_PERSISTENT_PER_HOST, WebhookBatcher,
+    acquire_webhook_client, request_failed, token_auth_headers)
+
+
+class WebhookBreakerStatuses(object):
+    '''Keeps the state of the circuit breakers of the webhook hosts that a
+    channel posts to as components of the channel's status, storing the
+    state of a breaker whenever it changes.'''
+
+    def __init__(self, store, channel_id):
+        self.store = store
+        self.channel_id = channel_id
+        self.states = {}
+
+    def update(self, webhooks, url):
+        '''Stores the state of the breaker of the host of ``url``, if it
+        has changed since it was last stored'''
+        breaker = webhooks.get_breaker(url)
+        if breaker is None:
+            return succeed(None)
+        state = breaker.state
+        if self.states.get(breaker.host) == state:
+            return succeed(None)
+        self.states[breaker.host] = state
+        return self.store.store_status(self.channel_id, breaker.status())
 
 
 class MessageForwardingConfig(ApplicationConfig):
@@ -63,6 +95,144 @@ class MessageForwardingConfig(ApplicationConfig):
         "Size of the buckets to use (in seconds) for metrics",
         required=True, static=True)
 
+    metric_flush_interval = ConfigFloat(
+        "If set, the interval (in seconds) at which aggregated metrics are "
+        "written to redis",
+        default=None, static=True)
+
+    event_route_cache_size = ConfigInt(
+        "The maximum amount of messages to cache the event url and auth "
+        "token of",
+        default=10000, static=True)
+
+    message_codec = ConfigText(
+        "The codec that messages and events are stored with",
+        default='json', static=True)
+
+    project_stored_messages = ConfigBool(
+        "Whether to only store the fields of messages and events that are "
+        "needed",
+        default=False, static=True)
+
+    redis_pool_size = ConfigInt(
+        "The maximum amount of connections in the shared redis pool",
+        default=DEFAULT_POOL_SIZE, static=True)
+
+    webhook_max_persistent_per_host = ConfigInt(
+        "The maximum amount of idle connections kept open to each webhook "
+        "host by the shared webhook client",
+        default=DEFAULT_MAX_PERSISTENT_PER_HOST, static=True)
+
+    webhook_idle_timeout = ConfigInt(
+        "The amount of seconds an idle connection to a webhook host is kept "
+        "open for",
+        default=DEFAULT_IDLE_TIMEOUT, static=True)
+
+    webhook_tls_session_reuse = ConfigBool(
+        "Whether new TLS connections to a webhook host resume the session of "
+        "an earlier connection to the host",
+        default=True, static=True)
+
+    webhook_breaker_error_rate = ConfigFloat(
+        "The fraction of failed or slow posts to a webhook host that opens "
+        "the circuit breaker of the host, failing its posts immediately. If "
+        "0, posts are never failed early.",
+        default=DEFAULT_BREAKER_ERROR_RATE, static=True)
+
+    webhook_breaker_slow_threshold = ConfigFloat(
+        "The amount of seconds after which a post to a webhook host counts "
+        "as failed for its circuit breaker",
+        default=DEFAULT_BREAKER_SLOW_THRESHOLD, static=True)
+
+    webhook_breaker_reset_timeout = ConfigFloat(
+        "The amount of seconds the circuit breaker of a webhook host stays "
+        "open for, before a trial post is made to the host",
+        default=DEFAULT_BREAKER_RESET_TIMEOUT, static=True)
+
+    priority_window = ConfigInt(
+        "If set, outbound messages are consumed from the priority lanes of "
+        "the channel, and sent to the transport with at most this many "
+        "messages waiting to be acked or nacked by the transport",
+        default=0, static=True)
+
+    event_log_size = ConfigInt(
+        "If set, events are appended to the event log of the channel, which "
+        "keeps this many of the most recent events for streaming to clients",
+        default=0, static=True)
+
+    mo_batch_size = ConfigInt(
+        "If set, inbound messages and events are posted to their URLs in "
+        "JSON arrays of at most this many messages or events. Messages are "
+        "only acked once the array they are in has been posted.",
+        default=0, static=True)
+
+    mo_batch_max_delay_ms = ConfigInt(
+        "The maximum amount of milliseconds a message or event waits for "
+        "the array it is in to be posted",
+        default=DEFAULT_BATCH_MAX_DELAY_MS, static=True)
+
+    max_in_flight = ConfigInt(
+        "If greater than 1, inbound messages and events are consumed "
+        "concurrently instead of one after another, with at most "
+        "`amqp_prefetch_count` of them in flight. The events of a message "
+        "are still forwarded in the order they were received.",
+        default=0, static=True)
+
+    webhook_retry_rate = ConfigInt(
+        "The maximum amount of failed webhook deliveries retried per second "
+        "by each process. If 0, failed deliveries are not retried.",
+        default=DEFAULT_RETRY_RATE, static=True)
+
+    webhook_retry_base_delay = ConfigFloat(
+        "The amount of seconds to wait before the first retry of a failed "
+        "webhook delivery. The delay doubles with each retry.",
+        default=DEFAULT_RETRY_BASE_DELAY, static=True)
+
+    webhook_retry_max_delay = ConfigFloat(
+        "The maximum amount of seconds to wait between retries of a failed "
+        "webhook delivery",
+        default=DEFAULT_RETRY_MAX_DELAY, static=True)
+
+    webhook_retry_max_attempts = ConfigInt(
+        "The amount of attempts after which a failed webhook delivery is "
+        "given up on, and kept with the dead letters of the channel",
+        default=DEFAULT_RETRY_MAX_ATTEMPTS, static=True)
+
+
+def forwarding_concurrency_config(batch_size, batch_max_delay_ms,
+                                  max_in_flight):
+    '''Returns the config of a :class:`MessageForwardingWorker` for posting
+    messages and events in batches of ``batch_size``, and for having
+    ``max_in_flight`` of them in flight, with the AMQP prefetch count that
+    they need'''
+    config = {}
+    prefetch_counts = []
+    if batch_size:
+        # Enough messages are fetched to fill the next batch while the
+        # last batch is being posted
+        config.update({
+            'mo_batch_size': batch_size,
+            'mo_batch_max_delay_ms': batch_max_delay_ms,
+        })
+        prefetch_counts.extend([
+            BaseConfig.amqp_prefetch_count.default, 2 * batch_size])
+    if max_in_flight > 1:
+        # The unacked messages of the worker are the messages it has in
+        # flight
+        config['max_in_flight'] = max_in_flight
+        prefetch_counts.append(max_in_flight)
+    if prefetch_counts:
+        config['amqp_prefetch_count'] = max(prefetch_counts)
+    return config
+
+
+def delivered(results):
+    '''Returns ``False`` if any of the deliveries that ``results`` are the
+    results of failed for good, so that vumi does not ack the message that
+    was delivered, otherwise ``None``'''
+    if any(result is False for result in results):
+        return False
+
 
 class MessageForwardingWorker(ApplicationWorker):
     '''This application worker consumes vumi messages placed on a configured
@@ -72,16 +242,57 @@ class MessageForwardingWorker(ApplicationWorker):
 
     @inlineCallbacks
     def setup_application(self):
-        self.redis = yield TxRedisManager.from_config(
-            self.config['redis_manager'])
+        config = self.get_static_config()
+        self.redis = yield acquire_redis_manager(
+            self.config['redis_manager'], config.redis_pool_size)
+        self.webhooks = acquire_webhook_client(
+            config.webhook_max_persistent_per_host,
+            config.webhook_idle_timeout, config.webhook_tls_session_reuse,
+            config.webhook_breaker_error_rate,
+            config.webhook_breaker_slow_threshold,
+            config.webhook_breaker_reset_timeout)
+
+        self.retries = None
+        if config.webhook_retry_rate:
+            self.retries = acquire_retry_scheduler(
+                self.channel_id, self.redis, self.webhooks,
+                self._delivery_credentials, config.webhook_retry_rate,
+                config.webhook_retry_base_delay,
+                config.webhook_retry_max_delay,
+                config.webhook_retry_max_attempts)
+
+        self.breaker_statuses = WebhookBreakerStatuses(
+            StatusStore(self.redis, ttl=None), self.channel_id)
+
+        codec = get_codec(
+            config.message_codec, config.project_stored_messages)
 
         self.inbounds = InboundMessageStore(
-            self.redis, self.config['inbound_ttl'])
+            self.redis, self.config['inbound_ttl'], codec=codec)
+
+        self.event_routes = get_shared_cache(
+            self.redis, 'event_routes', config.event_route_cache_size,
+            self.config['outbound_ttl'])
 
         self.outbounds = OutboundMessageStore(
-            self.redis, self.config['outbound_ttl'])
+            self.redis, self.config['outbound_ttl'],
+            event_routes=self.event_routes, codec=codec)
+
+        self.message_rate = MessageRateStore(
+            self.redis,
+            flush_interval=self.config.get('metric_flush_interval'))
+
+        self.batcher = None
+        if config.mo_batch_size:
+            self.batcher = WebhookBatcher(
+                self._post_batch, config.mo_batch_size,
+                config.mo_batch_max_delay_ms / 1000.0)
 
-        self.message_rate = MessageRateStore(self.redis)
+        self.event_sequencer = KeyedSequencer()
+
+        self.event_log = None
+        if config.event_log_size:
+            self.event_log = EventLogStore(self.redis, config.event_log_size)
 
         if self.config.get('message_queue') is not None:
             self.ro_connector = yield self.setup_ro_connector(
@@ -89,139 +300,322 @@ class MessageForwardingWorker(ApplicationWorker):
             self.ro_connector.set_outbound_handler(
                 self._publish_message)
 
+        self.priority_scheduler = None
+        if config.priority_window:
+            yield self.setup_priority_lanes(config.priority_window)
+
+    @inlineCallbacks
+    def setup_priority_lanes(self, window):
+        '''Consumes the outbound messages from the priority lanes of the
+        channel, and sends them on to the transport, with at most ``window``
+        messages in flight'''
+        connector = self.connectors[self.transport_name]
+        self.priority_scheduler = PriorityScheduler(
+            connector.publish_outbound, window)
+        for priority in PRIORITY_LEVELS:
+            yield self.consume(
+                lane_routing_key(self.channel_id, priority),
+                partial(self.priority_scheduler.enqueue, priority),
+                message_class=TransportUserMessage, prefetch_count=window)
+
     @inlineCallbacks
     def teardown_application(self):
+        if getattr(self, 'priority_scheduler', None) is not None:
+            self.priority_scheduler.stop()
+        if getattr(self, 'message_rate', None) is not None:
+            yield self.message_rate.close()
+        if getattr(self, 'batcher', None) is not None:
+            yield self.batcher.stop()
+        if getattr(self, 'retries', None) is not None:
+            yield self.retries.release(self.channel_id)
+        if getattr(self, 'webhooks', None) is not None:
+            yield self.webhooks.release()
         if getattr(self, 'redis', None) is not None:
             yield self.redis.close_manager()
 
+    def start_consumer(self, consumer_class, *args, **kwargs):
+        # Batched messages are only acked once their batch has been posted,
+        # so the next messages need to be consumed while they wait. The
+        # prefetch count of the consumer bounds the messages in flight.
+        config = self.get_static_config()
+        if config.mo_batch_size or config.max_in_flight > 1:
+            consumer_class = concurrent_consumer_class(consumer_class)
+        return super(MessageForwardingWorker, self).start_consumer(
+            consumer_class, *args, **kwargs)
+
     @property
     def channel_id(self):
         return self.config['transport_name']
 
     @inlineCallbacks
     def consume_user_message(self, message):
-        '''Sends the vumi message as an HTTP request to the configured URL'''
-        yield self.inbounds.store_vumi_message(self.channel_id, message)
+        '''Sends the vumi message as an HTTP request to the configured URL,
+        and publishes it to the configured queue. The message is stored, and
+        counted in the same operation, before it is forwarded, so that it
+        can be replied to.'''
+        yield self.inbounds.store_vumi_message(
+            self.channel_id, message, counter=self._count_stored('inbound'))
+        results = yield gatherResults([
+            self._forward_message_http(message),
+            self._forward_message_amqp(message),
+        ], consumeErrors=True)
+        returnValue(delivered(results))
 
+    @inlineCallbacks
+    def _forward_message_http(self, message):
+        '''POST the message to the configured URL'''
+        if self.config.get('mo_message_url') is None:
+            return
+
+        config = self.get_static_config()
+        (url, auth) = self._split_url_and_credentials(config.mo_message_url)
+        auth_token = config.mo_message_url_auth_token
         msg = api_from_message(message)
 
-        if self.config.get('mo_message_url') is not None:
-            config = self.get_static_config()
+        if self.batcher is not None:
+            returnValue((yield self.batcher.add(
+                ('message', url, auth, auth_token), msg)))
+        else:
+            yield self._post_message(url, auth, auth_token, msg)
 
-            (url, auth) = self._split_url_and_credentials(
-                config.mo_message_url)
+    def _forward_message_amqp(self, message):
+        '''Put the message on the configured queue'''
+        if self.config.get('message_queue') is None:
+            return succeed(None)
+        return self.ro_connector.publish_inbound(message)
 
-            # Construct token auth headers if configured
-            auth_token = config.mo_message_url_auth_token
-            if auth_token:
-                headers = {
-                    'Authorization': [
-                        'Token %s' % (auth_token,)]
-                }
-            else:
-                headers = {}
+    @inlineCallbacks
+    def _post_message(self, url, auth, auth_token, msg):
+        config = self.get_static_config()
+        timeout = config.mo_message_url_timeout
+        resp = yield self._post(url, msg, timeout, auth, auth_token)
+        if resp and request_failed(resp):
+            logging.exception(
+                'Error sending message, received HTTP code %r with body %r. '
+                'Message: %r' % (resp.code, (yield resp.content()), msg))
+        if resp is None or request_failed(resp):
+            yield self._park('message', url, msg, timeout)
 
-            resp = yield post(url, msg,
-                              timeout=config.mo_message_url_timeout,
-                              auth=auth, headers=headers)
-            if resp and request_failed(resp):
-                logging.exception(
-                    'Error sending message, received HTTP code %r with body %r'
-                    '. Message: %r' % (resp.code, (yield resp.content()), msg))
+    @inlineCallbacks
+    def _post_batch(self, key, items):
+        '''Posts a batch of inbound messages or events as a JSON array.
+        Returns ``False`` if the batch could neither be posted nor parked
+        for a retry, so that its messages and events are not acked.'''
+        (kind, url, auth, auth_token) = key
+        config = self.get_static_config()
+        if kind == 'message':
+            timeout = config.mo_message_url_timeout
+        else:
+            timeout = config.event_url_timeout
+        resp = yield self._post(url, items, timeout, auth, auth_token)
+        if resp and request_failed(resp):
+            logging.exception(
+                'Error sending batch of %d %ss, received HTTP code %r with '
+                'body %r' % (
+                    len(items), kind, resp.code, (yield resp.content())))
+        if resp is None or request_failed(resp):
+            parked = yield self._park(
+                '%s_batch' % (kind,), url, items, timeout)
+            returnValue(parked)
 
-        if self.config.get('message_queue') is not None:
-            yield self.ro_connector.publish_inbound(message)
+    @inlineCallbacks
+    def _post(self, url, data, timeout, auth, auth_token):
+        '''Posts to a webhook, and updates the channel status with the state
+        of the circuit breaker of its host. If failed deliveries are
+        retried, the post is given up on once it takes longer than the slow
+        threshold of the circuit breaker, so that a hung host does not hold
+        up the consumer for the full timeout. The delivery is then parked,
+        and retried with the full timeout.'''
+        if self.retries is not None:
+            config = self.get_static_config()
+            timeout = min(timeout, config.webhook_breaker_slow_threshold)
+        resp = yield self.webhooks.post(
+            url, data, timeout=timeout, auth=auth,
+            headers=token_auth_headers(auth_token))
+        yield self.breaker_statuses.update(self.webhooks, url)
+        returnValue(resp)
+
+    def _park(self, kind, url, data, timeout):
+        '''Keeps a failed delivery in the retry queue of the channel, if
+        failed deliveries are retried. Returns a deferred that fires with
+        whether the delivery was parked. The credentials of the delivery are
+        not kept with it, they are looked up again when it is retried.'''
+        if self.retries is None:
+            return succeed(False)
+        d = self.retries.park(self.channel_id, kind, url, data, timeout)
+        return d.addCallback(lambda _: True)
 
-        yield self._increment_metric('inbound')
+    @inlineCallbacks
+    def _delivery_credentials(self, delivery):
+        '''Returns the ``(auth, auth_token)`` pair to retry a parked delivery
+        with. They are looked up from the config of the channel for
+        messages, and from the event route of their message for events. If
+        the url they are for is no longer the url of the delivery, no
+        credentials are returned.'''
+        if delivery['kind'] in ('message', 'message_batch'):
+            config = self.get_static_config()
+            (url, auth_token) = (
+                config.mo_message_url, config.mo_message_url_auth_token)
+        else:
+            data = delivery['data']
+            if delivery['kind'] == 'event_batch':
+                # The events of a batch share their url and auth token
+                data = data[0]
+            (url, auth_token) = yield self.outbounds.load_event_route(
+                self.channel_id, data['message_id'])
+            if url is not None:
+                url = urlparse(url)
+
+        if url is None:
+            returnValue((None, None))
+        (url, auth) = self._split_url_and_credentials(url)
+        if url != delivery['url']:
+            returnValue((None, None))
+        returnValue((auth, auth_token))
 
     @inlineCallbacks
     def store_and_forward_event(self, event):
-        '''Store the event in the message store, POST it to the correct
-        URL.'''
-        yield self._store_event(event)
-        yield self._forward_event(event)
-        yield self._count_event(event)
+        '''Store and count the event in the message store, POST it to the
+        correct URL. The events of a message are handled one after another,
+        in the order they were received. A batched event only holds up the
+        next events of its message until it has been added to its batch.'''
+        batched = []
+        yield self.event_sequencer.run(
+            event['user_message_id'], self._store_and_forward_event, event,
+            batched)
+        results = yield gatherResults(batched, consumeErrors=True)
+        returnValue(delivered(results))
+
+    @inlineCallbacks
+    def _store_and_forward_event(self, event, batched=None):
+        '''Stores the event, and then forwards it, so that it can be looked
+        up by whoever it is forwarded to'''
+        yield maybeDeferred(self._store_event, event)
+        yield self._forward_event(event, batched)
 
     def _increment_metric(self, label):
         return self.message_rate.increment(
             self.channel_id, label, self.config['metric_window'])
 
-    def _count_event(self, event):
+    def _count_stored(self, label):
+        '''Counts a message that is about to be stored. If the message rate
+        store is aggregating increments, the message is counted in memory
+        straight away, and ``None`` is returned. Otherwise the counter, with
+        its message count series, that the store should increment along
+        with storing the message is returned.'''
+        if self.message_rate.aggregating:
+            self._increment_metric(label)
+            return None
+        return self.message_rate.get_counter(
+            self.channel_id, label, self.config['metric_window'])
+
+    def _get_event_label(self, event):
         if event['event_type'] == 'ack':
-            return self._increment_metric('submitted')
+            return 'submitted'
         if event['event_type'] == 'nack':
-            return self._increment_metric('rejected')
+            return 'rejected'
         if event['event_type'] == 'delivery_report':
-            if event['delivery_status'] == 'pending':
-                return self._increment_metric('delivery_pending')
-            if event['delivery_status'] == 'failed':
-                return self._increment_metric('delivery_failed')
-            if event['delivery_status'] == 'delivered':
-                return self._increment_metric('delivery_succeeded')
+            return {
+                'pending': 'delivery_pending',
+                'failed': 'delivery_failed',
+                'delivered': 'delivery_succeeded',
+            }.get(event['delivery_status'])
+
+    def _count_event(self, event):
+        label = self._get_event_label(event)
+        if label is not None:
+            return self._increment_metric(label)
 
     def _store_event(self, event):
-        '''Stores the event in the message store'''
+        '''Stores the event in the message store, and increments the event
+        rate counter. Requests waiting for the next event of the message
+        are woken once it is stored.'''
         message_id = event['user_message_id']
         if message_id is None:
             logging.warning(
                 "Cannot store event, missing user_message_id: %r" % event)
-        else:
-            return self.outbounds.store_event(
-                self.channel_id, message_id, event)
+            return self._count_event(event)
 
-    @inlineCallbacks
-    def _forward_event(self, event):
+        label = self._get_event_label(event)
+        counter = self._count_stored(label) if label is not None else None
+        d = self.outbounds.store_event(
+            self.channel_id, message_id, event, counter=counter)
+        d.addCallback(
+            lambda _: notify_event(self.redis, self.channel_id, message_id))
+        return d
+
+    def _forward_event(self, event, batched=None):
         '''Forward the event to the correct places.'''
-        yield self._forward_event_http(event)
-        yield self._forward_event_amqp(event)
+        return gatherResults([
+            self._forward_event_http(event, batched),
+            maybeDeferred(self._forward_event_amqp, event),
+            maybeDeferred(self._forward_event_log, event),
+        ], consumeErrors=True)
 
     @inlineCallbacks
-    def _forward_event_http(self, event):
-        '''POST the event to the correct URL'''
-        url = yield self._get_event_url(event)
+    def _forward_event_http(self, event, batched=None):
+        '''POST the event to the correct URL. If the event is batched and
+        ``batched`` is given, the deferred that fires once its batch has been
+        posted is appended to ``batched`` instead of being waited for.'''
+        (url, auth_token) = yield self._get_event_route(event)
 
         if url is None:
             return
 
         (url, auth) = self._split_url_and_credentials(urlparse(url))
 
-        # Construct token auth headers if configured
-        auth_token = yield self._get_event_auth_token(event)
-
-        if auth_token:
-            headers = {
-                'Authorization': [
-                    'Token %s' % (auth_token,)]
-            }
-        else:
-            headers = {}
-
         msg = api_from_event(self.channel_id, event)
 
         if msg['event_type'] is None:
             logging.exception("Discarding unrecognised event %r" % (event,))
             return
 
+        if self.batcher is not None:
+            d = self.batcher.add(('event', url, auth, auth_token), msg)
+            if batched is not None:
+                batched.append(d)
+            else:
+                yield d
+            return
+
         config = self.get_static_config()
-        resp = yield post(url, msg, timeout=config.event_url_timeout,
-                          auth=auth, headers=headers)
+        timeout = config.event_url_timeout
+        resp = yield self._post(url, msg, timeout, auth, auth_token)
 
         if resp and request_failed(resp):
             logging.exception(
                 'Error sending event, received HTTP code %r with body %r. '
                 'Event: %r' % (resp.code, (yield resp.content()), event))
+        if resp is None or request_failed(resp):
+            yield self._park('event', url, msg, timeout)
 
     def _forward_event_amqp(self, event):
         '''Put the event on the correct queue.'''
         if self.config.get('message_queue') is not None:
             return self.ro_connector.publish_event(event)
 
+    def _forward_event_log(self, event):
+        '''Append the event to the event log of the channel.'''
+        if self.event_log is None:
+            return
+        msg = api_from_event(self.channel_id, event)
+        if msg['event_type'] is not None:
+            return self.event_log.append(self.channel_id, msg)
+
     def consume_ack(self, event):
+        self._message_done(event)
         return self.store_and_forward_event(event)
 
     def consume_nack(self, event):
+        self._message_done(event)
         return self.store_and_forward_event(event)
 
+    def _message_done(self, event):
+        '''Frees the slot of the acked or nacked message in the priority
+        window'''
+        if self.priority_scheduler is not None:
+            self.priority_scheduler.message_done(event['user_message_id'])
+
     def consume_delivery_report(self, event):
         return self.store_and_forward_event(event)
 
@@ -243,22 +637,14 @@ class MessageForwardingWorker(ApplicationWorker):
             return (url, auth)
         return (url.geturl(), None)
 
-    def _get_event_url(self, event):
+    def _get_event_route(self, event):
         msg_id = event['user_message_id']
         if msg_id is not None:
-            return self.outbounds.load_event_url(self.channel_id, msg_id)
+            return self.outbounds.load_event_route(self.channel_id, msg_id)
         else:
             logging.warning(
                 "Cannot find event URL, missing user_message_id: %r" % event)
-
-    def _get_event_auth_token(self, event):
-        msg_id = event['user_message_id']
-        if msg_id is not None:
-            return self.outbounds.load_event_auth_token(
-                self.channel_id, msg_id)
-        else:
-            logging.warning(
-                "Cannot find event auth, missing user_message_id: %r" % event)
+            return (None, None)
 
 
 class ChannelStatusConfig(BaseConfig):
@@ -280,6 +666,41 @@ class ChannelStatusConfig(BaseConfig):
         "to process a status update",
         default=10, static=True)
 
+    redis_pool_size = ConfigInt(
+        "The maximum amount of connections in the shared redis pool",
+        default=DEFAULT_POOL_SIZE, static=True)
+
+    webhook_max_persistent_per_host = ConfigInt(
+        "The maximum amount of idle connections kept open to each webhook "
+        "host by the shared webhook client",
+        default=DEFAULT_MAX_PERSISTENT_PER_HOST, static=True)
+
+    webhook_idle_timeout = ConfigInt(
+        "The amount of seconds an idle connection to a webhook host is kept "
+        "open for",
+        default=DEFAULT_IDLE_TIMEOUT, static=True)
+
+    webhook_tls_session_reuse = ConfigBool(
+        "Whether new TLS connections to a webhook host resume the session of "
+        "an earlier connection to the host",
+        default=True, static=True)
+
+    webhook_breaker_error_rate = ConfigFloat(
+        "The fraction of failed or slow posts to a webhook host that opens "
+        "the circuit breaker of the host, failing its posts immediately. If "
+        "0, posts are never failed early.",
+        default=DEFAULT_BREAKER_ERROR_RATE, static=True)
+
+    webhook_breaker_slow_threshold = ConfigFloat(
+        "The amount of seconds after which a post to a webhook host counts "
+        "as failed for its circuit breaker",
+        default=DEFAULT_BREAKER_SLOW_THRESHOLD, static=True)
+
+    webhook_breaker_reset_timeout = ConfigFloat(
+        "The amount of seconds the circuit breaker of a webhook host stays "
+        "open for, before a trial post is made to the host",
+        default=DEFAULT_BREAKER_RESET_TIMEOUT, static=True)
+
 
 class ChannelStatusWorker(BaseWorker):
     '''This worker consumes status messages for the transport, and stores them
@@ -295,12 +716,26 @@ class ChannelStatusWorker(BaseWorker):
 
     @inlineCallbacks
     def setup_worker(self):
-        redis = yield TxRedisManager.from_config(self.config['redis_manager'])
-        self.store = StatusStore(redis, ttl=None)
+        config = self.get_static_config()
+        self.redis = yield acquire_redis_manager(
+            self.config['redis_manager'], config.redis_pool_size)
+        self.webhooks = acquire_webhook_client(
+            config.webhook_max_persistent_per_host,
+            config.webhook_idle_timeout, config.webhook_tls_session_reuse,
+            config.webhook_breaker_error_rate,
+            config.webhook_breaker_slow_threshold,
+            config.webhook_breaker_reset_timeout)
+        self.store = StatusStore(self.redis, ttl=None)
+        self.breaker_statuses = WebhookBreakerStatuses(
+            self.store, self.config['channel_id'])
         yield self.unpause_connectors()
 
+    @inlineCallbacks
     def teardown_worker(self):
-        pass
+        if getattr(self, 'webhooks', None) is not None:
+            yield self.webhooks.release()
+        if getattr(self, 'redis', None) is not None:
+            yield self.redis.close_manager()
 
     @inlineCallbacks
     def consume_status(self, status):
@@ -314,44 +749,12 @@ class ChannelStatusWorker(BaseWorker):
     def send_status(self, status):
         data = api_from_status(self.config['channel_id'], status)
         config = self.get_static_config()
-        resp = yield post(config.status_url, data,
-                          timeout=config.status_url_timeout)
+        resp = yield self.webhooks.post(
+            config.status_url, data, timeout=config.status_url_timeout)
+        yield self.breaker_statuses.update(self.webhooks, config.status_url)
 
         if resp and request_failed(resp):
             logging.exception(
                 'Error sending status event, received HTTP code %r with '
                 'body %r. Status event: %r'
                 % (resp.code, (yield resp.content()), status))
-
-
-def request_failed(resp):
-    return resp.code < 200 or resp.code >= 300
-
-
-def post_eb(reason, url):
-    errors = (
-        ResponseFailed,
-        ConnectingCancelledError,
-        ConnectionDone,
-        ConnectionRefusedError,
-        TaskStopped,
-        # Raised when Deferred is cancelled because of timeouts
-        CancelledError,
-        RequestTransmissionFailed,
-    )
-
-    err_class = reason.trap(*errors)
-    logging.exception('Post to %s failed because of %s: %s' % (
-        url, err_class, reason.getErrorMessage()))
-
-
-def post(url, data, timeout, auth=None, headers={}):
-    request_headers = {'Content-Type': ['application/json']}
-    request_headers.update(headers)
-    d = treq.post(
-        url.encode('utf-8'),
-        data=json.dumps(data, cls=JSONMessageEncoder),
-        headers=request_headers,
-        timeout=timeout, auth=auth)
-    d.addErrback(post_eb, url)
-    return d
@@ -32,6 +32,12 @@ setup(
         'PyYAML',
         'raven>=6.0.0,<7.0.0',
     ],
+    extras_require={
+        # For the msgpack message codec
+        'msgpack': ['msgpack>=0.5.2'],
+        # For faster JSON encoding and decoding
+        'fastjson': ['simplejson', 'ujson'],
+    },
     entry_points='''
     [console_scripts]
     jb = junebug.command_line:main
@@ -0,0 +1,72 @@
+'''Compares the per-request cost of validating message bodies with the
+draft 4 validator and with the compiled schema validator.
+
+Usage: python utils/bench_validation.py [number of iterations]
+'''
+import sys
+import timeit
+
+from jsonschema import Draft4Validator
+
+from junebug.api import OUTBOUND_MESSAGE_SCHEMA
+from junebug.validate import compile_schema
+
+
+BODIES = [
+    ('valid', {
+        'to': '+27821234567',
+        'from': None,
+        'content': 'Hello world',
+        'event_url': 'http://example.org/events',
+        'channel_data': {'session_event': 'new'},
+    }),
+    ('invalid', {
+        'to': 27821234567,
+        'content': ['Hello world'],
+        'session_event': 'new',
+    }),
+]
+
+
+def draft4_validator(schema):
+    json_validator = Draft4Validator(schema)
+
+    def validator(instance):
+        return sorted(
+            (e.message, list(e.schema_path))
+            for e in json_validator.iter_errors(instance))
+
+    return validator
+
+
+def compiled_validator(schema):
+    json_validator = compile_schema(schema)
+
+    def validator(instance):
+        return sorted(json_validator(instance))
+
+    return validator
+
+
+def bench(validator, body, number):
+    return min(timeit.repeat(
+        lambda: validator(body), number=number, repeat=3)) / number
+
+
+def main(number=20000):
+    validators = [
+        ('draft4', draft4_validator(OUTBOUND_MESSAGE_SCHEMA)),
+        ('compiled', compiled_validator(OUTBOUND_MESSAGE_SCHEMA)),
+    ]
+    for body_name, body in BODIES:
+        results = [
+            (name, bench(validator, body, number))
+            for name, validator in validators]
+        for name, seconds in results:
+            print '%-8s %-8s %8.2f us' % (body_name, name, seconds * 1e6)
+        print '%-8s speedup  %8.1fx' % (
+            body_name, results[0][1] / results[1][1])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])